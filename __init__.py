@@ -1,4 +1,5 @@
 from . import spectrumnumber
 from . import disciplefile
+from . import spectrumscan
 from . import spectrumtapblock
 from . import spectrumtranslate
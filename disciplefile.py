@@ -44,6 +44,7 @@
 
 import spectrumtranslate
 import sys
+from array import array
 from os.path import isfile as _isfile
 from os import fstat
 
@@ -88,6 +89,123 @@ def GetDirectoryEntryPosition(num):
     return (num-1) // 20, (((num-1) // 2) % 10) + 1
 
 
+class _DirectoryIndex:
+    """
+    The 80 directory entries of a DiscipleImage read in one go.  The
+    entries are held one after another in headers, and the fields most
+    asked for are decoded into lists indexed by file number - 1.  names
+    maps each raw file name to the file numbers of the entries with it.
+    owners holds how many files in use claim each of the 1560 sectors
+    that files can be saved in, in the same order as sector maps.  The
+    index is kept up to date as directory sectors are written.
+    """
+
+    def __init__(self, image):
+        # make note of the format the directory was read with.  The
+        # image isn't kept so that it can be closed as soon as it's
+        # deleted
+        self.imageformat = image.ImageFormat
+
+        # the directory is sectors 1 to 10 of tracks 0 to 3 on side 0,
+        # and they hold the entries in file number order
+        self.headers = bytearray()
+        for track in range(4):
+            for sector in range(1, 11):
+                self.headers += image.getsector(track, sector)
+
+        # an image that is too short has empty entries at the end
+        self.headers += bytearray(80 * 256 - len(self.headers))
+
+        self.filetypes = array("B", bytes(80))
+        self.sectors = array("H", bytes(160))
+        self.filelengths = array("L", bytes(80 * array("L").itemsize))
+        self.filenames = [None] * 80
+        self.names = {}
+        self.owners = bytearray(1560)
+        for filenumber in range(1, 81):
+            self._addentry(image, filenumber)
+
+    def _addentry(self, image, filenumber):
+        # decode the fields of an entry, and note the sectors it uses
+        headerdata = self.getheader(filenumber)
+        df = DiscipleFile(image, filenumber)
+        self.filetypes[filenumber - 1] = df.getfiletype(headerdata)
+        self.sectors[filenumber - 1] = df.getsectorsused(headerdata)
+        self.filelengths[filenumber - 1] = df.getfilelength(headerdata)
+        self.filenames[filenumber - 1] = df.getfilename(headerdata)
+        hits = self.names.setdefault(bytes(headerdata[1:11]), [])
+        hits.append(filenumber)
+        hits.sort()
+
+        if headerdata[0] != 0:
+            for i in _getsectorindexes(headerdata[15:210]):
+                self.owners[i] += 1
+
+    def _removeentry(self, filenumber):
+        # undo _addentry for an entry that's about to change
+        headerdata = self.getheader(filenumber)
+        name = bytes(headerdata[1:11])
+        self.names[name].remove(filenumber)
+        if not self.names[name]:
+            del self.names[name]
+
+        if headerdata[0] != 0:
+            for i in _getsectorindexes(headerdata[15:210]):
+                self.owners[i] -= 1
+
+    def getheader(self, filenumber):
+        """Returns a copy of the 256 byte header of the given file."""
+
+        return self.headers[(filenumber - 1) * 256:filenumber * 256]
+
+    def setheader(self, image, filenumber, headerdata):
+        """
+        Updates the index for a new header for the given file in the
+        DiscipleImage image.
+        """
+
+        self._removeentry(filenumber)
+        self.headers[(filenumber - 1) * 256:filenumber * 256] = headerdata
+        self._addentry(image, filenumber)
+
+    def setsector(self, image, track, sector, data):
+        """
+        Updates the index for a directory sector written to the
+        DiscipleImage image.  track is 0 to 3 and sector 1 to 10.
+        """
+
+        filenumber = track * 20 + (sector - 1) * 2 + 1
+        for headerstart in (0, 256):
+            if data[headerstart:headerstart + 256] != self.getheader(
+               filenumber):
+                self.setheader(image, filenumber,
+                               data[headerstart:headerstart + 256])
+
+            filenumber += 1
+
+    def getsectormap(self, filenumber):
+        """
+        Returns the 195 byte sector map of the given file as an int so
+        that maps can be combined quickly.
+        """
+
+        o = (filenumber - 1) * 256
+        return int.from_bytes(self.headers[o + 15:o + 210], "little")
+
+
+def _getsectorindexes(sectormap):
+    # returns the index of each sector in a 195 byte sector map that is
+    # used
+    return [i * 8 + b for i, m in enumerate(sectormap) if m
+            for b in range(8) if m & (1 << b)]
+
+
+def _sectormaptobytes(sectormap):
+    # converts a sector map from _DirectoryIndex.getsectormap back into
+    # 195 bytes
+    return bytearray(sectormap.to_bytes(195, "little"))
+
+
 class DiscipleFile:
     """A class that holds information about a file from a +D/Disciple
        disk image.
@@ -115,11 +233,7 @@ class DiscipleFile:
     def getheader(self):
         """Returns 256 bytearray file header"""
 
-        # work out if first or second entry in sector
-        headerstart = ((self.filenumber-1) & 1) * 256
-
-        t, s = GetDirectoryEntryPosition(self.filenumber)
-        return self.image.getsector(t, s)[headerstart: headerstart + 256]
+        return self.image._getdirectoryindex().getheader(self.filenumber)
 
     def getfiledata(self, wantheader=False, headerdata=None):
         """Get the data of the file. Returns a bytearray containing the
@@ -243,9 +357,10 @@ class DiscipleFile:
         headerdata is optional but saves resources.
         """
 
-        # if no header supplied, need to load it up
+        # if no header supplied, use the image's directory
         if headerdata is None:
-            headerdata = self.getheader()
+            return self.image._getdirectoryindex().sectors[
+                self.filenumber - 1]
 
         # check to make sure is valid file
         if self.isempty(headerdata):
@@ -265,9 +380,10 @@ class DiscipleFile:
         this method.
         """
 
-        # if no header supplied, need to load it up
+        # if no header supplied, use the image's directory
         if headerdata is None:
-            headerdata = self.getheader()
+            return self.image._getdirectoryindex().filelengths[
+                self.filenumber - 1]
 
         t = self.getfiletype(headerdata)
         # the length of the file in bytes depends on the file type
@@ -310,9 +426,10 @@ class DiscipleFile:
         headerdata is optional but saves resources.
         """
 
-        # if no header supplied, need to load it up
+        # if no header supplied, use the image's directory
         if headerdata is None:
-            headerdata = self.getheader()
+            return self.image._getdirectoryindex().filetypes[
+                self.filenumber - 1]
 
         # &31 to exclude hidden flags
         return headerdata[0] & 31
@@ -360,9 +477,10 @@ class DiscipleFile:
         headerdata is optional but saves resources.
         """
 
-        # if no header supplied, need to load it up
+        # if no header supplied, use the image's directory
         if headerdata is None:
-            headerdata = self.getheader()
+            return self.image._getdirectoryindex().filenames[
+                self.filenumber - 1]
 
         return spectrumtranslate.getspectrumstring(headerdata[1:11])
 
@@ -764,6 +882,20 @@ class DiscipleFile:
         if headerdata is None:
             headerdata = self.getheader()
 
+        # get sectors used by other files
+        directory = self.image._getdirectoryindex()
+        sectorMap = 0
+        for entry in range(1, 81):
+            # skip if is this file
+            if self.filenumber != entry:
+                sectorMap |= directory.getsectormap(entry)
+
+        return self._checkfaults(headerdata, _sectormaptobytes(sectorMap),
+                                 fast)
+
+    def _checkfaults(self, headerdata, sectorMap, fast):
+        # does the checks for checkforfaults.  sectorMap is the 195 byte
+        # map of the sectors used by other files
         faults = []
 
         # is filetype (excluding flags) consistent with valid file?
@@ -777,29 +909,6 @@ class DiscipleFile:
                 return ["Contains invalid filetype"]
             faults += ["Contains invalid filetype"]
 
-        # get sectors used by other files
-        sectorMap = bytearray(195)
-
-        track = -1
-        sector = -1
-        # iterate through all headers
-        for entry in range(1, 81):
-            # skip if is this file
-            if self.filenumber == entry:
-                continue
-
-            headerstart = ((entry - 1) & 1) * 256
-            # only load sector if needed
-            newtrack, newsector = GetDirectoryEntryPosition(entry)
-            if track != newtrack or sector != newsector:
-                track = newtrack
-                sector = newsector
-                header = self.image.getsector(track, sector)
-
-            for i in range(195):
-                # update sector map
-                sectorMap[i] |= header[headerstart + 15 + i]
-
         # check sector map
         sectorcount = 0
 
@@ -968,6 +1077,7 @@ class DiscipleImage:
     def __init__(self, fileName=None, accessmode="rb"):
         self.ImageSource = "Undefined"
         self.ImageFormat = "Unknown"
+        self._resetcache()
 
         if fileName is not None:
             self.setfilename(fileName, accessmode=accessmode)
@@ -979,6 +1089,7 @@ class DiscipleImage:
 
         self.ImageSource = "File"
         self.filehandle = filehandle
+        self._resetcache()
         self.setimageformat(form)
 
     def setfilename(self, filename, form="Unknown", accessmode="rb"):
@@ -995,6 +1106,7 @@ class DiscipleImage:
             return
 
         self.ImageSource = "FileName"
+        self._resetcache()
         self.setimageformat(form)
 
     def setbytes(self, bytedata, form="Unknown"):
@@ -1007,6 +1119,7 @@ class DiscipleImage:
         self.bytedata = _validateandpreparebytes(bytedata, "bytedata")
 
         self.ImageSource = "Bytes"
+        self._resetcache()
         self.setimageformat(form)
 
     def setimageformat(self, form):
@@ -1019,11 +1132,93 @@ class DiscipleImage:
         """
         if form in ["MGT", "IMG", "Unknown"]:
             self.ImageFormat = form
+            self._formatguessed = False
             return
 
         raise spectrumtranslate.SpectrumTranslateError(
             'Only valid image formats are "MGT" and "IMG"')
 
+    def _resetcache(self):
+        # the whole of an image in a file is read into _imagecache the
+        # first time a sector is needed, and sectors written to it are
+        # noted in _dirtysectors until they are flushed to the file
+        self._imagecache = None
+        self._dirtysectors = set()
+        self._deferwrites = 0
+        self._directoryindex = None
+        self._formatguessed = False
+
+    def _getdirectoryindex(self):
+        """
+        Returns the _DirectoryIndex of this image, reading the directory
+        if it hasn't been read since it was last changed.
+        """
+
+        # if we don't know what format we've got then guess
+        if self.ImageFormat == "Unknown" and not self._formatguessed:
+            self.guessimageformat()
+
+        if self._directoryindex is None or \
+           self._directoryindex.imageformat != self.ImageFormat:
+            self._directoryindex = _DirectoryIndex(self)
+
+        return self._directoryindex
+
+    def _getimagedata(self):
+        """
+        Returns the bytearray holding the whole image. For an image in a
+        file the file is read in one go the first time this is called,
+        and the copy in memory is used from then on.
+        """
+
+        if self.ImageSource == "Bytes":
+            return self.bytedata
+
+        if self.ImageSource in ["File", "FileName"]:
+            if self._imagecache is None:
+                self.filehandle.seek(0)
+                self._imagecache = bytearray(self.filehandle.read(819200))
+
+            return self._imagecache
+
+        raise spectrumtranslate.SpectrumTranslateError(
+            'Uninitiated DiscipleImage')
+
+    def flush(self):
+        """
+        Writes any sectors that have been changed but not yet saved to
+        the image's file. Neighbouring sectors are written together so
+        the changes are saved in as few writes as possible. Does
+        nothing for an image held in bytes.
+        """
+
+        if not self._dirtysectors:
+            return
+
+        positions = sorted(self._dirtysectors)
+        self._dirtysectors = set()
+        start = end = positions[0]
+        for pos in positions[1:] + [None]:
+            if pos == end + 512:
+                end = pos
+                continue
+
+            self.filehandle.seek(start)
+            self.filehandle.write(self._imagecache[start:end + 512])
+            start = end = pos
+
+        self.filehandle.flush()
+
+    def _startwrites(self):
+        # writes made until the matching _endwrites are only flushed to
+        # the file once at the end
+        self._deferwrites += 1
+
+    def _endwrites(self):
+        self._deferwrites -= 1
+        if self._deferwrites == 0:
+            self.flush()
+
     def get_offset_and_bit_from_track_and_sector(self, track, sector):
         """calculate offset & bit of this track & sector in sectorMap"""
         if track < 4 or (track & 127) > 79 or sector < 1 or sector > 10:
@@ -1039,13 +1234,98 @@ sector map.".format(track, sector))
 
         return o, b
 
+    def _scoreimageformat(self, form):
+        """
+        Looks at a few directory entries and the start of their sector
+        chains as if the image were in the format form.  Returns a
+        tuple of the number of things that look right, and the number
+        that look wrong.
+        """
+
+        self.ImageFormat = form
+        good = 0
+        bad = 0
+
+        # the entries in track 0 are in the same place in both formats,
+        # but the first sector of tracks 1 to 3 are not
+        entries = []
+        for track, sector in [(0, s) for s in range(1, 11)] + [
+                (1, 1), (2, 1), (3, 1)]:
+            sectordata = self.getsector(track, sector)
+            for headerstart in (0, 256):
+                headerdata = sectordata[headerstart:headerstart + 256]
+                if headerdata[0] == 0:
+                    continue
+
+                # does the entry make sense
+                sectorMap = headerdata[15:210]
+                sectorcount = headerdata[12] + 256 * headerdata[11]
+                t = headerdata[13]
+                s = headerdata[14]
+                if (headerdata[0] & 31) > 11 or sectorcount == 0 or \
+                   sectorcount != sum(bin(m).count("1") for m in sectorMap) \
+                   or (t & 127) > 79 or t < 4 or s < 1 or s > 10:
+                    bad += 1
+                    continue
+
+                good += track > 0
+                entries += [(t, s, sectorcount, sectorMap)]
+
+        # follow the first few links of the sector chains of some files.
+        # In the wrong format they will lead to the wrong sectors
+        for t, s, sectorcount, sectorMap in entries[:8]:
+            for i in range(min(sectorcount, 4)):
+                if (t & 127) > 79 or t < 4 or s < 1 or s > 10:
+                    bad += 1
+                    break
+
+                o, b = self.get_offset_and_bit_from_track_and_sector(t, s)
+                if sectorMap[o] & b == 0:
+                    bad += 1
+                    break
+
+                sectorMap[o] &= ~b
+                sectordata = self.getsector(t, s)
+                t = sectordata[510]
+                s = sectordata[511]
+                # last sector in file should link to nothing
+                if sectorcount - i == 1 and (t != 0 or s != 0):
+                    bad += 1
+                    break
+
+                good += 1
+
+        return good, bad
+
     def guessimageformat(self):
         """
         This method will try and work out and set the image format for
-        this image.
+        this image.  A few sectors are looked at to see which format
+        makes sense, and only if that is unclear are all the files in
+        the image checked in each format.  The result is remembered so
+        that it's only guessed once.
         """
 
-        # simplest way I can think of is to try out the different formats
+        self._formatguessed = True
+
+        # can't be either if the size is wrong
+        if not self.couldbeimage()[0]:
+            self.ImageFormat = "Unknown"
+            return self.ImageFormat
+
+        mgtgood, mgtbad = self._scoreimageformat("MGT")
+        imggood, imgbad = self._scoreimageformat("IMG")
+
+        # use a format if it makes sense and the other doesn't
+        if mgtgood > 0 and mgtbad == 0 and imgbad > 0:
+            self.ImageFormat = "MGT"
+            return self.ImageFormat
+
+        if imggood > 0 and imgbad == 0 and mgtbad > 0:
+            self.ImageFormat = "IMG"
+            return self.ImageFormat
+
+        # otherwise try out the different formats in full
         self.ImageFormat = "MGT"
         if self.isimagevalid(True)[0]:
             return self.ImageFormat
@@ -1060,6 +1340,7 @@ sector map.".format(track, sector))
     def __del__(self):
         # close filehandle if needed
         if self.ImageSource == "FileName":
+            self.flush()
             self.filehandle.close()
 
     def getsectorposition(self, track, sector, head=-1):
@@ -1075,7 +1356,7 @@ sector map.".format(track, sector))
         """
 
         # if we don't know what format we've got then guess
-        if self.ImageFormat == "Unknown":
+        if self.ImageFormat == "Unknown" and not self._formatguessed:
             self.guessimageformat()
 
         # is head part of track?
@@ -1105,21 +1386,14 @@ sector map.".format(track, sector))
     def getsector(self, track, sector, head=-1):
         """Returns a bytearray of the sector requested."""
 
+        if self.ImageSource == "Undefined":
+            raise spectrumtranslate.SpectrumTranslateError(
+                'Uninitiated DiscipleImage')
+
         # where is sector we're after
         pos = self.getsectorposition(track, sector, head)
 
-        if self.ImageSource == "Bytes":
-            return self.bytedata[pos:pos + 512]
-
-        elif self.ImageSource in ["File", "FileName"]:
-            if self.filehandle.tell() != pos:
-                self.filehandle.seek(pos)
-
-            return bytearray(self.filehandle.read(512))
-
-        else:
-            raise spectrumtranslate.SpectrumTranslateError(
-                'Uninitiated DiscipleImage')
+        return self._getimagedata()[pos:pos + 512]
 
     def writesector(self, data, track, sector, head=-1):
         """Writes supplied sector to image. data has to be 512 long and
@@ -1143,6 +1417,7 @@ length, and a list or tuple of int, or of type 'byte' or 'bytearray'.")
 
         # where is sector we're after
         pos = self.getsectorposition(track, sector, head)
+
         if self.ImageSource == "Bytes":
             self.bytedata[pos:pos + 512] = data
 
@@ -1154,14 +1429,29 @@ length, and a list or tuple of int, or of type 'byte' or 'bytearray'.")
                 raise spectrumtranslate.SpectrumTranslateError(
                     'DiscipleImage not opened with access mode rb+')
 
-            self.filehandle.seek(pos)
-            self.filehandle.write(data)
+            # change the copy in memory, and save it to the file now
+            # unless in the middle of writing a file
+            imagedata = self._getimagedata()
+            if len(imagedata) < pos:
+                imagedata.extend(bytearray(pos - len(imagedata)))
+
+            imagedata[pos:pos + 512] = data
+            self._dirtysectors.add(pos)
+            if self._deferwrites == 0:
+                self.flush()
 
         # this should not happen, but be cautious
         else:
             raise spectrumtranslate.SpectrumTranslateError(
                 'Uninitiated DiscipleImage')
 
+        # keep the directory index up to date if writing to it
+        if head != -1:
+            track += head << 7
+
+        if track < 4 and self._directoryindex is not None:
+            self._directoryindex.setsector(self, track, sector, data)
+
     def deleteentry(self, entrynumber):
         """
         This method deletes the specified entry in this disk image.
@@ -1213,6 +1503,42 @@ per track, 512 byte sector image."
 
         return True, None
 
+    def checkforfaults(self, fast=False):
+        """
+        This checks every file in the image in one pass.  The directory
+        is read once and a single map is made of which sectors are
+        claimed by more than one file, then each file's details and
+        sector chain are checked against it.  Returns a dictionary
+        mapping the number of each file with faults to a list of
+        strings detailing them as DiscipleFile.checkforfaults does.  An
+        empty dictionary means no faults were found.
+        If fast is True this returns as soon as it finds a fault, with
+        just that fault.
+        """
+
+        directory = self._getdirectoryindex()
+
+        # work out the sectors used by more than one file
+        used = 0
+        shared = 0
+        for entry in range(1, 81):
+            sectormap = directory.getsectormap(entry)
+            shared |= used & sectormap
+            used |= sectormap
+
+        shared = _sectormaptobytes(shared)
+
+        faults = {}
+        for entry in range(1, 81):
+            filefaults = DiscipleFile(self, entry)._checkfaults(
+                directory.getheader(entry), shared, fast)
+            if filefaults:
+                faults[entry] = filefaults
+                if fast:
+                    break
+
+        return faults
+
     def isimagevalid(self, deeptest=False):
         """
         This method will go through all the file entries in an image and
@@ -1234,21 +1560,21 @@ per track, 512 byte sector image."
             return False, problem
 
         if self.ImageFormat == "Unknown":
-            self.guessimageformat()
+            if not self._formatguessed:
+                self.guessimageformat()
+
             if self.ImageFormat == "Unknown":
                 return False, "Can't work out image format"
 
         faults = []
-        # iterate through all files
-        for entry in range(1, 81):
-            df = DiscipleFile(self, entry)
-            filefaults = df.checkforfaults(fast=not deeptest)
-            if filefaults:
-                msg = "Contains file (number {}) with the error{}: {}.\
+        # check all files in one go
+        for entry, filefaults in self.checkforfaults(
+                fast=not deeptest).items():
+            msg = "Contains file (number {}) with the error{}: {}.\
 ".format(entry, ("s" if len(filefaults) > 1 else ""), ". ".join(filefaults))
-                if not deeptest:
-                    return False, msg
-                faults += [msg]
+            if not deeptest:
+                return False, msg
+            faults += [msg]
 
         return faults == [], None if faults == [] else "\n".join(faults)
 
@@ -1276,77 +1602,71 @@ per track, 512 byte sector image."
             raise spectrumtranslate.SpectrumTranslateError(
                 "Invalid file position.")
 
-        # find first empty header slot and build map of used sectors
-        i = 1
-        sectorcount = 0
-        # create empty sector map
-        sectorMap = bytearray(195)
-        while i <= 80:
-            t, s = GetDirectoryEntryPosition(i)
-            sector = self.getsector(t, s)
-            for headeroffset in (0, 256):
-                # if empty check if we can use it
-                if sector[headeroffset] == 0:
-                    if position == -1:
-                        position = i
-
-                # if used then make note of sectors used if we're not
-                # overwriting
-                elif position != i:
-                    for m in range(195):
-                        if sectorMap[m] & sector[headeroffset + 15 + m] != 0:
-                            # we have conflicting FAT entries
-                            raise spectrumtranslate.SpectrumTranslateError(
-                                "Corrupt FAT table in destination image.")
-
-                        # update sector map
-                        sectorMap[m] |= sector[headeroffset + 15 + m]
-                        # work out number of sectors used
-                        sectorcount += bin(
-                            sector[headeroffset + 15 + m]).count("1")
-
-                i += 1
+        directory = self._getdirectoryindex()
+
+        # find first empty header slot
+        if position == -1:
+            position = directory.headers[::256].find(0) + 1
 
         # if no empty headers and not wanting to over-write then raise
         # error
-        if position == -1:
+        if position == 0:
             raise spectrumtranslate.SpectrumTranslateError(
                 "No empty header entries.")
 
+        # get map of how many files use each sector leaving out any file
+        # we're overwriting
+        owners = bytearray(directory.owners)
+        if directory.headers[(position - 1) * 256] != 0:
+            for i in _getsectorindexes(directory.getheader(position)[15:210]):
+                owners[i] -= 1
+
+        if max(owners) > 1:
+            # we have conflicting FAT entries
+            raise spectrumtranslate.SpectrumTranslateError(
+                "Corrupt FAT table in destination image.")
+
         # check if we have enogh sectors. 510 bytes can be saved per
         # sector
         sectorsused = (len(filedata) + 509) // 510
 
-        if sectorsused + sectorcount > 1560:
+        if sectorsused > owners.count(0):
             raise spectrumtranslate.SpectrumTranslateError(
                 "Not enough space on disk for file.")
 
-        # define nested function to search for next unused sector
-        def NextUnusedSector(sectormap):
-            for i in range(195):
-                if sectormap[i] == 255:
-                    continue
+        # save the file in the first run of free sectors long enough to
+        # hold it to keep it on as few tracks as possible, otherwise
+        # fill the first free sectors
+        i = owners.find(bytes(sectorsused))
+        if i != -1:
+            sectorindexes = list(range(i, i + sectorsused))
+
+        else:
+            sectorindexes = []
+            while len(sectorindexes) < sectorsused:
+                sectorindexes.append(owners.find(0, sectorindexes[-1] + 1
+                                                 if sectorindexes else 0))
 
-                for b in range(8):
-                    if sectormap[i] & (1 << b) == 0:
-                        # work out track & sector
-                        s = i * 8 + b
-                        t = (s // 10) + 4
-                        if t > 79:
-                            t += 48
+        # work out track & sector of each.  An empty file still notes
+        # the first free sector as it's start
+        if not sectorindexes:
+            if owners.find(0) == -1:
+                raise spectrumtranslate.SpectrumTranslateError("Image full.")
 
-                        s = (s % 10) + 1
-                        return [t, s]
+            sectorindexes = [owners.find(0)]
 
-            raise spectrumtranslate.SpectrumTranslateError("Image full.")
+        chain = [[(i // 10) + (52 if i >= 760 else 4), (i % 10) + 1]
+                 for i in sectorindexes[:max(sectorsused, 1)]] + [[0, 0]]
 
-        # clear FAT table for file header
+        # clear FAT table for file header, and mark the sectors used
         for i in range(195):
             header[i + 15] = 0
 
-        # get starting sector, and remember it in header
-        t, s = NextUnusedSector(sectorMap)
+        for i in sectorindexes[:sectorsused]:
+            header[15 + (i >> 3)] |= 1 << (i & 7)
 
+        # remember starting sector in header
+        t, s = chain[0]
         header[13] = t
         header[14] = s
 
@@ -1354,69 +1674,76 @@ per track, 512 byte sector image."
         header[12] = sectorsused & 0xFF
         header[11] = sectorsused // 0x100
 
-        # now save file
-        m = 0
-        while m < len(filedata):
-            # mark sector as being used in disk FAT & file FAT
-            o, b = self.get_offset_and_bit_from_track_and_sector(t, s)
-            sectorMap[o] |= b
-            header[15 + o] |= b
+        # the sectors of the file and it's header are saved to the
+        # file in one go when done
+        self._startwrites()
+        try:
+            # now save file, each sector holding 510 bytes and finishing
+            # off with the next track & sector in the chain
+            for n, (t, s) in enumerate(chain[:sectorsused]):
+                sectordata = filedata[n * 510:(n + 1) * 510]
+                sectordata += bytearray(510 - len(sectordata)) + bytearray(
+                    chain[n + 1])
+                self.writesector(sectordata, t, s)
 
-            # work out how much to save in this sector
-            chunklength = min(len(filedata) - m, 510)
+            # now save header
+            # work out track, sector, and offset for header for file
+            headerstart = ((position - 1) & 1) * 256
+            track, sector = GetDirectoryEntryPosition(position)
 
-            # work out what next track & sector will be
-            # will be 0,0 if last sector in chain
-            if len(filedata) - m <= 510:
-                nextsector = [0, 0]
+            sectordata = self.getsector(track, sector)
+            sectordata[headerstart:headerstart + 256] = header
+            self.writesector(sectordata, track, sector)
 
-            else:
-                nextsector = NextUnusedSector(sectorMap)
+        finally:
+            self._endwrites()
+
+    def writefiles(self, files):
+        """
+        This method writes many files to the disk image in one go.
+        files is a list of tuples of the arguments to writefile for
+        each file (header, filedata, and optionally position).  The
+        sectors of all the files are saved to the image's file together
+        at the end, and if any of the files can't be written the image
+        is left as it was before.
+        """
 
-            # create sector padding with 0 and finishing off with next
-            # sector
-            sectordata = filedata[m:m + chunklength] + bytearray(
-                510 - chunklength) + bytearray(nextsector)
-            self.writesector(sectordata, t, s)
+        # if we've got uninitiated DiscipleImage then set up as bytearray
+        if self.ImageSource == "Undefined":
+            self.setbytes([0] * 819200)
 
-            # update counters and next sectors
-            t, s = nextsector
-            m += chunklength
+        # remember the image as it is so it can be put back
+        imagedata = self._getimagedata()
+        originaldata = bytearray(imagedata)
+        dirtysectors = set(self._dirtysectors)
 
-        # now save header
-        # work out track, sector, and offset for header for file
-        headerstart = ((position - 1) & 1) * 256
-        track, sector = GetDirectoryEntryPosition(position)
+        self._startwrites()
+        try:
+            for f in files:
+                self.writefile(*f)
 
-        sectordata = self.getsector(track, sector)
-        sectordata[headerstart:headerstart + 256] = header
-        self.writesector(sectordata, track, sector)
+        except BaseException:
+            imagedata[:] = originaldata
+            self._dirtysectors = dirtysectors
+            self._directoryindex = None
+            raise
+
+        finally:
+            self._endwrites()
 
     def fileindexfromname(self, filename, wantdeleted=False):
         """Returns a list of directory positions for the supplied
         filename. It returns an empty list if the filename is not found.
         """
 
-        hits = []
-
         # ensure filename is valid
         filename = _validateandconvertfilename(filename)
 
-        # search to see if file exists
-        i = 1
-        while i <= 80:
-            t, s = GetDirectoryEntryPosition(i)
-            sector = self.getsector(t, s)
-            for headeroffset in (0, 256):
-                # if is the file we're after then note it
-                if ((not wantdeleted and sector[headeroffset] != 0) or
-                    (wantdeleted and sector[headeroffset] == 0)) and \
-                   sector[headeroffset + 1:headeroffset + 11] == filename:
-                    hits += [i]
-
-                i += 1
-
-        return hits
+        # look up entries with that name, and keep those that are
+        # deleted or not as wanted
+        directory = self._getdirectoryindex()
+        return [i for i in directory.names.get(bytes(filename), [])
+                if (directory.headers[(i - 1) * 256] == 0) == wantdeleted]
 
     def writebasicfile(self, filedata, filename, position=-1, autostartline=-1,
                        varposition=-1, overwritename=True):
@@ -74,6 +74,10 @@ if __name__ == "__main__":
                         line = "from . import spectrumtranslate\n"
                     elif line.startswith("import spectrumnumber"):
                         line = "from . import spectrumnumber\n"
+                    elif line.startswith("import spectrumtape"):
+                        line = "from . import spectrumtape\n"
+                    elif line.startswith("import disciplefile"):
+                        line = "from . import disciplefile\n"
                     temp_file.write(line.encode())
             temp_file.close()
             shutil_copy(temp_file.name, os.path.join(dest, src))
@@ -141,6 +145,7 @@ import from any project for this user? (y/n/q)")
                      "__init__.py",
                      "disciplefile.py",
                      "spectrumnumber.py",
+                     "spectrumscan.py",
                      "spectrumtape.py",
                      "spectrumtranslate.py"]
             for f in files:
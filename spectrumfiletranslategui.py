@@ -3943,9 +3943,9 @@ file {} from "{}".'.format(i, self.leFileNameIn.text()))
 
         with open(self.leFileNameIn.text(), 'rb') as f:
             if self.bBrowseContainer.text() == "Browse TAP":
-                tbs = [*spectrumtape.nexttapblock(f)]
+                tbs = [*spectrumtape.scantapblocks(f)]
             else:
-                tbs = [*spectrumtape.nexttzxblock(f)]
+                tbs = [*spectrumtape.scantzxblocks(f)]
         i = 0
         while i < len(tbs):
             # do we have a header that matches the next code block?
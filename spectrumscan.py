@@ -0,0 +1,1133 @@
+#!/usr/bin/python
+#
+# This file is part of the SpectrumTranslate python module.
+#
+# It's licenced under GPL version 3 (www.gnu.org/licenses/gpl.html) with
+# a few extra stipulations:
+# 1) These first lines in this file as far as the line with the date
+# needs to be left in so anyone who gets a copy of this file has access
+# to the licence, extra stipulations, and disclaimors.
+# 2) If this code is used as part of another project, I'd apreciate a
+# mention in that project's documentation.
+# 3) If you improve on any of the routines, I'd be most grateful if you
+# would pass them back to me so that I can have the option to
+# incorporate them into the origional module with apropriate attribution
+# under this licence and stipulations.
+#
+# A copy of the licence and stipulations is bundled with the source
+# files as licence.txt, or you can go to the GNU website for the terms
+# of the GPL licence.
+#
+# If you try hard enough, I'm sure someone could damage something
+# (software, data, system, hardware) useing it.  I've put a lot of time
+# and effort into this software, and have removed any obvious bugs, but
+# nothing is perfect.  If you spot any flaws, please let me know so that
+# I might be able to fix them.  However I reserve the right not to fix
+# flaws that I don't have the time, or resources to fix, or that I feel
+# that fixing would detriment the software overall.  By useing this
+# software you accept this, and any potential risk to your own hardware,
+# software, data, and/or physical and mental health.  This software is
+# provided "as is" and any express or implied warranties, including, but
+# not limited to, the implied warranties of merchantability and fitness
+# for a particular purpose are disclaimed.  In no event shall I or any
+# contributors be liable for any direct, indirect, incidental, special,
+# exemplary, or consequential damages (including, but not limited to,
+# procurement of substitute goods or services; loss of use, data, or
+# profits; or business interruption) however caused and on any theory of
+# liability, whether in contract, strict liability, or tort (including
+# negligence or otherwise) arising in any way out of the use of this
+# software, even if advised of the possibility of such damage.  By using
+# this software you agree to these terms.
+#
+# Author: william.fraser@virgin.net
+# Date: 17th October 2026
+
+import spectrumtranslate
+import spectrumtape
+import disciplefile
+import csv
+import hashlib
+import json
+import os
+import sqlite3
+import sys
+import time
+import zlib
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from itertools import groupby, islice
+
+
+# the file extensions of the archives found when scanning directories,
+# and the format of archive they hold
+ARCHIVEFORMATS = {".tap": "Tap",
+                  ".tzx": "Tzx",
+                  ".mgt": "MGT",
+                  ".img": "IMG"}
+
+# the fields in each row of a catalogue
+CATALOGUEFIELDS = ["archive", "format", "index", "name", "type", "length",
+                   "autostart", "codestart", "checksum", "sha256", "error"]
+
+# the fields in each row of a manifest of payloads put in a PayloadStore
+MANIFESTFIELDS = ["archive", "format", "index", "name", "type", "length",
+                  "sha256", "error"]
+
+# how many archives a worker process scans at a time
+_SCANBATCHSIZE = 16
+
+# how many batches per worker process are queued at a time
+_SCANQUEUEDBATCHES = 4
+
+# size in bytes of a disciple/+D disk image
+_DISKIMAGESIZE = 819200
+
+
+def findarchives(paths):
+    """
+    Generator that yields the path of each archive in paths.  Any
+    directories in paths are walked, and the files in them with a tap,
+    tzx, mgt, or img extension are yielded in sorted order.  Files named
+    in paths are always yielded whatever their extension.
+    """
+
+    for path in paths:
+        if not os.path.isdir(path):
+            yield path
+            continue
+
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                if os.path.splitext(name)[1].lower() in ARCHIVEFORMATS:
+                    yield os.path.join(root, name)
+
+
+def _newrow(archive, archiveformat, fields=CATALOGUEFIELDS, **values):
+    # returns a row with any of fields not given set to None
+    row = dict.fromkeys(fields)
+    row.update(archive=archive, format=archiveformat, **values)
+    return row
+
+
+def _getchecksumstatus(blocks):
+    # "bad" if any of the blocks has a wrong checksum, "ok" if any have
+    # a right one, or None if none of them have checksums
+    valid = [block.checksumisvalid() for block in blocks]
+    if False in valid:
+        return "bad"
+
+    return "ok" if True in valid else None
+
+
+def _gettaperow(archive, archiveformat, header, block):
+    # returns the catalogue row for a file on a tape made from it's
+    # header and data blocks, either of which can be None if missing
+    row = _newrow(archive, archiveformat,
+                  index=(block if header is None else header).blockPosition,
+                  checksum=_getchecksumstatus([b for b in (header, block) if
+                                               b is not None]))
+
+    if header is None:
+        row["type"] = "Headerless"
+
+    else:
+        row.update(name=header.getfilename(),
+                   type=header.getfiletypestring(),
+                   length=header.getheaderdescribeddatalength(),
+                   autostart=header.getheaderautostartline(),
+                   codestart=header.getheadercodestart())
+
+    if block is not None:
+        payload = block.getpayload()
+        row.update(length=len(payload),
+                   sha256=hashlib.sha256(payload).hexdigest())
+
+    return row
+
+
+def _gettapeblocks(data):
+    # returns the format of a tap or tzx tape and an iterator of it's
+    # blocks.  Blocks with bad checksums are kept so they can be reported
+    archiveformat, blocks = spectrumtape.getfiletypeandblockiteratorfromsource(
+        data, checkchecksums=False)
+    if archiveformat not in ("Tap", "Tzx"):
+        raise spectrumtranslate.SpectrumTranslateError(
+            "Not a valid tap or tzx file.")
+
+    return archiveformat, blocks
+
+
+def _scantape(result, data):
+    # adds a row for each file on a tap or tzx tape to result.  Each
+    # header is paired with the data block after it
+    archiveformat, blocks = _gettapeblocks(data)
+
+    result["format"] = archiveformat
+    rows = result["rows"]
+    header = None
+    try:
+        for block in blocks:
+            if block.isheader():
+                if header is not None:
+                    rows.append(_gettaperow(result["archive"], archiveformat,
+                                            header, None))
+
+                header = block
+
+            elif block.isdatablock():
+                rows.append(_gettaperow(result["archive"], archiveformat,
+                                        header, block))
+                header = None
+
+    # keep a header read before the tape ends or turns out to be corrupt
+    finally:
+        if header is not None:
+            rows.append(_gettaperow(result["archive"], archiveformat, header,
+                                    None))
+
+
+def _getdiskimage(result, data):
+    # returns a DiscipleImage of data, working out it's format if it's
+    # not known from the file extension
+    di = disciplefile.DiscipleImage()
+    di.setbytes(data, result["format"] or "Unknown")
+    valid, problem = di.couldbeimage()
+    if not valid:
+        raise spectrumtranslate.SpectrumTranslateError(problem)
+
+    if di.ImageFormat == "Unknown" and di.guessimageformat() == "Unknown":
+        raise spectrumtranslate.SpectrumTranslateError(
+            "Can't work out image format")
+
+    result["format"] = di.ImageFormat
+    return di
+
+
+def _scandisk(result, data):
+    # adds a row for each file in a disciple/+D disk image to result
+    di = _getdiskimage(result, data)
+    imagefaults = di.checkforfaults()
+    for df in di.iteratedisciplefiles():
+        headerdata = df.getheader()
+        if df.isempty(headerdata):
+            continue
+
+        autostart = df.getautostartline(headerdata)
+        codestart = df.getcodestart(headerdata)
+        faults = imagefaults.get(df.filenumber)
+        row = _newrow(result["archive"], di.ImageFormat, index=df.filenumber,
+                      name=df.getfilename(headerdata),
+                      type=df.getfiletypestring(headerdata),
+                      length=df.getfilelength(headerdata),
+                      autostart=autostart if autostart >= 0 else None,
+                      codestart=codestart if codestart >= 0 else None,
+                      checksum="bad" if faults else "ok")
+
+        # only read the data of files whose sector chain looks right
+        if faults:
+            row["error"] = ". ".join(faults)
+
+        else:
+            row["sha256"] = hashlib.sha256(df.getfiledata(
+                headerdata=headerdata)).hexdigest()
+
+        result["rows"].append(row)
+
+
+def _readarchive(path, readtape, readdisk, fields, **extra):
+    # reads the archive at path and passes it's result dictionary and
+    # data to readtape or readdisk depending on what it holds.  extra
+    # are added to the result.  Anything that goes wrong is added to the
+    # result as a row with fields holding the error
+    result = {"archive": path,
+              "format": ARCHIVEFORMATS.get(os.path.splitext(path)[1].lower()),
+              "size": 0,
+              "mtime": None,
+              "sha256": None,
+              "rows": [],
+              "error": None,
+              **extra}
+
+    try:
+        with open(path, "rb") as f:
+            result["mtime"] = os.fstat(f.fileno()).st_mtime_ns
+            data = f.read()
+
+        result["size"] = len(data)
+        result["sha256"] = hashlib.sha256(data).hexdigest()
+
+        # work out what files without a known extension hold
+        if result["format"] is None:
+            if spectrumtape.detecttapefiletype(data, True) != "unknown":
+                result["format"] = "Tape"
+
+            elif len(data) != _DISKIMAGESIZE:
+                raise spectrumtranslate.SpectrumTranslateError(
+                    "Not a recognised tape or disk image.")
+
+        if result["format"] in ("Tap", "Tzx", "Tape"):
+            readtape(result, data)
+
+        else:
+            readdisk(result, data)
+
+    # keep going whatever is wrong with a file
+    except Exception as e:
+        result["error"] = e.value if isinstance(
+            e, spectrumtranslate.SpectrumTranslateError) else \
+            str(e) or type(e).__name__
+        result["rows"].append(_newrow(path, result["format"], fields,
+                                      error=result["error"]))
+
+    return result
+
+
+def scanarchive(path):
+    """
+    Scans the tape or disk image at path, and returns a dictionary
+    describing it.  "archive" is path, "format" is the format of the
+    archive ("Tap", "Tzx", "MGT", "IMG", or None if not known), "size"
+    is the size of the archive in bytes, "mtime" is the time it was
+    last modified in nanoseconds, "sha256" is the hash of the whole
+    archive, "rows" is a list of catalogue rows, and "error" is None or
+    a message saying why the archive could not be read.
+    Each row is a dictionary with the keys in CATALOGUEFIELDS, and
+    describes one file in the archive.  Values that don't apply to a
+    file are None.  "checksum" is "ok" or "bad" for tape files with a
+    checksum, and for disk files says whether the file has any faults
+    in it's directory entry.  "sha256" is the hash of the file's data.
+    Problems with the archive are not raised as exceptions.  Instead
+    an extra row holding the error is added after the rows of any files
+    that could be read.
+    """
+
+    return _readarchive(path, _scantape, _scandisk, CATALOGUEFIELDS)
+
+
+def _runbatch(function, items):
+    # runs function on a batch of items in a worker process
+    return [function(item) for item in items]
+
+
+def _mapbatches(function, items, maxworkers):
+    # generator that yields function(item) for each of items in order,
+    # running batches of items in a pool of processes.  Only a few
+    # batches per process are queued at a time
+    if maxworkers == 1:
+        for item in items:
+            yield function(item)
+
+        return
+
+    queuelength = (maxworkers or os.cpu_count() or 1) * _SCANQUEUEDBATCHES
+    with ProcessPoolExecutor(max_workers=maxworkers) as executor:
+        pending = deque()
+        while True:
+            batch = list(islice(items, _SCANBATCHSIZE))
+            if len(batch) > 0:
+                pending.append(executor.submit(_runbatch, function, batch))
+                if len(pending) < queuelength:
+                    continue
+
+            if len(pending) == 0:
+                return
+
+            yield from pending.popleft().result()
+
+
+def scanarchives(paths, maxworkers=None):
+    """
+    Generator that scans the archives found in paths by findarchives in
+    a pool of processes, and yields the dictionary returned by
+    scanarchive for each in the order they were found.  Only a few
+    batches of archives per process are queued at a time, so directory
+    trees of any size can be scanned without listing them first.
+    maxworkers is the most processes to use.  If None then the number
+    of processors is used.  If it is 1, then the archives are scanned in
+    this process.
+    """
+
+    return _mapbatches(scanarchive, findarchives(paths), maxworkers)
+
+
+def _getrowwriter(f, form, fields=CATALOGUEFIELDS):
+    # returns a function that writes a row to f in the given form,
+    # writing the names of fields first for csv
+    if form not in ("jsonl", "csv"):
+        raise spectrumtranslate.SpectrumTranslateError(
+            '{} is not a valid catalogue format.'.format(form))
+
+    if form == "csv":
+        writer = csv.DictWriter(f, fields, lineterminator="\n")
+        writer.writeheader()
+        return writer.writerow
+
+    def writerow(row):
+        f.write(json.dumps(row) + "\n")
+
+    return writerow
+
+
+def writecatalogue(results, f, form="jsonl", fields=CATALOGUEFIELDS):
+    """
+    Writes the rows of the results from scanarchives to the text file
+    f.  form is "jsonl" to write each row as a line of JSON, or "csv" to
+    write them as comma seperated values with a line of column names
+    first.  fields are the column names, and should be MANIFESTFIELDS
+    for the results from storearchives.
+    Returns a tuple of the number of archives, the number of rows, the
+    number of archives with errors, and the total size of the archives
+    in bytes.
+    """
+
+    writerow = _getrowwriter(f, form, fields)
+    archives = rows = errors = size = 0
+    for result in results:
+        archives += 1
+        rows += len(result["rows"])
+        errors += result["error"] is not None
+        size += result["size"]
+        for row in result["rows"]:
+            writerow(row)
+
+    return archives, rows, errors, size
+
+
+# how many scanned archives are added to a catalogue between commits
+_CATALOGUECOMMITARCHIVES = 1000
+
+# the tables of a catalogue database.  Each file row belongs to an
+# archive, and the archive's size and modification time are kept so
+# that unchanged archives are not read again
+_CATALOGUESCHEMA = """
+CREATE TABLE IF NOT EXISTS archives (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL,
+    format TEXT,
+    size INTEGER,
+    mtime INTEGER,
+    sha256 TEXT,
+    error TEXT);
+CREATE TABLE IF NOT EXISTS files (
+    archive INTEGER NOT NULL,
+    "index" INTEGER,
+    name TEXT,
+    type TEXT,
+    length INTEGER,
+    autostart INTEGER,
+    codestart INTEGER,
+    checksum TEXT,
+    sha256 TEXT,
+    error TEXT);
+CREATE INDEX IF NOT EXISTS files_archive ON files (archive);
+CREATE INDEX IF NOT EXISTS files_sha256 ON files (sha256);
+CREATE INDEX IF NOT EXISTS files_codestart ON files (codestart);
+"""
+
+# the columns of the files table, which are the catalogue fields
+# after the archive and format
+_CATALOGUEFILEFIELDS = CATALOGUEFIELDS[2:]
+
+# selects catalogue rows from the files joined to their archive
+_CATALOGUESELECT = "SELECT archives.path, archives.format, " + ", ".join(
+    'files."{}"'.format(field) for field in _CATALOGUEFILEFIELDS) + \
+    " FROM files JOIN archives ON files.archive = archives.id"
+
+
+class ArchiveCatalogue:
+    """
+    A catalogue of the files in tape and disk archives kept in a sqlite
+    database.  Updating the catalogue only reads archives that are new,
+    or whose size or modification time has changed since they were
+    last scanned, so keeping the catalogue of a large collection up to
+    date is quick.
+    """
+
+    def __init__(self, filename=":memory:"):
+        """
+        Opens the catalogue in the sqlite database filename, creating
+        it if needed.  filename defaults to a catalogue held in memory.
+        """
+
+        self.connection = sqlite3.connect(filename)
+        self.connection.executescript(_CATALOGUESCHEMA)
+
+    def close(self):
+        """Closes the catalogue's database."""
+
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def isunchanged(self, path):
+        """
+        Returns True if the archive at path is in the catalogue and has
+        the same size and modification time as when it was scanned.
+        """
+
+        stat = os.stat(path)
+        return self.connection.execute(
+            "SELECT 1 FROM archives WHERE path = ? AND size = ? AND \
+mtime = ?", (path, stat.st_size, stat.st_mtime_ns)).fetchone() is not None
+
+    def addresult(self, result):
+        """
+        Adds the result of scanarchive for an archive to the catalogue,
+        replacing what the catalogue held for that archive.  If the
+        archive's hash is the same as before, only the size and
+        modification time are updated.  Returns True if the files of
+        the archive were changed.
+        """
+
+        row = self.connection.execute(
+            "SELECT id, sha256 FROM archives WHERE path = ?",
+            (result["archive"], )).fetchone()
+
+        # archive has been touched but not changed
+        if row is not None and result["sha256"] is not None and \
+           row[1] == result["sha256"]:
+            self.connection.execute(
+                "UPDATE archives SET size = ?, mtime = ? WHERE id = ?",
+                (result["size"], result["mtime"], row[0]))
+            return False
+
+        if row is not None:
+            self.connection.execute("DELETE FROM files WHERE archive = ?",
+                                    (row[0], ))
+            self.connection.execute("DELETE FROM archives WHERE id = ?",
+                                    (row[0], ))
+
+        archiveid = self.connection.execute(
+            "INSERT INTO archives (path, format, size, mtime, sha256, error) \
+VALUES (?, ?, ?, ?, ?, ?)", (result["archive"], result["format"],
+                             result["size"], result["mtime"],
+                             result["sha256"], result["error"])).lastrowid
+        self.connection.executemany(
+            'INSERT INTO files VALUES (?, {})'.format(", ".join(
+                "?" * len(_CATALOGUEFILEFIELDS))),
+            [[archiveid] + [row[field] for field in _CATALOGUEFILEFIELDS]
+             for row in result["rows"]])
+        return True
+
+    def removearchive(self, path):
+        """Removes the archive at path from the catalogue."""
+
+        self.connection.execute(
+            "DELETE FROM files WHERE archive IN (SELECT id FROM archives \
+WHERE path = ?)", (path, ))
+        self.connection.execute("DELETE FROM archives WHERE path = ?",
+                                (path, ))
+
+    def update(self, paths, maxworkers=None):
+        """
+        Brings the catalogue up to date with the archives found in paths
+        by findarchives.  Archives that are new or have changed size or
+        modification time are scanned by scanarchives, and archives in
+        the catalogue that were in the directories or files in paths
+        but no longer exist are removed.  Paths are stored as absolute
+        paths so the catalogue can be updated from any directory.
+        maxworkers is as for scanarchives.
+        Returns a tuple of the number of archives scanned, the number
+        that were unchanged, and the number removed.
+        """
+
+        paths = [os.path.abspath(path) for path in paths]
+        found = set()
+        unchanged = [0]
+
+        def changedarchives():
+            for path in findarchives(paths):
+                found.add(path)
+                try:
+                    if self.isunchanged(path):
+                        unchanged[0] += 1
+                        continue
+
+                # let scanarchive report archives that can't be read
+                except OSError:
+                    pass
+
+                yield path
+
+        scanned = 0
+        with self.connection:
+            for result in scanarchives(changedarchives(), maxworkers):
+                self.addresult(result)
+                scanned += 1
+                if scanned % _CATALOGUECOMMITARCHIVES == 0:
+                    self.connection.commit()
+
+            # remove archives that have gone from what was scanned
+            removed = 0
+            for (path, ) in self.connection.execute(
+                    "SELECT path FROM archives").fetchall():
+                if path not in found and any(
+                   path == root or path.startswith(os.path.join(root, ""))
+                   for root in paths):
+                    self.removearchive(path)
+                    removed += 1
+
+        return scanned, unchanged[0], removed
+
+    def _getrows(self, where="", parameters=()):
+        # returns the catalogue rows matching the where clause
+        return [dict(zip(CATALOGUEFIELDS, row)) for row in
+                self.connection.execute(
+                    _CATALOGUESELECT + where +
+                    ' ORDER BY archives.path, files.rowid', parameters)]
+
+    def getrows(self, path=None):
+        """
+        Returns a list of the catalogue rows of the archive at path, or
+        of every archive if path is None, in the same form as from
+        scanarchive.
+        """
+
+        if path is None:
+            return self._getrows()
+
+        return self._getrows(" WHERE archives.path = ?", (path, ))
+
+    def findfiles(self, **fields):
+        """
+        Returns a list of the catalogue rows whose fields match those
+        given.  A field given as True matches any value that isn't
+        None, and None only matches None.  For example
+        findfiles(codestart=0x8000) finds every file that loads at
+        32768, and findfiles(autostart=True) finds every BASIC program
+        that runs when loaded.
+        """
+
+        conditions = []
+        parameters = []
+        for field, value in fields.items():
+            if field not in CATALOGUEFIELDS:
+                raise spectrumtranslate.SpectrumTranslateError(
+                    '{} is not a valid catalogue field.'.format(field))
+
+            column = "archives.path" if field == "archive" else \
+                "archives.format" if field == "format" else \
+                'files."{}"'.format(field)
+            if value is True:
+                conditions.append(column + " IS NOT NULL")
+            elif value is None:
+                conditions.append(column + " IS NULL")
+            else:
+                conditions.append(column + " = ?")
+                parameters.append(value)
+
+        return self._getrows(" WHERE " + " AND ".join(conditions) if
+                             conditions else "", parameters)
+
+    def findduplicates(self):
+        """
+        Returns a list of lists of catalogue rows, one for each payload
+        that is held by more than one file in the catalogue.  Each list
+        holds the rows of the files with the same sha256 hash.
+        """
+
+        rows = self._getrows(" WHERE files.sha256 IN (SELECT sha256 FROM \
+files WHERE sha256 IS NOT NULL GROUP BY sha256 HAVING COUNT(*) > 1)")
+        rows.sort(key=lambda row: row["sha256"])
+        return [list(group) for sha256, group in
+                groupby(rows, key=lambda row: row["sha256"])]
+
+
+class PayloadStore:
+    """
+    A content-addressed store of payloads on disk.  Each payload is
+    saved once in a file named by it's sha256 hash, in directories named
+    by the first two and next two characters of the hash so that no
+    directory gets too big.  Payloads can be compressed with zlib.
+    Translations of payloads (such as BASIC listings, screen images, or
+    disassemblies) are kept alongside them so each payload is only
+    translated once.  Several processes can add to the same store at
+    once.
+    """
+
+    def __init__(self, directory, compress=False):
+        """
+        Opens the store in directory, creating it if needed.  compress
+        is True if you want payloads added to the store compressed with
+        zlib.  Payloads already in the store can be read whether they
+        are compressed or not.
+        """
+
+        self.directory = directory
+        self.compress = compress
+        os.makedirs(directory, exist_ok=True)
+
+    def getpath(self, sha256, suffix=""):
+        """
+        Returns the path of the file in the store for the hash sha256,
+        with suffix added to the file name.
+        """
+
+        return os.path.join(self.directory, sha256[:2], sha256[2:4],
+                            sha256 + suffix)
+
+    def _write(self, path, data):
+        # write to a temporary file and rename it so that other
+        # processes never see part of a file
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temppath = "{}.{}.tmp".format(path, os.getpid())
+        with open(temppath, "wb") as f:
+            f.write(data)
+
+        os.replace(temppath, path)
+
+    def __contains__(self, sha256):
+        return os.path.exists(self.getpath(sha256)) or \
+            os.path.exists(self.getpath(sha256, ".z"))
+
+    def add(self, data):
+        """
+        Adds data to the store if it isn't already in it.  Returns a
+        tuple of the sha256 hash of data, and True if it was added or
+        False if it was already in the store.
+        """
+
+        data = bytes(data)
+        sha256 = hashlib.sha256(data).hexdigest()
+        if sha256 in self:
+            return sha256, False
+
+        if self.compress:
+            self._write(self.getpath(sha256, ".z"), zlib.compress(data))
+
+        else:
+            self._write(self.getpath(sha256), data)
+
+        return sha256, True
+
+    def get(self, sha256):
+        """
+        Returns the payload with the hash sha256 as bytes.  Raises a
+        SpectrumTranslateError if it is not in the store.
+        """
+
+        try:
+            with open(self.getpath(sha256), "rb") as f:
+                return f.read()
+
+        except FileNotFoundError:
+            pass
+
+        try:
+            with open(self.getpath(sha256, ".z"), "rb") as f:
+                return zlib.decompress(f.read())
+
+        except FileNotFoundError:
+            raise spectrumtranslate.SpectrumTranslateError(
+                '{} is not in the store.'.format(sha256))
+
+    def gettranslation(self, sha256, name, translate):
+        """
+        Returns the translation called name of the payload with the hash
+        sha256.  The first time it is asked for, translate is called
+        with the payload to make it and the result is saved in the
+        store.  After that the saved translation is returned.
+        name must be usable in a file name, and should include anything
+        that changes the translation, for example "disassemble-32768".
+        translate must return a string, or bytes like object, and the
+        translation is returned as a string or bytes.
+        """
+
+        if not name or os.sep in name or "/" in name:
+            raise spectrumtranslate.SpectrumTranslateError(
+                '{} is not a valid translation name.'.format(name))
+
+        for suffix in (".txt", ".bin"):
+            try:
+                with open(self.getpath(sha256, "." + name + suffix),
+                          "rb") as f:
+                    data = f.read()
+
+                return data.decode("utf-8") if suffix == ".txt" else data
+
+            except FileNotFoundError:
+                pass
+
+        translation = translate(self.get(sha256))
+        if isinstance(translation, str):
+            self._write(self.getpath(sha256, "." + name + ".txt"),
+                        translation.encode("utf-8"))
+            return translation
+
+        translation = bytes(translation)
+        self._write(self.getpath(sha256, "." + name + ".bin"), translation)
+        return translation
+
+    def getbasiclisting(self, sha256, autostart=-1, variableoffset=-1):
+        """
+        Returns the listing of the BASIC program with the hash sha256 as
+        from spectrumtranslate.basictotext.
+        """
+
+        return self.gettranslation(
+            sha256, "basic{}_{}".format(autostart, variableoffset),
+            lambda data: spectrumtranslate.basictotext(data, autostart,
+                                                       variableoffset))
+
+    def getscreenimage(self, sha256, scale=1):
+        """
+        Returns the screen with the hash sha256 as a PNG image as from
+        spectrumtranslate.getpngfromscreen.
+        """
+
+        return self.gettranslation(
+            sha256, "screen{}".format(scale),
+            lambda data: spectrumtranslate.getpngfromscreen(data, scale))
+
+    def getdisassembly(self, sha256, origin):
+        """
+        Returns the disassembly of the code with the hash sha256 loaded
+        at origin as from spectrumtranslate.disassemble.
+        """
+
+        return self.gettranslation(
+            sha256, "disassemble{}".format(origin),
+            lambda data: spectrumtranslate.disassemble(data, 0, origin,
+                                                       len(data)))
+
+
+def _storetape(store, result, data):
+    # adds the payload of each header and data block on a tape to store
+    # and a manifest row for it to result
+    archiveformat, blocks = _gettapeblocks(data)
+
+    result["format"] = archiveformat
+    for block in blocks:
+        if not block.isheader() and not block.isdatablock():
+            continue
+
+        payload = block.getpayload()
+        sha256, added = store.add(payload)
+        result["added"] += added
+        result["rows"].append(_newrow(
+            result["archive"], archiveformat, MANIFESTFIELDS,
+            index=block.blockPosition, name=block.getfilename(),
+            type="Header" if block.isheader() else "Data",
+            length=len(payload), sha256=sha256))
+
+
+def _storedisk(store, result, data):
+    # adds the data of each file in a disciple/+D disk image to store
+    # and a manifest row for it to result
+    di = _getdiskimage(result, data)
+    imagefaults = di.checkforfaults()
+    for df in di.iteratedisciplefiles():
+        headerdata = df.getheader()
+        if df.isempty(headerdata):
+            continue
+
+        row = _newrow(result["archive"], di.ImageFormat, MANIFESTFIELDS,
+                      index=df.filenumber, name=df.getfilename(headerdata),
+                      type=df.getfiletypestring(headerdata))
+
+        # only read the data of files whose sector chain looks right
+        faults = imagefaults.get(df.filenumber)
+        if faults:
+            row["error"] = ". ".join(faults)
+
+        else:
+            payload = df.getfiledata(headerdata=headerdata)
+            sha256, added = store.add(payload)
+            result["added"] += added
+            row.update(length=len(payload), sha256=sha256)
+
+        result["rows"].append(row)
+
+
+def storearchive(path, store):
+    """
+    Adds the payload of every header and data block in the tape, or
+    every file in the disk image, at path to the PayloadStore store.
+    Returns a dictionary like that from scanarchive, except that the
+    rows are manifest rows with the keys in MANIFESTFIELDS mapping each
+    entry in the archive to the sha256 hash of it's payload, and
+    "added" is how many payloads were new to the store.
+    """
+
+    return _readarchive(path, partial(_storetape, store),
+                        partial(_storedisk, store), MANIFESTFIELDS, added=0)
+
+
+def storearchives(paths, store, maxworkers=None):
+    """
+    Generator that adds the payloads in the archives found in paths by
+    findarchives to the PayloadStore store in a pool of processes, and
+    yields the dictionary returned by storearchive for each in the order
+    they were found.  maxworkers is as for scanarchives.
+    """
+
+    return _mapbatches(partial(storearchive, store=store),
+                       findarchives(paths), maxworkers)
+
+
+def usage():
+    """
+    returns the command line arguments for spectrumscan as a string.
+    """
+
+    return """usage: python spectrumscan.py instruction [args] [catalogue]
+    [path ...]
+
+    scans tap, tzx, mgt, and img files, and directories holding them,
+    and writes or updates a catalogue of the files in them.
+
+    instruction is required and specifies what you want to do. It must
+    be 'scan', 'update', 'find', 'store', or 'help'.  'scan' walks the
+    directories given, reads every tape and disk image in them (and any
+    other files given) in a pool of processes, and writes a catalogue
+    row for each file they hold.  Each row has the archive path and
+    format, the index of the file in the archive, it's name, type,
+    length, autostart line, code start address, checksum status ("ok",
+    "bad" or empty if it has no checksum), sha256 hash of it's data,
+    and any error.  A file that can't be read gets a row with just the
+    error so one bad file won't stop the scan.  When done the number of
+    archives and speed of the scan are written to the standard error.
+    'update' keeps a catalogue in the sqlite database file given before
+    the paths up to date with the archives in them.  Only archives that
+    are new or whose size or modification time have changed are read,
+    and archives that have gone are removed.  'find' writes the rows in
+    the catalogue database given that match the find flags.  'store'
+    puts the payload of every header and data block of the tapes, and
+    every file of the disk images, in the paths into the content
+    addressed store in the directory given before the paths.  Each
+    payload is only stored once however many archives hold it, and a
+    manifest row mapping each entry in each archive to the sha256 hash
+    of it's payload is written.
+
+    general flags:
+    --csv writes the catalogue as comma seperated values with a line of
+      column names first.  Otherwise each row is written as a line of
+      JSON.
+    --output specifies the file to write the catalogue to.  It must be
+      followed by the file name.  Otherwise the catalogue is written to
+      the standard output.
+    -w or --workers specifies the most processes to use.  It must be
+      followed by a number.  The default is the number of processors.
+    -q or --quiet stops the speed of the scan, update or store being
+      written.
+
+    store flags:
+    --compress compresses payloads new to the store with zlib.
+
+    find flags:
+    --codestart finds files loading at the address that must follow
+      the flag.  It can be a decimal or hexadecimal number preceded by
+      '0x'.
+    --autostart finds BASIC programs that run when loaded.
+    --type finds files of the type that must follow the flag.
+    --sha256 finds files whose data has the hash that must follow the
+      flag.
+    --duplicates finds files whose data is also in other files, with
+      the files holding the same data one after the other.
+"""
+
+
+def _commandline(args):
+    def getint(x):
+        return int(x, 16 if x.lower().startswith("0x") else 10)
+
+    mode = None
+    paths = []
+    form = "jsonl"
+    outputfile = None
+    maxworkers = None
+    quiet = False
+    fields = {}
+    duplicates = False
+    compress = False
+
+    # handle no arguments
+    if len(args) == 1:
+        mode = 'help'
+
+    # go through arguments analysing them
+    i = 0
+    while i < len(args)-1:
+        i += 1
+
+        arg = args[i]
+        if arg in ['help', 'scan', 'update', 'find', 'store']:
+            if mode is not None:
+                raise spectrumtranslate.SpectrumTranslateError(
+                    "Can't have multiple commands.")
+
+            mode = arg
+            continue
+
+        if mode is None:
+            raise spectrumtranslate.SpectrumTranslateError('No command (scan, \
+update, find, store, or help) specified as first argument.')
+
+        if arg == '--csv':
+            form = "csv"
+            continue
+
+        if arg == '--output':
+            i += 1
+            if i == len(args):
+                raise spectrumtranslate.SpectrumTranslateError(
+                    'No output file specified.')
+
+            outputfile = args[i]
+            continue
+
+        if arg in ['-w', '--workers']:
+            i += 1
+            try:
+                maxworkers = int(args[i])
+                if maxworkers < 1:
+                    raise ValueError()
+
+                continue
+
+            except (ValueError, IndexError):
+                raise spectrumtranslate.SpectrumTranslateError('{} is not a \
+valid number of workers.'.format(args[i] if i < len(args) else ""))
+
+        if arg in ['-q', '--quiet']:
+            quiet = True
+            continue
+
+        if arg == '--codestart':
+            i += 1
+            try:
+                fields["codestart"] = getint(args[i])
+                continue
+
+            except (ValueError, IndexError):
+                raise spectrumtranslate.SpectrumTranslateError('{} is not a \
+valid code start address.'.format(args[i] if i < len(args) else ""))
+
+        if arg == '--autostart':
+            fields["autostart"] = True
+            continue
+
+        if arg in ['--type', '--sha256']:
+            i += 1
+            if i == len(args):
+                raise spectrumtranslate.SpectrumTranslateError(
+                    'No value specified for {}.'.format(arg))
+
+            fields[arg[2:]] = args[i]
+            continue
+
+        if arg == '--duplicates':
+            duplicates = True
+            continue
+
+        if arg == '--compress':
+            compress = True
+            continue
+
+        # have unrecognised argument.
+        if arg[0] == '-':
+            raise spectrumtranslate.SpectrumTranslateError('{} is not a \
+recognised flag.'.format(arg))
+
+        paths.append(arg)
+
+    # if help is needed display it
+    if mode == 'help':
+        sys.stdout.write(usage())
+        return
+
+    # update and find need a catalogue, and store needs a store
+    # directory, before any paths
+    cataloguefile = None
+    if mode in ['update', 'find', 'store']:
+        if len(paths) == 0:
+            raise spectrumtranslate.SpectrumTranslateError(
+                'No {} specified.'.format("store directory" if mode ==
+                                          'store' else "catalogue file"))
+
+        cataloguefile = paths.pop(0)
+
+    if len(paths) == 0 and mode != 'find':
+        raise spectrumtranslate.SpectrumTranslateError(
+            'No files or directories specified to scan.')
+
+    starttime = time.perf_counter()
+    if mode == 'update':
+        with ArchiveCatalogue(cataloguefile) as catalogue:
+            scanned, unchanged, removed = catalogue.update(paths, maxworkers)
+
+        if not quiet:
+            sys.stderr.write("Scanned {} archives, {} unchanged, {} removed \
+in {:.2f}s\n".format(scanned, unchanged, removed,
+                     time.perf_counter() - starttime))
+
+        return
+
+    f = sys.stdout if outputfile is None else \
+        open(outputfile, "w", newline="")
+    try:
+        if mode == 'find':
+            with ArchiveCatalogue(cataloguefile) as catalogue:
+                rows = catalogue.findfiles(**fields)
+                if duplicates:
+                    hashes = set(row["sha256"] for row in rows)
+                    rows = [row for group in catalogue.findduplicates() for
+                            row in group if group[0]["sha256"] in hashes]
+
+            writerow = _getrowwriter(f, form)
+            for row in rows:
+                writerow(row)
+
+            return
+
+        if mode == 'store':
+            # count the payloads stored, and how many were new
+            stored = [0, 0]
+
+            def countstored(results):
+                for result in results:
+                    stored[0] += sum(row["sha256"] is not None for row in
+                                     result["rows"])
+                    stored[1] += result["added"]
+                    yield result
+
+            store = PayloadStore(cataloguefile, compress)
+            archives, rows, errors, size = writecatalogue(
+                countstored(storearchives(paths, store, maxworkers)), f, form,
+                MANIFESTFIELDS)
+
+        else:
+            archives, rows, errors, size = writecatalogue(
+                scanarchives(paths, maxworkers), f, form)
+
+    finally:
+        if outputfile is not None:
+            f.close()
+
+    if not quiet and mode == 'store':
+        sys.stderr.write("Stored {} payloads ({} new) from {} archives in \
+{:.2f}s\n".format(stored[0], stored[1], archives,
+                  time.perf_counter() - starttime))
+
+    elif not quiet:
+        elapsed = max(time.perf_counter() - starttime, 1e-6)
+        sys.stderr.write("Scanned {} archives ({} files, {} archives with \
+errors, {:.1f}MB) in {:.2f}s: {:.1f} archives/s, {:.2f} MB/s\n".format(
+            archives, rows, errors, size / 1000000, elapsed,
+            archives / elapsed, size / 1000000 / elapsed))
+
+
+if __name__ == "__main__":
+    try:
+        _commandline(sys.argv)
+    except spectrumtranslate.SpectrumTranslateError as se:
+        sys.stderr.write(se.value + "\n")
+        sys.stdout.write(
+            "Use 'python spectrumscan.py' to see full list of options.\n")
+        sys.exit(2)
@@ -44,10 +44,23 @@
 
 import spectrumtranslate
 import sys
-from io import IOBase
+import mmap
+import struct
+import wave
+import zlib
+from array import array
+from collections import deque
+from io import BytesIO, IOBase
+from itertools import accumulate, chain, cycle, groupby, islice, repeat
+from itertools import takewhile
 from math import ceil, log2
 from os.path import isfile
 # os.path imported elsewhere so only used for command line
+# numpy is optional, but makes checksums of large blocks faster if present
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 
 def _isarray(x):
@@ -59,14 +72,19 @@ def _isarrayofint(x):
 
 
 def _bytesarevalid(x):
-    return isinstance(x, (bytes, bytearray)) or _isarrayofint(x)
+    return isinstance(x, (bytes, bytearray, memoryview)) or _isarrayofint(x)
 
 
 def _sourceisvalid(s):
-    return isinstance(s, IOBase) or _bytesarevalid(s)
+    return isinstance(s, (IOBase, mmap.mmap)) or _bytesarevalid(s)
 
 
 def _validateandpreparebytes(x, m=""):
+    # views into mapped tape files are kept as they are rather than
+    # copied
+    if isinstance(x, memoryview):
+        return x
+
     if _bytesarevalid(x):
         return bytearray(x)
 
@@ -74,10 +92,68 @@ def _validateandpreparebytes(x, m=""):
 list or tuple of ints, or of type 'bytes' or 'bytearray'".format(m))
 
 
+class _PayloadAttribute():
+    # an attribute of a tape block holding data that may be a view into
+    # the source the block was read from, so that reading a tape doesn't
+    # copy every payload.  The block's own methods read the data without
+    # copying it through the attribute's name with a leading underscore.
+    # Fetching the attribute itself copies a view into a bytearray that
+    # then replaces it, as whoever fetches it may want to change it
+
+    def __set_name__(self, owner, name):
+        self.name = "_" + name
+
+    def __get__(self, block, owner=None):
+        if block is None:
+            return self
+
+        value = getattr(block, self.name)
+        if isinstance(value, memoryview):
+            value = bytearray(value)
+            setattr(block, self.name, value)
+
+        return value
+
+    def __set__(self, block, value):
+        setattr(block, self.name, value)
+
+
 def _get_word(s):
     return int.from_bytes(s, 'little')
 
 
+# blocks shorter than this are quicker to checksum byte by byte
+_CHECKSUMLOOPLIMIT = 32
+
+
+def _getchecksum(data):
+    # returns the xor of all the bytes in data
+    length = len(data)
+    if length < _CHECKSUMLOOPLIMIT:
+        checksum = 0
+        for i in data:
+            checksum ^= i
+
+        return checksum
+
+    if not isinstance(data, (bytes, bytearray, memoryview)):
+        data = bytes(data)
+
+    if numpy is not None:
+        return int(numpy.bitwise_xor.reduce(numpy.frombuffer(data,
+                                                             numpy.uint8)))
+
+    # treat data as one big number, and keep xoring the top half onto
+    # the bottom half until only one byte is left
+    checksum = int.from_bytes(data, 'little')
+    while length > 1:
+        length = (length + 1) >> 1
+        bits = length << 3
+        checksum = (checksum >> bits) ^ (checksum & ((1 << bits) - 1))
+
+    return checksum
+
+
 def word_to_bytes(w, n, signed=False):
     return w.to_bytes(n, 'little', signed=signed)
 
@@ -106,6 +182,239 @@ def _validateandconvertfilename(filename):
     return bytearray(filename) + bytearray([32] * (10 - len(filename)))
 
 
+def _mapfile(f):
+    # returns a copy on write memoryview of the whole of file object f
+    try:
+        return memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY))
+    except ValueError:
+        # can't map empty files
+        return memoryview(b"")
+
+
+def _unmapfile(view):
+    # lets go of a memoryview from _mapfile.  The map is closed now
+    # unless blocks still hold views into it, in which case it is closed
+    # when they are gone
+    mapping = view.obj
+    view.release()
+    if isinstance(mapping, mmap.mmap):
+        try:
+            mapping.close()
+        except BufferError:
+            pass
+
+
+# tape timings are measured in T states of the spectrum's 3.5MHz clock
+_TSTATESPERSECOND = 3500000
+_TSTATESPERMS = 3500
+
+# the length of the pilot tone the rom saves before headers and data
+_ROMHEADERPILOTPULSES = 8063
+_ROMDATAPILOTPULSES = 3223
+
+# how many bytes of data or samples are turned into pulses at a time
+_PULSECHUNKBYTES = 1024
+
+# the bits of each byte, most significant first
+_BYTEBITS = [tuple((b >> i) & 1 for i in range(7, -1, -1))
+             for b in range(256)]
+
+
+def _getdatapulses(data, zero, one, lastbits=8):
+    # yields the pulses for data in chunks with two pulses per bit,
+    # most significant bit first.  Only the top lastbits of the last
+    # byte are played
+    if lastbits < 1 or lastbits > 8:
+        lastbits = 8
+
+    if numpy is None:
+        pulsetable = [list(chain.from_iterable(
+            (one, one) if bit else (zero, zero) for bit in bits))
+            for bits in _BYTEBITS]
+
+    length = len(data)
+    for start in range(0, length, _PULSECHUNKBYTES):
+        chunk = data[start:start + _PULSECHUNKBYTES]
+        if numpy is None:
+            pulses = list(chain.from_iterable(map(pulsetable.__getitem__,
+                                                  chunk)))
+        else:
+            bits = numpy.unpackbits(numpy.frombuffer(chunk, numpy.uint8))
+            pulses = numpy.where(bits, one, zero).repeat(2)
+
+        if start + _PULSECHUNKBYTES >= length and lastbits < 8:
+            pulses = pulses[:len(pulses) - 16 + lastbits * 2]
+
+        yield None, pulses
+
+
+def _getsamplepulses(samples, tstates, lastbits=8):
+    # yields direct recording samples as chunks of pulses, each chunk
+    # starting at the level of it's first sample
+    if lastbits < 1 or lastbits > 8:
+        lastbits = 8
+
+    length = len(samples)
+    for start in range(0, length, _PULSECHUNKBYTES):
+        chunk = samples[start:start + _PULSECHUNKBYTES]
+        if numpy is None:
+            bits = list(chain.from_iterable(map(_BYTEBITS.__getitem__,
+                                                chunk)))
+        else:
+            bits = numpy.unpackbits(numpy.frombuffer(chunk, numpy.uint8))
+
+        if start + _PULSECHUNKBYTES >= length and lastbits < 8:
+            bits = bits[:len(bits) - 8 + lastbits]
+
+        if numpy is None:
+            yield bits[0], [len(list(g)) * tstates for k, g in groupby(bits)]
+        else:
+            changes = numpy.flatnonzero(bits[1:] != bits[:-1]) + 1
+            yield int(bits[0]), numpy.diff(numpy.concatenate((
+                [0], changes, [len(bits)]))) * tstates
+
+
+def _gettonedatapulses(data, pilotpulse, pilottone, sync1, sync2, zero, one,
+                       lastbits, pause):
+    # yields the pulses for a block saved with a pilot tone and sync
+    # pulses before the data, and a pause after it
+    yield None, [pilotpulse] * pilottone + [sync1, sync2]
+    yield from _getdatapulses(data, zero, one, lastbits)
+    yield from _getpausepulses(pause)
+
+
+def _getpausepulses(pause):
+    # yields the pulses for a pause of pause milliseconds.  The last
+    # edge gets 1ms at the other level before the signal goes low
+    if pause <= 0:
+        return
+
+    yield None, [_TSTATESPERMS]
+    pause -= 1
+    # play long pauses a second at a time
+    while pause > 0:
+        yield 0, [min(pause, 1000) * _TSTATESPERMS]
+        pause -= 1000
+
+
+# how many bytes of csw data are decompressed at a time
+_CSWCHUNKBYTES = 65536
+
+
+def _getcswpulselengths(data, compressionType):
+    # yields the lengths in samples of the pulses in run length encoded
+    # csw data, decompressing Z-RLE data a chunk at a time
+    if compressionType == 1:
+        chunks = (data[start:start + _CSWCHUNKBYTES]
+                  for start in range(0, len(data), _CSWCHUNKBYTES))
+
+    elif compressionType == 2:
+        def decompress():
+            decompressor = zlib.decompressobj()
+            try:
+                for start in range(0, len(data), _CSWCHUNKBYTES):
+                    chunk = decompressor.decompress(
+                        data[start:start + _CSWCHUNKBYTES], _CSWCHUNKBYTES)
+                    yield chunk
+                    while decompressor.unconsumed_tail:
+                        yield decompressor.decompress(
+                            decompressor.unconsumed_tail, _CSWCHUNKBYTES)
+
+                yield decompressor.flush()
+
+            except zlib.error:
+                raise IOError("Corrupt TZX CSW Recording Block")
+
+        chunks = decompress()
+
+    else:
+        raise IOError("Corrupt TZX CSW Recording Block")
+
+    # pulses are one byte, or a 0 followed by a 4 byte length
+    leftover = b""
+    for chunk in chunks:
+        chunk = leftover + bytes(chunk)
+        position = 0
+        while True:
+            zero = chunk.find(0, position)
+            if zero < 0:
+                yield from chunk[position:]
+                position = len(chunk)
+                break
+
+            yield from chunk[position:zero]
+            position = zero
+            if zero + 5 > len(chunk):
+                break
+
+            yield _get_word(chunk[zero + 1:zero + 5])
+            position = zero + 5
+
+        leftover = chunk[position:]
+
+    if len(leftover) > 0:
+        raise IOError("Corrupt TZX CSW Recording Block")
+
+
+def _getsamplelengthpulses(lengths, samplerate):
+    # yields chunks of pulses in T states for pulse lengths in samples
+    if samplerate <= 0:
+        raise IOError("Corrupt TZX CSW Recording Block")
+
+    lengths = iter(lengths)
+    samples = 0
+    while True:
+        chunk = list(islice(lengths, _PULSECHUNKBYTES * 16))
+        if len(chunk) == 0:
+            return
+
+        ends = [x * _TSTATESPERSECOND // samplerate for x in
+                accumulate(chunk, initial=samples)]
+        yield None, [b - a for a, b in zip(ends, ends[1:])]
+        samples += sum(chunk)
+
+
+def _getsymbolpulses(symbols, definitions):
+    # yields chunks of pulses for a stream of generalized data symbols.
+    # The 2 lowest bits of a symbol's flags say if it's first pulse
+    # changes the level, keeps it (a 0 length pulse first), or forces
+    # it low or high.  A 0 length pulse ends a symbol early
+    table = []
+    for flags, pulses in definitions:
+        pulses = list(takewhile(bool, pulses))
+        flags &= 3
+        if flags > 1:
+            table.append((flags - 2, pulses))
+        else:
+            table.append((None, [0] + pulses if flags == 1 and pulses
+                          else pulses))
+
+    chunk = []
+    for symbol in symbols:
+        if symbol >= len(table):
+            raise IOError("Corrupt TZX Generalized Data Block")
+
+        level, pulses = table[symbol]
+        if level is None:
+            chunk += pulses
+            if len(chunk) < _PULSECHUNKBYTES * 16:
+                continue
+
+        if len(chunk) > 0:
+            yield None, chunk
+            chunk = []
+
+        if level is not None:
+            yield level, pulses
+
+    if len(chunk) > 0:
+        yield None, chunk
+
+
+# inverts all the bits in a byte
+_INVERTBYTES = bytes(range(255, -1, -1))
+
+
 class SpectrumTapeBlock:
     """
     A class that holds information about a block of data from a Spectrum
@@ -175,6 +484,15 @@ class SpectrumTapeBlock:
 
         return None
 
+    def checksumisvalid(self):
+        """
+        Does the checksum at the end of the data in this block match the
+        data?  Returns True if it does, False if not, or None if this
+        block has no checksum.
+        """
+
+        return None
+
     def getfilename(self):
         """
         This gets the filename from a header block.  Note that the
@@ -425,6 +743,18 @@ class SpectrumTapeBlock:
         raise spectrumtranslate.SpectrumTranslateError("Generic Tape Block \
 not useable in file. Use child classes instead")
 
+    def getpulses(self):
+        """
+        Returns an iterator of the pulses that make the sound of this
+        block when it is played.  Each item is a tuple of the level of
+        the first pulse (0 for low, 1 for high, or None if the level
+        changes from what it was), and a list of pulse lengths in T
+        states (1/3500000 of a second).  The level changes between each
+        pulse in the list.  Blocks that make no sound have no pulses.
+        """
+
+        return iter(())
+
 
 class SpectrumTapBlock(SpectrumTapeBlock):
     """
@@ -454,8 +784,52 @@ class SpectrumTapBlock(SpectrumTapeBlock):
         self.flag = flag
 
         # validate and prepare data
+        self._setdata(_validateandpreparebytes(data, "data"),
+                      isinstance(data, memoryview))
+
+        """
+        The checksum byte that followed the data in the tap file this
+        block was read from, or None if it wasn't read from a file.
+        """
+        self.storedChecksum = None
+
+    @property
+    def data(self):
         """An array of bytes holding the data for the block."""
-        self.data = _validateandpreparebytes(data, "data")
+
+        # copy a view into the tape file so it can be changed
+        if isinstance(self._data, memoryview):
+            self._data = bytearray(self._data)
+
+        # data can now be changed by whoever gets it
+        self._datashared = True
+        return self._data
+
+    @data.setter
+    def data(self, value):
+        self._setdata(value)
+
+    def _setdata(self, data, shared=True):
+        # shared is False if nothing outside this block can change data
+        self._data = data
+        self._datachecksum = None
+        self._datashared = shared
+
+    def getchecksum(self):
+        """
+        Returns the checksum byte for this block: the flag xored with
+        every byte of the data.  It is only worked out once and
+        remembered, unless the data has been fetched or set from outside
+        the block, as it could then be changed without the block knowing.
+        """
+
+        if self._datashared:
+            return self.flag ^ _getchecksum(self._data)
+
+        if self._datachecksum is None:
+            self._datachecksum = _getchecksum(self._data)
+
+        return self.flag ^ self._datachecksum
 
     def isheader(self):
         """
@@ -467,7 +841,7 @@ class SpectrumTapBlock(SpectrumTapeBlock):
         not.
         """
 
-        return (self.flag == 0 and len(self.data) == 17)
+        return (self.flag == 0 and len(self._data) == 17)
 
     def isdatablock(self):
         """
@@ -478,7 +852,7 @@ class SpectrumTapBlock(SpectrumTapeBlock):
         not.
         """
 
-        return len(self.data) > 0 and not self.isheader()
+        return len(self._data) > 0 and not self.isheader()
 
     def getpayloadlength(self):
         """
@@ -487,7 +861,7 @@ class SpectrumTapBlock(SpectrumTapeBlock):
         details such as the length of a block, a flag, and a checksum.
         """
 
-        return len(self.data)
+        return len(self._data)
 
     def getpayload(self):
         """
@@ -498,6 +872,18 @@ class SpectrumTapBlock(SpectrumTapeBlock):
 
         return self.data
 
+    def checksumisvalid(self):
+        """
+        Does the checksum at the end of the data in this block match the
+        data?  Returns True if the checksum byte read from the tap file
+        matches the data, False if not.  The checksum of a block not read
+        from a file is worked out from the data when it is saved, so
+        this returns True for such blocks.
+        """
+
+        return self.storedChecksum is None or \
+            self.getchecksum() == self.storedChecksum
+
     def getpayloadstartoffset(self):
         """
         This returns the offset to the data of a block of a tap file in
@@ -529,16 +915,22 @@ class SpectrumTapBlock(SpectrumTapeBlock):
         """
 
         # work out length of data+flag+checksum
-        length = len(self.data) + 2
-
-        # work out checksum
-        checksum = self.flag
-        for i in self.data:
-            checksum = checksum ^ i
+        length = len(self._data) + 2
 
         # merge it into a list, and return
         return word_to_bytes(length, 2) + bytearray([self.flag]) + \
-            self.data + bytearray([checksum])
+            self._data + bytearray([self.getchecksum()])
+
+    def getpulses(self):
+        """
+        Returns an iterator of the pulses that make the sound of this
+        block when saved by the rom, followed by a 1 second pause.
+        """
+
+        return _gettonedatapulses(
+            bytes([self.flag]) + self._data + bytes([self.getchecksum()]),
+            2168, _ROMHEADERPILOTPULSES if self.flag < 128 else
+            _ROMDATAPILOTPULSES, 667, 735, 855, 1710, 8, 1000)
 
 
 class SpectrumTZXStandardSpeedDataBlock(SpectrumTapeBlock):
@@ -547,6 +939,8 @@ class SpectrumTZXStandardSpeedDataBlock(SpectrumTapeBlock):
     from a TZX file.  These can be used to extract data from a tzx file.
     """
 
+    data = _PayloadAttribute()
+
     def __init__(self, endPause=0, data=[], filePosition=0,
                  blockPosition=None):
         """
@@ -577,7 +971,7 @@ class SpectrumTZXStandardSpeedDataBlock(SpectrumTapeBlock):
         not.
         """
 
-        return len(self.data) == 19 and self.data[0] == 0
+        return len(self._data) == 19 and self._data[0] == 0
 
     def isdatablock(self):
         """
@@ -588,7 +982,7 @@ class SpectrumTZXStandardSpeedDataBlock(SpectrumTapeBlock):
         not.
         """
 
-        return len(self.data) > 0 and not self.isheader()
+        return len(self._data) > 0 and not self.isheader()
 
     def getpayload(self):
         """
@@ -597,7 +991,16 @@ class SpectrumTZXStandardSpeedDataBlock(SpectrumTapeBlock):
         Returns None if block doesn't have data in it.
         """
 
-        return self.data[1: -1]
+        return bytearray(self._data[1: -1])
+
+    def checksumisvalid(self):
+        """
+        Does the checksum at the end of the data in this block match the
+        data?  Returns True if it does, False if not, or None if this
+        block has no checksum.
+        """
+
+        return _getchecksum(self._data) == 0 if len(self._data) > 1 else None
 
     def getpayloadlength(self):
         """
@@ -606,7 +1009,7 @@ class SpectrumTZXStandardSpeedDataBlock(SpectrumTapeBlock):
         details such as the length of a block, a flag, and a checksum.
         """
 
-        return len(self.data) - 2
+        return len(self._data) - 2
 
     def getpayloadstartoffset(self):
         """
@@ -660,7 +1063,18 @@ pause afterwards: {}ms".format(self.flag, self.getpayloadlength(),
 
         return bytearray([0x10]) + \
             word_to_bytes(self.endPause, 2) + \
-            word_to_bytes(len(self.data), 2) + self.data
+            word_to_bytes(len(self._data), 2) + self._data
+
+    def getpulses(self):
+        """
+        Returns an iterator of the pulses that make the sound of this
+        block when saved by the rom, followed by it's pause.
+        """
+
+        return _gettonedatapulses(
+            self._data, 2168, _ROMHEADERPILOTPULSES if len(self._data) > 0 and
+            self._data[0] < 128 else _ROMDATAPILOTPULSES, 667, 735, 855, 1710,
+            8, self.endPause)
 
 
 class SpectrumTZXTurboSpeedDataBlock(SpectrumTapeBlock):
@@ -669,6 +1083,8 @@ class SpectrumTZXTurboSpeedDataBlock(SpectrumTapeBlock):
     a TZX file.  These can be used to extract data from a tzx file.
     """
 
+    data = _PayloadAttribute()
+
     def __init__(self, endPause=0, data=[], lenPilotPulse=2168,
                  lenSyncPulse1=667, lenSyncPulse2=735, lenZeroPulse=855,
                  lenOnePulse=1710, lenPilotTone=3223,
@@ -709,7 +1125,7 @@ class SpectrumTZXTurboSpeedDataBlock(SpectrumTapeBlock):
         not.
         """
 
-        return (len(self.data) == 19 and self.data[0] == 0)
+        return (len(self._data) == 19 and self._data[0] == 0)
 
     def isdatablock(self):
         """
@@ -720,7 +1136,7 @@ class SpectrumTZXTurboSpeedDataBlock(SpectrumTapeBlock):
         not.
         """
 
-        return len(self.data) > 0 and not self.isheader()
+        return len(self._data) > 0 and not self.isheader()
 
     def getpayloadlength(self):
         """
@@ -729,7 +1145,7 @@ class SpectrumTZXTurboSpeedDataBlock(SpectrumTapeBlock):
         details such as the length of a block, a flag, and a checksum.
         """
 
-        return len(self.data) - 2
+        return len(self._data) - 2
 
     def getpayload(self):
         """
@@ -738,7 +1154,16 @@ class SpectrumTZXTurboSpeedDataBlock(SpectrumTapeBlock):
         Returns None if block doesn't have data in it.
         """
 
-        return self.data[1: -1]
+        return bytearray(self._data[1: -1])
+
+    def checksumisvalid(self):
+        """
+        Does the checksum at the end of the data in this block match the
+        data?  Returns True if it does, False if not, or None if this
+        block has no checksum.
+        """
+
+        return _getchecksum(self._data) == 0 if len(self._data) > 1 else None
 
     def getpayloadstartoffset(self):
         """
@@ -798,7 +1223,18 @@ afterwards: {}ms".format(self.flag, self.getpayloadlength(), self.endPause)
             word_to_bytes(self.lenPilotTone, 2) + \
             word_to_bytes(self.lastByteUsedBits, 1) + \
             word_to_bytes(self.endPause, 2) + \
-            word_to_bytes(len(self.data), 3) + self.data
+            word_to_bytes(len(self._data), 3) + self._data
+
+    def getpulses(self):
+        """
+        Returns an iterator of the pulses that make the sound of this
+        block useing it's timings, followed by it's pause.
+        """
+
+        return _gettonedatapulses(
+            self._data, self.lenPilotPulse, self.lenPilotTone,
+            self.lenSyncPulse1, self.lenSyncPulse2, self.lenZeroPulse,
+            self.lenOnePulse, self.lastByteUsedBits, self.endPause)
 
 
 class SpectrumTZXPureToneBlock(SpectrumTapeBlock):
@@ -851,6 +1287,14 @@ Pulses:{}".format(self.lenPulse, self.numberOfPulses)
             word_to_bytes(self.lenPilot, 2) + \
             word_to_bytes(self.numberOfPulses, 2)
 
+    def getpulses(self):
+        """
+        Returns an iterator of the pulses that make the tone of this
+        block.
+        """
+
+        return iter([(None, [self.lenPulse] * self.numberOfPulses)])
+
 
 class SpectrumTZXPulseSequenceBlock(SpectrumTapeBlock):
     """
@@ -903,6 +1347,13 @@ class SpectrumTZXPulseSequenceBlock(SpectrumTapeBlock):
         return bytearray([0x13]) + \
             word_to_bytes(len(self.pulses), 1) + self.pulses
 
+    def getpulses(self):
+        """
+        Returns an iterator of the pulses of this block.
+        """
+
+        return iter([(None, self.pulses)])
+
 
 class SpectrumTZXPureDataBlock(SpectrumTapeBlock):
     """
@@ -910,6 +1361,8 @@ class SpectrumTZXPureDataBlock(SpectrumTapeBlock):
     file.  These can be used to extract data from a tzx file.
     """
 
+    data = _PayloadAttribute()
+
     def __init__(self, endPause=0, data=[], lenZeroPulse=855,
                  lenOnePulse=1710, lastByteUsedBits=8, filePosition=0,
                  blockPosition=None):
@@ -942,7 +1395,7 @@ class SpectrumTZXPureDataBlock(SpectrumTapeBlock):
         not.
         """
 
-        return (len(self.data) == 19 and self.data[0] == 0)
+        return (len(self._data) == 19 and self._data[0] == 0)
 
     def isdatablock(self):
         """
@@ -953,7 +1406,7 @@ class SpectrumTZXPureDataBlock(SpectrumTapeBlock):
         not.
         """
 
-        return len(self.data) > 0 and not self.isheader()
+        return len(self._data) > 0 and not self.isheader()
 
     def getpayloadlength(self):
         """
@@ -962,7 +1415,7 @@ class SpectrumTZXPureDataBlock(SpectrumTapeBlock):
         details such as the length of a block, a flag, and a checksum.
         """
 
-        return len(self.data) - 2
+        return len(self._data) - 2
 
     def getpayload(self):
         """
@@ -971,7 +1424,16 @@ class SpectrumTZXPureDataBlock(SpectrumTapeBlock):
         Returns None if block doesn't have data in it.
         """
 
-        return self.data[1: -1]
+        return bytearray(self._data[1: -1])
+
+    def checksumisvalid(self):
+        """
+        Does the checksum at the end of the data in this block match the
+        data?  Returns True if it does, False if not, or None if this
+        block has no checksum.
+        """
+
+        return _getchecksum(self._data) == 0 if len(self._data) > 1 else None
 
     def getpayloadstartoffset(self):
         """
@@ -1007,7 +1469,17 @@ afterwards: {}ms".format(self.flag, self.getpayloadlength(), self.endPause)
             word_to_bytes(self.lenOnePulse, 2) + \
             word_to_bytes(self.lastByteUsedBits, 1) + \
             word_to_bytes(self.endPause, 2) + \
-            word_to_bytes(len(self.data), 3) + self.data
+            word_to_bytes(len(self._data), 3) + self._data
+
+    def getpulses(self):
+        """
+        Returns an iterator of the pulses that make the sound of the
+        data in this block, followed by it's pause.
+        """
+
+        return chain(_getdatapulses(self._data, self.lenZeroPulse,
+                                    self.lenOnePulse, self.lastByteUsedBits),
+                     _getpausepulses(self.endPause))
 
 
 class SpectrumTZXDirectRecordingBlock(SpectrumTapeBlock):
@@ -1016,6 +1488,8 @@ class SpectrumTZXDirectRecordingBlock(SpectrumTapeBlock):
     TZX file.  These can be used to extract data from a tzx file.
     """
 
+    sampleData = _PayloadAttribute()
+
     def __init__(self, TPerSample, lastByteUsedBits=8, endPause=0,
                  sampleData=[], filePosition=0, blockPosition=None):
         """
@@ -1065,7 +1539,7 @@ class SpectrumTZXDirectRecordingBlock(SpectrumTapeBlock):
         """Returns a basic String summary of the Block object."""
 
         return "TZX Direct Recording Block. Block length:{}, pause \
-afterwards:{}ms".format(len(self.sampleData), self.endPause)
+afterwards:{}ms".format(len(self._sampleData), self.endPause)
 
     def getpackagedforfile(self):
         """
@@ -1077,7 +1551,17 @@ afterwards:{}ms".format(len(self.sampleData), self.endPause)
             word_to_bytes(self.TPerSample, 2) + \
             word_to_bytes(self.endPause, 2) + \
             word_to_bytes(self.lastByteUsedBits, 1) + \
-            word_to_bytes(len(self.sampleData), 3) + self.sampleData
+            word_to_bytes(len(self._sampleData), 3) + self._sampleData
+
+    def getpulses(self):
+        """
+        Returns an iterator of the pulses that make the sound of the
+        samples in this block, followed by it's pause.
+        """
+
+        return chain(_getsamplepulses(self._sampleData, self.TPerSample,
+                                      self.lastByteUsedBits),
+                     _getpausepulses(self.endPause))
 
 
 class SpectrumTZXCSWRecording(SpectrumTapeBlock):
@@ -1086,6 +1570,8 @@ class SpectrumTZXCSWRecording(SpectrumTapeBlock):
     TZX file.  These can be used to extract data from a tzx file.
     """
 
+    CSWData = _PayloadAttribute()
+
     def __init__(self, sampleRate, compressionType, storedPulses, endPause=0,
                  CSWData=[], filePosition=0, blockPosition=None):
         """
@@ -1145,12 +1631,32 @@ afterwards:{}ms".format(self.storedPulses, self.endPause)
         """
 
         return bytearray([0x18]) + \
-            word_to_bytes(len(self.CSWData) + 10, 4) + \
+            word_to_bytes(len(self._CSWData) + 10, 4) + \
             word_to_bytes(self.endPause, 2) + \
-            word_to_bytes(self.sampleRate, 3) + \
+            word_to_bytes(self.samplesRate, 3) + \
             word_to_bytes(self.compressionType, 1) + \
             word_to_bytes(self.storedPulses, 4) + \
-            self.CSWData
+            self._CSWData
+
+    def getpulselengths(self):
+        """
+        Returns an iterator of the lengths in samples of the recorded
+        pulses.  The data is decompressed a chunk at a time as the
+        iterator is used, so the whole recording is never expanded at
+        once.  Raises IOError if the data is corrupt.
+        """
+
+        return _getcswpulselengths(self._CSWData, self.compressionType)
+
+    def getpulses(self):
+        """
+        Returns an iterator of the pulses recorded in this block,
+        followed by it's pause.
+        """
+
+        return chain(_getsamplelengthpulses(self.getpulselengths(),
+                                            self.samplesRate),
+                     _getpausepulses(self.endPause))
 
 
 class SpectrumTZXGeneralizedDataBlock(SpectrumTapeBlock):
@@ -1159,6 +1665,8 @@ class SpectrumTZXGeneralizedDataBlock(SpectrumTapeBlock):
     TZX file.  These can be used to extract data from a tzx file.
     """
 
+    dataStreamData = _PayloadAttribute()
+
     def __init__(self, symbolsInPilotBlock, pulsesPerPilotSymbol,
                  alphabetSizePilot, symbolsInDataBlock, pulsesPerDataSymbol,
                  alphabetSizeData, symbolDefinitionsPilot, dataStreamPilot,
@@ -1226,24 +1734,27 @@ afterwards:{}ms".format(self.symbolsInDataBlock, self.endPause)
         Will be returned as a bytearray.
         """
 
-        symdefasp = []
-        for symdef in self.symbolDefinitionsPilot:
-            symdefasp += [symdef[0]]
-            for w in symdef[1]:
-                symdefasp += word_to_bytes(w, 2)
+        # symbol tables are only there if they are used
+        symdefasp = bytearray()
+        prle = bytearray()
+        if self.symbolsInPilotBlock > 0:
+            for flags, pulses in self.symbolDefinitionsPilot:
+                symdefasp += bytes([flags])
+                for w in pulses:
+                    symdefasp += word_to_bytes(w, 2)
 
-        prle = []
-        for d in self.dataStreamPilot:
-            prle += [d[0]] + word_to_bytes(d[1], 2)
+            for symbol, count in self.dataStreamPilot:
+                prle += bytes([symbol]) + word_to_bytes(count, 2)
 
-        symdefasd = []
-        for symdef in self.symbolDefinitionsData:
-            symdefasp += [symdef[0]]
-            for w in symdef[1]:
-                symdefasp += word_to_bytes(w, 2)
+        symdefasd = bytearray()
+        if self.symbolsInDataBlock > 0:
+            for flags, pulses in self.symbolDefinitionsData:
+                symdefasd += bytes([flags])
+                for w in pulses:
+                    symdefasd += word_to_bytes(w, 2)
 
         lenstreams = len(symdefasp) + len(prle) + len(symdefasd) + \
-            len(self.dataStreamData)
+            len(self._dataStreamData)
 
         return bytearray([0x19]) + \
             word_to_bytes(lenstreams + 14, 4) + \
@@ -1254,7 +1765,142 @@ afterwards:{}ms".format(self.symbolsInDataBlock, self.endPause)
             word_to_bytes(self.symbolsInDataBlock, 4) + \
             word_to_bytes(self.pulsesPerDataSymbol, 1) + \
             word_to_bytes(self.alphabetSizeData, 1) + \
-            symdefasp + prle + symdefasd + self.dataStreamData
+            symdefasp + prle + symdefasd + self._dataStreamData
+
+    def getpilotsymbols(self):
+        """
+        Returns an iterator of the symbols in the pilot and sync part of
+        this block, with the repeats in dataStreamPilot expanded.
+        """
+
+        if self.symbolsInPilotBlock == 0:
+            return iter(())
+
+        return chain.from_iterable(repeat(symbol, count) for symbol, count in
+                                   self.dataStreamPilot)
+
+    def getdatasymbols(self):
+        """
+        Returns an iterator of the symbols in the data part of this
+        block, read from dataStreamData as it is used.
+        """
+
+        count = self.symbolsInDataBlock
+        bits = ceil(log2(self.alphabetSizeData or 256))
+        if bits == 0:
+            yield from repeat(0, count)
+            return
+
+        mask = (1 << bits) - 1
+        value = 0
+        valuebits = 0
+        for byte in self._dataStreamData:
+            value = (value << 8) | byte
+            valuebits += 8
+            while valuebits >= bits and count > 0:
+                valuebits -= bits
+                yield (value >> valuebits) & mask
+                count -= 1
+
+            if count == 0:
+                return
+
+            value &= (1 << valuebits) - 1
+
+    def getdecodeddata(self):
+        """
+        Returns the data in this block as bytes if it's data symbols are
+        one bit each, or None if not.  The symbol with the shorter
+        pulses is taken as the zero bit as the rom does.  For blocks
+        saved like the rom would, the first byte is the flag and the
+        last is the checksum.
+        """
+
+        if self.symbolsInDataBlock == 0 or self.alphabetSizeData != 2 or \
+           len(self.symbolDefinitionsData) != 2:
+            return None
+
+        data = bytes(self._dataStreamData[:(self.symbolsInDataBlock + 7) >> 3])
+        zero, one = [sum(takewhile(bool, pulses)) for flags, pulses in
+                     self.symbolDefinitionsData]
+        return data.translate(_INVERTBYTES) if zero > one else data
+
+    @property
+    def flag(self):
+        """The flag byte of the decoded data, or None if there isn't any."""
+
+        data = self.getdecodeddata()
+        return data[0] if data else None
+
+    def isheader(self):
+        """
+        Is this Block object probably a header block?
+        Header blocks come before the blocks holding the actual file
+        data and contain information such as the filename, the file
+        type, length, and other information depending on the file type.
+        Returns True if this is probably a header, or False if probably
+        not.
+        """
+
+        data = self.getdecodeddata()
+        return data is not None and len(data) == 19 and data[0] == 0
+
+    def isdatablock(self):
+        """
+        Is this Block object probably a data block?
+        Data blocks come after the Header blocks and contain the data
+        of a file.
+        Returns True if this is probably a data, or False if probably
+        not.
+        """
+
+        data = self.getdecodeddata()
+        return data is not None and len(data) > 1 and not self.isheader()
+
+    def getpayloadlength(self):
+        """
+        Returns the length of the data described by this block. Note
+        that the actual length of a block is longer as it often contains
+        details such as the length of a block, a flag, and a checksum.
+        """
+
+        data = self.getdecodeddata()
+        return 0 if data is None else max(len(data) - 2, 0)
+
+    def getpayload(self):
+        """
+        Returns the actual data that the block this describes would hold
+        (without flag or checksum) if it's data symbols are one bit each.
+        Returns None if block doesn't have data in it.
+        """
+
+        data = self.getdecodeddata()
+        return None if data is None else data[1:-1]
+
+    def checksumisvalid(self):
+        """
+        Does the checksum at the end of the decoded data in this block
+        match the data?  Returns True if it does, False if not, or None
+        if this block has no decoded data.
+        """
+
+        data = self.getdecodeddata()
+        if data is None or len(data) < 2:
+            return None
+
+        return _getchecksum(data) == 0
+
+    def getpulses(self):
+        """
+        Returns an iterator of the pulses of the pilot and sync symbols,
+        and the data symbols, in this block followed by it's pause.
+        """
+
+        return chain(_getsymbolpulses(self.getpilotsymbols(),
+                                      self.symbolDefinitionsPilot),
+                     _getsymbolpulses(self.getdatasymbols(),
+                                      self.symbolDefinitionsData),
+                     _getpausepulses(self.endPause))
 
 
 class SpectrumTZXPauseOrStopBlock(SpectrumTapeBlock):
@@ -1318,6 +1964,14 @@ class SpectrumTZXPauseOrStopBlock(SpectrumTapeBlock):
 
         return bytearray([0x20]) + word_to_bytes(self.pause, 2)
 
+    def getpulses(self):
+        """
+        Returns an iterator of the pulses of this pause.  Stopping the
+        tape makes no sound.
+        """
+
+        return _getpausepulses(self.pause)
+
 
 class SpectrumTZXGroupStartBlock(SpectrumTapeBlock):
     """
@@ -1857,6 +2511,13 @@ class SpectrumTZXSetSignalLevelBlock(SpectrumTapeBlock):
             word_to_bytes(1, 4) + \
             word_to_bytes(self.level, 1)
 
+    def getpulses(self):
+        """
+        Returns an iterator that sets the signal level.
+        """
+
+        return iter([(1 if self.level else 0, [])])
+
 
 class SpectrumTZXTextDescriptionBlock(SpectrumTapeBlock):
     """
@@ -2102,6 +2763,8 @@ class SpectrumTZXCustomInfoBlock(SpectrumTapeBlock):
     file.  These can be used to extract data from a tzx file.
     """
 
+    customInfo = _PayloadAttribute()
+
     def __init__(self, identification, customInfo, filePosition=0,
                  blockPosition=None):
         """
@@ -2136,7 +2799,7 @@ class SpectrumTZXCustomInfoBlock(SpectrumTapeBlock):
 
         return bytearray([0x35]) + \
             self.identification + \
-            word_to_bytes(len(self.customInfo), 4) + self.customInfo
+            word_to_bytes(len(self._customInfo), 4) + self._customInfo
 
 
 class SpectrumTZXHeaderBlock(SpectrumTapeBlock):
@@ -2185,22 +2848,60 @@ class SpectrumTapeSource():
     A class to abstract reading of Spectrum tape images.
     """
 
-    def __init__(self, source):
+    # struct formats to read words of 1, 2, and 4 bytes
+    _wordformats = {(1, False): struct.Struct("<B"),
+                    (2, False): struct.Struct("<H"),
+                    (4, False): struct.Struct("<I"),
+                    (1, True): struct.Struct("<b"),
+                    (2, True): struct.Struct("<h"),
+                    (4, True): struct.Struct("<i")}
+
+    def __init__(self, source, mapped=False):
         """
         Creates a new object that can be read from to abstract the
         differences between bytes and a file.
         source has to be a file object or a byte array or bytes, or list
-        or tupple of ints.
+        or tupple of ints.  It can also be a memoryview or mmap object
+        in which case the data of any blocks read are views into source
+        rather than copies.
+        mapped is True if you want a file object source to be memory
+        mapped, so that the data of any blocks read are views into the
+        mapped file rather than copies.  The file is mapped copy on
+        write, so changing block data will not change the file.
         position lists where in the source we curently are.
         """
         if not _sourceisvalid(source):
             raise spectrumtranslate.SpectrumTranslateError("source needs \
-to be a file, bytes, bytearray, or a list or tupple of ints.")
+to be a file, bytes, bytearray, memoryview, mmap, or a list or tupple of \
+ints.")
+
+        # map file if wanted
+        self._mappedview = None
+        if mapped and isinstance(source, IOBase):
+            source = self._mappedview = _mapfile(source)
+
+        if isinstance(source, (memoryview, mmap.mmap)):
+            source = memoryview(source).cast("B")
+            self.sourceType = 2
+        else:
+            self.sourceType = 1 if isinstance(source, IOBase) else 0
+
         self.source = source
-        self.sourceType = 1 if isinstance(source, IOBase) else 0
-        self.len = 0 if isinstance(source, IOBase) else len(source)
+        self.len = 0 if self.sourceType == 1 else len(source)
         self.position = 0
 
+    def close(self):
+        """
+        Lets go of any memory map of a file made by this object.  The
+        map is closed now if no blocks read from it still hold views
+        into it, otherwise it is closed once they have gone.
+        """
+
+        if self._mappedview is not None:
+            self.source.release()
+            _unmapfile(self._mappedview)
+            self._mappedview = None
+
     def getbytes(self, byteswanted):
         """Return up to byteswanted from the input source.
         Returns fewer bytes if fewer bytes left in source, and 0 if at
@@ -2230,8 +2931,11 @@ to be a file, bytes, bytearray, or a list or tupple of ints.")
         # handle other sources
         else:
             p = self.position
-            n = min(1, self.len - p)
-            b = self.source[p: p + n]
+            if p >= self.len:
+                return None
+
+            self.position += 1
+            return self.source[p]
 
         self.position += len(b)
         return b[0] if len(b) == 1 else None
@@ -2242,6 +2946,17 @@ to be a file, bytes, bytearray, or a list or tupple of ints.")
         in source.
         """
 
+        # read mapped words in place
+        if self.sourceType == 2 and (bytesize, signed) in self._wordformats:
+            p = self.position
+            if p + bytesize > self.len:
+                self.position = self.len
+                raise EOFError("Not Enough Bytes For Word")
+
+            self.position += bytesize
+            return self._wordformats[(bytesize, signed)].unpack_from(
+                self.source, p)[0]
+
         rawbytes = self.getbytes(bytesize)
         if len(rawbytes) < bytesize:
             raise EOFError("Not Enough Bytes For Word")
@@ -2249,11 +2964,14 @@ to be a file, bytes, bytearray, or a list or tupple of ints.")
         return int.from_bytes(rawbytes, 'little', signed=signed)
 
 
-def gettapblockfromsource(tapSource, block=0):
+def gettapblockfromsource(tapSource, block=0, checkchecksums=True):
     """
     Gets a TapBlock from the specified source.
     Returns None if have reached the end of a file.
     Raises IOError if any problems with file format.
+    If checkchecksums is False then a block whose checksum is wrong is
+    returned rather than raising an IOError, and it's checksumisvalid
+    method returns False.
     """
 
     tb = SpectrumTapBlock(filePosition=tapSource.position, blockPosition=block)
@@ -2279,21 +2997,20 @@ def gettapblockfromsource(tapSource, block=0):
 
     tb.flag = flagbyte[0]
 
-    tb.data = _validateandpreparebytes(tapSource.getbytes(blocklength))
-    if len(tb.data) != blocklength:
+    data = _validateandpreparebytes(tapSource.getbytes(blocklength))
+    if len(data) != blocklength:
         raise IOError("Malformed .tap File")
 
+    tb._setdata(data, False)
+
     # now do checksum
     checkbyte = _validateandpreparebytes(tapSource.getbytes(1))
     if len(checkbyte) != 1:
         raise IOError("Malformed .tap File")
 
     # ensure checksum is right
-    k = tb.flag
-    for i in tb.data:
-        k = k ^ i
-
-    if (k & 255) != checkbyte[0]:
+    tb.storedChecksum = checkbyte[0]
+    if checkchecksums and not tb.checksumisvalid():
         raise IOError("Malformed .tap File")
 
     return tb
@@ -2400,17 +3117,21 @@ def gettzxblockfromsource(tzxsource, block=0):
             def _X(x):
                 return [tzxsource.getword(2) for _ in range(x)]
 
+            # symbol tables are only there if they are used, and an
+            # alphabet size of 0 means 256
             symbolDefinitionsPilot = [
                 (tzxsource.getword(1), _X(pulsesPerPilotSymbol))
-                for _ in range(alphabetSizePilot)]
+                for _ in range(alphabetSizePilot or 256)
+            ] if symbolsInPilotBlock > 0 else []
             dataStreamPilot = [
                 (tzxsource.getword(1), tzxsource.getword(2))
                 for _ in range(symbolsInPilotBlock)]
             symbolDefinitionsData = [
                 (tzxsource.getword(1), _X(pulsesPerDataSymbol))
-                for _ in range(alphabetSizeData)]
+                for _ in range(alphabetSizeData or 256)
+            ] if symbolsInDataBlock > 0 else []
             datastreamsize = ceil(
-                ceil(log2(alphabetSizeData)) * symbolsInDataBlock / 8)
+                ceil(log2(alphabetSizeData or 256)) * symbolsInDataBlock / 8)
             dataStreamData = tzxsource.getbytes(datastreamsize)
             if len(dataStreamData) != datastreamsize:
                 raise IOError("Corrupt TZX Generalized Data Block")
@@ -2434,7 +3155,7 @@ def gettzxblockfromsource(tzxsource, block=0):
                                                block)
         elif blockid == 0x21:
             namelen = tzxsource.getword(1)
-            name = tzxsource.getbytes(namelen)
+            name = bytes(tzxsource.getbytes(namelen))
             if len(name) < namelen:
                 raise IOError("Corrupt TZX Group Start Block")
             return SpectrumTZXGroupStartBlock(name, position, block)
@@ -2459,7 +3180,7 @@ def gettzxblockfromsource(tzxsource, block=0):
             blocklen = tzxsource.getword(2)
             n = tzxsource.getword(1)
             selectoptions = [(tzxsource.getword(2, True),
-                             tzxsource.getbytes(tzxsource.getword(1)))
+                             bytes(tzxsource.getbytes(tzxsource.getword(1))))
                              for _ in range(n)]
             if tzxsource.position != position + 3 + blocklen:
                 raise IOError("Corrupt TZX Select Block")
@@ -2467,7 +3188,7 @@ def gettzxblockfromsource(tzxsource, block=0):
         elif blockid == 0x2A:
             blocklen = tzxsource.getword(4)
             if blocklen > 0:
-                tzxsource.getbytes(l)
+                tzxsource.getbytes(blocklen)
             return SpectrumTZXStopTapeIf48KBlock(position, block)
         elif blockid == 0x2B:
             blocklength = tzxsource.getword(4)
@@ -2477,7 +3198,7 @@ def gettzxblockfromsource(tzxsource, block=0):
             return SpectrumTZXSetSignalLevelBlock(level, position, block)
         elif blockid == 0x30:
             descriptionlen = tzxsource.getword(1)
-            description = tzxsource.getbytes(descriptionlen)
+            description = bytes(tzxsource.getbytes(descriptionlen))
             if len(description) < descriptionlen:
                 raise IOError("Corrupt TZX Text Description Block")
             return SpectrumTZXTextDescriptionBlock(description, position,
@@ -2485,7 +3206,7 @@ def gettzxblockfromsource(tzxsource, block=0):
         elif blockid == 0x31:
             duration = tzxsource.getword(1)
             messagelen = tzxsource.getword(1)
-            message = tzxsource.getbytes(messagelen)
+            message = bytes(tzxsource.getbytes(messagelen))
             if len(message) < messagelen:
                 raise IOError("Corrupt Message Block")
             return SpectrumTZXMessageBlock(message, duration, position, block)
@@ -2494,7 +3215,7 @@ def gettzxblockfromsource(tzxsource, block=0):
             n = tzxsource.getword(1)
             archiveInfoEntries = [
                 (tzxsource.getword(1),
-                 tzxsource.getbytes(tzxsource.getword(1)))
+                 bytes(tzxsource.getbytes(tzxsource.getword(1))))
                 for _ in range(n)]
             if tzxsource.position != position + 3 + blocklen:
                 raise IOError("Corrupt TZX Archive Info Block")
@@ -2503,9 +3224,10 @@ def gettzxblockfromsource(tzxsource, block=0):
         elif blockid == 0x33:
             n = tzxsource.getword(1)
             return SpectrumTZXHardwareTypeBlock(
-                [tzxsource.getbytes(3) for _ in range(n)], position, block)
+                [bytes(tzxsource.getbytes(3)) for _ in range(n)], position,
+                block)
         elif blockid == 0x35:
-            identification = tzxsource.getbytes(10)
+            identification = bytes(tzxsource.getbytes(10))
             if len(identification) < 10:
                 raise IOError("Corrupt TZX Custom Info Block")
             n = tzxsource.getword(4)
@@ -2516,8 +3238,8 @@ def gettzxblockfromsource(tzxsource, block=0):
             if tzxsource.getbytes(7) != b'XTape!\x1a':
                 raise IOError("Corrupt TZX Header Block" if block == 0 else
                               "Corrupt TZX Glue Block")
-            return SpectrumTZXHeaderBlock(tzxsource.getbytes(1),
-                                          tzxsource.getbytes(1),
+            return SpectrumTZXHeaderBlock(tzxsource.getword(1),
+                                          tzxsource.getword(1),
                                           position, block)
         else:
             raise IOError(
@@ -2551,12 +3273,16 @@ def gettzxblockfromsource(tzxsource, block=0):
         raise IOError(idmessages[blockid])
 
 
-def nexttapblock(source):
+def nexttapblock(source, mapped=False, checkchecksums=True):
     """
     Generator function that will supply SpectrumTapBlock objects from a
     tap file.
-    source can be a file object, a bytearray, a bytes object, or a list
-    or tuple of ints.
+    source can be a file object, a bytearray, a bytes object, a
+    memoryview, a mmap object, or a list or tuple of ints.
+    mapped is True if you want a file object source to be memory mapped
+    so that block data are views into the file rather than copies.
+    checkchecksums is False if you want blocks with a wrong checksum to
+    be supplied rather than raising an IOError.
 
     example:
     with open('RebelStar.tap', 'rb') as f:
@@ -2564,23 +3290,28 @@ def nexttapblock(source):
             do_stuff_with(tb)
     """
 
-    source = SpectrumTapeSource(source)
+    source = SpectrumTapeSource(source, mapped)
     block = 0
-    while True:
-        tb = gettapblockfromsource(source, block)
-        if tb:
-            block += 1
-            yield tb
-        else:
-            break
+    try:
+        while True:
+            tb = gettapblockfromsource(source, block, checkchecksums)
+            if tb:
+                block += 1
+                yield tb
+            else:
+                break
+    finally:
+        source.close()
 
 
-def nexttzxblock(source):
+def nexttzxblock(source, mapped=False):
     """
     Generator function that will supply SpectrumTzx* objects from a
     tzx file.
-    source can be a file object, a bytearray, a bytes object, or a list
-    or tuple of ints.
+    source can be a file object, a bytearray, a bytes object, a
+    memoryview, a mmap object, or a list or tuple of ints.
+    mapped is True if you want a file object source to be memory mapped
+    so that block data are views into the file rather than copies.
 
     example:
     with open('RebelStar.tzx', 'rb') as f:
@@ -2588,15 +3319,18 @@ def nexttzxblock(source):
             do_stuff_with(tb)
     """
 
-    source = SpectrumTapeSource(source)
+    source = SpectrumTapeSource(source, mapped)
     block = 0
-    while True:
-        tb = gettzxblockfromsource(source, block)
-        if tb:
-            block += 1
-            yield tb
-        else:
-            break
+    try:
+        while True:
+            tb = gettzxblockfromsource(source, block)
+            if tb:
+                block += 1
+                yield tb
+            else:
+                break
+    finally:
+        source.close()
 
 
 def convertblockformat(block, formatwanted):
@@ -2613,13 +3347,9 @@ recognised or supported tape file format.".format(formatwanted))
             return block
         # convert to Tzx
 
-        # work out checksum
-        checksum = block.flag
-        for i in block.data:
-            checksum = checksum ^ i
-
         # merge it into a list
-        data = bytearray([block.flag]) + block.data + bytearray([checksum])
+        checksum = block.getchecksum()
+        data = bytearray([block.flag]) + block._data + bytearray([checksum])
 
         return SpectrumTZXStandardSpeedDataBlock(
             endPause=1000, data=data, blockPosition=block.blockPosition)
@@ -2636,33 +3366,898 @@ convert {} Block to Tap format.".format(block.blocktype()))
                             blockPosition=block.blockPosition)
 
 
-def getfiletypeandblocksfromsource(source):
+# signature at the start of tzx files
+_TZXSIGNATURE = b"ZXTape!\x1a"
+# number of tap blocks checked before deciding in quick detection
+_QUICKDETECTBLOCKS = 4
+
+
+def detecttapefiletype(source, quick=False, checkchecksums=True):
+    """
+    Works out if source holds a tzx or tap file without parsing it.
+    tzx files are recognised by the signature at their start.  For tap
+    files the chain of block lengths has to end exactly at the end of
+    the source, and the checksum of the first block has to be right
+    unless checkchecksums is False.
+    Junk is rejected as soon as a block length doesn't fit.
+    source is a file object, bytes, bytearray, memoryview, mmap, or
+    list of ints.  File objects need to be seekable, and are read from
+    their current position which is restored afterwards.
+    quick is True if you only want the first few tap blocks to be
+    checked, which is faster for large files but less certain.
+    Returns "Tzx", "Tap", or "unknown".
+    """
+
+    if isinstance(source, IOBase):
+        start = source.tell()
+        size = source.seek(0, 2) - start
+
+        def read(position, length):
+            source.seek(start + position)
+            return source.read(length)
+
+    else:
+        if _isarray(source):
+            source = bytes(source)
+
+        view = memoryview(source).cast("B")
+        size = len(view)
+
+        def read(position, length):
+            return view[position:position + length]
+
+    try:
+        if read(0, 8) == _TZXSIGNATURE:
+            return "Tzx"
+
+        # follow chain of tap block lengths
+        position = 0
+        blocks = 0
+        while position < size:
+            if position + 2 > size:
+                return "unknown"
+
+            length = _get_word(read(position, 2))
+            if length < 2 or position + 2 + length > size:
+                return "unknown"
+
+            # flag, data, and checksum xor to 0 in a valid block
+            if checkchecksums and blocks == 0 and \
+               _getchecksum(read(position + 2, length)) != 0:
+                return "unknown"
+
+            blocks += 1
+            position += 2 + length
+            if quick and blocks == _QUICKDETECTBLOCKS:
+                break
+
+        return "Tap" if blocks > 0 else "unknown"
+
+    finally:
+        if isinstance(source, IOBase):
+            source.seek(start)
+
+
+def getfiletypeandblockiteratorfromsource(source, quick=False,
+                                          checkchecksums=True):
+    """
+    Returns a tuple detailing the file type ("Tap", "Tzx", or "unknown")
+    as the first element, and an iterator of the blocks as the second.
+    The file type is found by detecttapefiletype, and the blocks are
+    only parsed as they are iterated over, so may raise IOError if the
+    source turns out to be corrupt.
+    source, quick, and checkchecksums are the same as for
+    detecttapefiletype, and checkchecksums is also passed to
+    nexttapblock.
+    """
+
+    filetype = detecttapefiletype(source, quick, checkchecksums)
+    if filetype == "Tzx":
+        return (filetype, nexttzxblock(source))
+
+    if filetype == "Tap":
+        return (filetype, nexttapblock(source, checkchecksums=checkchecksums))
+
+    return (filetype, iter([]))
+
+
+def getfiletypeandblocksfromsource(source, mapped=False):
     """
-    Returns a tuple detailing the file type ("tap", "tzx", or "unknown")
+    Returns a tuple detailing the file type ("Tap", "Tzx", or "unknown")
     as the first element, and a list of all the blocks as the second.
-    source is a file, bytes, bytearray, or list of ints.
+    The file type is found by detecttapefiletype so the source is only
+    parsed once.
+    source is a file, bytes, bytearray, memoryview, mmap, or list of
+    ints.
+    mapped is True if you want a file source to be memory mapped rather
+    than read so that block data are views into the file.
     """
 
+    mappedview = None
     if isinstance(source, IOBase):
-        source = bytearray(source.read())
+        if mapped:
+            source = mappedview = _mapfile(source)
+        else:
+            source = bytearray(source.read())
 
+    filetype, blocks = getfiletypeandblockiteratorfromsource(source)
     try:
-        tbs = [*nexttzxblock(source)]
+        tbs = [*blocks]
         if len(tbs) > 0:
-            return ('Tzx', tbs)
-    except IOError:
+            return (filetype, tbs)
+    except (IOError, EOFError):
         pass
+    finally:
+        if mappedview is not None:
+            blocks = None
+            _unmapfile(mappedview)
+
+    return ('unknown', [])
+
+
+# payload blocks bigger than this are not read when scanning tape files
+_SCANPAYLOADLIMIT = 256
+# number of bytes at the start of a skipped payload that are remembered
+_SCANHEADLENGTH = 20
+# tzx blocks whose payload can be skipped when scanning.  For each block
+# ID this holds the length of the fixed part of the block before the
+# payload, the offset and size of the length in the fixed part, what to
+# subtract from the length to get the payload length, and the name of
+# the attribute holding the payload
+_SCANTZXPAYLOADBLOCKS = {0x10: (4, 2, 2, 0, "data"),
+                         0x11: (18, 15, 3, 0, "data"),
+                         0x14: (10, 7, 3, 0, "data"),
+                         0x15: (8, 5, 3, 0, "sampleData"),
+                         0x18: (14, 0, 4, 10, "CSWData")}
+
+
+class _LazyTapeData():
+    # stands in for the payload of a block that hasn't been loaded yet.
+    # The length and first few bytes are known, anything else loads the
+    # payload
+
+    def __init__(self, length, head, loader):
+        self.length = length
+        self.head = head
+        self.loader = loader
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, i):
+        if isinstance(i, int) and 0 <= i < len(self.head):
+            return self.head[i]
+
+        return self.loader()[i]
+
+    def __iter__(self):
+        return iter(self.loader())
+
+
+class SpectrumTapeBlockProxy():
+    """
+    A class that stands in for a block of a tap or tzx file that has
+    been found by scantapblocks or scantzxblocks.  Listing methods and
+    attributes use the details found when the file was scanned.
+    Accessing the payload of the block, or any other method, loads the
+    whole block from the source the first time it is needed and then
+    uses that block.
+    """
+
+    # methods that can be answered without loading the payload
+    _LISTINGMETHODS = frozenset(["blocktype", "isheader", "isdatablock",
+                                 "getblockinfo", "getdetailslist",
+                                 "getpayloadlength", "getpayloadstartoffset",
+                                 "getfilename", "getrawfilename",
+                                 "getfiletypestring"])
+
+    def __init__(self, blockid, filePosition, blockLength, blockPosition,
+                 block, payloadname, source):
+        """
+        Creates a new SpectrumTapeBlockProxy.  blockid is the tzx block
+        ID, or None for a tap block.  filePosition is the offset to the
+        block in source, and blockLength is the length of the block in
+        bytes.  block is the block as far as it has been read, and
+        payloadname is the name of it's payload attribute if the
+        payload hasn't been loaded, or None if block is complete.
+        source is the file object, or bytes like object the block is in.
+        """
+
+        self.blockid = blockid
+        self.filePosition = filePosition
+        self.blockLength = blockLength
+        self.blockPosition = blockPosition
+        self._summary = block
+        self._payloadname = payloadname
+        self._block = block if payloadname is None else None
+        self._source = source
+
+    def isloaded(self):
+        """Returns True if the whole block has been loaded."""
+
+        return self._block is not None
+
+    def getblock(self):
+        """
+        Returns the SpectrumTapeBlock this stands in for, loading it
+        from the source if needed.  If the source was a file that has
+        since been closed, it is reopened by name.
+        """
+
+        if self._block is not None:
+            return self._block
+
+        source = self._source
+        if isinstance(source, IOBase):
+            if source.closed:
+                with open(source.name, 'rb') as f:
+                    f.seek(self.filePosition)
+                    data = f.read(self.blockLength)
+            else:
+                position = source.tell()
+                source.seek(self.filePosition)
+                data = source.read(self.blockLength)
+                source.seek(position)
+        else:
+            data = source[self.filePosition:
+                          self.filePosition + self.blockLength]
+
+        if len(data) != self.blockLength:
+            raise IOError("Tape file has changed since it was scanned")
+
+        tapesource = SpectrumTapeSource(data)
+        if self.blockid is None:
+            block = gettapblockfromsource(tapesource, self.blockPosition)
+        else:
+            block = gettzxblockfromsource(tapesource, self.blockPosition)
+
+        block.filePosition = self.filePosition
+        self._block = block
+        return block
+
+    def _getpayload(self):
+        return getattr(self.getblock(), self._payloadname)
+
+    def __getattr__(self, name):
+        # only called for attributes not in this object
+        if self._block is None:
+            if name in self._LISTINGMETHODS:
+                return getattr(self._summary, name)
+
+            value = self._summary.__dict__.get(name)
+            if value is not None and not isinstance(value, _LazyTapeData):
+                return value
+
+        return getattr(self.getblock(), name)
+
+    def __str__(self):
+        """Returns a basic String summary of the Block object."""
+
+        return str(self._summary if self._block is None else self._block)
+
+
+def _scanblocks(source, scanner):
+    # handles different types of source for scanning
+    if isinstance(source, IOBase):
+        start = source.tell()
+        size = source.seek(0, 2) - start
+        source.seek(start)
+    else:
+        if not _bytesarevalid(source) and not isinstance(source, mmap.mmap):
+            raise spectrumtranslate.SpectrumTranslateError("source needs \
+to be a file, bytes, bytearray, memoryview, mmap, or a list or tupple of \
+ints.")
+        if _isarray(source):
+            source = bytes(source)
+        start = 0
+        size = len(source)
+
+    tapesource = SpectrumTapeSource(source if isinstance(source, IOBase)
+                                    else memoryview(source).cast("B"))
+
+    def skip(n):
+        # skip n bytes of the source
+        if tapesource.position + n > size:
+            raise IOError("Malformed Tape File")
+
+        if tapesource.sourceType == 1:
+            source.seek(n, 1)
+
+        tapesource.position += n
 
+    block = 0
+    while tapesource.position < size:
+        yield scanner(tapesource, block, start, skip, source)
+        block += 1
+
+
+def _scantapblock(tapesource, block, start, skip, source):
+    # scans a tap block
+    position = tapesource.position
+    blocklength = tapesource.getword(2)
+    if blocklength < 2:
+        raise IOError("Malformed .tap File")
+
+    # read small blocks fully
+    if blocklength - 2 <= _SCANPAYLOADLIMIT:
+        data = tapesource.getbytes(blocklength)
+        if len(data) != blocklength:
+            raise IOError("Malformed .tap File")
+
+        tb = gettapblockfromsource(SpectrumTapeSource(
+            bytes(word_to_bytes(blocklength, 2)) + bytes(data)), block)
+        tb.filePosition = start + position
+        return SpectrumTapeBlockProxy(None, start + position,
+                                      blocklength + 2, block, tb, None,
+                                      source)
+
+    # remember flag and start of data, and skip the rest
+    head = bytes(tapesource.getbytes(_SCANHEADLENGTH + 1))
+    skip(blocklength - _SCANHEADLENGTH - 1)
+    tb = SpectrumTapBlock(head[0], filePosition=start + position,
+                          blockPosition=block)
+    proxy = SpectrumTapeBlockProxy(None, start + position, blocklength + 2,
+                                   block, tb, "data", source)
+    tb.data = _LazyTapeData(blocklength - 2, head[1:], proxy._getpayload)
+    return proxy
+
+
+def _scantzxblock(tapesource, block, start, skip, source):
+    # scans a tzx block
+    position = tapesource.position
+    blockid = tapesource.getbyte()
+
+    details = _SCANTZXPAYLOADBLOCKS.get(blockid)
+    if details is not None:
+        fixedlength, lengthoffset, lengthsize, adjust, name = details
+        fixed = bytearray(tapesource.getbytes(fixedlength))
+        if len(fixed) != fixedlength:
+            raise IOError("Corrupt TZX file")
+
+        payloadlength = _get_word(
+            fixed[lengthoffset:lengthoffset + lengthsize]) - adjust
+
+        # skip large payloads
+        if payloadlength > _SCANPAYLOADLIMIT:
+            head = bytes(tapesource.getbytes(_SCANHEADLENGTH))
+            skip(payloadlength - _SCANHEADLENGTH)
+
+            # make block with start of payload
+            fixed[lengthoffset:lengthoffset + lengthsize] = word_to_bytes(
+                _SCANHEADLENGTH + adjust, lengthsize)
+            tb = gettzxblockfromsource(SpectrumTapeSource(
+                bytes([blockid]) + fixed + head), block)
+            tb.filePosition = start + position
+            proxy = SpectrumTapeBlockProxy(
+                blockid, start + position, 1 + fixedlength + payloadlength,
+                block, tb, name, source)
+            setattr(tb, name, _LazyTapeData(payloadlength, head,
+                                            proxy._getpayload))
+            return proxy
+
+    # otherwise read whole block
+    tapesource.position = position
+    if tapesource.sourceType == 1:
+        source.seek(start + position)
+
+    tb = gettzxblockfromsource(tapesource, block)
+    if tb is None:
+        raise IOError("Corrupt TZX file")
+
+    tb.filePosition = start + position
+    return SpectrumTapeBlockProxy(blockid, start + position,
+                                  tapesource.position - position, block, tb,
+                                  None, source)
+
+
+def scantapblocks(source):
+    """
+    Generator function that scans a tap file and supplies a
+    SpectrumTapeBlockProxy for each block.  Only the start of large
+    blocks is read, the rest is skipped, and is only loaded if it is
+    needed.  This makes listing large files fast, but also means that
+    the checksums of large blocks are not checked until they are loaded.
+    source can be a file object, a bytearray, a bytes object, a
+    memoryview, a mmap object, or a list or tuple of ints.  If source is
+    a file object, it needs to be seekable, and scanning starts from the
+    current position in the file.  Raises IOError if the file is not a
+    valid tap file.
+    """
+
+    return _scanblocks(source, _scantapblock)
+
+
+def scantzxblocks(source):
+    """
+    Generator function that scans a tzx file and supplies a
+    SpectrumTapeBlockProxy for each block.  Only the start of large data
+    blocks is read, the rest is skipped, and is only loaded if it is
+    needed.  This makes listing large files fast.
+    source is the same as for scantapblocks.  Raises IOError if the file
+    is not a valid tzx file.
+    """
+
+    return _scanblocks(source, _scantzxblock)
+
+
+def getfiletypeandblockindexfromsource(source):
+    """
+    Returns a tuple detailing the file type ("Tap", "Tzx", or "unknown")
+    as the first element, and a list of SpectrumTapeBlockProxy objects
+    for all the blocks as the second.  The file is scanned rather than
+    read so large blocks are not loaded unless they are needed.
+    source is the same as for scantapblocks.
+    """
+
+    filetype = detecttapefiletype(source)
     try:
-        tbs = [*nexttapblock(source)]
-        if len(tbs) > 0:
-            return ('Tap', tbs)
-    except IOError:
+        if filetype == "Tzx":
+            return (filetype, [*scantzxblocks(source)])
+
+        if filetype == "Tap":
+            return (filetype, [*scantapblocks(source)])
+    except (IOError, EOFError):
         pass
 
     return ('unknown', [])
 
 
+# the sample values for low and high signal levels in 8 bit wav files
+_WAVLEVELS = (0x40, 0xC0)
+
+
+def _expandtapeloops(blocks):
+    # yields blocks with the blocks inside loops repeated
+    loop = None
+    for block in blocks:
+        if isinstance(block, SpectrumTZXLoopStartBlock) and loop is None:
+            loop = []
+            repetitions = block.repetitions
+
+        elif isinstance(block, SpectrumTZXLoopEndBlock) and loop is not None:
+            for i in range(repetitions):
+                yield from loop
+
+            loop = None
+
+        elif loop is not None:
+            loop.append(block)
+
+        else:
+            yield block
+
+    # play an unfinished loop once
+    if loop is not None:
+        yield from loop
+
+
+def gettapeaudiosamples(blocks, samplerate=44100):
+    """
+    A generator function that plays the tape blocks in blocks (such as
+    from nexttapblock, nexttzxblock, or a list of blocks), and yields
+    the sound as bytes objects of 8 bit unsigned mono samples at
+    samplerate samples per second.  Blocks are played one chunk of
+    pulses at a time so long tapes need little memory.  Loops in tzx
+    files are repeated, but jumps, calls and selections are ignored.
+    """
+
+    if not isinstance(samplerate, int) or samplerate < 1:
+        raise spectrumtranslate.SpectrumTranslateError(
+            "samplerate needs to be a positive whole number.")
+
+    levelbytes = (bytes([_WAVLEVELS[0]]), bytes([_WAVLEVELS[1]]))
+    # tapes start low
+    level = 0
+    # T states played, and samples made so far
+    tstates = 0
+    written = 0
+    for block in _expandtapeloops(blocks):
+        for firstlevel, pulses in block.getpulses():
+            level = 1 - level if firstlevel is None else firstlevel
+            if len(pulses) == 0:
+                continue
+
+            # work out which sample each pulse ends on, and how many
+            # samples each pulse lasts
+            if numpy is not None:
+                ends = numpy.cumsum(numpy.asarray(pulses, numpy.int64))
+                ends += tstates
+                edges = ends * samplerate // _TSTATESPERSECOND
+                runs = numpy.diff(edges, prepend=written)
+                levels = numpy.empty(len(runs), numpy.uint8)
+                levels[0::2] = _WAVLEVELS[level]
+                levels[1::2] = _WAVLEVELS[1 - level]
+                samples = numpy.repeat(levels, runs).tobytes()
+                tstates = int(ends[-1])
+                written = int(edges[-1])
+
+            else:
+                edges = [t * samplerate // _TSTATESPERSECOND for t in
+                         accumulate(pulses, initial=tstates)]
+                samples = b"".join(map(bytes.__mul__, cycle(
+                    (levelbytes[level], levelbytes[1 - level])), [
+                    b - a for a, b in zip([written] + edges[1:], edges[1:])]))
+                tstates += sum(pulses)
+                written = edges[-1]
+
+            # level of last pulse
+            level ^= (len(pulses) - 1) & 1
+            if len(samples) > 0:
+                yield samples
+
+
+def _getwavheader(samplerate, length):
+    # returns the header of an 8 bit mono PCM wav file of length samples.
+    # lengths too big for a wav file are left at the largest possible
+    length = min(length, 0xFFFFFFD8)
+    return struct.pack("<4sI4s4sIHHIIHH4sI", b"RIFF", length + 36 +
+                       (length & 1), b"WAVE", b"fmt ", 16, 1, 1, samplerate,
+                       samplerate, 1, 8, b"data", length)
+
+
+def writetapewav(blocks, f, samplerate=44100):
+    """
+    Plays the tape blocks in blocks as gettapeaudiosamples does, and
+    writes the sound to the file object f as an 8 bit mono PCM wav file
+    with samplerate samples per second.  Samples are written as they are
+    made.  If f can seek, the lengths in the wav header are filled in at
+    the end, otherwise (or if there are too many samples for a wav file)
+    they are left as the largest possible as is usual for streamed wav
+    files.  Returns the number of samples written.
+    """
+
+    seekable = hasattr(f, "seekable") and f.seekable()
+    if seekable:
+        start = f.tell()
+
+    f.write(_getwavheader(samplerate, 0 if seekable else 0xFFFFFFFF))
+    length = 0
+    for samples in gettapeaudiosamples(blocks, samplerate):
+        f.write(samples)
+        length += len(samples)
+
+    if seekable:
+        # data chunks have to be an even length
+        if length & 1:
+            f.write(b"\x00")
+
+        end = f.tell()
+        f.seek(start)
+        f.write(_getwavheader(samplerate, length))
+        f.seek(end)
+
+    return length
+
+
+# how far either side of the middle a wav file's samples have to go, as
+# a fraction of full volume, to count as a change of level
+_WAVHYSTERESIS = 0.05
+
+# frames of a wav file read at a time
+_WAVCHUNKFRAMES = 65536
+
+# the fewest similar pulses that count as a pilot tone, how far from
+# their average they can be, and the shortest pilot pulse in T states
+_PILOTMINPULSES = 256
+_PILOTTOLERANCE = 0.2
+_PILOTMINLENGTH = 200
+
+# the number of data pulses used to work out how long zero and one bits
+# are
+_DATASAMPLEPULSES = 128
+
+# up to this many runs of samples between blocks are taken as a pause
+_PAUSEMAXRUNS = 8
+
+# runs of samples kept before they are made into a direct recording
+_WAVRECORDINGRUNS = 65536
+
+
+def _getwavruns(wav, hysteresis):
+    # yields the level and length in samples of each run of samples at
+    # the same level in the first channel of the wave.Wave_read wav.
+    # Samples have to pass hysteresis either side of the middle to
+    # change level
+    width = wav.getsampwidth()
+    channels = wav.getnchannels()
+    centre = 128 if width == 1 else 0
+    threshold = int(hysteresis * (128 if width == 1 else 32768))
+    level = 0
+    run = 0
+    while True:
+        frames = wav.readframes(_WAVCHUNKFRAMES)
+        if len(frames) == 0:
+            break
+
+        if numpy is not None:
+            samples = numpy.frombuffer(frames, numpy.uint8 if width == 1
+                                       else numpy.dtype('<i2'))[::channels]
+            samples = samples.astype(numpy.int32) - centre
+            # carry the level of the last sample past the threshold
+            # forward through samples that are inside the threshold
+            index = numpy.where(numpy.abs(samples) > threshold,
+                                numpy.arange(len(samples)), -1)
+            numpy.maximum.accumulate(index, out=index)
+            levels = numpy.where(index < 0, level, samples[index] > 0)
+            changes = numpy.flatnonzero(levels[1:] != levels[:-1]) + 1
+            if levels[0] != level:
+                changes = numpy.concatenate(([0], changes))
+
+            if len(changes) > 0:
+                for length in numpy.diff(changes, prepend=-run).tolist():
+                    if length > 0:
+                        yield level, length
+
+                    level ^= 1
+
+                run = len(samples) - int(changes[-1])
+
+            else:
+                run += len(samples)
+
+            continue
+
+        if width == 1:
+            samples = frames[::channels]
+        else:
+            samples = array('h', frames)
+            if sys.byteorder == 'big':
+                samples.byteswap()
+
+            samples = samples[::channels]
+
+        for sample in samples:
+            sample -= centre
+            if (sample > threshold and level == 0) or \
+               (sample < -threshold and level == 1):
+                if run > 0:
+                    yield level, run
+
+                level ^= 1
+                run = 0
+
+            run += 1
+
+    if run > 0:
+        yield level, run
+
+
+def _getrecordingblock(runs, samplerate):
+    # returns a direct recording block of the runs of samples
+    bits = "".join(("1" if level else "0") * length for level, length in runs)
+    lastbits = len(bits) & 7
+    bits += "0" * (-len(bits) & 7)
+    return SpectrumTZXDirectRecordingBlock(
+        round(_TSTATESPERSECOND / samplerate), lastbits if lastbits else 8, 0,
+        int(bits, 2).to_bytes(len(bits) >> 3, 'big'))
+
+
+def _getdatathreshold(lengths, pilot):
+    # works out the length in T states of a pair of pulses between
+    # those for a zero bit and those for a one bit.  If only one sort of
+    # bit has been seen, the pilot pulse length tells which it is as the
+    # rom's zero bits are shorter than two pilot pulses, and it's one
+    # bits longer
+    pairs = [lengths[i] + lengths[i + 1] for i in range(0, len(lengths) - 1,
+                                                        2)]
+    shortest = min(pairs)
+    longest = max(pairs)
+    if longest > shortest * 1.4:
+        return (shortest + longest) / 2
+
+    return shortest * 1.5 if shortest < pilot * 1.2 else shortest * 0.75
+
+
+def _getwavdatablock(pilot, pilotcount, sync1, sync2, lengths, threshold):
+    # returns a standard or turbo speed data block for data pulses in T
+    # states, or None if there is less than a byte
+    bits = [lengths[i] + lengths[i + 1] > threshold
+            for i in range(0, len(lengths), 2)]
+    if len(bits) < 8:
+        return None
+
+    zeros = [lengths[i] + lengths[i + 1] for i in range(0, len(lengths), 2)
+             if not bits[i >> 1]]
+    ones = [lengths[i] + lengths[i + 1] for i in range(0, len(lengths), 2)
+            if bits[i >> 1]]
+    zero = sum(zeros) / len(zeros) / 2 if zeros else sum(ones) / len(ones) / 4
+    one = sum(ones) / len(ones) / 2 if ones else zero * 2
+
+    lastbits = len(bits) & 7
+    bits += [False] * (-len(bits) & 7)
+    data = int("".join("1" if bit else "0" for bit in bits), 2).to_bytes(
+        len(bits) >> 3, 'big')
+
+    def isrom(length, romlength, tolerance):
+        return abs(length - romlength) <= romlength * tolerance
+
+    # use a standard speed block if it looks like the rom saved it
+    if lastbits == 0 and isrom(pilot, 2168, 0.1) and \
+       isrom(sync1, 667, 0.25) and isrom(sync2, 735, 0.25) and \
+       isrom(zero, 855, 0.15) and isrom(one, 1710, 0.15) and \
+       len(data) > 1 and _getchecksum(data) == 0:
+        return SpectrumTZXStandardSpeedDataBlock(0, data)
+
+    return SpectrumTZXTurboSpeedDataBlock(
+        0, data, round(pilot), round(sync1), round(sync2), round(zero),
+        round(one), pilotcount, lastbits if lastbits else 8)
+
+
+def getblocksfromwav(f, hysteresis=_WAVHYSTERESIS):
+    """
+    Reads a recording of a tape from the wav file f (a file name or
+    file object) and returns an iterator of the tzx blocks it holds.
+    Data saved with a pilot tone and sync pulses is made into
+    SpectrumTZXStandardSpeedDataBlock objects if it matches the rom's
+    timings and checksum, or SpectrumTZXTurboSpeedDataBlock objects
+    otherwise.  Quiet gaps become the pause after the block before, or
+    SpectrumTZXPauseOrStopBlock objects, and anything else that can't be
+    decoded becomes SpectrumTZXDirectRecordingBlock objects.  The wav
+    file is read a chunk at a time so long recordings need little
+    memory.  8 and 16 bit wav files are supported, and only the first
+    channel is used.  hysteresis is how far either side of the middle,
+    as a fraction of full volume, the signal has to go to change level.
+    """
+
+    try:
+        wav = wave.open(f, 'rb')
+    except (wave.Error, EOFError):
+        raise spectrumtranslate.SpectrumTranslateError(
+            "Not a valid wav file.")
+
+    if wav.getsampwidth() not in (1, 2):
+        wav.close()
+        raise spectrumtranslate.SpectrumTranslateError(
+            "Only 8 and 16 bit wav files are supported.")
+
+    return _getwavblocks(wav, hysteresis)
+
+
+def _getwavblocks(wav, hysteresis):
+    # yields the blocks decoded from the wave.Wave_read wav
+    with wav:
+        samplerate = wav.getframerate()
+        tstates = _TSTATESPERSECOND / samplerate
+        runs = _getwavruns(wav, hysteresis)
+        # runs read ahead that need to be looked at again
+        replay = deque()
+
+        def nextrun():
+            return replay.popleft() if replay else next(runs, None)
+
+        def readdata(pilot):
+            # reads data pulses.  Returns the lengths of the complete
+            # pairs of pulses, the threshold between zero and one bits,
+            # and the runs read
+            read = []
+            lengths = []
+            threshold = None
+            while True:
+                run = nextrun()
+                if run is None:
+                    break
+
+                read.append(run)
+                length = run[1] * tstates
+                if threshold is None and length >= pilot * 2:
+                    break
+
+                if threshold is not None and not \
+                   threshold / 6 < length < threshold:
+                    break
+
+                lengths.append(length)
+                if len(lengths) == _DATASAMPLEPULSES:
+                    threshold = _getdatathreshold(lengths, pilot)
+                    # check the pulses used to get the threshold
+                    for i, length in enumerate(lengths):
+                        if not threshold / 6 < length < threshold:
+                            del lengths[i:]
+                            break
+
+                    if len(lengths) < _DATASAMPLEPULSES:
+                        break
+
+            if threshold is None and len(lengths) > 1:
+                threshold = _getdatathreshold(lengths, pilot)
+
+            return lengths[:len(lengths) & ~1], threshold, read
+
+        # a block waiting to find out how long the pause after it is
+        lastblock = None
+
+        def getgapblocks(gap):
+            # yields the blocks for the runs between decoded blocks
+            nonlocal lastblock
+            if len(gap) >= _PAUSEMAXRUNS:
+                if lastblock is not None:
+                    yield lastblock
+                    lastblock = None
+
+                yield _getrecordingblock(gap, samplerate)
+                return
+
+            pause = round(sum(length for level, length in gap) * 1000 /
+                          samplerate)
+            if lastblock is not None:
+                lastblock.endPause = min(pause, 0xFFFF)
+                pause -= lastblock.endPause
+                yield lastblock
+                lastblock = None
+
+            while pause > 0:
+                yield SpectrumTZXPauseOrStopBlock(min(pause, 0xFFFF))
+                pause -= 0xFFFF
+
+        # runs not yet in a block, where a possible pilot tone starts in
+        # them, and how many pulses and how long it is so far
+        pending = []
+        pilotstart = 0
+        pilotcount = 0
+        pilottotal = 0
+        while True:
+            run = nextrun()
+            if run is None:
+                break
+
+            length = run[1] * tstates
+            if pilotcount > 0:
+                pilot = pilottotal / pilotcount
+                if abs(length - pilot) <= pilot * _PILOTTOLERANCE:
+                    pending.append(run)
+                    pilotcount += 1
+                    pilottotal += length
+                    continue
+
+                # try reading a block if this could be the first sync
+                # pulse after a pilot tone
+                if pilotcount >= _PILOTMINPULSES and length < pilot * 0.75:
+                    syncrun = nextrun()
+                    read = []
+                    if syncrun is not None and \
+                       syncrun[1] * tstates < pilot * 0.75:
+                        lengths, threshold, read = readdata(pilot)
+                        block = None if threshold is None else \
+                            _getwavdatablock(pilot, pilotcount, length,
+                                             syncrun[1] * tstates, lengths,
+                                             threshold)
+                        if block is not None:
+                            yield from getgapblocks(pending[:pilotstart])
+                            lastblock = block
+                            pending = []
+                            pilotcount = 0
+                            replay.extendleft(reversed(read[len(lengths):]))
+                            continue
+
+                    # look at what was read again
+                    replay.extendleft(reversed(read))
+                    if syncrun is not None:
+                        replay.appendleft(syncrun)
+
+            # this run could start a pilot tone
+            pending.append(run)
+            if length >= _PILOTMINLENGTH:
+                pilotstart = len(pending) - 1
+                pilotcount = 1
+                pilottotal = length
+            else:
+                pilotcount = 0
+
+            # don't keep too many runs
+            if pilotcount == 0 and len(pending) > _WAVRECORDINGRUNS:
+                yield from getgapblocks(pending)
+                pending = []
+
+            elif pilotstart > _WAVRECORDINGRUNS:
+                yield from getgapblocks(pending[:pilotstart])
+                pending = pending[pilotstart:]
+                pilotstart = 0
+
+        yield from getgapblocks(pending)
+        if lastblock is not None:
+            yield lastblock
+
+
 def createbasicheader(filename, VariableOffset, ProgLength, AutoStart=-1):
     """Create a header for a program SpectrumTapBlock."""
 
@@ -2761,13 +4356,16 @@ def usage():
     save as a file into a tap or tzx file) and outputs it to outfile.
 
     instruction is required and specifies what you want to do. It must
-    be 'list', 'extract', 'delete', 'copy, or 'create'.  'list' will
-    list the contents of the specified file.  'extract' extracts the
-    data from a file entry to wherever you want.  'copy' copies the
-    specified file entries to another file.  'delete' deletes the
-    specified entries from the source file and outputs the resulting
-    file. 'create' creates a tap entry (as well as a header entry if
-    needed) in outfile using the supplied file data.
+    be 'list', 'extract', 'delete', 'copy, 'create', 'wav', or
+    'fromwav'.  'list' will list the contents of the specified file.
+    'extract' extracts the data from a file entry to wherever you want.
+    'copy' copies the specified file entries to another file.  'delete'
+    deletes the specified entries from the source file and outputs the
+    resulting file. 'create' creates a tap entry (as well as a header
+    entry if needed) in outfile using the supplied file data.  'wav'
+    plays the file (or the entries specified with the -s flag) and
+    saves the sound as an 8 bit mono wav file.  'fromwav' decodes a
+    recording of a tape in an 8 or 16 bit wav file into a tzx file.
 
     infile and outfile are required unless reading from the standard
     input or outputting to the standard output.  Usually arguments are
@@ -2804,7 +4402,8 @@ def usage():
        minus.  The numbers are assumed to be decimal unless preceded by
        0x in which case they are assumed to be hexadecimal.
        For example: 2,0x10-20,23 will specify entry 2, 16 to 20
-       inclusive, and 23.  This flag is used by list, delete, and copy.
+       inclusive, and 23.  This flag is used by list, delete, copy, and
+       wav.
     --specifyfiles same as -s.
     --specificfiles same as -s.
     --tap specifies that you want the output in tap file format.
@@ -2873,6 +4472,11 @@ def usage():
        decimal or hexadecimal number preceded by '0x'.
     --pos same as -p.
     --position same as -p.
+
+    wav flags:
+    --samplerate This specifies the number of samples per second in the
+                 wav file.  It must be followed by a number, and is
+                 44100 if not specified.
 """
 
 
@@ -2922,6 +4526,7 @@ def _commandline(args):
     creatingblockflag = 0xFF
     filetyperequested = None
     generatetzxheader = True
+    samplerate = 44100
     infiletype = None
     outfiletype = None
 
@@ -2934,7 +4539,8 @@ def _commandline(args):
         i += 1
 
         arg = args[i]
-        if arg in ['help', 'extract', 'list', 'copy', 'delete', 'create']:
+        if arg in ['help', 'extract', 'list', 'copy', 'delete', 'create',
+                   'wav', 'fromwav']:
             if mode is not None:
                 raise spectrumtranslate.SpectrumTranslateError(
                     "Can't have multiple commands.")
@@ -2944,7 +4550,8 @@ def _commandline(args):
 
         if mode is None:
             raise spectrumtranslate.SpectrumTranslateError('No command (list, \
-extract, delete, copy, create, or help) specified as first argument.')
+extract, delete, copy, create, wav, fromwav, or help) specified as first \
+argument.')
 
         if mode == 'create' and creating is None:
             if arg not in ['basic', 'code', 'array', 'screen', 'block']:
@@ -3013,6 +4620,20 @@ and block.')
 
             continue
 
+        if arg == '--samplerate':
+            i += 1
+            try:
+                samplerate = getint(args[i])
+            except ValueError:
+                raise spectrumtranslate.SpectrumTranslateError(
+                    '{} is not a valid sample rate.'.format(args[i]))
+
+            if samplerate < 1:
+                raise spectrumtranslate.SpectrumTranslateError(
+                    'sample rate must be more than 0.')
+
+            continue
+
         if arg == '--arraytype':
             i += 1
             if args[i] in ['character', 'c']:
@@ -3172,8 +4793,12 @@ valid index in the input file.'.format(arg))
         sys.stdout.write(usage())
         return
 
-    # get data
-    if not fromstandardinput:
+    # get data.  Files are scanned rather than read when listing, and
+    # read as they are needed when makeing or reading a wav file
+    if mode in ['list', 'wav', 'fromwav'] and not fromstandardinput:
+        data = None
+
+    elif not fromstandardinput:
         with open(inputfile, 'rb') as infile:
             data = bytearray(infile.read())
 
@@ -3184,7 +4809,7 @@ valid index in the input file.'.format(arg))
     if mode in ['create', 'copy', 'delete'] and not tostandardoutput and \
        isfile(outputfile):
         with open(outputfile, 'rb') as f:
-            outfiletype = getfiletypeandblocksfromsource(f)[0]
+            outfiletype = detecttapefiletype(f)
         if outfiletype is not None and filetyperequested is not None and \
            filetyperequested != outfiletype:
             raise spectrumtranslate.SpectrumTranslateError('{} type \
@@ -3201,11 +4826,59 @@ requested, but "{}" is already {}.'.format(filetyperequested, outputfile,
         outfiletype = "Tap"
 
     # now do command
+    if mode == 'wav':
+        infile = None if data is not None else open(inputfile, 'rb')
+        fo = sys.stdout.buffer if tostandardoutput else \
+            open(outputfile, 'wb')
+        try:
+            (infiletype, tbs) = getfiletypeandblockiteratorfromsource(
+                data if infile is None else infile)
+            if infiletype not in ['Tap', 'Tzx']:
+                raise spectrumtranslate.SpectrumTranslateError(
+                    "Input is not a tap or tzx file.")
+
+            if specifiedfiles is not None:
+                tbs = (tb for pos, tb in enumerate(tbs)
+                       if pos in specifiedfiles)
+
+            writetapewav(tbs, fo, samplerate)
+
+        finally:
+            if infile is not None:
+                infile.close()
+            if not tostandardoutput:
+                fo.close()
+
+        return
+
+    if mode == 'fromwav':
+        tbs = getblocksfromwav(inputfile if data is None else BytesIO(data))
+        fo = sys.stdout.buffer if tostandardoutput else \
+            open(outputfile, 'wb')
+        try:
+            if generatetzxheader:
+                fo.write(SpectrumTZXHeaderBlock(1, 20).getpackagedforfile())
+
+            for tb in tbs:
+                fo.write(tb.getpackagedforfile())
+
+        finally:
+            if not tostandardoutput:
+                fo.close()
+
+        return
+
     if mode == 'list':
         pos = 0
         retdata = '' if wantdetails else \
             'block type                content information\n'
-        (infiletype, tbs) = getfiletypeandblocksfromsource(data)
+        if data is None:
+            with open(inputfile, 'rb') as infile:
+                (infiletype, tbs) = getfiletypeandblockindexfromsource(infile)
+
+        else:
+            (infiletype, tbs) = getfiletypeandblockindexfromsource(data)
+
         for tb in tbs:
             if specifiedfiles is not None and pos not in specifiedfiles:
                 pos += 1
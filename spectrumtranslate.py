@@ -45,14 +45,29 @@
 import spectrumnumber
 import sys
 import re
+import os
+import zlib
+import json
+import hashlib
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from queue import Empty
 from functools import reduce
+from bisect import bisect_left
+from itertools import chain
 from operator import attrgetter
+# numpy is optional, but makes decoding screens faster if present
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 def _isarray(x):
     return isinstance(x, (list, tuple))
 
 def _validateandpreparebytes(x, m):
-    if (isinstance(x, (bytes, bytearray)) or
+    if (isinstance(x, (bytes, bytearray, memoryview)) or
        (_isarray(x) and
        all(isinstance(val, int) for val in x))):
         return bytearray(x)
@@ -986,6 +1001,100 @@ Z80_OPCODE_DATA = {
     3295524, 3295524, 3295524, 3295524, 3295524, 3295524, 1198372, 3295524)
 }
 
+
+# Precompiled decode table built from the above opcode tables so that
+# the disassembler can decode an instruction with at most three index
+# operations rather than working out prefixes on each pass.
+# Each entry for a non-prefix byte is a tuple of:
+#   (mnemonic template, flag word, timing word, command length,
+#    data offset, operand kinds, opcode, operand place holders)
+# operand kinds is a bitfield of what has to be filled in the template:
+#   1=displacement (d), 2=relative jump (j), 4=address (aa),
+#   8=2 byte number (nn), 16=1 byte number (n)
+# opcode is the Z80Instruction opcode of the instruction, and operand
+# place holders are the place holders for the operand kinds in order.
+# Entries for prefix bytes (CB, DD, ED, FD) are lists of 256 entries
+# indexed by the byte after the prefix.  For DD and FD the entry at CB is
+# itself a list indexed by the 4th byte of the instruction.
+def _buildz80decodetable():
+    def makerecord(s, instructionData, instructionTimes, commandlength,
+                   dataOffset, opcode):
+        operands = 0
+        if "d" in s:
+            operands |= 1
+        if "j" in s:
+            operands |= 2
+        if "aa" in s:
+            operands |= 4
+        if "nn" in s:
+            operands |= 8
+        if "n" in s.replace("nn", ""):
+            operands |= 16
+
+        kinds = tuple([kind for bit, kind in ((1, "d"), (2, "j"), (4, "aa"),
+                                              (8, "nn"), (16, "n"))
+                       if operands & bit])
+
+        return (s, instructionData, instructionTimes, commandlength,
+                dataOffset, operands, opcode, kinds)
+
+    def makeprefixtable(prefix, commandlength, dataOffset, nulllength):
+        table = []
+        for code in range(256):
+            opcode = code if prefix == "base" else \
+                (int(prefix, 16) << 8) + code
+            s = Z80_OPCODES[prefix][code]
+            if s is None and nulllength is None:
+                table.append(None)
+            elif s is None:
+                # invalid codes are only nulllength bytes long
+                table.append(makerecord(
+                    "", 0, 1, nulllength, 2, opcode >> (
+                        8 * (commandlength - nulllength))))
+            else:
+                table.append(makerecord(s, Z80_OPCODE_DATA[prefix][code],
+                                        Z80_OPCODE_TIMES[prefix][code],
+                                        commandlength, dataOffset, opcode))
+
+        return table
+
+    # invalid DD/FD codes are treated like a NOP, and invalid ED codes
+    # as doing nothing (is like 2 NOPs)
+    table = makeprefixtable("base", 1, 1, None)
+    table[0xCB] = makeprefixtable("CB", 2, 1, None)
+    table[0xED] = makeprefixtable("ED", 2, 2, 2)
+    for prefix in ("DD", "FD"):
+        table[int(prefix, 16)] = makeprefixtable(prefix, 2, 2, 1)
+        table[int(prefix, 16)][0xCB] = makeprefixtable(prefix + "CB", 3, 2,
+                                                       1)
+
+    return table
+
+
+_Z80_DECODE_TABLE = _buildz80decodetable()
+
+# lookup tables of how each byte is displayed in each number format
+# without a type indicator: 0=hex,1=decimal,2=octal,3=binary
+_BYTE_STRINGS = (tuple("{:02X}".format(b) for b in range(256)),
+                 tuple("{}".format(b) for b in range(256)),
+                 tuple("{:03o}".format(b) for b in range(256)),
+                 tuple("{:08b}".format(b) for b in range(256)))
+# holds max length of opcode for each number format
+_FORMAT_OPCODE_MAX_LENGTH = (19, 20, 21, 27)
+
+
+def _getcommentpadding(instruction, AddressOutput, NumberOutput):
+    """Returns the spaces to put after a disassembled instruction to
+    line up a comment after it.
+    """
+
+    return " " * (_FORMAT_OPCODE_MAX_LENGTH[AddressOutput] if
+                  _FORMAT_OPCODE_MAX_LENGTH[AddressOutput] >
+                  _FORMAT_OPCODE_MAX_LENGTH[NumberOutput] else
+                  _FORMAT_OPCODE_MAX_LENGTH[NumberOutput] -
+                  len(instruction))
+
+
 SPECTRUM_COMMANDS = (
     "SPECTRUM", "PLAY", "RND", "INKEY$", "PI", "FN", "POINT", "SCREEN$",
     "ATTR", "AT", "TAB", "VAL$", "CODE", "VAL", "LEN", "SIN", "COS", "TAN",
@@ -1995,6 +2104,7 @@ def stringtospectrum(s, wantcommands=True):
 # array to map from colours to colour data so that bright black & not
 # bright black both map to 0x000000
 _COLOUR_MAP = (0, 1, 2, 3, 4, 5, 6, 7, 0, 9, 10, 11, 12, 13, 14, 15)
+_COLOUR_MAP_TABLE = bytes(_COLOUR_MAP) + bytes(240)
 # array of ZX spectrum colours
 _ZXCOLOURTORGB = (0x000000, 0x0000CD, 0xCD0000, 0xCD00CD,
                   0x00CD00, 0x00CDCD, 0xCDCD00, 0xCDCDCD,
@@ -2008,6 +2118,252 @@ _ZXCOLOURTORGBLIST = ([0x00, 0x00, 0x00], [0x00, 0x00, 0xCD],
                       [0xFF, 0x00, 0x00], [0xFF, 0x00, 0xFF],
                       [0x00, 0xFF, 0x00], [0x00, 0xFF, 0xFF],
                       [0xFF, 0xFF, 0x00], [0xFF, 0xFF, 0xFF])
+# address in the screen bitmap of the start of each of the 192 rows
+_SCREEN_ROW_ADDRESSES = tuple(((y >> 6) << 11) + ((y & 7) << 8) +
+                              (((y >> 3) & 7) << 5) for y in range(192))
+# the 8 pixels of a bitmap byte as 0 for paper, 1 for ink
+_SCREEN_PIXEL_BITS = tuple(bytes([(b >> (7 - i)) & 1 for i in range(8)])
+                           for b in range(256))
+# translation tables to turn 0 and 1 pixels into the paper and ink
+# colours of an attribute, with and without flashing colours swapped
+_SCREEN_ATTRIBUTE_COLOURS = tuple(bytes([(a >> 3) & 15,
+                                         (a & 7) + ((a >> 3) & 8)]) +
+                                  bytes(254) for a in range(256))
+_SCREEN_ATTRIBUTE_FLASH_COLOURS = tuple(c if a < 128 else bytes([c[1], c[0]]) +
+                                        bytes(254) for a, c in
+                                        enumerate(_SCREEN_ATTRIBUTE_COLOURS))
+# if have numpy, the address of each bitmap byte in the order they are
+# displayed
+_SCREEN_BITMAP_ORDER = None if numpy is None else numpy.array(
+    [a + x for a in _SCREEN_ROW_ADDRESSES for x in range(32)], numpy.intp)
+
+
+def getindexesfromscreen(data, flashswapped=False):
+    """This function decodes spectrum screen format data into the colour
+    of each pixel.
+
+    data must be a list or tuple of ints, or a bytes or bytearray object.
+
+    flashswapped is True if you want the image with the flashing colours
+    swapped, or False for the normal image.
+
+    This returns a bytearray of 256*192 colour numbers from 0 to 15 (bit
+    3 is set for bright colours).  The pixels start at the top left, so
+    any pixel can be extracted by useing image[x+y*256].  If numpy is
+    available then this is used to decode the screen.
+    """
+
+    # validate and convert data from string to bytearray if needed
+    data = _validateandpreparebytes(data, "data")
+
+    if len(data) < 6912:
+        raise SpectrumTranslateError("Not enough data for screen.")
+
+    if numpy is not None:
+        # get bitmap rows in order and split into pixels
+        bitmap = numpy.frombuffer(bytes(data[:0x1800]), numpy.uint8)
+        pixels = numpy.unpackbits(bitmap[_SCREEN_BITMAP_ORDER].reshape(
+            192, 32), axis=1)
+
+        # get attribute for each pixel
+        attributes = numpy.frombuffer(bytes(data[0x1800:0x1B00]),
+                                      numpy.uint8).reshape(24, 32)
+        attributes = attributes.repeat(8, axis=0).repeat(8, axis=1)
+
+        # swap ink and paper if flashing
+        if flashswapped:
+            pixels ^= attributes >> 7
+
+        return bytearray(numpy.where(pixels == 1, (attributes & 7) |
+                                     ((attributes >> 3) & 8),
+                                     (attributes >> 3) & 15).astype(
+                                         numpy.uint8).tobytes())
+
+    colours = _SCREEN_ATTRIBUTE_FLASH_COLOURS if flashswapped else \
+        _SCREEN_ATTRIBUTE_COLOURS
+
+    image = []
+    for y in range(192):
+        # get pixel and colour address for start of row
+        p = _SCREEN_ROW_ADDRESSES[y]
+        c = 0x1800 + ((y >> 3) << 5)
+        image += [_SCREEN_PIXEL_BITS[data[p + x]].translate(
+            colours[data[c + x]]) for x in range(32)]
+
+    return bytearray(b"".join(image))
+
+
+def _getflashswappedindexes(data, indexes):
+    """Returns the colour numbers of a screen with the flashing colours
+    swapped, made from the colour numbers of the normal image as
+    returned by getindexesfromscreen rather than decoding the screen
+    again.  Every pixel in a flashing cell is either the ink or paper
+    colour, so swapping them is the same as taking the pixel's colour
+    from the sum of the ink and paper colours.
+    """
+
+    if numpy is not None:
+        attributes = numpy.frombuffer(bytes(data[0x1800:0x1B00]),
+                                      numpy.uint8).reshape(24, 32)
+        attributes = attributes.repeat(8, axis=0).repeat(8, axis=1)
+        pixels = numpy.frombuffer(bytes(indexes), numpy.uint8).reshape(192,
+                                                                       256)
+        return bytearray(numpy.where(
+            attributes > 0x7F, ((attributes & 7) | ((attributes >> 3) & 8)) +
+            ((attributes >> 3) & 15) - pixels, pixels).astype(
+                numpy.uint8).tobytes())
+
+    image = bytearray(indexes)
+    for c, a in enumerate(data[0x1800:0x1B00]):
+        if a > 0x7F:
+            colours = (a & 7) + ((a >> 3) & 8) + ((a >> 3) & 15)
+            # top left pixel of cell
+            p = ((c >> 5) << 11) + ((c & 31) << 3)
+            for y in range(8):
+                image[p:p + 8] = bytes([colours - i for i in
+                                        image[p:p + 8]])
+                p += 256
+
+    return image
+
+
+# the colour table used in gif images
+_GIF_COLOUR_TABLE = bytes(b for i in _COLOUR_MAP for b in
+                          _ZXCOLOURTORGBLIST[i])
+
+
+def _lzwencodegifimage(pixels, initialcodesize=4):
+    """Compresses palette indexed pixels using the gif variant of LZW
+    compression.  Returns a bytearray holding the initial code size
+    followed by the compressed data in sub-blocks, and the block
+    terminator.
+    """
+
+    clearcode = 1 << initialcodesize
+    eofcode = clearcode + 1
+    codesize = initialcodesize + 1
+    incbitsat = (1 << codesize) + 1
+    nextcode = eofcode + 1
+
+    # sequences of codes are looked up as (prefix code, next pixel) pairs
+    # combined into a single int
+    table = {}
+    lookup = table.get
+
+    # each pixel adds at most one code of up to 12 bits, plus the odd
+    # table reset, so 2 bytes per pixel is more than enough
+    out = bytearray(2 * len(pixels) + 8)
+    pos = 0
+
+    # start bit accumulator with the table reset code
+    accumulator = clearcode
+    bits = codesize
+
+    prefix = pixels[0]
+    for pixel in memoryview(pixels)[1:]:
+        key = (prefix << initialcodesize) | pixel
+        code = lookup(key)
+        # if sequence already exists then look for longer sequence
+        if code is not None:
+            prefix = code
+            continue
+
+        # new sequence, so add it to the table and output the code for
+        # the existing sequence
+        table[key] = nextcode
+        nextcode += 1
+        accumulator |= prefix << bits
+        bits += codesize
+        while bits >= 8:
+            out[pos] = accumulator & 0xFF
+            pos += 1
+            accumulator >>= 8
+            bits -= 8
+
+        # start new sequence with the pixel that didn't match
+        prefix = pixel
+
+        # if table full, output reset code and start again
+        if nextcode == 0xFFF:
+            accumulator |= clearcode << bits
+            bits += codesize
+            while bits >= 8:
+                out[pos] = accumulator & 0xFF
+                pos += 1
+                accumulator >>= 8
+                bits -= 8
+
+            table.clear()
+            nextcode = eofcode + 1
+            codesize = initialcodesize + 1
+            incbitsat = (1 << codesize) + 1
+
+        # increase size of output codes if needed
+        if nextcode == incbitsat:
+            codesize += 1
+            incbitsat = (1 << codesize) + 1
+
+    # output last sequence and end of file code
+    accumulator |= (prefix | (eofcode << codesize)) << bits
+    bits += codesize * 2
+    while bits > 0:
+        out[pos] = accumulator & 0xFF
+        pos += 1
+        accumulator >>= 8
+        bits -= 8
+
+    # split into sub-blocks of up to 255 bytes
+    ret = bytearray([initialcodesize])
+    for i in range(0, pos, 255):
+        block = out[i:min(i + 255, pos)]
+        ret.append(len(block))
+        ret += block
+
+    # block terminator
+    ret.append(0)
+    return ret
+
+
+def _getgifheader(animated):
+    """Returns the header, logical screen descriptor and colour table of
+    a gif image of a spectrum screen.  If animated is True then the
+    looping application extension is added.
+    """
+
+    # header, width 256, height 192, global 4 bit colour table
+    ret = bytearray(b"GIF89a\x00\x01\xC0\x00\xF3\x00\x00")
+    ret += _GIF_COLOUR_TABLE
+
+    if animated:
+        # app extension with loop count of 0 (repeat forever)
+        ret += b"\x21\xFF\x0BNETSCAPE2.0\x03\x01\x00\x00\x00"
+
+    return ret
+
+
+def _getgifframe(pixels, delay, localcolourtable):
+    """Returns a gif frame of a 256 by 192 palette indexed image.  The
+    delay is in milliseconds.  If localcolourtable is True then the
+    frame has it's own colour table.
+    """
+
+    delay //= 10
+    # graphic control extension with delay in 1/100 of seconds, and
+    # image descriptor
+    ret = bytearray((0x21, 0xF9, 4, 0, delay & 0xFF, delay >> 8, 0, 0,
+                     0x2C, 0, 0, 0, 0, 0, 1, 0xC0, 0,
+                     0x83 if localcolourtable else 0))
+    if localcolourtable:
+        ret += _GIF_COLOUR_TABLE
+
+    ret += _lzwencodegifimage(pixels)
+    return ret
+
+
+def _getgifpixels(data, flashswapped):
+    # get gif palette indexes for screen
+    return getindexesfromscreen(data, flashswapped).translate(
+        _COLOUR_MAP_TABLE)
 
 
 def getgiffromscreen(data, delay=320):
@@ -2039,250 +2395,6 @@ def getgiffromscreen(data, delay=320):
     problems.
     """
 
-    class _gif_encoder_stream():
-        # private class to encode gif data
-        output_masks = (0x0000, 0x0001, 0x0003, 0x0007, 0x000F, 0x001F, 0x003F,
-                        0x007F, 0x00FF, 0x01FF, 0x03FF, 0x07FF, 0x0FFF, 0x1FFF,
-                        0x3FFF, 0x7FFF, 0xFFFF)
-
-        MaxOutputCode = 0xFFF
-
-        def __init__(self, data):
-            # remember screen we're encodeing
-            self.data = data
-            self.out = [0] * 10000
-            self.pout = 0
-
-        def OutAdd(self, x):
-            xlen = len(x)
-            if xlen + self.pout > len(self.out):
-                self.out += [0] * 10000
-            self.out[self.pout: self.pout + xlen] = x
-            self.pout += xlen
-
-        def PutImageAsGif(self, bFlash, delay, bFirst):
-            """this method outputs an image to the supplied stream."""
-
-            # output graphic control extension
-            self.PutByte(0x21)  # extension introducer
-            self.PutByte(0xf9)  # GCE label
-            self.PutByte(4)     # data block size
-            self.PutByte(0)     # no transparency
-            # delay in 1/100 of seconds
-            self.PutWord(0 if delay in [-1, -2] else delay//10)
-            self.PutByte(0)     # transparent color index
-            self.PutByte(0)     # block terminator
-
-            # output image desriptor
-            self.PutByte(0x2c)  # image separator
-            self.PutWord(0)     # image position x,y = 0,0
-            self.PutWord(0)
-            self.PutWord(256)   # image size
-            self.PutWord(192)
-            # packed fields
-            # no Local Colour Table if first frame, othewise 4 bit LCT
-            self.PutByte(0 if bFirst else 0x83)
-
-            # output colour map if not first
-            if not bFirst:
-                for i in _COLOUR_MAP:
-                    self.PutByte((_ZXCOLOURTORGB[i] >> 16) & 0XFF)
-                    self.PutByte((_ZXCOLOURTORGB[i] >> 8) & 0XFF)
-                    self.PutByte(_ZXCOLOURTORGB[i] & 0XFF)
-
-            # record initial code bit size
-            self.PutByte(4)
-
-            # output compressed image
-            # add 1 to code size to accomodate control codes
-            self.compress(not bFirst or delay == -2, 5)
-
-            # write block terminator
-            self.PutByte(0)
-
-        def compress(self, bFlash, initialDataBitSize):
-            """compress image to output stream using LZW compression"""
-
-            # initiate bit cue & byte cue
-            self.cue = [0]*255
-            self.output_cue = 0
-            self.output_cueBits = 0
-            self.output_dataSize = initialDataBitSize
-            self.output_cuePointer = 0
-
-            # initiate compression stuff
-            code_tableReset = 1 << (initialDataBitSize-1)
-            code_EOF = code_tableReset + 1
-            incBitsAt = (1 << initialDataBitSize) + 1
-            compressionArray = [0]*(self.MaxOutputCode + 1)
-            compressionArraySize = code_EOF + 1
-            for i in range(code_EOF):
-                compressionArray[i] = i | 0xFFFF000
-
-            # start by issuing table reset code
-            self.OutputBits(code_tableReset)
-            # set no previous sequence
-            CompressionValue = 0
-            # get first pixel
-            OldCompressionValue = self.GetPixelColour(0, 0, bFlash)
-            # set where to start looking for sequence to see if we've
-            # encountered it before
-            # Code_EOF+1 will be first code not used by control code or
-            # basic colours
-            SearchPoint = code_EOF + 1
-
-            # now go through image compressing pixels
-            # start with x=1 on first line of y
-            startx = 1
-            for y in range(192):
-                for x in range(startx, 256):
-                    # calculate internal code for sequence+next pixel
-                    CompressionValue = (OldCompressionValue << 12) | \
-                                       self.GetPixelColour(x, y, bFlash)
-                    # search list of sequences to see if current
-                    # sequence already exists
-                    i = SearchPoint
-                    while i < compressionArraySize:
-                        if compressionArray[i] == CompressionValue:
-                            break
-
-                        i += 1
-
-                    # if sequence already exists, then remember loop
-                    # back to look for longer sequence
-                    if i < compressionArraySize:
-                        # longer matching sequence will come later in
-                        # sequence table if exists so no point searching
-                        # first part of sequence table again.  Setting
-                        # Search Point avoids this.
-                        OldCompressionValue = i
-                        SearchPoint = i
-                        continue
-
-                    # have found a new pixel sequence, so add it to the
-                    # list of sequences
-                    compressionArray[compressionArraySize] = CompressionValue
-                    compressionArraySize += 1
-                    # reset where to search sequence table from as will
-                    # be starting a new sequence now
-                    SearchPoint = code_EOF + 1
-                    # output existing sequence
-                    self.OutputBits(OldCompressionValue)
-                    # start new sequence with first pixel that doesn't
-                    # match existing pixel sequence
-                    OldCompressionValue = CompressionValue & 0xFFF
-                    # check if have reached maximum number of sequences
-                    # possible
-                    if compressionArraySize == self.MaxOutputCode:
-                        # if so then output code to note table reset
-                        self.OutputBits(code_tableReset)
-                        # reset sequence table
-                        compressionArraySize = code_EOF + 1
-                        # reset output code bit size as will be shorter
-                        # code for sequences
-                        self.output_dataSize = initialDataBitSize
-                        # work out when will need to increase output
-                        # code bit size
-                        incBitsAt = (1 << initialDataBitSize) + 1
-
-                    # if we have to have more bits in output code to
-                    # hold sequence code then increment output bits and
-                    # make note of when to increase the number of output
-                    # bits again
-                    if compressionArraySize == incBitsAt:
-                        self.output_dataSize += 1
-                        incBitsAt = (1 << self.output_dataSize) + 1
-
-                startx = 0
-
-            # finished going through image.
-            # There will be sequence still left in output buffer so
-            # output this
-            self.OutputBits(OldCompressionValue & 0xFFF)
-            # output end of file code
-            self.OutputBits(code_EOF)
-            # if there are bits waiting to be written int the output cue
-            # write them now
-            while self.output_cueBits > 0:
-                self.cue[self.output_cuePointer] = self.output_cue & 0xFF
-                self.output_cuePointer += 1
-                # if cue full, then output it
-                if self.output_cuePointer == 255:
-                    self.OutAdd([0xFF] + self.cue)
-                    self.output_cuePointer = 0
-
-                self.output_cue >>= 8
-                self.output_cueBits -= 8
-
-            # if still bits in cue
-            if self.output_cuePointer > 0:
-                self.OutAdd([self.output_cuePointer] +
-                            self.cue[0:self.output_cuePointer])
-
-        def GetPixelColour(self, x, y, bFlash):
-            """
-            get colour 1-15 of specified pixel, inverted if is flashing.
-            """
-            colour = self.data[0x1800 + ((y >> 3) << 5) + (x >> 3)]
-            fg = _COLOUR_MAP[(colour & 7) + ((colour >> 3) & 8)]
-            bg = _COLOUR_MAP[(colour >> 3) & 15]
-
-            # swap foreground & background if flash & second image
-            if colour >= 128 and bFlash:
-                fg, bg = bg, fg
-
-            pixels = self.data[((y >> 6) << 11) + ((y & 7) << 8) +
-                               (((y >> 3) & 7) << 5) + (x >> 3)]
-
-            return fg if ((pixels >> (7-(x & 7))) & 1) == 1 else bg
-
-        # output bits to bit output cue
-        def OutputBits(self, bits):
-            # tidy bitcue in case loose bits attached (not sure if this
-            # is strictly needed but is safe)
-            self.output_cue &= self.output_masks[self.output_cueBits]
-            # add new bits to bitcue
-            if self.output_cueBits > 0:
-                self.output_cue |= bits << self.output_cueBits
-
-            # no bitcue so set bitcue as bits to add
-            else:
-                self.output_cue = bits
-
-            # update how many bits in bitcue
-            self.output_cueBits += self.output_dataSize
-            # if more than 8 bits in bitcue, output a byte at a time
-            while self.output_cueBits >= 8:
-                # add from bitcue to byte cue
-                self.cue[self.output_cuePointer] = self.output_cue & 0xFF
-                # increment number of bytes in byte cue
-                self.output_cuePointer += 1
-                # if buffer full, output them to stream
-                if self.output_cuePointer == 255:
-                    # block headder & cue
-                    self.OutAdd([0xFF] + self.cue)
-                    # reset byte cue pointer
-                    self.output_cuePointer = 0
-
-                # 8 bits have been moved from bit cue to byte cue.
-                # Update bitcue & bitcue length
-                self.output_cue >>= 8
-                self.output_cueBits -= 8
-
-        # output 2 byte word
-        def PutWord(self, w):
-            self.OutAdd([w & 0xff, (w >> 8) & 0xff])
-
-        # output string
-        def PutString(self, s):
-            self.OutAdd([ord(x) for x in s])
-
-        # output single byte
-        def PutByte(self, b):
-            self.OutAdd([b])
-
-    # end of private class
-
     # if not enough data for image supplied
     if len(data) < 6912:
         return None
@@ -2290,53 +2402,84 @@ def getgiffromscreen(data, delay=320):
     # validate and convert data from string to bytearray if needed
     data = _validateandpreparebytes(data, "data")
 
-    # is there a flash atribute in the screen
-    bFlash = False
-
     # is there a flash flag set in the colour area?
     bFlash = any(i > 0x7F for i in data[0x1800:0x1B00])
 
-    # create object to encode gif data
-    ges = _gif_encoder_stream(data)
-
-    # put headder
-    ges.PutString("GIF89a")
-    # width
-    ges.PutWord(256)
-    # height
-    ges.PutWord(192)
-    # bits per pixel+other flags
-    ges.PutByte(243)
-    ges.PutByte(0)
-    ges.PutByte(0)
-
-    # output colour map
-    for i in _COLOUR_MAP:
-        ges.PutByte((_ZXCOLOURTORGB[i] >> 16) & 0XFF)
-        ges.PutByte((_ZXCOLOURTORGB[i] >> 8) & 0XFF)
-        ges.PutByte(_ZXCOLOURTORGB[i] & 0XFF)
-
-    # put delay if have flash & want flashing image (delay != -1 and -2)
-    if bFlash and delay > 0:
-        ges.PutByte(0x21)  # extension introducer
-        ges.PutByte(0xff)  # app extension label
-        ges.PutByte(11)    # block size
-        ges.PutString("NETSCAPE2.0")   # app id + auth code
-        ges.PutByte(3)     # sub-block size
-        ges.PutByte(1)     # loop sub-block id
-        ges.PutWord(0)     # loop count (0=repeat forever)
-        ges.PutByte(0)     # block terminator
+    # put headder, with delay if have flash & want flashing image (delay
+    # != -1 and -2)
+    ret = _getgifheader(bFlash and delay > 0)
+
+    # get colours of image, and of image with flashing colours swapped
+    # if wanted
+    indexes = getindexesfromscreen(data)
+    if bFlash and delay != -1:
+        flashindexes = _getflashswappedindexes(data, indexes)
 
     # output Image
-    ges.PutImageAsGif(bFlash, delay, True)
+    framedelay = 0 if delay in [-1, -2] else delay
+    ret += _getgifframe((flashindexes if bFlash and delay == -2 else
+                         indexes).translate(_COLOUR_MAP_TABLE), framedelay,
+                        False)
     # output 2nd image if apropriate
     if bFlash and delay != -1:
-        ges.PutImageAsGif(bFlash, delay, False)
+        ret += _getgifframe(flashindexes.translate(_COLOUR_MAP_TABLE),
+                            framedelay, True)
+
+    # gif trailer
+    ret.append(0x3B)
+
+    return ret
+
+
+def getgiffromscreens(screens, delay=320, multiframe=False,
+                      framedelay=2000):
+    """This function converts a number of spectrum screens into GIF
+    images.  It either returns a list of GIF images, one for each
+    screen, or one animated GIF image showing each screen in turn which
+    is useful for previewing a collection of screens.
+
+    screens is an iterable of screens, each of which must be a list or
+    tuple of ints, or a bytes or bytearray object.
+
+    delay is the delay between flashing images in milliseconds as used
+    by getgiffromscreen.  If multiframe is True then flashing colours
+    are not animated, and passing -2 for delay will use the screens with
+    the flash attributes in the flashing state.
+
+    multiframe is False if you want a separate GIF image for each
+    screen, or True if you want all the screens as frames in one
+    animated GIF image.
+
+    framedelay is the time in milliseconds each screen is shown for if
+    multiframe is True.
+
+    If multiframe is False this returns a list of bytearrays, each of
+    which is the same as getgiffromscreen would return for that screen.
+    If multiframe is True, this returns a bytearray which holds the
+    animated GIF image.  In either case a SpectrumTranslateError is
+    raised if any screen is too short.
+    """
+
+    if not multiframe:
+        gifs = []
+        for data in screens:
+            # getgiffromscreen returns None for a short screen
+            if len(data) < 6912:
+                raise SpectrumTranslateError("Not enough data for screen.")
+
+            gifs.append(getgiffromscreen(data, delay))
+
+        return gifs
+
+    ret = _getgifheader(True)
+    for data in screens:
+        ret += _getgifframe(_getgifpixels(data, delay == -2), framedelay,
+                            False)
 
     # gif trailer
-    ges.PutByte(0x3b)
+    ret.append(0x3B)
 
-    return bytearray(ges.out[:ges.pout])
+    return ret
 
 
 def getrgbfromscreen(data, alphamask=0xFF, imageformat=0):
@@ -2361,13 +2504,14 @@ def getrgbfromscreen(data, alphamask=0xFF, imageformat=0):
 
     imageformat specifies what format you want the image to be output
     as.  0 for a list of ARGB integers (bits 24-31 are alpha if wanted,
-    bits 16-23 are red, 8-15 are green, and 0-7 are Blue), or 1 for a
+    bits 16-23 are red, 8-15 are green, and 0-7 are Blue), 1 for a
     list of lists containing [Red, Green, Blue, Alpha] (or [Red, Green,
-    Blue] if alpha isn't wanted).
+    Blue] if alpha isn't wanted), or 2 for a bytearray with the Red,
+    Green, Blue, and Alpha (if wanted) bytes of each pixel in turn.
     """
 
     # validate inputs
-    if imageformat < 0 or imageformat > 1:
+    if imageformat < 0 or imageformat > 2:
         raise SpectrumTranslateError("Invalid imageformat.")
 
     if alphamask < -1 or alphamask > 255:
@@ -2376,76 +2520,208 @@ def getrgbfromscreen(data, alphamask=0xFF, imageformat=0):
     # validate and convert data from string to bytearray if needed
     data = _validateandpreparebytes(data, "data")
 
+    alpha = [] if alphamask == -1 else [alphamask]
     if imageformat == 0:
-        alpha = 0 if alphamask == -1 else alphamask << 24
-        colourtransform = _ZXCOLOURTORGB
+        colours = [c + (0 if alphamask == -1 else alphamask << 24) for c in
+                   _ZXCOLOURTORGB]
+    elif imageformat == 1:
+        colours = [c + alpha for c in _ZXCOLOURTORGBLIST]
     else:
-        alpha = [] if alphamask == -1 else [alphamask]
-        colourtransform = _ZXCOLOURTORGBLIST
+        colours = [bytes(c + alpha) for c in _ZXCOLOURTORGBLIST]
 
     # calculate number of images needed: is there a flash flag set in
     # the colour area?
     bFlash = any(i > 0x7F for i in data[0x1800:0x1B00])
 
-    image1 = []
-    for y in range(192):
-        # get pixel address for start of row
-        p = ((y >> 6) << 11) + ((y & 7) << 8) + (((y >> 3) & 7) << 5)
-        # get colour address for start of row
-        c = 0x1800 + ((y >> 3) << 5)
-        for x in range(0, 256, 8):
-            # work out foreground & background colour
-            i = data[c]
-            fg = colourtransform[(i & 7) + ((i >> 3) & 8)] + alpha
-            bg = colourtransform[(i >> 3) & 15] + alpha
-            # get pixel data for 8 pixel row
-            i = data[p]
-            image1 += [bg if (i & 128) == 0 else fg,
-                       bg if (i & 64) == 0 else fg,
-                       bg if (i & 32) == 0 else fg,
-                       bg if (i & 16) == 0 else fg,
-                       bg if (i & 8) == 0 else fg,
-                       bg if (i & 4) == 0 else fg,
-                       bg if (i & 2) == 0 else fg,
-                       bg if (i & 1) == 0 else fg]
-            c += 1
-            p += 1
-
-    # now deal with flash image if needed
-    if bFlash:
-        image2 = []
-        for y in range(192):
-            # get pixel address for start of row
-            p = ((y >> 6) << 11) + ((y & 7) << 8) + (((y >> 3) & 7) << 5)
-            # get colour address for start of row
-            c = 0x1800 + ((y >> 3) << 5)
-            for x in range(0, 256, 8):
-                # work out foreground & background colour
-                i = data[c]
-                fg = colourtransform[(i & 7) + ((i >> 3) & 8)] + alpha
-                bg = colourtransform[(i >> 3) & 15] + alpha
-                if i >= 128:
-                    # swap foreground & background as flashing
-                    fg, bg = bg, fg
-
-                # get pixel data for 8 pixel row
-                i = data[p]
-                image2 += [bg if (i & 128) == 0 else fg,
-                           bg if (i & 64) == 0 else fg,
-                           bg if (i & 32) == 0 else fg,
-                           bg if (i & 16) == 0 else fg,
-                           bg if (i & 8) == 0 else fg,
-                           bg if (i & 4) == 0 else fg,
-                           bg if (i & 2) == 0 else fg,
-                           bg if (i & 1) == 0 else fg]
-                c += 1
-                p += 1
-
-        # return 2 images
-        return [image1, image2]
-
-    # return only one image as no flash
-    return [image1, None]
+    # image with flashing colours swapped is made from normal image
+    indexes = getindexesfromscreen(data)
+    images = []
+    for indexes in ([indexes, _getflashswappedindexes(data, indexes)] if
+                    bFlash else [indexes]):
+        if imageformat != 2:
+            images += [[colours[i] for i in indexes]]
+
+        elif numpy is not None:
+            images += [bytearray(numpy.frombuffer(b"".join(colours),
+                                                  numpy.uint8).reshape(
+                16, -1)[numpy.frombuffer(indexes, numpy.uint8)].tobytes())]
+
+        else:
+            images += [_indexestorgb(indexes, alphamask)]
+
+    # return only one image if no flash
+    if not bFlash:
+        images += [None]
+
+    return images
+
+
+# size in pixels of the border around a screen image if wanted
+_SCREEN_BORDER_SIZE = 32
+# translation tables from colour number to red, green, and blue bytes
+_SCREEN_CHANNEL_TABLES = tuple(bytes(c[i] for c in _ZXCOLOURTORGBLIST) +
+                               bytes(240) for i in range(3))
+# png signature and palette chunk data
+_PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+_PNG_PALETTE = bytes(b for c in _ZXCOLOURTORGBLIST for b in c)
+
+
+def _indexestorgb(indexes, alphamask):
+    """Converts a bytearray of colour numbers into a bytearray of the
+    red, green, blue, and alpha (if alphamask isn't -1) bytes of each
+    pixel.
+    """
+
+    step = 3 if alphamask == -1 else 4
+    ret = bytearray(len(indexes) * step)
+    for i, table in enumerate(_SCREEN_CHANNEL_TABLES):
+        ret[i::step] = indexes.translate(table)
+
+    if alphamask != -1:
+        ret[3::step] = bytes([alphamask]) * len(indexes)
+
+    return ret
+
+
+def _getscreenimagerows(data, scale, border, flashswapped):
+    """Returns the width and height of the screen image, and a generator
+    of the rows of colour numbers in the image scaled and with a border
+    if wanted.
+    """
+
+    if not isinstance(scale, int) or scale < 1 or scale > 16:
+        raise SpectrumTranslateError("Invalid scale.")
+
+    if border < -1 or border > 7:
+        raise SpectrumTranslateError("Invalid border colour.")
+
+    indexes = getindexesfromscreen(data, flashswapped)
+
+    bordersize = 0 if border == -1 else _SCREEN_BORDER_SIZE
+    width = (256 + 2 * bordersize) * scale
+    height = (192 + 2 * bordersize) * scale
+
+    def rows():
+        side = bytes([max(border, 0)]) * (bordersize * scale)
+        borderrow = bytes([max(border, 0)]) * width
+        for y in range(bordersize * scale):
+            yield borderrow
+
+        row = bytearray(256 * scale)
+        for y in range(0, 49152, 256):
+            # repeat each pixel scale times across the row
+            for i in range(scale):
+                row[i::scale] = indexes[y:y + 256]
+
+            scaledrow = side + row + side
+            for i in range(scale):
+                yield scaledrow
+
+        for y in range(bordersize * scale):
+            yield borderrow
+
+    return width, height, rows()
+
+
+def _getpngchunk(chunktype, data):
+    # length, type, data, and crc of type and data
+    return len(data).to_bytes(4, "big") + chunktype + data + \
+        zlib.crc32(chunktype + data).to_bytes(4, "big")
+
+
+def getpngfromscreen(data, scale=1, border=-1, flashswapped=False):
+    """This function converts spectrum screen format data into a PNG
+    image.  The image is a palette based PNG, and the rows of the image
+    are passed straight to the compressor as they are made.
+
+    data must be a list or tuple of ints, or a bytes or bytearray object.
+
+    scale is how many times bigger than the 256 by 192 pixel screen you
+    want the image to be.  It must be from 1 to 16.
+
+    border is the colour (0 to 7) of a 32 pixel wide border around the
+    screen, or -1 if you don't want a border.  The border is scaled with
+    the rest of the image.
+
+    flashswapped is True if you want the image with the flashing colours
+    swapped, or False for the normal image.
+
+    This returns a bytearray which holds the image in PNG format.
+    """
+
+    width, height, rows = _getscreenimagerows(data, scale, border,
+                                              flashswapped)
+
+    # compress each row with no filter
+    compressor = zlib.compressobj()
+    imagedata = bytearray()
+    for row in rows:
+        imagedata += compressor.compress(b"\x00")
+        imagedata += compressor.compress(row)
+
+    imagedata += compressor.flush()
+
+    # header is width, height, 8 bits per pixel, palette colour type,
+    # and no interlace
+    ret = bytearray(_PNG_SIGNATURE)
+    ret += _getpngchunk(b"IHDR", width.to_bytes(4, "big") +
+                        height.to_bytes(4, "big") + b"\x08\x03\x00\x00\x00")
+    ret += _getpngchunk(b"PLTE", _PNG_PALETTE)
+    ret += _getpngchunk(b"IDAT", bytes(imagedata))
+    ret += _getpngchunk(b"IEND", b"")
+
+    return ret
+
+
+def getppmfromscreen(data, scale=1, border=-1, flashswapped=False):
+    """This function converts spectrum screen format data into a binary
+    PPM (portable pixmap) image.
+
+    data must be a list or tuple of ints, or a bytes or bytearray object.
+
+    scale, border, and flashswapped are the same as for
+    getpngfromscreen.
+
+    This returns a bytearray which holds the image in PPM format.
+    """
+
+    width, height, rows = _getscreenimagerows(data, scale, border,
+                                              flashswapped)
+
+    ret = bytearray("P6\n{} {}\n255\n".format(width, height).encode("ascii"))
+    ret += _indexestorgb(bytearray(b"".join(rows)), -1)
+    return ret
+
+
+def getrawfromscreen(data, rgb=False, alphamask=0xFF, scale=1, border=-1,
+                     flashswapped=False):
+    """This function converts spectrum screen format data into a raw
+    image with no header.  The pixels start at the top left of the
+    image, and go from left to right for each row.
+
+    data must be a list or tuple of ints, or a bytes or bytearray object.
+
+    rgb is False if you want the colour number (0 to 15, with 8 added
+    for bright colours) of each pixel, or True if you want the red,
+    green, blue, and alpha bytes of each pixel.
+
+    alphamask is the alpha value from 0 to 255 of each pixel if rgb is
+    True.  Set it to be -1 if you don't want an alpha component.
+
+    scale, border, and flashswapped are the same as for
+    getpngfromscreen.
+
+    This returns a bytearray which holds the image.
+    """
+
+    if alphamask < -1 or alphamask > 255:
+        raise SpectrumTranslateError("Invalid alphamask.")
+
+    width, height, rows = _getscreenimagerows(data, scale, border,
+                                              flashswapped)
+
+    image = bytearray(b"".join(rows))
+    return _indexestorgb(image, alphamask) if rgb else image
 
 
 def snaptosna(data, register, border=0):
@@ -2706,2107 +2982,3138 @@ def snaptoz80(data, register, version=3, compressed=True, border=0):
     return bytearray(out)
 
 
-def disassemble(data, offset, origin, length, SpecialInstructions=None,
-                progressfunction=None):
-    """This function will disassemble a byte string or list holding Z80
-    code.  You can specify instructions to alter the disassembled
-    output.
+def _getflagchanges(instructionData):
+    """Returns a string describing how the flags are changed by an
+    instruction with the given flag word, or None if this is not known.
+    """
 
-    data must be a list or tuple of ints, or a bytes or bytearray object.
-    offset is how far into the array to start disassembling.
-    origin is the address of the first byte in the byte array.
-    length is how many bytes to disassemble
-    SpecialInstructions is a list of DisassembleInstruction instructing
-    things like output format, and data blocks.  Should be None if no
-    array to pass.
-    progressfunction is a function that takes X arguments. The first is
-    a string detailing what the Disassembler is currently doing.  The
-    second is how far through the current section of work it is, and
-    the third is how much work there is in the current section.  To get
-    a percentage of how much work in the current section use argument2
-    / argument3 * 100. The fourth argument gives the overall work done,
-    and the fifth argument the overall work to do. Note that the work
-    done can change, and the total work to do can increase as the
-    disassembly progresses, but the ratio (and thus the percentage work
-    done) will never decrease.
+    # do we have flag data?
+    if ((instructionData >> 20) & 1) == 0:
+        # if not return None
+        return None
 
-    Returns a String representation of the data.
+    # holds flag indicators
+    FlagStates = ("?", "-", "+", "0", "1", "P", "V")
+
+    s = "S{} Z{} H{} PV{} N{} C{}".format(
+        FlagStates[(instructionData >> 17) & 7],
+        FlagStates[(instructionData >> 14) & 7],
+        FlagStates[(instructionData >> 11) & 7],
+        FlagStates[(instructionData >> 8) & 7],
+        FlagStates[(instructionData >> 5) & 7],
+        FlagStates[(instructionData >> 2) & 7])
+
+    return s
+
+
+def _gettiminginfo(instructionTimes):
+    """Extracts the timing information from an instruction's timing word.
+    Returns a list of the total T states, and the alternative total T
+    states (0 if there is no alternative), and a list of the individual
+    T states of each machine cycle for both of these, or None if they are
+    not known.
     """
 
-    # nested functions
+    # calculate times
+    # first clear variables where results will be calculated
+    duration = [0, 0]
+    states = None
 
-    # get string for used flags
-    def getFlagChanges(instructionData):
-        # do we have flag data?
-        if ((instructionData >> 20) & 1) == 0:
-            # if not return None
-            return None
+    # if only overall T length known then extract this now
+    if (instructionTimes & 0x1) != 0:
+        duration = [(instructionTimes >> 1) & 0x7FFF,
+                    (instructionTimes >> 17) & 0x7FFF]
 
-        # holds flag indicators
-        FlagStates = ("?", "-", "+", "0", "1", "P", "V")
+    # otherwise individual component parts of time known
+    else:
+        states = [[], []]
+        # get number of T states
+        k = (instructionTimes >> 1) & 7
+        # offset
+        i = 4
+        while k > 0:
+            t = ((instructionTimes >> i) & 3) + 3
+            states[0].append(t)
+            duration[0] += t
+            i += 2
+            k -= 1
+
+        # do alternative length if exists
+        k = (instructionTimes >> 16) & 7
+        i = 19
+        while k > 0:
+            t = ((instructionTimes >> i) & 3) + 3
+            states[1].append(t)
+            duration[1] += t
+            i += 2
+            k -= 1
+
+    return duration, states
+
+
+def _decodez80instruction(data, offset, address):
+    """Decodes the Z80 instruction starting at offset in data, which is
+    at the given address.
+    Returns the record from _Z80_DECODE_TABLE for the instruction, the
+    length of the instruction in bytes, and a list of the values for
+    the operands in the order they appear in the record's operand kinds.
+    The value for a relative jump is the address jumped to.  Raises
+    IndexError if the instruction runs beyond the end of data.
+    """
+
+    record = _Z80_DECODE_TABLE[data[offset]]
+    if record.__class__ is list:
+        record = record[data[offset + 1]]
+        # deal with DDCB or FDCB
+        if record.__class__ is list:
+            record = record[data[offset + 3]]
+
+    operands = record[5]
+    commandlength = record[3]
+    if operands == 0:
+        return record, commandlength, []
+
+    values = []
+    dataOffset = offset + record[4]
+    # displacement byte
+    if operands & 1:
+        values.append(data[dataOffset])
+        dataOffset += 1
+        commandlength += 1
+
+    # relative jump byte
+    if operands & 2:
+        i = data[dataOffset]
+        values.append(address + commandlength + 1 + (i if i < 128 else
+                                                     i - 256))
+        dataOffset += 1
+        commandlength += 1
+
+    # 2 byte address or number
+    if operands & 12:
+        values.append(data[dataOffset] + 256 * data[dataOffset + 1])
+        dataOffset += 2
+        commandlength += 2
+
+    # 1 byte number
+    if operands & 16:
+        values.append(data[dataOffset])
+        commandlength += 1
+
+    return record, commandlength, values
+
+
+class Z80Instruction:
+    """A compact record of a single Z80 instruction as returned by
+    disassembletorecords.
+
+    address is the address of the instruction.
+    code is a bytes object of the instruction's bytes.
+    opcode is an int identifying the instruction: the prefix bytes and
+      the opcode byte, but not any displacement or data bytes (so LD
+      (IX+d),n is 0xDD36 and RLC (IY+d) is 0xFDCB06).  It is None for
+      bytes at the end of the data that do not form a whole
+      instruction.  These are output one byte per record as DB.
+    mnemonic is the instruction with place holders for the operands:
+      d for displacements, j for relative jumps, aa for addresses, nn
+      for 2 byte numbers, and n for single byte numbers.
+    operands is a tuple of pairs of the place holder and it's value in
+      the order they appear in the mnemonic.  The value of a relative
+      jump is the address jumped to.
+    times is the timing word for the instruction (see Z80_OPCODE_TIMES).
+    flags is the flag word for the instruction (see Z80_OPCODE_DATA).
+    comment is a comment for the end of the line, or None.  This is
+      not set by disassembletorecords, but can be set by the caller
+      before the records are output.
+    """
+
+    __slots__ = ("address", "code", "opcode", "mnemonic", "operands",
+                 "times", "flags", "comment")
+
+    def __init__(self, address, code, opcode, mnemonic, operands, times,
+                 flags, comment=None):
+        self.address = address
+        self.code = code
+        self.opcode = opcode
+        self.mnemonic = mnemonic
+        self.operands = operands
+        self.times = times
+        self.flags = flags
+        self.comment = comment
+
+    def __len__(self):
+        return len(self.code)
+
+    def __repr__(self):
+        return "Z80Instruction({:04X}, {})".format(self.address,
+                                                   self.getinstruction())
+
+    def getinstruction(self, AddressOutput=0, NumberOutput=0):
+        """Returns the instruction text with the operands filled in.
+        AddressOutput and NumberOutput are the formats to use for
+        addresses and numbers: 0=hex, 1=decimal, 2=octal, 3=binary.
+        """
+
+        s = self.mnemonic
+        for kind, value in self.operands:
+            if kind == "d" or kind == "n":
+                fmt = _getnumberformat(8, NumberOutput)
+            elif kind == "nn":
+                fmt = _getnumberformat(16, NumberOutput)
+            else:
+                fmt = _getnumberformat(16, AddressOutput)
 
-        s = "S{} Z{} H{} PV{} N{} C{}".format(
-            FlagStates[(instructionData >> 17) & 7],
-            FlagStates[(instructionData >> 14) & 7],
-            FlagStates[(instructionData >> 11) & 7],
-            FlagStates[(instructionData >> 8) & 7],
-            FlagStates[(instructionData >> 5) & 7],
-            FlagStates[(instructionData >> 2) & 7])
+            s = s.replace(kind, fmt.format(value))
 
         return s
 
-    # extract timing information
-    def GetTimingInfo(instructionTimes):
-        # calculate times
-        # first clear variables where results will be calculated
-        duration = [0, 0]
-        states = None
+    def getflagchanges(self):
+        """Returns a string describing the effect of the instruction on
+        the flags, or None if not known.
+        """
 
-        # if only overall T length known then extract this now
-        if (instructionTimes & 0x1) != 0:
-            duration = [(instructionTimes >> 1) & 0x7FFF,
-                        (instructionTimes >> 17) & 0x7FFF]
+        return _getflagchanges(self.flags)
 
-        # otherwise individual component parts of time known
-        else:
-            states = [[], []]
-            # get number of T states
-            k = (instructionTimes >> 1) & 7
-            # offset
-            i = 4
-            while k > 0:
-                t = ((instructionTimes >> i) & 3) + 3
-                states[0].append(t)
-                duration[0] += t
-                i += 2
-                k -= 1
-
-            # do alternative length if exists
-            k = (instructionTimes >> 16) & 7
-            i = 19
-            while k > 0:
-                t = ((instructionTimes >> i) & 3) + 3
-                states[1].append(t)
-                duration[1] += t
-                i += 2
-                k -= 1
+    def gettiminginfo(self):
+        """Returns the T states that the instruction takes.  See
+        _gettiminginfo for details.
+        """
 
-        return duration, states
+        return _gettiminginfo(self.times)
 
-    def CommentOutput(comment, XMLOutput):
-        if XMLOutput == 1:
-            return "  <line><comment>" + comment + "</comment></line>"
-        else:
-            linestart = "\0" + chr(12) + chr(0) + "0000" + Seperator + ";"
-            return "\n".join([linestart + txt for txt in comment.split("\n")])
+    def isundocumented(self):
+        """Returns True if this is an undocumented instruction."""
 
-    # end nested functions
+        return ((self.flags >> 21) & 1) == 1
 
-    # holds how long address is in each number format
-    FormatAddressLength = (4, 5, 7, 17)
-    # holds how long byte is in each number format
-    FormatByteLength = (2, 3, 3, 8)
-    # holds max length of opcode for each number format
-    FormatOpCodeMaxLength = (19, 20, 21, 27)
+    def getreferences(self, TreatDataNumbersAsLineReferences=0):
+        """Returns a list of the addresses referenced by this
+        instruction: jump destinations, addresses, and unless
+        TreatDataNumbersAsLineReferences is 1, 2 byte numbers.
+        """
 
-    maxAddressLength = 0
+        return [value for kind, value in self.operands if kind in
+                ("j", "aa") or (kind == "nn" and
+                                TreatDataNumbersAsLineReferences == 0)]
 
-    # work out where we are
-    currentAddress = origin + offset
 
-    # validate and convert data to bytearray if needed
-    data = _validateandpreparebytes(data, "data")
+def _getz80instruction(data, offset, address):
+    """Decodes the Z80 instruction starting at offset in data, which is
+    at the given address, into a Z80Instruction.  Raises IndexError if
+    the instruction runs beyond the end of data.
+    """
 
-    # get list of line numbers that are being referenced
-    ReferencedLineNumbers = [currentAddress]
+    record, commandlength, values = _decodez80instruction(data, offset,
+                                                          address)
+    if offset + commandlength > len(data):
+        raise IndexError
 
-    # set format flags to default
-    AddressOutput = 0        # 0=hex,1=decimal,2=octal,3=binary
-    NumberOutput = 0         # 0=hex,1=decimal,2=octal,3=binary
-    CommandOutput = 0        # 0=hex,1=decimal,2=octal,3=binary
-    # 0=no, 1=total only, 2=list state times, 3=total & state times
-    OutputTStates = 0
-    # 0=no empty lines, 1=after absolute jumps/rets, 2=after all rets/jumps
-    BreakAfterJumps = 1
-    LineNumberOutput = 0     # 0=All, 1=None, 2=only referenced lines
-    # list every X lines regardless of LineNumberOutput
-    ListEveryXLines = 0
-    # 0=empty line after data, 1=no empty line after data
-    BreakAfterData = 0
-    # 0=track line numbers for display purposes, 1=don't
-    TreatDataNumbersAsLineReferences = 0
-    DisplayCommandBytes = 0  # 0=print them, 1=don't
-    DisplayComments = 0      # 0=display them, 1=don't
-    Seperator = "  "
-    ShowFlags = 0            # 0=no, 1=yes
-    MarkUndocumenedCommand = 0  # 0=no, 1=yes
-    XMLOutput = 0            # 0=no, 1=yes
-    HexForNonASCII = 0       # 0=no, 1=yes
-    CommentEnd = ""
-    CommentAfter = ""
-    CommentReferences = []
-    CommentDisplacementsX = [[[None, 0x10000, 0], []] for i in range(256)]
-    CommentDisplacementsY = [[[None, 0x10000, 0], []] for i in range(256)]
-    FunctionMatcher = re.compile(r"^\s*%![a-zA-Z_][a-zA-Z_0-9]*[(].*[)]\s*$",
-                                 re.DOTALL)
-    MatcherinBraces = re.compile(r"^\s*%[(]\s*%!([a-zA-Z_][a-zA-Z_0-9]*"
-                                 r"[(].*[)])\s*%[)](\s*%#[^\n]*?)?$",
-                                 re.DOTALL)
+    return Z80Instruction(address, bytes(data[offset:offset + commandlength]),
+                          record[6], record[0],
+                          tuple(zip(record[7], values)) if values else (),
+                          record[2], record[1])
 
-    # Work out how much there is to process for progress callback
-    # faster going through formatting at end than actual disassembling
-    # assume that phase 1 where process instructions will take 10%
-    # this may be wrong but good average: simple instructions will take
-    # less and complex will take longer.
-    worktodo1 = 0           # default no work pre-processing
-    worktodo2 = length * 2  # *2 for disassembling
-    worktodo3 = length      # for formatting
-    workdone = 0
-    # now look at special instructions as this can increase workload
-    if SpecialInstructions is not None and len(SpecialInstructions) > 0:
-        for di in SpecialInstructions:
-            worktodo1 += 1
-            if (di.instruction in [DisassembleInstruction.DISASSEMBLE_CODES[
-                    "Pattern Data Block"],
-                    DisassembleInstruction.DISASSEMBLE_CODES[
-                    "Comment Pattern"]]):
-                # work out start and end points
-                e = di.end
-                if e >= origin + len(data):
-                    e = origin + len(data)-1
-                s = di.start
-                if s < origin:
-                    s = origin
-                # must process once before disassembly
-                worktodo1 += (e - s) * 2
 
-    # process special instructions
-    DisassembleInstructions = []
-    if SpecialInstructions is not None and len(SpecialInstructions) > 0:
-        for di in SpecialInstructions:
-            # update progress
-            workdone += 1
-            # call progress update
-            if progressfunction is not None:
-                progressfunction("Evaluating Instructions",
-                                 workdone, worktodo1,
-                                 (workdone * 10) / worktodo1, 100)
+class ReferencedAddresses:
+    """A class to hold the addresses referenced in a disassembly, and
+    the addresses of the instructions that referenced them.  Checking
+    if an address is referenced takes constant time however many
+    addresses are held.  Iterating gives the referenced addresses in
+    ascending order.
 
-            # check if special formatting commands for default for whole
-            # output
-            if di.start == 0x0000 and di.end >= 0xFFFF:
-                if di.instruction & 0xFFFF00 == 0x000100:
-                    # AddressOutputFormat
-                    AddressOutput = di.instruction & 0x03
-                    continue
+    Can be created with an iterable of addresses, or with another
+    ReferencedAddresses to copy.
+    """
 
-                elif di.instruction & 0xFFFF00 == 0x000200:
-                    # NumberOutputFormat
-                    NumberOutput = di.instruction & 0x03
-                    continue
+    __slots__ = ("references",)
 
-                elif di.instruction & 0xFFFF00 == 0x000300:
-                    # CommandOutputFormat
-                    CommandOutput = di.instruction & 0x03
-                    continue
+    def __init__(self, addresses=None):
+        # dictionary of referenced address to set of addresses that
+        # referenced it
+        self.references = {}
+        if addresses is not None:
+            self.update(addresses)
 
-                elif di.instruction & 0xFFFF00 == 0x000400:
-                    # OutputTStatesFormat
-                    OutputTStates = di.instruction & 0x03
-                    continue
+    def add(self, address, source=None):
+        """Adds address as being referenced.  source is the address of
+        the instruction making the reference, or None if not known.
+        """
 
-                elif di.instruction & 0xFFFF00 == 0x000500:
-                    # LineAfterJumpOutputFormat
-                    BreakAfterJumps = di.instruction & 0x03
-                    continue
+        sources = self.references.get(address)
+        if sources is None:
+            sources = self.references[address] = set()
 
-                elif di.instruction & 0xFFFF00 == 0x000600:
-                    # DefaultFormat
-                    AddressOutput = di.instruction & 0x03
-                    NumberOutput = di.instruction & 0x03
-                    CommandOutput = di.instruction & 0x03
-                    OutputTStates = 0
-                    BreakAfterJumps = 1
-                    LineNumberOutput = 0
-                    ListEveryXLines = 0
-                    BreakAfterData = 0
-                    TreatDataNumbersAsLineReferences = 0
-                    DisplayCommandBytes = 0
-                    DisplayComments = 0
-                    Seperator = "  "
-                    ShowFlags = 0
-                    MarkUndocumenedCommand = 0
-                    XMLOutput = 0
-                    HexForNonASCII = 0
-                    continue
+        if source is not None:
+            sources.add(source)
 
-                elif(di.instruction & 0xFFFF00 == 0x000700):
-                    # CustomFormat
-                    settingstemp = get_custom_format_values(di.data, False)
-                    AddressOutput = settingstemp["AddressOutput"]
-                    NumberOutput = settingstemp["NumberOutput"]
-                    CommandOutput = settingstemp["CommandOutput"]
-                    OutputTStates = settingstemp["OutputTStates"]
-                    BreakAfterJumps = settingstemp["BreakAfterJumps"]
-                    LineNumberOutput = settingstemp["LineNumberOutput"]
-                    ListEveryXLines = settingstemp["ListEveryXLines"]
-                    BreakAfterData = settingstemp["BreakAfterData"]
-                    TreatDataNumbersAsLineReferences = settingstemp[
-                        "TreatDataNumbersAsLineReferences"]
-                    DisplayCommandBytes = settingstemp["DisplayCommandBytes"]
-                    DisplayComments = settingstemp["DisplayComments"]
-                    Seperator = settingstemp["Seperator"]
-                    ShowFlags = settingstemp["ShowFlags"]
-                    MarkUndocumenedCommand = settingstemp[
-                        "MarkUndocumenedCommand"]
-                    XMLOutput = settingstemp["XMLOutput"]
-                    HexForNonASCII = settingstemp["HexForNonASCII"]
-                    continue
+    def update(self, addresses):
+        """Adds all the addresses in an iterable of addresses, or in
+        another ReferencedAddresses along with where they are referenced
+        from.
+        """
 
-                elif di.instruction & 0xFFFF00 == 0x000800:
-                    # LineNumberOutput
-                    LineNumberOutput = di.instruction & 0x03
-                    continue
+        if isinstance(addresses, ReferencedAddresses):
+            for address, sources in addresses.references.items():
+                if address in self.references:
+                    self.references[address] |= sources
+                else:
+                    self.references[address] = set(sources)
 
-                elif di.instruction & 0xFFFF00 == 0x000900:
-                    # ListEveryXLines
-                    ListEveryXLines = int(di.data, 16)
-                    continue
+        else:
+            for address in addresses:
+                self.add(address)
 
-                elif di.instruction & 0xFFFF00 == 0x000A00:
-                    # BreakAfterData
-                    BreakAfterData = di.instruction & 0x01
-                    continue
+        return self
 
-                elif di.instruction & 0xFFFF00 == 0x000B00:
-                    # TreatDataNumbersAsLineReferences
-                    TreatDataNumbersAsLineReferences = di.instruction & 0x01
-                    continue
+    # allow += and |= to add addresses as with a list or set
+    __iadd__ = update
+    __ior__ = update
 
-                elif di.instruction & 0xFFFF00 == 0x000C00:
-                    # DisplayCommandBytes
-                    DisplayCommandBytes = di.instruction & 0x01
-                    continue
+    def __contains__(self, address):
+        return address in self.references
 
-                elif di.instruction & 0xFFFF00 == 0x000D00:
-                    # DisplayComments
-                    DisplayComments = di.instruction & 0x01
-                    continue
+    def __len__(self):
+        return len(self.references)
 
-                elif di.instruction & 0xFFFFFF == 0x000E00:
-                    # Seperator space
-                    Seperator = "  "
-                    continue
+    def __iter__(self):
+        return iter(sorted(self.references))
 
-                elif di.instruction & 0xFFFFFF == 0x000E01:
-                    # Seperator tab
-                    Seperator = "\t"
-                    continue
+    def __repr__(self):
+        return "ReferencedAddresses([{}])".format(
+            ", ".join(["0x{:04X}".format(a) for a in self]))
 
-                elif di.instruction & 0xFFFFFF == 0x000E02:
-                    # Seperator custom
-                    Seperator = di.data
-                    continue
+    def getxref(self):
+        """Returns a sorted list of pairs of the referenced address, and
+        a sorted list of the addresses it is referenced from.
+        """
 
-                elif di.instruction & 0xFFFF00 == 0x000F00:
-                    # Display flags
-                    ShowFlags = di.instruction & 0x01
-                    continue
+        return [(address, sorted(self.references[address])) for address in
+                sorted(self.references)]
 
-                elif di.instruction & 0xFFFF00 == 0x001000:
-                    # note undocumened commands
-                    MarkUndocumenedCommand = di.instruction & 0x01
-                    continue
+    def xreftotext(self, AddressOutput=0):
+        """Returns the cross reference as text, one referenced address
+        per line followed by the addresses it is referenced from.
+        AddressOutput is the format to use for addresses: 0=hex,
+        1=decimal, 2=octal, 3=binary.
+        """
 
-                elif di.instruction & 0xFFFF00 == 0x001200:
-                    # XML mode
-                    XMLOutput = di.instruction & 0x01
-                    continue
+        return "".join([_numbertostring(address, 16, AddressOutput,
+                                        False) + "  " +
+                        ",".join([_numbertostring(source, 16, AddressOutput,
+                                                  False) for source in
+                                  sources]) + "\n" for address, sources in
+                        self.getxref()])
 
-                elif di.instruction & 0xFFFF00 == 0x001300:
-                    # HexForNonASCII mode
-                    HexForNonASCII = di.instruction & 0x01
-                    continue
 
-            # check if end after end of code, in which case truncate it
-            if di.end >= origin + len(data):
-                di.end = origin + len(data)-1
+def getreferencedaddresses(records, TreatDataNumbersAsLineReferences=0):
+    """Returns a ReferencedAddresses of all the addresses referenced by
+    the instructions in records.
 
-            # check if start before start of code, but ends inside code,
-            # in which case truncate it
-            if di.start < origin and di.end > origin:
-                di.start = origin
+    records is a list of Z80Instruction such as that returned by
+    disassembletorecords.
+    TreatDataNumbersAsLineReferences is 0 if 2 byte numbers are treated
+    as addresses, and 1 if not.
+    """
 
-            # is this a patterndatablock instruction or a find&comment
-            if (di.instruction in [DisassembleInstruction.DISASSEMBLE_CODES[
-                    "Pattern Data Block"],
-                    DisassembleInstruction.DISASSEMBLE_CODES[
-                    "Comment Pattern"]]):
-                # get parts of patterndatablock
-                TestBlock, PrepBlock, ActionBlock = getpartsofpatterndatablock(
-                    di.data)
+    ra = ReferencedAddresses()
+    for record in records:
+        for address in record.getreferences(TreatDataNumbersAsLineReferences):
+            ra.add(address, record.address)
 
-                # first check is valid test block
-                if TestBlock is None:
-                    raise SpectrumTranslateError(
-                        "patern to search for must be inside brackets")
+    return ra
 
-                # now check is valid preperation block
-                if PrepBlock is None:
-                    raise SpectrumTranslateError(
-                        "preperation block must be inside brackets")
 
-                # now should have valid pattern match we can work with
+def disassembletorecords(data, offset, origin, length):
+    """This function will decode a byte string or list holding Z80
+    code into a list of Z80Instruction records without producing any
+    text.  Use this if you only need the addresses and instructions, or
+    want to produce your own output.  The records can be turned into
+    text with recordstotext.
 
-                # setup environment ready to search for matches
-                Settings = {"DATASTRINGPOS": 0,
-                            "NUMBERFORMAT": 0,
-                            "NUMBERSIGNED": 0,
-                            "NUMBERWORDORDER": 0,
-                            "DISPLAYEVERYXLINES": 1,
-                            "ORIGIONALSEPERATOR": Seperator,
-                            "SEPERATOR": Seperator,
-                            "ORIGIN": origin,
-                            "ADDRESSOUTPUT": AddressOutput,
-                            "NUMBEROUTPUT": NumberOutput,
-                            "COMMANDOUTPUT": CommandOutput,
-                            "XMLOutput": XMLOutput,
-                            "HexForNonASCII": HexForNonASCII,
-                            "InstructionsToAdd": []}
+    data must be a list or tuple of ints, or a bytes or bytearray object.
+    offset is how far into the array to start disassembling.
+    origin is the address of the first byte in the byte array.
+    length is how many bytes to disassemble
 
-                Vars = [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, di.start, 0, 0, di.start,
-                        di.end]
+    Returns a list of Z80Instruction.
+    """
 
-                # work done after done this
-                wdafter = workdone + ((di.end - di.start) * 2)
+    # validate and convert data to bytes if needed
+    data = bytes(_validateandpreparebytes(data, "data"))
 
-                matches = []
-                # handle predefined routine
-                match = MatcherinBraces.match(TestBlock)
-                if match:
-                    if progressfunction is not None:
-                        progressfunction("Evaluating Instructions", workdone,
-                                         worktodo1,
-                                         (workdone * 10) / worktodo1, 100)
-                    details = _ProcessFunctionDetails(match.group(1))
-                    if isinstance(details, str):
-                        raise SpectrumTranslateError(details)
+    records = []
+    address = origin + offset
+    while length > 0:
+        try:
+            record = _getz80instruction(data, offset, address)
 
-                    # check is valid command
-                    if (details[0] not in
-                       DisassembleInstruction.PredefinedRoutines):
-                        raise SpectrumTranslateError(
-                            'Routine "{}" not defined'.format(details[0]))
+        except IndexError:
+            # remaining bytes don't make an instruction so output them as
+            # data bytes
+            for b in data[offset:offset + length]:
+                records.append(Z80Instruction(address, bytes((b,)), None,
+                                              "DB n", (("n", b),), 1, 0))
+                address += 1
 
-                    # process routine
-                    Vars = [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, di.start, 0, 0,
-                            di.start, di.end]
-                    args = [data, Settings, Vars] + details[1]
-                    keyargs = details[2]
-                    matches = DisassembleInstruction.\
-                        PredefinedRoutines[details[0]](*args, **keyargs)
-                else:
-                    # search for matches using scripting language
+            break
 
-                    # move through area covered by instruction & check for
-                    # matches
-                    k = di.start
-                    while k <= di.end:
-                        # update progress
-                        workdone += 2
-                        # call progress update
-                        if progressfunction is not None:
-                            progressfunction("Evaluating Instructions",
-                                             workdone, worktodo1,
-                                             (workdone * 10) / worktodo1, 100)
-                        try:
-                            Settings["DATASTRINGPOS"] = 0
-                            Vars[0x00] = k
-                            Vars[0x01] = di.end
-                            Vars[0x0C] = 0
-                            Vars[0x0A] = k
-                            Vars[0x0D] = k
-                            Vars[0x0E] = di.end
-                            # test each address
-                            # will fail for Comment pattern but only after
-                            # pattern has been added
-                            if (_processcommandblock(TestBlock, Vars, Settings,
-                                                    data, True,
-                                                    True)[0] & 1) == 1:
-                                matches += [k]
-                            k += 1
+        records.append(record)
 
-                        except IndexError:
-                            # continue gracefully if test involves bytes
-                            # outside supplied data.
-                            continue
+        commandlength = len(record.code)
+        length -= commandlength
+        offset += commandlength
+        address += commandlength
 
-                blockdetails = []
-                # process matches if needed
-                match = MatcherinBraces.match(PrepBlock)
-                if len(matches) > 0 and _isarray(matches[0]):
-                    # matching routine has returned list of blockdetails
-                    blockdetails = matches
-                elif len(matches) > 0 and match:
-                    details = _ProcessFunctionDetails(match.group(1))
-                    if isinstance(details, str):
-                        raise SpectrumTranslateError(details)
+    return records
 
-                    # check is valid command
-                    if (details[0] not in
-                       DisassembleInstruction.PredefinedRoutines):
-                        raise SpectrumTranslateError(
-                            'Routine "{}" not defined'.format(details[0]))
 
-                    # process routine
-                    Vars = [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, di.start, 0, 0,
-                            di.start, di.end]
-                    args = [data, Settings, Vars, matches] + details[1]
-                    keyargs = details[2]
-                    blockdetails = DisassembleInstruction.\
-                        PredefinedRoutines[details[0]](*args, **keyargs)
-                elif len(matches) > 0:
-                    # process matches using scripting
-                    for k in matches:
-                        try:
-                            Settings["DATASTRINGPOS"] = 0
-                            Vars[0x00] = k
-                            Vars[0x01] = di.end
-                            Vars[0x0C] = 0
-                            Vars[0x0A] = k
-                            Vars[0x0D] = k
-                            Vars[0x0E] = di.end
-                            # now adjust variables as needed
-                            _processcommandblock(PrepBlock, Vars, Settings,
-                                                 data, True, False)
-                            blockdetails += [[Vars[0x00], Vars[0x01]]]
-                        except IndexError:
-                            # continue gracefully if test involves bytes
-                            # outside supplied data.
-                            continue
+def recordstotext(records, AddressOutput=0, NumberOutput=0, CommandOutput=0,
+                  XMLOutput=0):
+    """Renders a list of Z80Instruction records as returned by
+    disassembletorecords as text.  The instructions are rendered in the
+    same way as disassemble does with no special instructions other
+    than the given formats, along with any comments set in the records.
+    Other special instructions such as data blocks, line number output,
+    and comments are not supported: use disassemble for these.  Bytes
+    at the end that don't make a whole instruction are listed as DB in
+    the NumberOutput format, whereas disassemble always lists them in
+    hex.
 
-                # add data blocks
-                for start, end in blockdetails:
-                    # add datablock
-                    DisassembleInstructions += [DisassembleInstruction(
-                        DisassembleInstruction.DISASSEMBLE_CODES["Data Block"],
-                        start, end, ActionBlock)]
+    AddressOutput, NumberOutput, and CommandOutput are the formats to
+      use for addresses, numbers, and command bytes: 0=hex, 1=decimal,
+      2=octal, 3=binary.
+    XMLOutput is 1 if you want XML output, or 0 for plain text.
 
-                    # increase work in disassembly phase for each block
-                    worktodo2 += (end - start) * 2
+    Returns a String representation of the records.
+    """
 
-                # if have instructions, add them
-                if len(Settings["InstructionsToAdd"]) > 0:
-                    DisassembleInstructions += Settings["InstructionsToAdd"]
+    if not records:
+        return ""
 
-                workdone = wdafter
+    # holds how long address is in each number format
+    FormatAddressLength = (4, 5, 7, 17)
 
-                continue
+    # default format settings other than those given
+    lineformat = (AddressOutput, NumberOutput, CommandOutput, 0, 1, 0, 0, 0,
+                  0, "  ", 0, 0, XMLOutput)
 
-            # check if is reference instruction
-            if di.instruction == DisassembleInstruction.DISASSEMBLE_CODES[
-                    "Reference Line"]:
-                ReferencedLineNumbers += [di.start]
-                continue
+    if XMLOutput == 1:
+        items = ['<?xml version="1.0" encoding="UTF-8" ?>', '<z80code>',
+                 '  <org>' + _numbertostring(records[0].address, 16,
+                                             AddressOutput) + '</org>']
+    else:
+        items = ['ORG ' + _numbertostring(records[0].address, 16,
+                                          AddressOutput), '']
 
-            if di.instruction == DisassembleInstruction.DISASSEMBLE_CODES[
-                    "Data Block"]:
-                # increase work in disassembly phase
-                worktodo2 += (di.end - di.start) * 2
+    inData = False
+    for record in records:
+        if record.opcode is not None:
+            items.append((record, lineformat, ""))
+            continue
 
-            # add instruction to list of stuff to do during disassembly
-            DisassembleInstructions += [di]
+        # trailing data bytes
+        number = _numbertostring(record.code[0], 8, NumberOutput, True)
+        if XMLOutput == 1:
+            items.append(
+                "  <line><address>{}</address><instruction>DB"
+                "</instruction><data>{}</data></line>".format(
+                    _numbertostring(record.address, 16, AddressOutput,
+                                    False), number))
+        else:
+            items.append((AddressOutput + 4, 1, record.address,
+                          "    DB  " + number))
 
-        # sort instructions by their start address
-        DisassembleInstructions = sorted(DisassembleInstructions,
-                                         key=attrgetter('start', 'end'))
+        inData = True
 
-    # should now be sorted along by start
+    if inData and XMLOutput == 0:
+        items.append("")
 
-    # adjust workdone to be 10% of total work to stop progress going
-    # backwards with extra work in disassembly phase
-    worktodo1 = (worktodo2 + worktodo3) / 9
-    workdone = 0
+    items.append("</z80code>" if XMLOutput == 1 else "")
 
-    # set up format stack to hold current format
-    # hold formatting instructions
-    s = get_custom_format_string(AddressOutput, NumberOutput, CommandOutput,
-                                 OutputTStates, BreakAfterJumps,
-                                 LineNumberOutput, ListEveryXLines,
-                                 BreakAfterData,
-                                 TreatDataNumbersAsLineReferences,
-                                 DisplayCommandBytes, DisplayComments,
-                                 Seperator, ShowFlags, MarkUndocumenedCommand,
-                                 XMLOutput, HexForNonASCII)
-    Format = [DisassembleInstruction(DisassembleInstruction.DISASSEMBLE_CODES[
-        "Custom Format"], 0, 65536, s)]
-    CurrentFormatEnd = 65536  # end after
+    # disassemble only pads addresses if there are lines of code
+    maxAddressLength = 0
+    if XMLOutput == 0 and any(record.opcode is not None for record in
+                              records):
+        maxAddressLength = FormatAddressLength[AddressOutput]
 
-    # hold data formatting instructions
-    nextDataFormatStart = 65536  # start after
-    nextDataFormatEnd = 65536    # end after
+    return "\n".join(_renderdisassembly(items, ReferencedAddresses(),
+                                        maxAddressLength))
 
-    # output start text
-    if XMLOutput == 1:
-        soutput = ['<?xml version="1.0" encoding="UTF-8" ?>', '<z80code>',
-                   '  <org>' + _numbertostring(currentAddress, 16,
-                                               AddressOutput) + '</org>']
 
+def disassemble(data, offset, origin, length, SpecialInstructions=None,
+                progressfunction=None, referencedaddresses=None, cache=None):
+    """This function will disassemble a byte string or list holding Z80
+    code.  You can specify instructions to alter the disassembled
+    output.
+
+    data must be a list or tuple of ints, or a bytes or bytearray object.
+    offset is how far into the array to start disassembling.
+    origin is the address of the first byte in the byte array.
+    length is how many bytes to disassemble
+    SpecialInstructions is a list of DisassembleInstruction instructing
+    things like output format, and data blocks.  Should be None if no
+    array to pass.
+    progressfunction is a function that takes X arguments. The first is
+    a string detailing what the Disassembler is currently doing.  The
+    second is how far through the current section of work it is, and
+    the third is how much work there is in the current section.  To get
+    a percentage of how much work in the current section use argument2
+    / argument3 * 100. The fourth argument gives the overall work done,
+    and the fifth argument the overall work to do. Note that the work
+    done can change, and the total work to do can increase as the
+    disassembly progresses, but the ratio (and thus the percentage work
+    done) will never decrease.
+    referencedaddresses is a ReferencedAddresses object that is filled
+    with the addresses referenced by the disassembled code along with
+    where they were referenced from.  Use this to produce a cross
+    reference of the disassembly.  Any addresses already in it are
+    treated as being referenced.  Should be None if not wanted.
+    cache is a DisassemblyCache to look up the result in before
+    disassembling, and to remember the result in afterwards.  Note that
+    if the result is found in the cache then SpecialInstructions are not
+    altered as they would be by disassembling.  Should be None if not
+    wanted.
+
+    Returns a String representation of the data.
+    """
+
+    # get list of line numbers that are being referenced
+    if referencedaddresses is None:
+        ReferencedLineNumbers = ReferencedAddresses()
     else:
-        soutput = ['ORG ' + _numbertostring(currentAddress, 16, AddressOutput),
-                   '']
+        ReferencedLineNumbers = referencedaddresses
+
+    # see if already have result
+    if cache is not None:
+        key = DisassemblyCache.getkey(data, offset, origin, length,
+                                      SpecialInstructions,
+                                      ReferencedLineNumbers)
+        result = cache.get(key)
+        if result is not None:
+            for address, sources in result[1]:
+                ReferencedLineNumbers.add(address)
+                for source in sources:
+                    ReferencedLineNumbers.add(address, source)
 
-    # start disassembling
-    while length > 0:
-        # call progress update
-        if progressfunction is not None:
-            progressfunction("Disassembling", workdone, worktodo2,
-                             workdone + worktodo1,
-                             worktodo1 + worktodo2 + worktodo3)
+            if progressfunction is not None:
+                progressfunction("Done", 100, 100, 100, 100)
 
-        # are we exiting format section?
-        if currentAddress > CurrentFormatEnd:
-            # if so recover details of underlying format
-            diTemp = Format.pop()
-            settingstemp = get_custom_format_values(diTemp.data, False)
-            AddressOutput = settingstemp["AddressOutput"]
-            NumberOutput = settingstemp["NumberOutput"]
-            CommandOutput = settingstemp["CommandOutput"]
-            OutputTStates = settingstemp["OutputTStates"]
-            BreakAfterJumps = settingstemp["BreakAfterJumps"]
-            LineNumberOutput = settingstemp["LineNumberOutput"]
-            ListEveryXLines = settingstemp["ListEveryXLines"]
-            BreakAfterData = settingstemp["BreakAfterData"]
-            TreatDataNumbersAsLineReferences = settingstemp[
-                "TreatDataNumbersAsLineReferences"]
-            DisplayCommandBytes = settingstemp["DisplayCommandBytes"]
-            DisplayComments = settingstemp["DisplayComments"]
-            Seperator = settingstemp["Seperator"]
-            ShowFlags = settingstemp["ShowFlags"]
-            MarkUndocumenedCommand = settingstemp["MarkUndocumenedCommand"]
-            XMLOutput = settingstemp["XMLOutput"]
-            HexForNonASCII = settingstemp["HexForNonASCII"]
+            return result[0]
 
-            CurrentFormatEnd = diTemp.end
-            continue
+    soutput = _disassembletotext(data, offset, origin, length,
+                                 SpecialInstructions, progressfunction,
+                                 ReferencedLineNumbers)
 
-        # remove expired comment references
-        if CommentReferences and currentAddress >= CommentReferences[0].end:
-            CommentReferences = [x for x in CommentReferences if
-                                 x.end > currentAddress]
+    # remember result
+    if cache is not None:
+        cache.put(key, soutput, ReferencedLineNumbers.getxref())
 
-        # skip past instructions not relavent to code
-        while DisassembleInstructions and \
-              currentAddress > DisassembleInstructions[0].end:
-            DisassembleInstructions.pop(0)
-        # get instruction or set to None
-        if (DisassembleInstructions and
-           currentAddress >= DisassembleInstructions[0].start):
-            di = DisassembleInstructions.pop(0)
-        else:
-            di = None
+    return soutput
 
-        # first check if in data block
-        if (di is not None and
-           di.instruction == DisassembleInstruction.DISASSEMBLE_CODES[
-               "Data Block"]):
-            Settings = {"DATASTRINGPOS": 0,
-                        "NUMBERFORMAT": 0,
-                        "NUMBERSIGNED": 0,
-                        "NUMBERWORDORDER": 0,
-                        "DISPLAYEVERYXLINES": 1,
-                        "ORIGIONALSEPERATOR": Seperator,
-                        "SEPERATOR": Seperator,
-                        "ORIGIN": origin,
-                        "ADDRESSOUTPUT": AddressOutput,
-                        "NUMBEROUTPUT": NumberOutput,
-                        "COMMANDOUTPUT": CommandOutput,
-                        "XMLOutput": XMLOutput,
-                        "HexForNonASCII": HexForNonASCII,
-                        "COMMENTCONTROL": [DisassembleInstructions,
-                                           DisplayComments, CommentEnd,
-                                           CommentAfter, CommentOutput]}
-            if TreatDataNumbersAsLineReferences == 0:
-                Settings["ReferencedLineNumbers"] = ReferencedLineNumbers
 
-            if FunctionMatcher.match(di.data):
-                details = _ProcessFunctionDetails(di.data.strip()[2:])
-                if isinstance(details, str):
-                    raise SpectrumTranslateError(details)
+def _disassembletotext(data, offset, origin, length, SpecialInstructions,
+                       progressfunction, ReferencedLineNumbers,
+                       markstart=True):
+    """Does the disassembling for disassemble and disassemblebatch, and
+    returns the text of the disassembly.  markstart is False if the
+    start of the code isn't to be counted as referenced.
+    """
 
-                # check is valid command
-                if (details[0] not in
-                   DisassembleInstruction.PredefinedRoutines):
-                    raise SpectrumTranslateError(
-                        'Routine "{}" not defined'.format(details[0]))
+    # disassemble the code
+    Details = {}
+    items = []
+    for lineitems in _disassemble(data, offset, origin, length,
+                                  SpecialInstructions, progressfunction,
+                                  ReferencedLineNumbers, Details, False,
+                                  markstart):
+        items += lineitems
+
+    workdone = Details["WorkDone"]
+    worktodo = Details["WorkToDo"]
+
+    def progressitems():
+        count = len(items)
+        for k, item in enumerate(items):
+            # call progress update
+            progressfunction("Formatting", k, count,
+                             ((k * worktodo) / count) + workdone,
+                             workdone + worktodo)
+            yield item
 
-                # process routine
-                Vars = [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, di.start, 0, 0, di.start,
-                        di.end]
-                args = [data, Settings, Vars] + details[1]
-                keyargs = details[2]
-                result = DisassembleInstruction.PredefinedRoutines[details[0]](
-                    *args, **keyargs)
-                # adjust end of data block
-                di.end = Vars[10] - 1
-                # extract text from result
-                if isinstance(result, str):
-                    txt = result
-                elif (_isarray(result) and len(result) > 0 and
-                     isinstance(result[0], str)):
-                    txt = result[0]
-                elif (_isarray(result) and len(result) > 1 and
-                     isinstance(result[1], str)):
-                    txt = result[1]
-                else:
-                    txt = ""
-            else:
-                di.end, txt = di.disassembledatablock(Settings, data)
+    # now that know all referenced lines, render the lines
+    soutput = "\n".join(_renderdisassembly(
+        items if progressfunction is None else progressitems(),
+        ReferencedLineNumbers, Details["MaxAddressLength"]))
 
-            if txt.endswith("\n"):
-                txt = txt[:-1]
-            soutput += txt.split("\n")
+    # report job done
+    if progressfunction is not None:
+        progressfunction("Done", 100, 100, workdone + worktodo,
+                         workdone + worktodo)
 
-            # update comments
-            CommentEnd = Settings["COMMENTCONTROL"][2]
-            CommentAfter = Settings["COMMENTCONTROL"][3]
+    return soutput
 
-            # adjust length
-            length -= di.end-currentAddress + 1
 
-            # before update address, check for formatting that might
-            # have been missed
-            for ditemp in DisassembleInstructions:
-                # ensure is line after data and applies to this block
-                if (ditemp.instruction & 0xFFFFFF00 == 0xA00 and
-                   ditemp.start <= currentAddress and
-                   ditemp.end >= di.end):
-                    # record current format state in custom, place on stack
-                    s = get_custom_format_string(
-                        AddressOutput, NumberOutput, CommandOutput,
-                        OutputTStates, BreakAfterJumps, LineNumberOutput,
-                        ListEveryXLines, BreakAfterData,
-                        TreatDataNumbersAsLineReferences, DisplayCommandBytes,
-                        DisplayComments, Seperator, ShowFlags,
-                        MarkUndocumenedCommand, XMLOutput, HexForNonASCII)
-                    Format += [DisassembleInstruction(
-                        DisassembleInstruction.DISASSEMBLE_CODES[
-                            "Custom Format"],
-                        currentAddress, CurrentFormatEnd, s)]
-                    # update breakafterdata setting
-                    BreakAfterData = ditemp.instruction & 0x01
-                    # remember when format ends
-                    CurrentFormatEnd = ditemp.end
-                    # remove format command
-                    DisassembleInstructions.remove(ditemp)
+def disassemble_iter(data, offset, origin, length, SpecialInstructions=None,
+                     progressfunction=None, referencedaddresses=None,
+                     cache=None):
+    """This function works like disassemble, but is a generator that
+    yields the lines of the disassembly (without newline characters) as
+    they are produced rather than building the whole disassembly in
+    memory.  "\\n".join(disassemble_iter(...)) gives the same result as
+    disassemble(...).
+
+    To know which lines are referenced and how wide the line addresses
+    are before any lines are output, the code is first scanned without
+    producing any output, so the disassembly is worked through twice.
+
+    The arguments are the same as for disassemble.  The
+    progressfunction is only called for the second pass which produces
+    the output.  If cache is used then the lines are still output as
+    they are produced, and the result is remembered once they all have
+    been.
+    """
 
-            # point to end of data block
-            currentAddress = di.end + 1
+    # get list of line numbers that are being referenced
+    if referencedaddresses is None:
+        ReferencedLineNumbers = ReferencedAddresses()
+    else:
+        ReferencedLineNumbers = referencedaddresses
+
+    # see if already have result
+    if cache is not None:
+        key = DisassemblyCache.getkey(data, offset, origin, length,
+                                      SpecialInstructions,
+                                      ReferencedLineNumbers)
+        result = cache.get(key)
+        if result is not None:
+            for address, sources in result[1]:
+                ReferencedLineNumbers.add(address)
+                for source in sources:
+                    ReferencedLineNumbers.add(address, source)
+
+            for line in result[0].split("\n"):
+                yield line
 
-            # adjust offset
-            offset = currentAddress-origin
+            if progressfunction is not None:
+                progressfunction("Done", 100, 100, 100, 100)
 
-            # update work done
-            workdone += (di.end - di.start) * 2
+            return
 
-            # put empty line after data if needed
-            if (("LINEAFTERDATA" in Settings and Settings["LINEAFTERDATA"]) or
-               (BreakAfterData == 0 and "LINEAFTERDATA" not in Settings)):
-                soutput += ['']
+        # keep lines to remember once all have been output
+        soutput = []
 
-            continue
+    # prescan to find referenced lines, and width of addresses.  Work on
+    # a copy of the instructions as they are changed by disassembling
+    Details = {}
+    for lines in _disassemble(
+            data, offset, origin, length, None if SpecialInstructions is
+            None else [DisassembleInstruction(di) for di in
+                       SpecialInstructions], None, ReferencedLineNumbers,
+            Details, True):
+        pass
 
-        # check formatting command
-        if di is not None and di.isformatinstruction():
-            # record current format state in custom, place on stack
-            s = get_custom_format_string(AddressOutput, NumberOutput,
-                                         CommandOutput, OutputTStates,
-                                         BreakAfterJumps, LineNumberOutput,
-                                         ListEveryXLines, BreakAfterData,
-                                         TreatDataNumbersAsLineReferences,
-                                         DisplayCommandBytes, DisplayComments,
-                                         Seperator, ShowFlags,
-                                         MarkUndocumenedCommand, XMLOutput,
-                                         HexForNonASCII)
-            Format += [DisassembleInstruction(
-                DisassembleInstruction.DISASSEMBLE_CODES["Custom Format"],
-                currentAddress, CurrentFormatEnd, s)]
+    maxAddressLength = Details["MaxAddressLength"]
 
-            # deal with format commands
-            if di.instruction & 0xFFFF00 == 0x000100:
-                # AddressOutputFormat
-                AddressOutput = di.instruction & 0x03
+    # now output lines as they are disassembled
+    for line in _renderdisassembly(chain.from_iterable(_disassemble(
+            data, offset, origin, length, SpecialInstructions,
+            progressfunction, ReferencedLineNumbers, Details)),
+            ReferencedLineNumbers, maxAddressLength):
+        if cache is not None:
+            soutput.append(line)
 
-            elif di.instruction & 0xFFFF00 == 0x000200:
-                # NumberOutputFormat
-                NumberOutput = di.instruction & 0x03
+        yield line
 
-            elif di.instruction & 0xFFFF00 == 0x000300:
-                # CommandOutputFormat
-                CommandOutput = di.instruction & 0x03
+    # remember result
+    if cache is not None:
+        cache.put(key, "\n".join(soutput), ReferencedLineNumbers.getxref())
 
-            elif di.instruction & 0xFFFF00 == 0x000400:
-                # OutputTStatesFormat
-                OutputTStates = di.instruction & 0x03
+    # report job done
+    if progressfunction is not None:
+        worktodo = Details["WorkDone"] + Details["WorkToDo"]
+        progressfunction("Done", 100, 100, worktodo, worktodo)
+
+
+class DisassemblyCache:
+    """A class to remember the results of disassemble so that
+    disassembling the same code with the same instructions again returns
+    the remembered result rather than disassembling it again.  Pass it
+    to disassemble as the cache argument.
+
+    Results are remembered in memory, with the least recently used ones
+    forgotten once there are more than maxentries of them.  If cachedir
+    is the name of a directory then the results are also saved there
+    compressed, one file per result, so that they can be used by later
+    runs.  Once the files take up more than maxdisksize bytes, the least
+    recently used ones are deleted.
+
+    A result is looked up by a hash of the code being disassembled
+    (along with the few bytes after it that the last instruction could
+    use), it's address, the packed special instructions (see
+    DisassembleInstruction.__str__), and any addresses already marked as
+    referenced.  This means the same code is found in the cache wherever
+    it is in the data.  Special instructions other than those setting
+    the output format can look at any of the data, so if there are any
+    then all of the data and the origin are hashed as well.  Predefined
+    functions and routines used by the instructions are assumed to
+    always give the same result for the same input.
+    """
 
-            elif di.instruction & 0xFFFF00 == 0x000500:
-                # LineAfterJumpOutputFormat
-                BreakAfterJumps = di.instruction & 0x03
+    def __init__(self, cachedir=None, maxentries=128, maxdisksize=0x4000000):
+        self.cachedir = cachedir
+        self.maxentries = maxentries
+        self.maxdisksize = maxdisksize
+        # key to (disassembly text, cross reference)
+        self.entries = OrderedDict()
+        self.memoryhits = 0
+        self.diskhits = 0
+        self.misses = 0
+        self.disksize = 0
+
+        if cachedir is not None:
+            if not os.path.isdir(cachedir):
+                os.makedirs(cachedir)
+
+            self.disksize = sum([os.path.getsize(f) for f in
+                                 self._getcachefiles()])
+
+    def _getcachefiles(self):
+        return [os.path.join(self.cachedir, name) for name in
+                os.listdir(self.cachedir) if name.endswith(".stc")]
+
+    def _getfilename(self, key):
+        return os.path.join(self.cachedir, key + ".stc")
+
+    @staticmethod
+    def getkey(data, offset, origin, length, SpecialInstructions=None,
+               referencedaddresses=None):
+        """Returns the key used to remember a disassembly with the given
+        arguments to disassemble.
+        """
 
-            elif di.instruction & 0xFFFF00 == 0x000600:
-                # DefaultFormat
-                AddressOutput = di.instruction & 0x03
-                NumberOutput = di.instruction & 0x03
-                CommandOutput = di.instruction & 0x03
-                OutputTStates = 0
-                BreakAfterJumps = 1
-                LineNumberOutput = 0
-                ListEveryXLines = 0
-                BreakAfterData = 0
-                TreatDataNumbersAsLineReferences = 0
-                DisplayCommandBytes = 0
-                DisplayComments = 0
-                Seperator = "  "
-                ShowFlags = 0
-                MarkUndocumenedCommand = 0
-                XMLOutput = 0
-                HexForNonASCII = 0
+        data = _validateandpreparebytes(data, "data")
 
-            elif di.instruction & 0xFFFF00 == 0x000700:
-                # CustomFormat
-                settingstemp = get_custom_format_values(di.data, False)
-                AddressOutput = settingstemp["AddressOutput"]
-                NumberOutput = settingstemp["NumberOutput"]
-                CommandOutput = settingstemp["CommandOutput"]
-                OutputTStates = settingstemp["OutputTStates"]
-                BreakAfterJumps = settingstemp["BreakAfterJumps"]
-                LineNumberOutput = settingstemp["LineNumberOutput"]
-                ListEveryXLines = settingstemp["ListEveryXLines"]
-                BreakAfterData = settingstemp["BreakAfterData"]
-                TreatDataNumbersAsLineReferences = settingstemp[
-                    "TreatDataNumbersAsLineReferences"]
-                DisplayCommandBytes = settingstemp["DisplayCommandBytes"]
-                DisplayComments = settingstemp["DisplayComments"]
-                Seperator = settingstemp["Seperator"]
-                ShowFlags = settingstemp["ShowFlags"]
-                MarkUndocumenedCommand = settingstemp["MarkUndocumenedCommand"]
-                XMLOutput = settingstemp["XMLOutput"]
-                HexForNonASCII = settingstemp["HexForNonASCII"]
+        # the last instruction can use up to 3 bytes after the code
+        h = hashlib.sha256(data[offset:offset + length + 3])
+        h.update("#{}#{}\n".format(origin + offset, length).encode())
+        if SpecialInstructions is not None:
+            for di in SpecialInstructions:
+                h.update((str(di) + "\n").encode())
 
-            elif di.instruction & 0xFFFF00 == 0x000800:
-                # LineNumberOutput
-                LineNumberOutput = di.instruction & 0x03
+            # instructions other than formatting can use any of the data
+            if [di for di in SpecialInstructions if di.instruction >=
+                    DisassembleInstruction.DISASSEMBLE_CODES["Data Block"]]:
+                h.update(data)
+                h.update("#{}\n".format(origin).encode())
 
-            elif di.instruction & 0xFFFF00 == 0x000900:
-                # ListEveryXLines
-                ListEveryXLines = int(di.data, 16)
+        if referencedaddresses:
+            h.update(",".join(["{:X}".format(address) for address in
+                               referencedaddresses]).encode())
 
-            elif di.instruction & 0xFFFF00 == 0x000A00:
-                # BreakAfterData
-                BreakAfterData = di.instruction & 0x01
+        return h.hexdigest()
 
-            elif di.instruction & 0xFFFF00 == 0x000B00:
-                # TreatDataNumbersAsLineReferences
-                TreatDataNumbersAsLineReferences = di.instruction & 0x01
+    def get(self, key):
+        """Returns the disassembly text and cross reference (as
+        returned by ReferencedAddresses.getxref) remembered for key, or
+        None if there isn't one.
+        """
 
-            elif di.instruction & 0xFFFF00 == 0x000C00:
-                # DisplayCommandBytes
-                DisplayCommandBytes = di.instruction & 0x01
+        result = self.entries.get(key)
+        if result is not None:
+            self.entries.move_to_end(key)
+            self.memoryhits += 1
+            return result
 
-            elif di.instruction & 0xFFFF00 == 0x000D00:
-                # DisplayComments
-                DisplayComments = di.instruction & 0x01
+        if self.cachedir is not None:
+            try:
+                filename = self._getfilename(key)
+                with open(filename, "rb") as f:
+                    result = json.loads(zlib.decompress(f.read()).decode())
 
-            elif di.instruction & 0xFFFFFF == 0x000E00:
-                # Seperator space
-                Seperator = "  "
+                result = (result[0], [(address, sources) for address,
+                                      sources in result[1]])
+                # mark as recently used
+                os.utime(filename, None)
 
-            elif di.instruction & 0xFFFFFF == 0x000E01:
-                # Seperator tab
-                Seperator = "\t"
+            except (IOError, OSError, ValueError, zlib.error):
+                result = None
 
-            elif di.instruction & 0xFFFFFF == 0x000E02:
-                # Seperator custom
-                Seperator = di.data
+            if result is not None:
+                self.diskhits += 1
+                self._remember(key, result)
+                return result
 
-            elif di.instruction & 0xFFFF00 == 0x000F00:
-                # Display flags
-                ShowFlags = di.instruction & 0x01
+        self.misses += 1
+        return None
 
-            elif di.instruction & 0xFFFF00 == 0x001000:
-                # note undocumened commands
-                MarkUndocumenedCommand = di.instruction & 0x01
+    def put(self, key, text, xref):
+        """Remembers the disassembly text and cross reference (as
+        returned by ReferencedAddresses.getxref) for key.
+        """
 
-            elif di.instruction & 0xFFFF00 == 0x001200:
-                # XML mode
-                XMLOutput = di.instruction & 0x01
+        self._remember(key, (text, xref))
 
-            elif di.instruction & 0xFFFF00 == 0x001300:
-                # HexForNonASCII mode
-                HexForNonASCII = di.instruction & 0x01
+        if self.cachedir is None:
+            return
 
-            CurrentFormatEnd = di.end
-            continue
+        filename = self._getfilename(key)
+        if os.path.exists(filename):
+            self.disksize -= os.path.getsize(filename)
 
-        # check is comment
-        if (di is not None and di.instruction & 0xFFFF00 == 0x030000 and
-           di.data is not None and di.data != ""):
-            # handle commenmts before this line first
+        # write to temporary file first so that other processes never
+        # see a partly written file
+        tempname = "{}.{}.tmp".format(filename, os.getpid())
+        with open(tempname, "wb") as f:
+            f.write(zlib.compress(json.dumps([text, xref]).encode()))
+
+        os.replace(tempname, filename)
+        self.disksize += os.path.getsize(filename)
+
+        # remove least recently used files if using too much space
+        if self.disksize > self.maxdisksize:
+            for name in sorted(self._getcachefiles(),
+                               key=os.path.getmtime):
+                if self.disksize <= self.maxdisksize:
+                    break
+
+                if name == filename:
+                    continue
+
+                self.disksize -= os.path.getsize(name)
+                os.remove(name)
+
+    def _remember(self, key, result):
+        self.entries[key] = result
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxentries:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        """Forgets all remembered results, including any saved in
+        cachedir.
+        """
+
+        self.entries.clear()
+        if self.cachedir is not None:
+            for name in self._getcachefiles():
+                os.remove(name)
+
+        self.disksize = 0
+
+    def getstats(self):
+        """Returns a dictionary of how well the cache is doing: the
+        number of results found in memory ("memoryhits"), found on disk
+        ("diskhits"), and not found ("misses"), as well as the number of
+        results held in memory ("entries") and the bytes used on disk
+        ("disksize").
+        """
+
+        return {"memoryhits": self.memoryhits,
+                "diskhits": self.diskhits,
+                "misses": self.misses,
+                "entries": len(self.entries),
+                "disksize": self.disksize}
+
+
+def getdisassemblyjobs(data, offset, origin, length, parts,
+                       SpecialInstructions=None):
+    """This function splits the disassembly of a block of code into
+    jobs for disassemblebatch.  The code is split into roughly equal
+    parts at the start of instructions, so that each part starts where
+    disassembling the whole block would have, and no data block is split
+    between parts.  This is only known for data blocks given as "Data
+    Block" instructions; data blocks found by a "Pattern Data Block"
+    can still be split.
+
+    The instructions are decoded once without being disassembled to
+    find where they start and the addresses they reference.  These
+    addresses are given to every part so that lines referenced from
+    other parts are marked as referenced.  References made by data
+    block scripts are not found this way, and code in data blocks found
+    by a "Pattern Data Block" is treated as code, so these can mark
+    lines differently to disassembling the whole block in one go.
+
+    data, offset, origin, length, and SpecialInstructions are as for
+    disassemble.
+    parts is how many parts to split the code into.
+
+    Returns a list of (data, offset, origin, length,
+    SpecialInstructions, referencedaddresses) tuples with only the
+    bytes of each part, a copy of SpecialInstructions for each part,
+    and the ReferencedAddresses of the whole of the code.
+    """
+
+    # validate and convert data to bytearray if needed
+    data = _validateandpreparebytes(data, "data")
+
+    # the start of the code is referenced
+    ReferencedLineNumbers = ReferencedAddresses([origin + offset])
+
+    # get list of data blocks as code does not restart until after
+    # them, and where 2 byte numbers aren't treated as references
+    datablocks = []
+    numberformats = []
+    TreatDataNumbersAsLineReferences = 0
+    if SpecialInstructions is not None:
+        for di in SpecialInstructions:
             if di.instruction == DisassembleInstruction.DISASSEMBLE_CODES[
-                    "Comment Before"]:
-                if DisplayComments == 0:
-                    soutput += CommentOutput(di.data, XMLOutput).split("\n")
+                    "Data Block"]:
+                datablocks.append((di.start, di.end))
+                continue
 
+            if di.instruction == DisassembleInstruction.DISASSEMBLE_CODES[
+                    "Reference Line"]:
+                ReferencedLineNumbers.add(di.start)
                 continue
-            # otherwise comnment end of this line or after
-            if di.instruction == 0x030002:
-                if CommentAfter != "":
-                    CommentAfter += "\n"
-                CommentAfter += di.data
+
+            if di.instruction & 0xFFFF00 == 0x000B00:
+                # TreatDataNumbersAsLineReferences
+                value = di.instruction & 0x01
+            elif di.instruction & 0xFFFF00 == 0x000600:
+                # DefaultFormat
+                value = 0
+            elif di.instruction & 0xFFFF00 == 0x000700:
+                # CustomFormat
+                value = get_custom_format_values(di.data, False)[
+                    "TreatDataNumbersAsLineReferences"]
             else:
-                if CommentEnd != "":
-                    CommentEnd += ". "
-                CommentEnd += di.data
+                continue
 
+            if di.start == 0x0000 and di.end >= 0xFFFF:
+                TreatDataNumbersAsLineReferences = value
+            else:
+                numberformats.append((di.start, di.end, value))
+
+        numberformats.sort()
+
+    # decode along code noting where instructions start and what they
+    # reference
+    end = offset + length
+    starts = []
+    k = offset
+    while k < end:
+        # skip past data blocks
+        address = origin + k
+        skip = [e for s, e in datablocks if s <= address <= e]
+        if skip:
+            k = max(skip) + 1 - origin
             continue
 
-        # check is reference comment
-        if di is not None and di.instruction & 0xFFFF00 == 0x030100:
-            # make note of reference, flag, and comment
-            di.reference, di.flag, di.comment = get_comment_reference_values(
-                di.data)
-            # add it to list to look for
-            CommentReferences += [di]
-            # now sort it so 1st is next to expire
-            CommentReferences.sort(key=attrgetter('end'))
-            continue
+        try:
+            record, commandlength, values = _decodez80instruction(data, k,
+                                                                  address)
+        except IndexError:
+            break
 
-        # check is reference displacement
-        if di is not None and di.instruction & 0xFFFF00 == 0x030200:
-            # Remove expired comment displacements
-            for i in range(256):
-                while currentAddress > CommentDisplacementsX[i][0][1]:
-                    CommentDisplacementsX[i][0] = CommentDisplacementsX[i][
-                        1].pop()
-                while currentAddress > CommentDisplacementsY[i][0][1]:
-                    CommentDisplacementsY[i][0] = CommentDisplacementsY[i][
-                        1].pop()
+        starts.append(k)
+        for kind, value in zip(record[7], values):
+            if kind == "nn":
+                # last format to start before this instruction applies
+                treatnumbers = TreatDataNumbersAsLineReferences
+                for s, e, formatvalue in numberformats:
+                    if s > address:
+                        break
 
-            # get displacement, flag, and comment
-            displace, flag, comment = get_comment_displacement_values(di.data)
-            # add it to IX if indicated
-            if flag & 1 == 1:
-                CommentDisplacementsX[displace][1] += [
-                    CommentDisplacementsX[displace][0]]
-                CommentDisplacementsX[displace][0] = [comment, di.end,
-                                                      di.instruction & 3]
-            # add it to IY if indicated
-            if flag & 2 == 2:
-                CommentDisplacementsY[displace][1] += [
-                    CommentDisplacementsY[displace][0]]
-                CommentDisplacementsY[displace][0] = [comment, di.end,
-                                                      di.instruction & 3]
-            continue
+                    if address <= e:
+                        treatnumbers = formatvalue
 
-        # now deal with machine code
+                if treatnumbers == 0:
+                    ReferencedLineNumbers.add(value, address)
 
-        # set length for standard command (ignoring any associated data)
-        commandlength = 1
-        # offset to data
-        dataOffset = 1
-        # get opcode details
-        s = Z80_OPCODES["base"][data[offset]]
-        instructionData = Z80_OPCODE_DATA["base"][data[offset]]
-        instructionTimes = Z80_OPCODE_TIMES["base"][data[offset]]
-
-        # deal with CB,DD,ED,and FD
-        if s is None:
-            if data[offset] == 0xCB:
-                s = Z80_OPCODES["CB"][data[offset + 1]]
-                instructionData = Z80_OPCODE_DATA["CB"][data[offset + 1]]
-                instructionTimes = Z80_OPCODE_TIMES["CB"][data[offset + 1]]
-                commandlength = 2
-
-            elif data[offset] == 0xED:
-                s = Z80_OPCODES["ED"][data[offset + 1]]
-                instructionData = Z80_OPCODE_DATA["ED"][data[offset + 1]]
-                instructionTimes = Z80_OPCODE_TIMES["ED"][data[offset + 1]]
-                commandlength = 2
-                dataOffset = 2
-                # convert invalid ED codes to do nothing (is like 2
-                # NOPs)
-                if s is None:
-                    s = ""
-                    instructionData = 0
-                    instructionTimes = 1
-
-            else:  # is DD or FD
-                dataOffset = 2
-                codehex = '{:02X}'.format(data[offset])
-                s = Z80_OPCODES[codehex][data[offset + 1]]
-                instructionData = Z80_OPCODE_DATA[codehex][data[offset + 1]]
-                instructionTimes = Z80_OPCODE_TIMES[codehex][data[offset + 1]]
-                commandlength = 2
-                # deal with DDCB or FDCB
-                if data[offset + 1] == 0xCB:
-                    commandlength = 3
-                    s = Z80_OPCODES[codehex + "CB"][data[offset + 3]]
-                    instructionData = Z80_OPCODE_DATA[codehex + "CB"][data[
-                        offset + 3]]
-                    instructionTimes = Z80_OPCODE_TIMES[codehex + "CB"][data[
-                        offset + 3]]
-
-                # deal with invalid DD/FD codes (is like a NOP)
-                if s is None:
-                    s = ""
-                    instructionData = 0
-                    instructionTimes = 1
-                    commandlength = 1
-
-        # now have opcode description in s, number of bytes in command
-        # (excluding data) in commandlength, and where to start looking
-        # for data in dataOffset
-        # data holds information about timing, T states, if needs new
-        # line etc
-
-        # place in try block to catch trying to get extra data from
-        # beyond end of supplied bytes
-        try:
-            # first check for & replace displacement byte
-            if "d" in s:
-                # Remove expired comment displacements
-                for i in range(256):
-                    while currentAddress > CommentDisplacementsX[i][0][1]:
-                        CommentDisplacementsX[i][0] = CommentDisplacementsX[i][
-                            1].pop()
-                    while currentAddress > CommentDisplacementsY[i][0][1]:
-                        CommentDisplacementsY[i][0] = CommentDisplacementsY[i][
-                            1].pop()
+            elif kind == "j" or kind == "aa":
+                ReferencedLineNumbers.add(value, address)
 
-                # get number
-                i = data[offset + dataOffset]
+        k += commandlength
 
-                # check for reference comments
-                if ('IX' in s and CommentDisplacementsX[i][0][0] and
-                   CommentDisplacementsX[i][0][0] != ""):
-                    # handle comment
-                    if CommentDisplacementsX[i][0][2] == 1:
-                        if DisplayComments == 0:
-                            soutput += CommentOutput(
-                                CommentDisplacementsX[i][0][0],
-                                XMLOutput).split("\n")
-                    # otherwise comnment end of this line or after
-                    elif CommentDisplacementsX[i][0][2] == 2:
-                        if CommentAfter != "":
-                            CommentAfter += "\n"
-                        CommentAfter += CommentDisplacementsX[i][0][0]
-                    else:
-                        if CommentEnd != "":
-                            CommentEnd += ". "
-                        CommentEnd += CommentDisplacementsX[i][0][0]
-                if ('IY' in s and CommentDisplacementsY[i][0][0] and
-                   CommentDisplacementsY[i][0][0] != ""):
-                    # handle comment
-                    if CommentDisplacementsY[i][0][2] == 1:
-                        if DisplayComments == 0:
-                            soutput += CommentOutput(
-                                CommentDisplacementsY[i][0][0],
-                                XMLOutput).split("\n")
-                    # otherwise comnment end of this line or after
-                    elif CommentDisplacementsY[i][0][2] == 2:
-                        if CommentAfter != "":
-                            CommentAfter += "\n"
-                        CommentAfter += CommentDisplacementsY[i][0][0]
-                    else:
-                        if CommentEnd != "":
-                            CommentEnd += ". "
-                        CommentEnd += CommentDisplacementsY[i][0][0]
-
-                s = s.replace("d", _numbertostring(i, 8, NumberOutput, True))
-                dataOffset += 1
-                commandlength += 1
-
-            # check for & replace relative jump byte
-            if "j" in s:
-                # calculate address of next command
-                i = currentAddress + commandlength + 1
-                # add displacement
-                i += data[offset + dataOffset] if (
-                    data[offset + dataOffset] < 128) else \
-                    data[offset + dataOffset] - 256
-
-                # check for reference comments
-                for di in CommentReferences:
-                    # have we got right reference
-                    if di.reference != i:
-                        continue
-                    # do the flags match
-                    if di.flag & 16 == 16:
-                        # handle comment
-                        if di.instruction & 3 == 1:
-                            if DisplayComments == 0:
-                                soutput += CommentOutput(di.comment,
-                                                         XMLOutput).split("\n")
-                        # otherwise comnment end of this line or after
-                        elif di.instruction & 3 == 2:
-                            if CommentAfter != "":
-                                CommentAfter += "\n"
-                            CommentAfter += di.comment
-                        else:
-                            if CommentEnd != "":
-                                CommentEnd += ". "
-                            CommentEnd += di.comment
-
-                s = s.replace("j", _numbertostring(i, 16, AddressOutput, True))
-                dataOffset += 1
-                commandlength += 1
-
-                # make note of referenced line
-                ReferencedLineNumbers += [i]
+    # work out where each part starts: the first instruction at or after
+    # an equal share of the code
+    partstarts = [offset]
+    for i in range(1, parts):
+        k = bisect_left(starts, offset + (length * i) // parts)
+        if k == len(starts):
+            break
 
-            # check for & replace 2 byte address
-            if "aa" in s:
-                # get number
-                i = data[offset + dataOffset] + \
-                    256*data[offset + dataOffset + 1]
+        if starts[k] > partstarts[-1]:
+            partstarts.append(starts[k])
 
-                # check for reference comments
-                for di in CommentReferences:
-                    # have we got right reference
-                    if di.reference != i:
-                        continue
-                    # do the flags match
-                    if ((di.flag & 1 == 1 and '(' in s) or
-                       (di.flag & 2 == 2 and s == 'LD SP,aa') or
-                       (di.flag & 4 == 4 and s[0] == 'C') or
-                       (di.flag & 8 == 8 and s[0] == 'J')):
-                        # handle comment
-                        if di.instruction & 3 == 1:
-                            if DisplayComments == 0:
-                                soutput += CommentOutput(di.comment,
-                                                         XMLOutput).split("\n")
-                        # otherwise comnment end of this line or after
-                        elif di.instruction & 3 == 2:
-                            if CommentAfter != "":
-                                CommentAfter += "\n"
-                            CommentAfter += di.comment
-                        else:
-                            if CommentEnd != "":
-                                CommentEnd += ". "
-                            CommentEnd += di.comment
+    # create jobs with the bytes of each part, and the bytes that an
+    # instruction at the end of a part could run in to.  The last part
+    # has the rest of the data as disassembling the whole block would
+    return [(data[start:stop + 3 if stop < end else len(data)], 0,
+             origin + start, stop - start, None if
+             SpecialInstructions is None else
+             [DisassembleInstruction(di) for di in SpecialInstructions],
+             ReferencedLineNumbers)
+            for start, stop in zip(partstarts, partstarts[1:] + [end])]
 
-                s = s.replace("aa", _numbertostring(i, 16, AddressOutput,
-                                                    True))
-                dataOffset += 2
-                commandlength += 2
 
-                # make note of referenced address
-                ReferencedLineNumbers += [i]
+def _disassemblejob(job, progressqueue, index):
+    """Disassembles one job in a worker process for disassemblebatch.
+    Progress is sent as whole percentages with the job index to
+    progressqueue if it is not None.
 
-            # check for & replace 2 byte number
-            if "nn" in s:
-                # get number
-                i = data[offset + dataOffset] + \
-                    256*data[offset + dataOffset + 1]
+    Returns the disassembled text, and the ReferencedAddresses.
+    """
 
-                # check for reference comments
-                for di in CommentReferences:
-                    # have we got right reference
-                    if di.reference != i:
-                        continue
-                    # do the flags match
-                    if di.flag & 2 == 2:
-                        # handle comment
-                        if di.instruction & 3 == 1:
-                            if DisplayComments == 0:
-                                soutput += CommentOutput(di.comment,
-                                                         XMLOutput).split("\n")
-                        # otherwise comnment end of this line or after
-                        elif di.instruction & 3 == 2:
-                            if CommentAfter != "":
-                                CommentAfter += "\n"
-                            CommentAfter += di.comment
-                        else:
-                            if CommentEnd != "":
-                                CommentEnd += ". "
-                            CommentEnd += di.comment
+    progressfunction = None
+    if progressqueue is not None:
+        lastpercent = [-1]
+
+        def progressfunction(stage, done, todo, overalldone, overalltodo):
+            # only send when percentage changes to keep traffic down
+            percent = int(overalldone * 100 / overalltodo) if \
+                overalltodo else 100
+            if percent != lastpercent[0]:
+                lastpercent[0] = percent
+                progressqueue.put((index, percent))
+
+    # a job from getdisassemblyjobs knows the referenced lines in the
+    # whole of the code, which include the start of the code, so the
+    # start of this part isn't marked as referenced
+    referencedaddresses = ReferencedAddresses(job[5] if len(job) > 5 else
+                                              None)
+    text = _disassembletotext(job[0], job[1], job[2], job[3],
+                              job[4] if len(job) > 4 else None,
+                              progressfunction, referencedaddresses,
+                              len(job) < 6)
+    return text, referencedaddresses
+
+
+def disassemblebatch(jobs, progressfunction=None, maxworkers=None):
+    """This function disassembles several blocks of code at the same
+    time in a pool of processes.
+
+    jobs is a list of (data, offset, origin, length) or (data, offset,
+    origin, length, SpecialInstructions) tuples, each of which are the
+    arguments to disassemble.  getdisassemblyjobs can be used to split
+    a single block of code into jobs, which also have the
+    ReferencedAddresses of the whole of the code as a sixth element.
+    These addresses are marked as referenced in every job, and the
+    start of each job is only marked if it is referenced.
+    progressfunction is as for disassemble.  The progress of the jobs
+    is combined into the overall work done, with the second and third
+    arguments being the number of jobs finished, and the number of
+    jobs.
+    maxworkers is the most processes to use.  If None then the number
+    of processors is used.  If it is 1, or there is only one job, then
+    the jobs are done in this process.
+
+    Returns a list of the disassembled text for each job in the same
+    order as the jobs, and a ReferencedAddresses combining the
+    referenced addresses from all the jobs.
+    """
 
-                s = s.replace("nn", _numbertostring(i, 16, NumberOutput, True))
-                dataOffset += 2
-                commandlength += 2
+    jobs = list(jobs)
+    results = [None] * len(jobs)
 
-                # make note of referenced number
-                if TreatDataNumbersAsLineReferences == 0:
-                    ReferencedLineNumbers += [i]
+    # work is measured in bytes to disassemble
+    worktodo = sum([job[3] for job in jobs])
+    percents = [0] * len(jobs)
 
-            # check for & replace 1 byte number
-            if "n" in s:
-                s = s.replace("n", _numbertostring(data[offset + dataOffset],
-                                                   8, NumberOutput, True))
-                dataOffset += 1
-                commandlength += 1
+    def updateprogress(jobsdone):
+        if progressfunction is not None:
+            progressfunction("Disassembling", jobsdone, len(jobs),
+                             sum([p * job[3] for p, job in
+                                  zip(percents, jobs)]) / 100, worktodo)
 
-        # catch if tried to get data from beyond end of supplied data
-        except IndexError:
-            # have tried to access bytes from beyond end of given data
-            # output bytes as DB data
-            # create DisassembleInstruction to do this
-            DisassembleInstructions.insert(0, DisassembleInstruction(
-                DisassembleInstruction.DISASSEMBLE_CODES["Data Block"],
-                currentAddress, currentAddress + len(data)-offset-1,
-                "%!DefineByte()"))
-            # back too start of while loop & should enter data block
-            continue
+    if maxworkers == 1 or len(jobs) < 2:
+        for i, job in enumerate(jobs):
+            results[i] = _disassemblejob(job, None, i)
+            percents[i] = 100
+            updateprogress(i + 1)
 
-        # commandlength now holds number of bytes in current command
-        # s holds assembly command
-        # now do output
+    else:
+        # workers pass progress back through a queue
+        manager = None
+        progressqueue = None
+        if progressfunction is not None:
+            manager = multiprocessing.Manager()
+            progressqueue = manager.Queue()
 
-        # Handle XML output
-        if XMLOutput == 1:
-            currentline = "  <line><address>" + _numbertostring(
-                currentAddress, 16, AddressOutput, AddressOutput > 1) + \
-                "</address>"
+        try:
+            with ProcessPoolExecutor(max_workers=maxworkers) as executor:
+                futures = dict([(executor.submit(_disassemblejob, job,
+                                                 progressqueue, i), i)
+                                for i, job in enumerate(jobs)])
+                pending = set(futures)
+                while pending:
+                    done, pending = wait(
+                        pending, None if progressqueue is None else 0.1,
+                        FIRST_COMPLETED)
+
+                    for future in done:
+                        i = futures[future]
+                        results[i] = future.result()
+                        percents[i] = 100
+
+                    # gather progress from workers
+                    while progressqueue is not None:
+                        try:
+                            i, percent = progressqueue.get_nowait()
+                        except Empty:
+                            break
 
-        # handle non-XML
-        else:
-            # work out max length of address
-            maxAddressLength = max(FormatAddressLength[AddressOutput],
-                                   maxAddressLength)
+                        percents[i] = max(percents[i], percent)
 
-            # output address ready for processing later
-            i = AddressOutput + (LineNumberOutput << 3)
-            if Seperator != "  ":
-                i += 1 << 5
+                    updateprogress(len(jobs) - len(pending))
 
-            currentline = "\0" + chr(i) + chr(ListEveryXLines)
-            currentline += _numbertostring(currentAddress, 16, 0, False)
+        finally:
+            if manager is not None:
+                manager.shutdown()
 
-            # add seperator after address
-            currentline += Seperator
+    # merge referenced addresses in job order
+    ReferencedLineNumbers = ReferencedAddresses()
+    for text, referencedaddresses in results:
+        ReferencedLineNumbers.update(referencedaddresses)
 
-            # remember where commands start
-            k = len(currentline)
+    # report job done
+    if progressfunction is not None:
+        progressfunction("Done", len(jobs), len(jobs), worktodo, worktodo)
+
+    return [text for text, referencedaddresses in results], \
+        ReferencedLineNumbers
+
+
+def _disassemble(data, offset, origin, length, SpecialInstructions,
+                 progressfunction, ReferencedLineNumbers, Details,
+                 prescan=False, markstart=True):
+    """Generator that does the disassembling for disassemble and
+    disassemble_iter.  It works along the code decoding the
+    instructions into Z80Instruction records as disassembletorecords
+    does, and yields lists of items for _renderdisassembly to turn into
+    the lines of the disassembly once the referenced lines are known.
+    Once all the items have been yielded, Details is filled with the
+    width to pad line addresses to and the work done for progress
+    reporting.  If prescan is True then no items are made for the
+    instructions as only the referenced lines and width of the
+    addresses are wanted.  If markstart is False then the start of the
+    code is not marked as referenced.
+
+    The format settings of each instruction are passed on in a tuple of
+    AddressOutput, NumberOutput, CommandOutput, OutputTStates,
+    BreakAfterJumps, LineNumberOutput, ListEveryXLines,
+    DisplayCommandBytes, DisplayComments, Seperator, ShowFlags,
+    MarkUndocumenedCommand, and XMLOutput.
+    """
 
-        # output bytes of commands
-        # Handle XML output
-        if XMLOutput == 1:
-            currentline += "<bytes>{}</bytes>".format(
-                ",".join([_numbertostring(b, 8, CommandOutput, False) for b in
-                          data[offset:offset + commandlength]]))
+    # nested functions
 
-        # handle non-XML
-        else:
-            # only do if want them output
-            if DisplayCommandBytes == 0:
-                currentline += ",".join(
-                    [_numbertostring(b, 8, CommandOutput, False) for b in
-                     data[offset:offset + commandlength]])
-
-                # now ensure opcodes line up
-                # don't need to bother if using tabs
-                if Seperator == "  ":
-                    i = 5*FormatByteLength[CommandOutput]
-                    # adjust for commas
-                    if CommandOutput > 0:
-                        i += 4
-                    i += k
-                    i -= len(currentline)
-                    while i >= 0:
-                        currentline += " "
-                        i -= 1
-
-            # add seperator after command bytes
-            # needed even if no command bytes as can go from disply
-            # command bytes to not and have to ensure output stays in
-            # same column in case tab seperated output is used in
-            # spreadsheet
-            currentline += Seperator
-
-        # output opcode
-        # Handle XML output
+    # used by data block scripts to output comments
+    def CommentOutput(comment, XMLOutput):
         if XMLOutput == 1:
-            currentline += "<instruction>" + s + "</instruction>"
-
-        # handle non-XML
+            return "  <line><comment>" + comment + "</comment></line>"
         else:
-            currentline += s
+            linestart = "\0" + chr(12) + chr(0) + "0000" + Seperator + ";"
+            return "\n".join([linestart + txt for txt in comment.split("\n")])
 
-        # Handle XML output of stuff in comments (timing, flags,
-        # undocumented commands)
+    # comments are output as in a data block without an address
+    def CommentLines(comment, XMLOutput):
         if XMLOutput == 1:
-            # do comment
-            if DisplayComments == 0 and CommentEnd != "":
-                currentline += "<comment>" + CommentEnd + "</comment>"
+            return ("  <line><comment>" + comment +
+                    "</comment></line>").split("\n")
+        else:
+            return [(12, 0, 0, Seperator + ";" + txt) for txt in
+                    comment.split("\n")]
 
-            # do flags
-            sflags = getFlagChanges(instructionData)
-            # output flag states if we have them
-            if sflags is not None:
-                currentline += "<flags>" + sflags + "</flags>"
+    # end nested functions
 
-            # do times
-            # get times
-            duration, states = GetTimingInfo(instructionTimes)
+    # holds how long address is in each number format
+    FormatAddressLength = (4, 5, 7, 17)
 
-            # now output timings
-            currentline += "<timeing><cycles>"
-            currentline += "unknown" if duration[0] == 0 else str(duration[0])
-            currentline += "</cycles>"
+    maxAddressLength = 0
 
-            if states is not None:
-                currentline += "<tstates>" + ",".join(
-                    str(x) for x in states[0])
-                currentline += "</tstates>"
+    # work out where we are
+    currentAddress = origin + offset
 
-            currentline += "</timeing>"
+    # validate and convert data to bytearray if needed
+    data = _validateandpreparebytes(data, "data")
 
-            if duration[1] != 0:
-                currentline += '<timeing alternate="true"><cycles>'
-                currentline += str(duration[1]) + "</cycles>"
+    # get list of line numbers that are being referenced
+    if markstart:
+        ReferencedLineNumbers.add(currentAddress)
 
-                if states is not None:
-                    currentline += "<tstates>"
-                    currentline += ",".join(str(x) for x in states[1])
-                    currentline += "</tstates>"
+    # set format flags to default
+    AddressOutput = 0        # 0=hex,1=decimal,2=octal,3=binary
+    NumberOutput = 0         # 0=hex,1=decimal,2=octal,3=binary
+    CommandOutput = 0        # 0=hex,1=decimal,2=octal,3=binary
+    # 0=no, 1=total only, 2=list state times, 3=total & state times
+    OutputTStates = 0
+    # 0=no empty lines, 1=after absolute jumps/rets, 2=after all rets/jumps
+    BreakAfterJumps = 1
+    LineNumberOutput = 0     # 0=All, 1=None, 2=only referenced lines
+    # list every X lines regardless of LineNumberOutput
+    ListEveryXLines = 0
+    # 0=empty line after data, 1=no empty line after data
+    BreakAfterData = 0
+    # 0=track line numbers for display purposes, 1=don't
+    TreatDataNumbersAsLineReferences = 0
+    DisplayCommandBytes = 0  # 0=print them, 1=don't
+    DisplayComments = 0      # 0=display them, 1=don't
+    Seperator = "  "
+    ShowFlags = 0            # 0=no, 1=yes
+    MarkUndocumenedCommand = 0  # 0=no, 1=yes
+    XMLOutput = 0            # 0=no, 1=yes
+    HexForNonASCII = 0       # 0=no, 1=yes
+    CommentEnd = ""
+    CommentAfter = ""
+    # tuple of format settings for instructions, None if needs updating
+    LineFormat = None
+    CommentReferences = []
+    CommentDisplacementsX = [[[None, 0x10000, 0], []] for i in range(256)]
+    CommentDisplacementsY = [[[None, 0x10000, 0], []] for i in range(256)]
+    FunctionMatcher = re.compile(r"^\s*%![a-zA-Z_][a-zA-Z_0-9]*[(].*[)]\s*$",
+                                 re.DOTALL)
+    MatcherinBraces = re.compile(r"^\s*%[(]\s*%!([a-zA-Z_][a-zA-Z_0-9]*"
+                                 r"[(].*[)])\s*%[)](\s*%#[^\n]*?)?$",
+                                 re.DOTALL)
 
-                currentline += "</timeing>"
+    # Work out how much there is to process for progress callback
+    # faster going through formatting at end than actual disassembling
+    # assume that phase 1 where process instructions will take 10%
+    # this may be wrong but good average: simple instructions will take
+    # less and complex will take longer.
+    worktodo1 = 0           # default no work pre-processing
+    worktodo2 = length * 2  # *2 for disassembling
+    worktodo3 = length      # for formatting
+    workdone = 0
+    # now look at special instructions as this can increase workload
+    if SpecialInstructions is not None and len(SpecialInstructions) > 0:
+        for di in SpecialInstructions:
+            worktodo1 += 1
+            if (di.instruction in [DisassembleInstruction.DISASSEMBLE_CODES[
+                    "Pattern Data Block"],
+                    DisassembleInstruction.DISASSEMBLE_CODES[
+                    "Comment Pattern"]]):
+                # work out start and end points
+                e = di.end
+                if e >= origin + len(data):
+                    e = origin + len(data)-1
+                s = di.start
+                if s < origin:
+                    s = origin
+                # must process once before disassembly
+                worktodo1 += (e - s) * 2
 
-            # do undocumented comments if needed
-            if ((instructionData >> 21) & 1) == 1:
-                currentline += "<undocumented/>"
+    # process special instructions
+    DisassembleInstructions = []
+    if SpecialInstructions is not None and len(SpecialInstructions) > 0:
+        for di in SpecialInstructions:
+            # update progress
+            workdone += 1
+            # call progress update
+            if progressfunction is not None:
+                progressfunction("Evaluating Instructions",
+                                 workdone, worktodo1,
+                                 (workdone * 10) / worktodo1, 100)
 
-        # if we're not doing XML and want comments, do so
-        elif DisplayComments == 0:
-            precomment = ""
+            # check if special formatting commands for default for whole
+            # output
+            if di.start == 0x0000 and di.end >= 0xFFFF:
+                if di.instruction & 0xFFFF00 == 0x000100:
+                    # AddressOutputFormat
+                    AddressOutput = di.instruction & 0x03
+                    continue
 
-            # align any comments
-            # don't need to bother if using tabs
-            if Seperator == "  ":
-                precomment = " " * (FormatOpCodeMaxLength[AddressOutput] if
-                                    FormatOpCodeMaxLength[AddressOutput] >
-                                    FormatOpCodeMaxLength[NumberOutput] else
-                                    FormatOpCodeMaxLength[NumberOutput] -
-                                    len(s))
+                elif di.instruction & 0xFFFF00 == 0x000200:
+                    # NumberOutputFormat
+                    NumberOutput = di.instruction & 0x03
+                    continue
 
-            # space between opcode and comments, and comment marker
-            precomment += Seperator + ";"
-
-            # will we need a space before this comment (and any comment
-            # following)
-            bNeedSpace = False
+                elif di.instruction & 0xFFFF00 == 0x000300:
+                    # CommandOutputFormat
+                    CommandOutput = di.instruction & 0x03
+                    continue
 
-            # do comment
-            if CommentEnd != "":
-                # output pre comment text
-                currentline += precomment
-                # note has been output
-                precomment = None
+                elif di.instruction & 0xFFFF00 == 0x000400:
+                    # OutputTStatesFormat
+                    OutputTStates = di.instruction & 0x03
+                    continue
 
-                if CommentEnd.find("\n") == -1:
-                    currentline += CommentEnd
+                elif di.instruction & 0xFFFF00 == 0x000500:
+                    # LineAfterJumpOutputFormat
+                    BreakAfterJumps = di.instruction & 0x03
+                    continue
 
-                else:
-                    comments = CommentEnd.split("\n")
-                    currentline += comments[0]
-                    if CommentAfter != "":
-                        CommentAfter = "\n" + CommentAfter
-                    CommentAfter = "\n".join(comments[1:]) + CommentAfter
+                elif di.instruction & 0xFFFF00 == 0x000600:
+                    # DefaultFormat
+                    AddressOutput = di.instruction & 0x03
+                    NumberOutput = di.instruction & 0x03
+                    CommandOutput = di.instruction & 0x03
+                    OutputTStates = 0
+                    BreakAfterJumps = 1
+                    LineNumberOutput = 0
+                    ListEveryXLines = 0
+                    BreakAfterData = 0
+                    TreatDataNumbersAsLineReferences = 0
+                    DisplayCommandBytes = 0
+                    DisplayComments = 0
+                    Seperator = "  "
+                    ShowFlags = 0
+                    MarkUndocumenedCommand = 0
+                    XMLOutput = 0
+                    HexForNonASCII = 0
+                    continue
 
-                # mark will need space if any comment following
-                bNeedSpace = True
+                elif(di.instruction & 0xFFFF00 == 0x000700):
+                    # CustomFormat
+                    settingstemp = get_custom_format_values(di.data, False)
+                    AddressOutput = settingstemp["AddressOutput"]
+                    NumberOutput = settingstemp["NumberOutput"]
+                    CommandOutput = settingstemp["CommandOutput"]
+                    OutputTStates = settingstemp["OutputTStates"]
+                    BreakAfterJumps = settingstemp["BreakAfterJumps"]
+                    LineNumberOutput = settingstemp["LineNumberOutput"]
+                    ListEveryXLines = settingstemp["ListEveryXLines"]
+                    BreakAfterData = settingstemp["BreakAfterData"]
+                    TreatDataNumbersAsLineReferences = settingstemp[
+                        "TreatDataNumbersAsLineReferences"]
+                    DisplayCommandBytes = settingstemp["DisplayCommandBytes"]
+                    DisplayComments = settingstemp["DisplayComments"]
+                    Seperator = settingstemp["Seperator"]
+                    ShowFlags = settingstemp["ShowFlags"]
+                    MarkUndocumenedCommand = settingstemp[
+                        "MarkUndocumenedCommand"]
+                    XMLOutput = settingstemp["XMLOutput"]
+                    HexForNonASCII = settingstemp["HexForNonASCII"]
+                    continue
 
-            # are we listing flags?
-            if ShowFlags > 0:
-                if precomment:
-                    # output pre comment text
-                    currentline += precomment
-                    # note has been output
-                    precomment = None
+                elif di.instruction & 0xFFFF00 == 0x000800:
+                    # LineNumberOutput
+                    LineNumberOutput = di.instruction & 0x03
+                    continue
 
-                # insert space if needed
-                if bNeedSpace:
-                    currentline += "  "
+                elif di.instruction & 0xFFFF00 == 0x000900:
+                    # ListEveryXLines
+                    ListEveryXLines = int(di.data, 16)
+                    continue
 
-                # get flag states for this instruction
-                sflags = getFlagChanges(instructionData)
-                # output flag states if we have them
-                if sflags is not None:
-                    currentline += sflags
+                elif di.instruction & 0xFFFF00 == 0x000A00:
+                    # BreakAfterData
+                    BreakAfterData = di.instruction & 0x01
+                    continue
 
-                    # mark will need space if any comment following
-                    bNeedSpace = True
+                elif di.instruction & 0xFFFF00 == 0x000B00:
+                    # TreatDataNumbersAsLineReferences
+                    TreatDataNumbersAsLineReferences = di.instruction & 0x01
+                    continue
 
-            if OutputTStates > 0:
-                if precomment:
-                    # output pre comment text
-                    currentline += precomment
-                    # note has been output
-                    precomment = None
+                elif di.instruction & 0xFFFF00 == 0x000C00:
+                    # DisplayCommandBytes
+                    DisplayCommandBytes = di.instruction & 0x01
+                    continue
 
-                # insert space if needed
-                if bNeedSpace:
-                    currentline += "  "
+                elif di.instruction & 0xFFFF00 == 0x000D00:
+                    # DisplayComments
+                    DisplayComments = di.instruction & 0x01
+                    continue
 
-                # get times
-                duration, states = GetTimingInfo(instructionTimes)
+                elif di.instruction & 0xFFFFFF == 0x000E00:
+                    # Seperator space
+                    Seperator = "  "
+                    continue
 
-                # now output timings
-                currentline += "T="
-                if (OutputTStates & 1) == 1:
-                    if duration[0] == 0:
-                        currentline += "unknown"
-                    else:
-                        currentline += str(duration[0])
+                elif di.instruction & 0xFFFFFF == 0x000E01:
+                    # Seperator tab
+                    Seperator = "\t"
+                    continue
 
-                if (OutputTStates & 2) == 2 and states is not None:
-                    currentline += "(" + ",".join(
-                        str(x) for x in states[0]) + ")"
+                elif di.instruction & 0xFFFFFF == 0x000E02:
+                    # Seperator custom
+                    Seperator = di.data
+                    continue
 
-                if duration[1] != 0:
-                    currentline += "/"
-                    if (OutputTStates & 1) == 1:
-                        currentline += str(duration[1])
+                elif di.instruction & 0xFFFF00 == 0x000F00:
+                    # Display flags
+                    ShowFlags = di.instruction & 0x01
+                    continue
 
-                    if (OutputTStates & 2) == 2 and states is not None:
-                        currentline += "(" + ",".join(
-                            str(x) for x in states[1]) + ")"
+                elif di.instruction & 0xFFFF00 == 0x001000:
+                    # note undocumened commands
+                    MarkUndocumenedCommand = di.instruction & 0x01
+                    continue
 
-                bNeedSpace = True
+                elif di.instruction & 0xFFFF00 == 0x001200:
+                    # XML mode
+                    XMLOutput = di.instruction & 0x01
+                    continue
 
-            # are we noteing undocumented commands?
-            if (MarkUndocumenedCommand > 0 and
-               ((instructionData >> 21) & 1) == 1):
-                if precomment:
-                    # output pre comment text
-                    currentline += precomment
-                    # note has been output
-                    precomment = None
+                elif di.instruction & 0xFFFF00 == 0x001300:
+                    # HexForNonASCII mode
+                    HexForNonASCII = di.instruction & 0x01
+                    continue
 
-                # do we need gap?
-                if bNeedSpace:
-                    currentline += "  "
+            # check if end after end of code, in which case truncate it
+            if di.end >= origin + len(data):
+                di.end = origin + len(data)-1
 
-                # record that is undocumented
-                currentline += "Undocumented Command"
+            # check if start before start of code, but ends inside code,
+            # in which case truncate it
+            if di.start < origin and di.end > origin:
+                di.start = origin
 
-        # end of line
-        # Handle XML output
-        if XMLOutput == 1:
-            currentline += "</line>"
+            # is this a patterndatablock instruction or a find&comment
+            if (di.instruction in [DisassembleInstruction.DISASSEMBLE_CODES[
+                    "Pattern Data Block"],
+                    DisassembleInstruction.DISASSEMBLE_CODES[
+                    "Comment Pattern"]]):
+                # get parts of patterndatablock, and their compiled form
+                (TestBlock, PrepBlock, ActionBlock, CompiledTest,
+                 CompiledPrep, FirstByte) = di._getcompiledpattern()
 
-        soutput += [currentline]
+                # first check is valid test block
+                if TestBlock is None:
+                    raise SpectrumTranslateError(
+                        "patern to search for must be inside brackets")
 
-        # handle comments after line
-        if DisplayComments == 0 and CommentAfter != "":
-            soutput += CommentOutput(CommentAfter, XMLOutput).split('\n')
+                # now check is valid preperation block
+                if PrepBlock is None:
+                    raise SpectrumTranslateError(
+                        "preperation block must be inside brackets")
 
-        # clear comments
-        CommentEnd = ""
-        CommentAfter = ""
+                # now should have valid pattern match we can work with
 
-        # do we need to have newline after command to make more
-        # readable.  Only needed if not doing XML
-        i = instructionData & 3
-        if XMLOutput == 0 and BreakAfterJumps != 0 and i != 0:
-            if BreakAfterJumps != 1 or i != 1:
-                soutput += ['']
+                # setup environment ready to search for matches
+                Settings = {"DATASTRINGPOS": 0,
+                            "NUMBERFORMAT": 0,
+                            "NUMBERSIGNED": 0,
+                            "NUMBERWORDORDER": 0,
+                            "DISPLAYEVERYXLINES": 1,
+                            "ORIGIONALSEPERATOR": Seperator,
+                            "SEPERATOR": Seperator,
+                            "ORIGIN": origin,
+                            "ADDRESSOUTPUT": AddressOutput,
+                            "NUMBEROUTPUT": NumberOutput,
+                            "COMMANDOUTPUT": CommandOutput,
+                            "XMLOutput": XMLOutput,
+                            "HexForNonASCII": HexForNonASCII,
+                            "InstructionsToAdd": []}
 
-        length -= commandlength
-        offset += commandlength
-        offset &= 0xFFFF
-        currentAddress += commandlength
+                Vars = [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, di.start, 0, 0, di.start,
+                        di.end]
 
-        workdone += commandlength * 2
+                # work done after done this
+                wdafter = workdone + ((di.end - di.start) * 2)
 
-    # end 1st pass
-    if XMLOutput == 1:
-        soutput += ["</z80code>"]
-    else:
-        soutput += ['']
+                matches = []
+                # handle predefined routine
+                match = MatcherinBraces.match(TestBlock)
+                if match:
+                    if progressfunction is not None:
+                        progressfunction("Evaluating Instructions", workdone,
+                                         worktodo1,
+                                         (workdone * 10) / worktodo1, 100)
+                    details = _ProcessFunctionDetails(match.group(1))
+                    if isinstance(details, str):
+                        raise SpectrumTranslateError(details)
 
-    # now search for line numbers and remove them if not needed
-    lastLineInData = -1  # -1 start, 0=last in code, 1=last in data
-    # count how many lines since last address reference
-    lineCounter = 0
+                    # check is valid command
+                    if (details[0] not in
+                       DisassembleInstruction.PredefinedRoutines):
+                        raise SpectrumTranslateError(
+                            'Routine "{}" not defined'.format(details[0]))
 
-    # keep track of where we are in text
-    k = 0
-    lines = len(soutput)
+                    # process routine
+                    Vars = [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, di.start, 0, 0,
+                            di.start, di.end]
+                    args = [data, Settings, Vars] + details[1]
+                    keyargs = details[2]
+                    matches = DisassembleInstruction.\
+                        PredefinedRoutines[details[0]](*args, **keyargs)
+                else:
+                    # search for matches using scripting language
 
-    workdone = worktodo1 + worktodo2
+                    # move through area covered by instruction & check for
+                    # matches
+                    k = di.start
+                    while k <= di.end:
+                        # if match must start with a particular byte then
+                        # skip to next address holding it
+                        if FirstByte is not None and k >= origin:
+                            i = data.find(FirstByte, k - origin,
+                                          di.end - origin + 1)
+                            i = di.end + 1 if i == -1 else i + origin
+                            workdone += (i - k) * 2
+                            k = i
+                            if k > di.end:
+                                break
 
-    # search for address markers
-    while k < lines:
-        # call progress update
-        if progressfunction is not None:
-            progressfunction("Formatting", k, lines,
-                             ((k * worktodo3) / lines) + workdone,
-                             worktodo1 + worktodo2 + worktodo3)
+                        # update progress
+                        workdone += 2
+                        # call progress update
+                        if progressfunction is not None:
+                            progressfunction("Evaluating Instructions",
+                                             workdone, worktodo1,
+                                             (workdone * 10) / worktodo1, 100)
+                        try:
+                            Settings["DATASTRINGPOS"] = 0
+                            Vars[0x00] = k
+                            Vars[0x01] = di.end
+                            Vars[0x0C] = 0
+                            Vars[0x0A] = k
+                            Vars[0x0D] = k
+                            Vars[0x0E] = di.end
+                            # test each address
+                            # will fail for Comment pattern but only after
+                            # pattern has been added
+                            if CompiledTest is not None:
+                                i = _runcompiledblock(CompiledTest, TestBlock,
+                                                      Vars, Settings, data,
+                                                      True)[0]
+                            else:
+                                i = _processcommandblock(TestBlock, Vars,
+                                                         Settings, data, True,
+                                                         True)[0]
+                            if (i & 1) == 1:
+                                matches += [k]
 
-        # skip lines that don't need formatting
-        if len(soutput[k]) < 1 or soutput[k][0] != '\0':
-            k += 1
-            continue
+                        except IndexError:
+                            # continue gracefully if test involves bytes
+                            # outside supplied data.
+                            pass
 
-        # retrieve Address output formating details
-        AddressOutput = ord(soutput[k][1])
-        # are we in a data block?
-        bInData = (AddressOutput & 4) == 4
-        # 0=All, 1=None,  2=only referenced lines
-        LineNumberOutput = (AddressOutput >> 3) & 3
-        # 0=2 spaces
-        SeperatorMode = (AddressOutput >> 5) & 1
-        # list every X lines regardless of LineNumberOutput
-        ListEveryXLines = ord(soutput[k][2])
-        AddressOutput &= 3
+                        k += 1
 
-        # if moved from data to code
-        if lastLineInData != 0 and not bInData:
-            # this will force line to be rendered
-            lineCounter = ListEveryXLines
+                blockdetails = []
+                # process matches if needed
+                match = MatcherinBraces.match(PrepBlock)
+                if len(matches) > 0 and _isarray(matches[0]):
+                    # matching routine has returned list of blockdetails
+                    blockdetails = matches
+                elif len(matches) > 0 and match:
+                    details = _ProcessFunctionDetails(match.group(1))
+                    if isinstance(details, str):
+                        raise SpectrumTranslateError(details)
 
-        # remember if last in code or data
-        lastLineInData = 1 if bInData else 0
+                    # check is valid command
+                    if (details[0] not in
+                       DisassembleInstruction.PredefinedRoutines):
+                        raise SpectrumTranslateError(
+                            'Routine "{}" not defined'.format(details[0]))
 
-        # increment line counter
-        lineCounter += 1
+                    # process routine
+                    Vars = [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, di.start, 0, 0,
+                            di.start, di.end]
+                    args = [data, Settings, Vars, matches] + details[1]
+                    keyargs = details[2]
+                    blockdetails = DisassembleInstruction.\
+                        PredefinedRoutines[details[0]](*args, **keyargs)
+                elif len(matches) > 0:
+                    # process matches using scripting
+                    for k in matches:
+                        try:
+                            Settings["DATASTRINGPOS"] = 0
+                            Vars[0x00] = k
+                            Vars[0x01] = di.end
+                            Vars[0x0C] = 0
+                            Vars[0x0A] = k
+                            Vars[0x0D] = k
+                            Vars[0x0E] = di.end
+                            # now adjust variables as needed
+                            if CompiledPrep is not None:
+                                _runcompiledblock(CompiledPrep, PrepBlock,
+                                                  Vars, Settings, data, False)
+                            else:
+                                _processcommandblock(PrepBlock, Vars, Settings,
+                                                     data, True, False)
+                            blockdetails += [[Vars[0x00], Vars[0x01]]]
+                        except IndexError:
+                            # continue gracefully if test involves bytes
+                            # outside supplied data.
+                            continue
 
-        # retrieve address to format
-        currentAddress = int(soutput[k][3:7], 16)
+                # add data blocks
+                for start, end in blockdetails:
+                    # add datablock
+                    DisassembleInstructions += [DisassembleInstruction(
+                        DisassembleInstruction.DISASSEMBLE_CODES["Data Block"],
+                        start, end, ActionBlock)]
 
-        s = ""
-        if (LineNumberOutput == 0 or
-           (lineCounter >= ListEveryXLines and ListEveryXLines != 0) or
-           (LineNumberOutput == 2 and currentAddress in ReferencedLineNumbers)
-           ):
-            # output address
-            s = _numbertostring(currentAddress, 16, AddressOutput,
-                                AddressOutput > 1)
+                    # increase work in disassembly phase for each block
+                    worktodo2 += (end - start) * 2
 
-            # reset line counter
-            lineCounter = 0
+                # if have instructions, add them
+                if len(Settings["InstructionsToAdd"]) > 0:
+                    DisassembleInstructions += Settings["InstructionsToAdd"]
 
-        # if space seperator mode then pad with spaces if needed
-        if SeperatorMode == 0:
-            m = maxAddressLength - len(s)
-            s += " " * m
+                workdone = wdafter
 
-        # replace address sting with correct text
-        soutput[k] = s + soutput[k][7:]
-        # next line
-        k += 1
+                continue
 
-    # report job done
-    if progressfunction is not None:
-        progressfunction("Done", 100, 100, worktodo1 + worktodo2 + worktodo3,
-                         worktodo1 + worktodo2 + worktodo3)
+            # check if is reference instruction
+            if di.instruction == DisassembleInstruction.DISASSEMBLE_CODES[
+                    "Reference Line"]:
+                ReferencedLineNumbers.add(di.start)
+                continue
 
-    return "\n".join(soutput)
+            if di.instruction == DisassembleInstruction.DISASSEMBLE_CODES[
+                    "Data Block"]:
+                # increase work in disassembly phase
+                worktodo2 += (di.end - di.start) * 2
 
+            # add instruction to list of stuff to do during disassembly
+            DisassembleInstructions += [di]
 
-def PredefinedStartLine(Settings, Vars, datatitle):
-    """This functions starts off a line for predefined functions."""
+        # sort instructions by their start address
+        DisassembleInstructions = sorted(DisassembleInstructions,
+                                         key=attrgetter('start', 'end'))
 
-    soutput = ""
+    # should now be sorted along by start
 
-    # check if any comments to be added to this data
-    if "COMMENTCONTROL" in Settings:
-        # move past any instructions that has been & gone
-        dis = Settings["COMMENTCONTROL"][0]
-        # get rid of passed commands
-        while dis and Vars[0x0A] > dis[0].end:
-            dis.pop(0)
-        # cycle through commands for this line to find comments
-        i = 0
-        while dis and Vars[0x0A] >= dis[i].start:
-            # if is comment instruction process it
-            if (dis[i].instruction & 0xFFFF00 == 0x030000 and
-               dis[i].data is not None and dis[i].data != ""):
-                di = dis.pop(i)
-                if di.instruction == DisassembleInstruction.DISASSEMBLE_CODES[
-                   "Comment Before"]:
-                    if Settings["COMMENTCONTROL"][1] == 0:
-                        soutput += Settings["COMMENTCONTROL"][4](
-                            di.data, Settings["XMLOutput"]) + "\n"
+    # adjust workdone to be 10% of total work to stop progress going
+    # backwards with extra work in disassembly phase
+    worktodo1 = (worktodo2 + worktodo3) / 9
+    workdone = 0
 
-                # otherwise comnment end of this line or after
-                elif di.instruction == 0x030002:
-                    if Settings["COMMENTCONTROL"][3] != "":
-                        Settings["COMMENTCONTROL"][3] += "\n"
-                    Settings["COMMENTCONTROL"][3] += di.data
-                else:
-                    if Settings["COMMENTCONTROL"][2] != "":
-                        Settings["COMMENTCONTROL"][2] += ". "
-                    Settings["COMMENTCONTROL"][2] += di.data
-            else:
-                i += 1
+    # set up format stack to hold current format
+    # hold formatting instructions
+    s = get_custom_format_string(AddressOutput, NumberOutput, CommandOutput,
+                                 OutputTStates, BreakAfterJumps,
+                                 LineNumberOutput, ListEveryXLines,
+                                 BreakAfterData,
+                                 TreatDataNumbersAsLineReferences,
+                                 DisplayCommandBytes, DisplayComments,
+                                 Seperator, ShowFlags, MarkUndocumenedCommand,
+                                 XMLOutput, HexForNonASCII)
+    Format = [DisassembleInstruction(DisassembleInstruction.DISASSEMBLE_CODES[
+        "Custom Format"], 0, 65536, s)]
+    CurrentFormatEnd = 65536  # end after
 
-    # output line details
-    if Settings["XMLOutput"] == 1:
-        if not Settings["HadLineStart"]:
-            soutput += "  <line>"
-        soutput += "<address>{}</address>".format(
-            _numbertostring(Vars[10], 16, Settings["ADDRESSOUTPUT"], False))
-        soutput += "<instruction>{}</instruction>".format(datatitle)
-    else:
-        i = Settings["ADDRESSOUTPUT"] + 4
-        if Settings["SEPERATOR"] != "  ":
-            i += 1 << 5
-        soutput += "\0" + chr(i) + chr(Settings["DISPLAYEVERYXLINES"])
-        soutput += "{0:04X}{1}{1}{2}{1}".format(Vars[10],
-                                                Settings["SEPERATOR"],
-                                                datatitle)
+    # hold data formatting instructions
+    nextDataFormatStart = 65536  # start after
+    nextDataFormatEnd = 65536    # end after
 
-    Settings["HadLineStart"] = True
-    Settings["HadLineEnd"] = False
+    # output start text
+    if XMLOutput == 1:
+        soutput = ['<?xml version="1.0" encoding="UTF-8" ?>', '<z80code>',
+                   '  <org>' + _numbertostring(currentAddress, 16,
+                                               AddressOutput) + '</org>']
 
-    return soutput
+    else:
+        soutput = ['ORG ' + _numbertostring(currentAddress, 16, AddressOutput),
+                   '']
 
+    # start disassembling
+    while length > 0:
+        # pass on lines that are finished with.  Done in batches to
+        # save on the overhead of passing on each instruction
+        if len(soutput) >= 256:
+            yield soutput
+            soutput = []
 
-def PredefinedEndLine(Settings, Vars):
-    """This functions ends a line for predefined functions."""
+        # call progress update
+        if progressfunction is not None:
+            progressfunction("Disassembling", workdone, worktodo2,
+                             workdone + worktodo1,
+                             worktodo1 + worktodo2 + worktodo3)
 
-    soutput = ""
+        # are we exiting format section?
+        if currentAddress > CurrentFormatEnd:
+            # if so recover details of underlying format
+            diTemp = Format.pop()
+            settingstemp = get_custom_format_values(diTemp.data, False)
+            AddressOutput = settingstemp["AddressOutput"]
+            NumberOutput = settingstemp["NumberOutput"]
+            CommandOutput = settingstemp["CommandOutput"]
+            OutputTStates = settingstemp["OutputTStates"]
+            BreakAfterJumps = settingstemp["BreakAfterJumps"]
+            LineNumberOutput = settingstemp["LineNumberOutput"]
+            ListEveryXLines = settingstemp["ListEveryXLines"]
+            BreakAfterData = settingstemp["BreakAfterData"]
+            TreatDataNumbersAsLineReferences = settingstemp[
+                "TreatDataNumbersAsLineReferences"]
+            DisplayCommandBytes = settingstemp["DisplayCommandBytes"]
+            DisplayComments = settingstemp["DisplayComments"]
+            Seperator = settingstemp["Seperator"]
+            ShowFlags = settingstemp["ShowFlags"]
+            MarkUndocumenedCommand = settingstemp["MarkUndocumenedCommand"]
+            XMLOutput = settingstemp["XMLOutput"]
+            HexForNonASCII = settingstemp["HexForNonASCII"]
+            LineFormat = None
 
-    # update position
-    Vars[0x0A] += Vars[0x0C]
-    # update line number
-    Vars[0x0B] += 1
+            CurrentFormatEnd = diTemp.end
+            continue
 
-    # do comment
-    if ("COMMENTCONTROL" in Settings and
-       Settings["COMMENTCONTROL"][1] == 0 and
-       Settings["COMMENTCONTROL"][2] != ""):
-        # XML comments
-        if Settings["XMLOutput"] == 1:
-            soutput += "<comment>{}</comment>".format(
-                Settings["COMMENTCONTROL"][2])
-        # plain text comments
-        else:
-            # output pre comment text
-            soutput += Settings["SEPERATOR"] + ';'
+        # remove expired comment references
+        if CommentReferences and currentAddress >= CommentReferences[0].end:
+            CommentReferences = [x for x in CommentReferences if
+                                 x.end > currentAddress]
 
-            if Settings["COMMENTCONTROL"][2].find("\n") == -1:
-                soutput += Settings["COMMENTCONTROL"][2]
+        # skip past instructions not relavent to code
+        while DisassembleInstructions and \
+              currentAddress > DisassembleInstructions[0].end:
+            DisassembleInstructions.pop(0)
+        # get instruction or set to None
+        if (DisassembleInstructions and
+           currentAddress >= DisassembleInstructions[0].start):
+            di = DisassembleInstructions.pop(0)
+        else:
+            di = None
 
-            else:
-                comments = Settings["COMMENTCONTROL"][2].split("\n")
-                soutput += comments[0] + "\n"
-                soutput += Settings["COMMENTCONTROL"][4](
-                    "".join(comments[1:]), Settings["XMLOutput"])
+        # first check if in data block
+        if (di is not None and
+           di.instruction == DisassembleInstruction.DISASSEMBLE_CODES[
+               "Data Block"]):
+            Settings = {"DATASTRINGPOS": 0,
+                        "NUMBERFORMAT": 0,
+                        "NUMBERSIGNED": 0,
+                        "NUMBERWORDORDER": 0,
+                        "DISPLAYEVERYXLINES": 1,
+                        "ORIGIONALSEPERATOR": Seperator,
+                        "SEPERATOR": Seperator,
+                        "ORIGIN": origin,
+                        "ADDRESSOUTPUT": AddressOutput,
+                        "NUMBEROUTPUT": NumberOutput,
+                        "COMMANDOUTPUT": CommandOutput,
+                        "XMLOutput": XMLOutput,
+                        "HexForNonASCII": HexForNonASCII,
+                        "COMMENTCONTROL": [DisassembleInstructions,
+                                           DisplayComments, CommentEnd,
+                                           CommentAfter, CommentOutput]}
+            if TreatDataNumbersAsLineReferences == 0:
+                Settings["ReferencedLineNumbers"] = ReferencedLineNumbers
 
-    if not Settings["HadLineEnd"]:
-        # end of line
-        if Settings["XMLOutput"] == 1:
-            soutput += '</line>'
+            if FunctionMatcher.match(di.data):
+                details = _ProcessFunctionDetails(di.data.strip()[2:])
+                if isinstance(details, str):
+                    raise SpectrumTranslateError(details)
 
-        # new line
-        soutput += "\n"
+                # check is valid command
+                if (details[0] not in
+                   DisassembleInstruction.PredefinedRoutines):
+                    raise SpectrumTranslateError(
+                        'Routine "{}" not defined'.format(details[0]))
 
-    # handle comments after line
-    if "COMMENTCONTROL" in Settings:
-        if (Settings["COMMENTCONTROL"][1] == 0 and
-           Settings["COMMENTCONTROL"][3] != ""):
-            soutput += Settings["COMMENTCONTROL"][4](
-                Settings["COMMENTCONTROL"][3],
-                Settings["XMLOutput"]) + "\n"
+                # process routine
+                Vars = [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, di.start, 0, 0, di.start,
+                        di.end]
+                args = [data, Settings, Vars] + details[1]
+                keyargs = details[2]
+                result = DisassembleInstruction.PredefinedRoutines[details[0]](
+                    *args, **keyargs)
+                # adjust end of data block
+                di.end = Vars[10] - 1
+                # extract text from result
+                if isinstance(result, str):
+                    txt = result
+                elif (_isarray(result) and len(result) > 0 and
+                     isinstance(result[0], str)):
+                    txt = result[0]
+                elif (_isarray(result) and len(result) > 1 and
+                     isinstance(result[1], str)):
+                    txt = result[1]
+                else:
+                    txt = ""
+            else:
+                di.end, txt = di.disassembledatablock(Settings, data)
 
-        # clear comments
-        Settings["COMMENTCONTROL"][2] = ""
-        Settings["COMMENTCONTROL"][3] = ""
+            if txt.endswith("\n"):
+                txt = txt[:-1]
+            soutput += _getaddressedlines(txt)
 
-    Settings["HadLineStart"] = False
-    Settings["HadLineEnd"] = True
+            # update comments
+            CommentEnd = Settings["COMMENTCONTROL"][2]
+            CommentAfter = Settings["COMMENTCONTROL"][3]
 
-    return soutput
+            # adjust length
+            length -= di.end-currentAddress + 1
 
+            # before update address, check for formatting that might
+            # have been missed
+            for ditemp in DisassembleInstructions:
+                # ensure is line after data and applies to this block
+                if (ditemp.instruction & 0xFFFFFF00 == 0xA00 and
+                   ditemp.start <= currentAddress and
+                   ditemp.end >= di.end):
+                    # record current format state in custom, place on stack
+                    s = get_custom_format_string(
+                        AddressOutput, NumberOutput, CommandOutput,
+                        OutputTStates, BreakAfterJumps, LineNumberOutput,
+                        ListEveryXLines, BreakAfterData,
+                        TreatDataNumbersAsLineReferences, DisplayCommandBytes,
+                        DisplayComments, Seperator, ShowFlags,
+                        MarkUndocumenedCommand, XMLOutput, HexForNonASCII)
+                    Format += [DisassembleInstruction(
+                        DisassembleInstruction.DISASSEMBLE_CODES[
+                            "Custom Format"],
+                        currentAddress, CurrentFormatEnd, s)]
+                    # update breakafterdata setting
+                    BreakAfterData = ditemp.instruction & 0x01
+                    # remember when format ends
+                    CurrentFormatEnd = ditemp.end
+                    # remove format command
+                    DisassembleInstructions.remove(ditemp)
 
-# pre-defined Functions
-def _PredefinedDefineByte(data, Settings, Vars, Signed=False, Format=0,
-                          FormatIdentifyer=True, GapFrequency=1, Gap=",",
-                          MaxPerLine=1):
-    """Outputs data as bytes.
+            # point to end of data block
+            currentAddress = di.end + 1
 
-data is the data to process.
-Settings is a dictionary containing needed setings such as the origin of
-  the code, if wanting XML output, formats for adress, numbers, and
-  commands. This is the same as for the disassembledatablock in a
-  DisassembleInstruction object.
-Vars is a list of variables as used internally to process the scripting
-  code used by the disassembler. Of note Vars[0x0A] is the address of
-  the current line, Vars[0x0E] is the last byte that's part of the data,
-  and Vars[0x0C] is the offset of the current byte being processed in
-  bytes from Vars[0x0A].
-Signed specifies if 255 (0xFF) is 255 or -1.
-Format specifies the number format: 0 for Hexadecimal, 1 for decimal,
-  2 for octal, 3 for binary, 4 to use the same format as is used for
-  addresses, 5 to use same format as for numbers, and 6 to use the
-  same format as the bytes of a command
-FormatIdentifyer specifies if you want a label to identify the data:
-  # for hexadecimal numbers, b for binary, o for octal, nothing for
-  decimal. Set this to text if you want to specify your own identifyer
-  to use infront of a number.
-GapFrequency is how many bytes between gaps in the data output.
-  Set this to 0 if you don't want any gaps.
-Gap specifies what text you want to use between bytes in the output as
-  controlled by GapFrequency.
-MaxPerLine specified the maximum number of bytes output per line of data
-  before moveing onto a new line."""
+            # adjust offset
+            offset = currentAddress-origin
 
-    if Format == 4:
-        Format = Settings["ADDRESSOUTPUT"]
-    elif Format == 5:
-        Format = Settings["NUMBEROUTPUT"]
-    elif Format == 6:
-        Format = Settings["COMMANDOUTPUT"]
-    dataformat = FormatIdentifyer if isinstance(FormatIdentifyer, str) else \
-        (("#", "", "o", "b")[Format] if FormatIdentifyer else "")
-    dataformat += ("{:02X}", "{}", "{:03o}", "{:08b}")[Format]
+            # update work done
+            workdone += (di.end - di.start) * 2
 
-    soutput = ""
+            # put empty line after data if needed
+            if (("LINEAFTERDATA" in Settings and Settings["LINEAFTERDATA"]) or
+               (BreakAfterData == 0 and "LINEAFTERDATA" not in Settings)):
+                soutput += ['']
 
-    # look until have passed end point
-    while Vars[0x0A] <= Vars[0x0E]:
-        # output line details
-        soutput += PredefinedStartLine(Settings, Vars,
-                                       "SB" if Signed else "DB")
+            continue
 
-        # loop until run out of data area or hit max line length
-        Vars[0x0C] = 0
-        while Vars[0x0A] + Vars[0x0C] <= Vars[0x0E] and \
-              Vars[0x0C] < MaxPerLine:
-            if Settings["XMLOutput"] == 1:
-                soutput += "<data>"
-            elif (GapFrequency > 0 and Vars[0x0C] > 0 and
-                 Vars[0x0C] % GapFrequency == 0):
-                soutput += Gap
+        # check formatting command
+        if di is not None and di.isformatinstruction():
+            # record current format state in custom, place on stack
+            s = get_custom_format_string(AddressOutput, NumberOutput,
+                                         CommandOutput, OutputTStates,
+                                         BreakAfterJumps, LineNumberOutput,
+                                         ListEveryXLines, BreakAfterData,
+                                         TreatDataNumbersAsLineReferences,
+                                         DisplayCommandBytes, DisplayComments,
+                                         Seperator, ShowFlags,
+                                         MarkUndocumenedCommand, XMLOutput,
+                                         HexForNonASCII)
+            Format += [DisassembleInstruction(
+                DisassembleInstruction.DISASSEMBLE_CODES["Custom Format"],
+                currentAddress, CurrentFormatEnd, s)]
 
-            # get value to output
-            n = data[Vars[0x0A] + Vars[0x0C] - Settings["ORIGIN"]]
-            # handle negative
-            if Signed and n > 127:
-                soutput += "-"
-                n = 256 - n
-            # output value
-            soutput += dataformat.format(n)
-            if Settings["XMLOutput"] == 1:
-                soutput += "</data>"
-            Vars[0x0C] += 1
+            # deal with format commands
+            if di.instruction & 0xFFFF00 == 0x000100:
+                # AddressOutputFormat
+                AddressOutput = di.instruction & 0x03
 
-        # end of line
-        soutput += PredefinedEndLine(Settings, Vars)
+            elif di.instruction & 0xFFFF00 == 0x000200:
+                # NumberOutputFormat
+                NumberOutput = di.instruction & 0x03
 
-    Vars[0x0E] = Vars[0x0A] - 1
-    return soutput
+            elif di.instruction & 0xFFFF00 == 0x000300:
+                # CommandOutputFormat
+                CommandOutput = di.instruction & 0x03
 
+            elif di.instruction & 0xFFFF00 == 0x000400:
+                # OutputTStatesFormat
+                OutputTStates = di.instruction & 0x03
 
-def _PredefinedDefineWord(data, Settings, Vars, Signed=False, Format=0,
-                          FormatIdentifyer=True, GapFrequency=1, Gap=',',
-                          MaxPerLine=1, LittleEndian=True):
-    """Outputs data as 2 byte words.
+            elif di.instruction & 0xFFFF00 == 0x000500:
+                # LineAfterJumpOutputFormat
+                BreakAfterJumps = di.instruction & 0x03
 
-data is the data to process.
-Settings is a dictionary containing needed setings such as the origin of
-  the code, if wanting XML output, formats for adress, numbers, and
-  commands. This is the same as for the disassembledatablock in a
-  DisassembleInstruction object.
-Vars is a list of variables as used internally to process the scripting
-  code used by the disassembler. Of note Vars[0x0A] is the address of
-  the current line, Vars[0x0E] is the last byte that's part of the data,
-  and Vars[0x0C] is the offset of the current byte being processed in
-  bytes from Vars[0x0A].
-Signed specifies if 255 (0xFF) is 255 or -1.
-Format specifies the number format: 0 for Hexadecimal, 1 for decimal,
-  2 for octal, 3 for binary, 4 to use the same format as is used for
-  addresses, 5 to use same format as for numbers, and 6 to use the
-  same format as the bytes of a command
-FormatIdentifyer specifies if you want a label to identify the data:
-  # for hexadecimal numbers, b for binary, o for octal, nothing for
-  decimal. Set this to text if you want to specify your own identifyer
-  to use infront of a number.
-GapFrequency is how many words between gaps in the data output.
-  Set this to 0 if you don't want any gaps.
-Gap specifies what text you want to use between words in the output as
-  controlled by GapFrequency.
-MaxPerLine specified the maximum number of words output per line of data
-  before moveing onto a new line."""
-
-    if Format == 4:
-        Format = Settings["ADDRESSOUTPUT"]
-    elif Format == 5:
-        Format = Settings["NUMBEROUTPUT"]
-    elif Format == 6:
-        Format = Settings["COMMANDOUTPUT"]
-    dataformat = FormatIdentifyer if isinstance(FormatIdentifyer, str) else \
-        (("#", "", "o", "b")[Format] if FormatIdentifyer else "")
-    dataformat += ("{:04X}", "{}", "{:06o}", "{:016b}")[Format]
-    datatitle = "{}{}".format("SW" if Signed else "DW",
-                                "" if LittleEndian else "BE")
-
-    soutput = ""
+            elif di.instruction & 0xFFFF00 == 0x000600:
+                # DefaultFormat
+                AddressOutput = di.instruction & 0x03
+                NumberOutput = di.instruction & 0x03
+                CommandOutput = di.instruction & 0x03
+                OutputTStates = 0
+                BreakAfterJumps = 1
+                LineNumberOutput = 0
+                ListEveryXLines = 0
+                BreakAfterData = 0
+                TreatDataNumbersAsLineReferences = 0
+                DisplayCommandBytes = 0
+                DisplayComments = 0
+                Seperator = "  "
+                ShowFlags = 0
+                MarkUndocumenedCommand = 0
+                XMLOutput = 0
+                HexForNonASCII = 0
 
-    # look until have passed end point
-    while Vars[0x0A] <= Vars[0x0E]:
-        # output line details
-        soutput += PredefinedStartLine(Settings, Vars, datatitle)
+            elif di.instruction & 0xFFFF00 == 0x000700:
+                # CustomFormat
+                settingstemp = get_custom_format_values(di.data, False)
+                AddressOutput = settingstemp["AddressOutput"]
+                NumberOutput = settingstemp["NumberOutput"]
+                CommandOutput = settingstemp["CommandOutput"]
+                OutputTStates = settingstemp["OutputTStates"]
+                BreakAfterJumps = settingstemp["BreakAfterJumps"]
+                LineNumberOutput = settingstemp["LineNumberOutput"]
+                ListEveryXLines = settingstemp["ListEveryXLines"]
+                BreakAfterData = settingstemp["BreakAfterData"]
+                TreatDataNumbersAsLineReferences = settingstemp[
+                    "TreatDataNumbersAsLineReferences"]
+                DisplayCommandBytes = settingstemp["DisplayCommandBytes"]
+                DisplayComments = settingstemp["DisplayComments"]
+                Seperator = settingstemp["Seperator"]
+                ShowFlags = settingstemp["ShowFlags"]
+                MarkUndocumenedCommand = settingstemp["MarkUndocumenedCommand"]
+                XMLOutput = settingstemp["XMLOutput"]
+                HexForNonASCII = settingstemp["HexForNonASCII"]
 
-        # loop until run out of data area or hit max line length
-        Vars[0x0C] = 0
-        while Vars[0x0A] + Vars[0x0C] <= Vars[0x0E] and \
-              Vars[0x0C] < (MaxPerLine * 2):
-            if Settings["XMLOutput"] == 1:
-                soutput += "<data>"
-            elif (GapFrequency > 0 and Vars[0x0C] > 0 and
-                 Vars[0x0C] % (GapFrequency * 2) == 0):
-                soutput += Gap
+            elif di.instruction & 0xFFFF00 == 0x000800:
+                # LineNumberOutput
+                LineNumberOutput = di.instruction & 0x03
 
-            # get value to output
-            n = Vars[0x0A] + Vars[0x0C] - Settings["ORIGIN"]
-            n = (data[n] + 256 * data[n + 1]) if LittleEndian else \
-                (data[n + 1] + 256 * data[n])
-            # handle negative
-            if Signed and n > 0x7FFF:
-                soutput += "-"
-                n = 65536 - n
-            # output value
-            soutput += dataformat.format(n)
-            if Settings["XMLOutput"] == 1:
-                soutput += "</data>"
-            Vars[0x0C] += 2
+            elif di.instruction & 0xFFFF00 == 0x000900:
+                # ListEveryXLines
+                ListEveryXLines = int(di.data, 16)
 
-        # end of line
-        soutput += PredefinedEndLine(Settings, Vars)
+            elif di.instruction & 0xFFFF00 == 0x000A00:
+                # BreakAfterData
+                BreakAfterData = di.instruction & 0x01
 
-    Vars[0x0E] = Vars[0x0A] - 1
+            elif di.instruction & 0xFFFF00 == 0x000B00:
+                # TreatDataNumbersAsLineReferences
+                TreatDataNumbersAsLineReferences = di.instruction & 0x01
 
-    return soutput
+            elif di.instruction & 0xFFFF00 == 0x000C00:
+                # DisplayCommandBytes
+                DisplayCommandBytes = di.instruction & 0x01
 
+            elif di.instruction & 0xFFFF00 == 0x000D00:
+                # DisplayComments
+                DisplayComments = di.instruction & 0x01
 
-def _PredefinedDefineMessage(data, Settings, Vars, DataType="DM",
-                             Noncharoutofquotes=False):
-    """Outputs data as text.
+            elif di.instruction & 0xFFFFFF == 0x000E00:
+                # Seperator space
+                Seperator = "  "
 
-data is the data to process.
-Settings is a dictionary containing needed setings such as the origin of
-  the code, if wanting XML output, formats for adress, numbers, and
-  commands. This is the same as for the disassembledatablock in a
-  DisassembleInstruction object.
-Vars is a list of variables as used internally to process the scripting
-  code used by the disassembler. Of note Vars[0x0A] is the address of
-  the current line, Vars[0x0E] is the last byte that's part of the data,
-  and Vars[0x0C] is the offset of the current byte being processed in
-  bytes from Vars[0x0A].
-DataType specifies the length encoding of the message. "DM" to be length
-  of the data block, "DM0" to be terminated by a zero byte (ignoring a
-  zero after a control code), "DM7" to be terminated by bit 7 being set
-  on the last character, "DMLB" where the string length is encoded as a
-  byte at the start of the string, "DMLW" where the length is encoded as
-  a Little endian string before the start of a string, and "DMLWBE"
-  where he length is encoded as a big-endian word before the string.
-Noncharoutofquotes defines if you want non characters (ie control codes,
-  or commands if the "Hex instead of non-ASCII On" control is being
-  used) displayed as hex numbers outside of strings instead of 2 digit
-  hexacecimal numbers preceded by '^' (which is never used on the
-  spectrum) inside a string."""
-    endings = {"DM": "DM",
-               "DM0": "DM0", "0": "DM0",
-               "DM7": "DM7", "7": "DM7",
-               "DMLB": "DMLB", "LB": "DMLB",
-               "DMLW": "DMLW", "LW": "DMLW",
-               "DMLWBE": "DMLWBE", "LWBE": "DMLWBE", "BE": "DMLWBE"}
-    if DataType not in endings:
-        raise SpectrumTranslateError("{} not a recognised Word format".format(
-            DataType))
-    datatitle = endings[DataType]
+            elif di.instruction & 0xFFFFFF == 0x000E01:
+                # Seperator tab
+                Seperator = "\t"
 
-    soutput = ""
-    maxaddress = len(data) + Settings["ORIGIN"] - 1
+            elif di.instruction & 0xFFFFFF == 0x000E02:
+                # Seperator custom
+                Seperator = di.data
 
-    # look until have passed end point
-    while Vars[0x0A] <= Vars[0x0E]:
-        # output line details
-        soutput += PredefinedStartLine(Settings, Vars, datatitle)
-        Vars[0x0C] = 0
-        # get last char of string
-        if datatitle == "DM":
-            end = Vars[0x0E]
-        elif datatitle == "DM0":
-            bytesaftercontrol = -1
-            end = Vars[0x0A]
-            while end < maxaddress and (data[end - Settings["ORIGIN"]] != 0 or
-                  bytesaftercontrol > 0):
-                bytesaftercontrol -= 1
-                d = data[end - Settings["ORIGIN"]]
-                end += 1
-                if d >= 16 and d <= 21:
-                    bytesaftercontrol = 1
-                elif d == 22:
-                    bytesaftercontrol = 2
-        elif datatitle == "DM7":
-            bytesaftercontrol = -1
-            end = Vars[0x0A]
-            while end < maxaddress and (data[end - Settings["ORIGIN"]] < 128 or
-                  bytesaftercontrol > 0):
-                bytesaftercontrol -= 1
-                d = data[end - Settings["ORIGIN"]]
-                end += 1
-                if d >= 16 and d <= 21:
-                    bytesaftercontrol = 1
-                elif d == 22:
-                    bytesaftercontrol = 2
-        elif datatitle == "DMLB":
-            length = data[Vars[0x0A] - Settings["ORIGIN"]]
-            end = min(maxaddress, Vars[0x0A] + length)
-            Vars[0x0C] = 1
-        elif datatitle == "DMLW":
-            length = data[Vars[0x0A] - Settings["ORIGIN"]] + \
-                     256 * data[Vars[0x0A] - Settings["ORIGIN"] + 1]
-            end = min(maxaddress, Vars[0x0A] + length + 1)
-            Vars[0x0C] = 2
-        else:
-            length = data[Vars[0x0A] - Settings["ORIGIN"] + 1] + \
-                     256 * data[Vars[0x0A] - Settings["ORIGIN"]]
-            end = min(maxaddress, Vars[0x0A] + length + 1)
-            Vars[0x0C] = 2
+            elif di.instruction & 0xFFFF00 == 0x000F00:
+                # Display flags
+                ShowFlags = di.instruction & 0x01
 
-        if Settings["XMLOutput"] == 1:
-            soutput += "<data>"
-        # loop until run out of data area or hit max line length
-        bytesaftercontrol = 0
-        inquotes = False
-        startoffset = Vars[0x0C]
-        while Vars[0x0A] + Vars[0x0C] <= end:
-            n = data[Vars[0x0A] + Vars[0x0C] - Settings["ORIGIN"]]
-            c = getspectrumchar(n, Settings["HexForNonASCII"])
-            # force bytes after control character to be number not char
-            # also bytes>127 in bit 7 mode
-            if bytesaftercontrol > 0 or (datatitle == "DM7" and n > 127):
-                c = "^{:02X}".format(n)
-            bytesaftercontrol -= 1
-            # handle numbers outside quotes
-            if c[0] == '^' and Noncharoutofquotes:
-                if inquotes:
-                    soutput += '"'
-                    inquotes = False
-                soutput += "{}0x{:02X}".format(
-                    "" if Vars[0x0C] == startoffset else ",", n)
-            else:
-                # print enter quotes if needed
-                if not inquotes:
-                    if Vars[0x0C] > startoffset:
-                        soutput += ','
-                    soutput += '"'
-                    inquotes = True
-                soutput += c
+            elif di.instruction & 0xFFFF00 == 0x001000:
+                # note undocumened commands
+                MarkUndocumenedCommand = di.instruction & 0x01
 
-            # if is control code, work out how many bytes follow
-            if n >= 16 and n <= 21:
-                bytesaftercontrol = 1
-            elif n == 22:
-                bytesaftercontrol = 2
+            elif di.instruction & 0xFFFF00 == 0x001200:
+                # XML mode
+                XMLOutput = di.instruction & 0x01
 
-            # move to next char
-            Vars[0x0C] += 1
+            elif di.instruction & 0xFFFF00 == 0x001300:
+                # HexForNonASCII mode
+                HexForNonASCII = di.instruction & 0x01
 
-        # close quotes if needed
-        if inquotes:
-            soutput += '"'
+            LineFormat = None
+            CurrentFormatEnd = di.end
+            continue
 
-        if Settings["XMLOutput"] == 1:
-            soutput += "</data>"
-        # end of line
-        soutput += PredefinedEndLine(Settings, Vars)
+        # check is comment
+        if (di is not None and di.instruction & 0xFFFF00 == 0x030000 and
+           di.data is not None and di.data != ""):
+            # handle commenmts before this line first
+            if di.instruction == DisassembleInstruction.DISASSEMBLE_CODES[
+                    "Comment Before"]:
+                if DisplayComments == 0:
+                    soutput += CommentLines(di.data, XMLOutput)
 
-    Vars[0x0E] = end
+                continue
+            # otherwise comnment end of this line or after
+            if di.instruction == 0x030002:
+                if CommentAfter != "":
+                    CommentAfter += "\n"
+                CommentAfter += di.data
+            else:
+                if CommentEnd != "":
+                    CommentEnd += ". "
+                CommentEnd += di.data
 
-    return soutput
+            continue
 
+        # check is reference comment
+        if di is not None and di.instruction & 0xFFFF00 == 0x030100:
+            # make note of reference, flag, and comment
+            di.reference, di.flag, di.comment = get_comment_reference_values(
+                di.data)
+            # add it to list to look for
+            CommentReferences += [di]
+            # now sort it so 1st is next to expire
+            CommentReferences.sort(key=attrgetter('end'))
+            continue
 
-def _PredefinedFindPattern(data, Settings, Vars, *args):
-    """Returns a list of matching addresses to the supplied list of
-bytes. After the basic data, just supp;y the vlues to search for in
-order."""
-    arglen = len(args)
-    if arglen == 0:
-        raise SpectrumTranslateError("No bytes to match")
+        # check is reference displacement
+        if di is not None and di.instruction & 0xFFFF00 == 0x030200:
+            # Remove expired comment displacements
+            for i in range(256):
+                while currentAddress > CommentDisplacementsX[i][0][1]:
+                    CommentDisplacementsX[i][0] = CommentDisplacementsX[i][
+                        1].pop()
+                while currentAddress > CommentDisplacementsY[i][0][1]:
+                    CommentDisplacementsY[i][0] = CommentDisplacementsY[i][
+                        1].pop()
 
-    matches = []
-    pos = Vars[0x0A]
-    origin = Settings["ORIGIN"]
-    l = len(data)
-    # convert args to a bytearray so can be matched
-    args = bytearray(args)
-    while pos <= Vars[0x0E] and pos - origin < l:
-        n = pos - origin
-        if data[n:n + arglen] == args:
-            matches += [pos]
-        pos += 1
+            # get displacement, flag, and comment
+            displace, flag, comment = get_comment_displacement_values(di.data)
+            # add it to IX if indicated
+            if flag & 1 == 1:
+                CommentDisplacementsX[displace][1] += [
+                    CommentDisplacementsX[displace][0]]
+                CommentDisplacementsX[displace][0] = [comment, di.end,
+                                                      di.instruction & 3]
+            # add it to IY if indicated
+            if flag & 2 == 2:
+                CommentDisplacementsY[displace][1] += [
+                    CommentDisplacementsY[displace][0]]
+                CommentDisplacementsY[displace][0] = [comment, di.end,
+                                                      di.instruction & 3]
+            continue
 
-    return matches
+        # now deal with machine code
 
+        # decode instruction into a record using precompiled decode
+        # table.  Place in try block to catch trying to get extra data
+        # from beyond end of supplied bytes
+        try:
+            instruction = _getz80instruction(data, offset, currentAddress)
 
-def _PredefinedStartandEndByOffset(data, Settings, Vars, addresses,
-                                   startoffset=0, endoffset=0):
-    """Returns a list of lists for start and end addresses, given the
-offsets and origional addresses."""
+        # catch if tried to get data from beyond end of supplied data
+        except IndexError:
+            # have tried to access bytes from beyond end of given data
+            # output bytes as DB data
+            # create DisassembleInstruction to do this
+            DisassembleInstructions.insert(0, DisassembleInstruction(
+                DisassembleInstruction.DISASSEMBLE_CODES["Data Block"],
+                currentAddress, currentAddress + len(data)-offset-1,
+                "%!DefineByte()"))
+            # back too start of while loop & should enter data block
+            continue
 
-    return [[x + startoffset, x + endoffset] for x in addresses]
+        s = instruction.mnemonic
+        commandlength = len(instruction.code)
 
+        # handle any comments or references for the operands
+        for kind, value in instruction.operands:
+            # first check for displacement byte
+            if kind == "d":
+                # Remove expired comment displacements
+                for i in range(256):
+                    while currentAddress > CommentDisplacementsX[i][0][1]:
+                        CommentDisplacementsX[i][0] = CommentDisplacementsX[i][
+                            1].pop()
+                    while currentAddress > CommentDisplacementsY[i][0][1]:
+                        CommentDisplacementsY[i][0] = CommentDisplacementsY[i][
+                            1].pop()
 
-class DisassembleInstruction:
-    DISASSEMBLE_CODES = {
-        "Address Output Format Hex": 0x0100,
-        "Address Output Format Decimal": 0x0101,
-        "Address Output Format Octal": 0x0102,
-        "Address Output Format Binary": 0x0103,
-        "Number Output Format Hex": 0x0200,
-        "Number Output Format Decimal": 0x0201,
-        "Number Output Format Octal": 0x0202,
-        "Number Output Format Binary": 0x0203,
-        "Command Output Format Hex": 0x0300,
-        "Command Output Format Decimal": 0x0301,
-        "Command Output Format Octal": 0x0302,
-        "Command Output Format Binary": 0x0303,
-        "Output T States Format None": 0x0400,
-        "Output T States Format Total": 0x0401,
-        "Output T States Format List States": 0x0402,
-        "Output T States Format List All": 0x0403,
-        "Line After Jump None": 0x0500,
-        "Line After Jump After Absolute": 0x0501,
-        "Line After Jump After All": 0x0502,
-        "Default Format Hex": 0x0600,
-        "Default Format Decimal": 0x0601,
-        "Default Format Octal": 0x0602,
-        "Default Format Binary": 0x0603,
-        "Custom Format": 0x0700,
-        "Line Numbers All": 0x0800,
-        "Line Numbers None": 0x0801,
-        "Line Numbers Referenced": 0x0802,
-        "Line Number Every X": 0x0900,
-        "Empty Line After Data On": 0x0A00,
-        "Empty Line After Data Off": 0x0A01,
-        "Reference Data Numbers On": 0x0B00,
-        "Reference Data Numbers Off": 0x0B01,
-        "List Command Bytes On": 0x0C00,
-        "List Command Bytes Off": 0x0C01,
-        "Comments On": 0x0D00,
-        "Comments Off": 0x0D01,
-        "Seperators Space": 0x0E00,
-        "Seperators Tab": 0x0E01,
-        "Seperators Custom": 0x0E02,
-        "Display Flags Off": 0x0F00,
-        "Display Flags On": 0x0F01,
-        "Mark Undocumented Command Off": 0x1000,
-        "Mark Undocumented Command On": 0x1001,
-        "Reference Line": 0x1100,
-        "XML Output Off": 0x1200,
-        "XML Output On": 0x1201,
-        "Hex instead of non-ASCII Off": 0x1300,
-        "Hex instead of non-ASCII On": 0x1301,
-        "Data Block": 0x010000,
-        "Pattern Data Block": 0x020000,
-        "Comment": 0x030000,
-        "Comment Before": 0x030001,
-        "Comment After": 0x030002,
-        "Comment Reference": 0x030100,
-        "Comment Reference Before": 0x030101,
-        "Comment Reference After": 0x030102,
-        "Comment Displacement": 0x030200,
-        "Comment Displacement Before": 0x030201,
-        "Comment Displacement After": 0x030202,
-        "Comment Pattern": 0x040001}
+                # get number
+                i = value
 
-    DISASSEMBLE_DATABLOCK_CODES = {
-        "Define Byte Hex": """\
-%$A       %#start address xml tag
-%F0004    %#set output format to general output format
-%ACA      %#output line address as address
-%$-A      %#close address xml tag
-%S%S      %#seperator
-%$I       %#start instruction xml tag
-DB        %#output instruction (DB or define byte in this case)
-%$-I      %#close instruction tag
-%S        %#seperator
-%$D       %#start data tag
-%F0000    %#set format to hexadecimal
-%F0100    %#set format to unsigned
-#         %#output '#' to indicate hex number following
-%B0F      %#output contents at current position as byte,
-          %#and increment current position
-%$-D      %#close data xml tag""",
-        "Define Byte Decimal": """\
-%$A       %#start address xml tag
-%F0004    %#set output format to general output format
-%ACA      %#output line address as address
-%$-A      %#close address xml tag
-%S%S      %#seperator
-%$I       %#start instruction xml tag
-DB        %#output instruction (DB or define byte in this case)
-%$-I      %#close instruction tag
-%S        %#seperator
-%$D       %#start data tag
-%F0001    %#set format to decimal
-%F0100    %#set format to unsigned
-%B0F      %#output contents at current position as byte,
-          %#and increment current position
-%$-D      %#close data xml tag""",
-        "Define Byte Octal": """\
-%$A       %#start address xml tag
-%F0004    %#set output format to general output format
-%ACA      %#output line address as address
-%$-A      %#close address xml tag
-%S%S      %#seperator
-%$I       %#start instruction xml tag
-DB        %#output instruction (DB or define byte in this case)
-%$-I      %#close instruction tag
-%S        %#seperator
-%$D       %#start data tag
-%F0002    %#set format to octal
-%F0100    %#set format to unsigned
-o         %#output 'o' to indicate octal number following
-%B0F      %#output contents at current position as byte,
-          %#and increment current position
-%$-D      %#close data xml tag""",
-        "Define Byte Binary": """\
-%$A       %#start address xml tag
-%F0004    %#set output format to general output format
-%ACA      %#output line address as address
-%$-A      %#close address xml tag
-%S%S      %#seperator
-%$I       %#start instruction xml tag
-DB        %#output instruction (DB or define byte in this case)
-%$-I      %#close instruction tag
-%S        %#seperator
-%$D       %#start data tag
-%F0003    %#set format to binary
-%F0100    %#set format to unsigned
-b         %#output 'b' to indicate binary number following
-%B0F      %#output contents at current position as byte,
-          %#and increment current position
-%$-D      %#close data xml tag""",
-        "Define Byte": """\
-%$A       %#start address xml tag
-%F0004    %#set output format to general output format
-%ACA      %#output line address as address
-%$-A      %#close address xml tag
-%S%S      %#seperator
-%$I       %#start instruction xml tag
-DB        %#output instruction (DB or define byte in this case)
-%$-I      %#close instruction tag
-%S        %#seperator
-%$D       %#start data tag
-%F0000    %#set format to hexadecimal (default for generic define byte)
-%F0100    %#set format to unsigned
-#         %#output '#' to indicate hex number following
-%B0F      %#output contents at current position as byte,
-          %#and increment current position
-%$-D      %#close data xml tag""",
-        "Signed Byte Hex": """\
-%$A       %#start address xml tag
-%F0004    %#set output format to general output format
-%ACA      %#output line address as address
-%$-A      %#close address xml tag
+                # check for reference comments
+                if ('IX' in s and CommentDisplacementsX[i][0][0] and
+                   CommentDisplacementsX[i][0][0] != ""):
+                    # handle comment
+                    if CommentDisplacementsX[i][0][2] == 1:
+                        if DisplayComments == 0:
+                            soutput += CommentLines(
+                                CommentDisplacementsX[i][0][0],
+                                XMLOutput)
+                    # otherwise comnment end of this line or after
+                    elif CommentDisplacementsX[i][0][2] == 2:
+                        if CommentAfter != "":
+                            CommentAfter += "\n"
+                        CommentAfter += CommentDisplacementsX[i][0][0]
+                    else:
+                        if CommentEnd != "":
+                            CommentEnd += ". "
+                        CommentEnd += CommentDisplacementsX[i][0][0]
+                if ('IY' in s and CommentDisplacementsY[i][0][0] and
+                   CommentDisplacementsY[i][0][0] != ""):
+                    # handle comment
+                    if CommentDisplacementsY[i][0][2] == 1:
+                        if DisplayComments == 0:
+                            soutput += CommentLines(
+                                CommentDisplacementsY[i][0][0],
+                                XMLOutput)
+                    # otherwise comnment end of this line or after
+                    elif CommentDisplacementsY[i][0][2] == 2:
+                        if CommentAfter != "":
+                            CommentAfter += "\n"
+                        CommentAfter += CommentDisplacementsY[i][0][0]
+                    else:
+                        if CommentEnd != "":
+                            CommentEnd += ". "
+                        CommentEnd += CommentDisplacementsY[i][0][0]
+
+            # check for relative jump byte
+            if kind == "j":
+                # get address jumped to
+                i = value
+
+                # check for reference comments
+                for di in CommentReferences:
+                    # have we got right reference
+                    if di.reference != i:
+                        continue
+                    # do the flags match
+                    if di.flag & 16 == 16:
+                        # handle comment
+                        if di.instruction & 3 == 1:
+                            if DisplayComments == 0:
+                                soutput += CommentLines(di.comment,
+                                                        XMLOutput)
+                        # otherwise comnment end of this line or after
+                        elif di.instruction & 3 == 2:
+                            if CommentAfter != "":
+                                CommentAfter += "\n"
+                            CommentAfter += di.comment
+                        else:
+                            if CommentEnd != "":
+                                CommentEnd += ". "
+                            CommentEnd += di.comment
+
+                # make note of referenced line
+                ReferencedLineNumbers.add(i, currentAddress)
+
+            # check for 2 byte address
+            if kind == "aa":
+                # get number
+                i = value
+                # check for reference comments
+                for di in CommentReferences:
+                    # have we got right reference
+                    if di.reference != i:
+                        continue
+                    # do the flags match
+                    if ((di.flag & 1 == 1 and '(' in s) or
+                       (di.flag & 2 == 2 and s == 'LD SP,aa') or
+                       (di.flag & 4 == 4 and s[0] == 'C') or
+                       (di.flag & 8 == 8 and s[0] == 'J')):
+                        # handle comment
+                        if di.instruction & 3 == 1:
+                            if DisplayComments == 0:
+                                soutput += CommentLines(di.comment,
+                                                        XMLOutput)
+                        # otherwise comnment end of this line or after
+                        elif di.instruction & 3 == 2:
+                            if CommentAfter != "":
+                                CommentAfter += "\n"
+                            CommentAfter += di.comment
+                        else:
+                            if CommentEnd != "":
+                                CommentEnd += ". "
+                            CommentEnd += di.comment
+
+                # make note of referenced address
+                ReferencedLineNumbers.add(i, currentAddress)
+
+            # check for 2 byte number
+            if kind == "nn":
+                # get number
+                i = value
+                # check for reference comments
+                for di in CommentReferences:
+                    # have we got right reference
+                    if di.reference != i:
+                        continue
+                    # do the flags match
+                    if di.flag & 2 == 2:
+                        # handle comment
+                        if di.instruction & 3 == 1:
+                            if DisplayComments == 0:
+                                soutput += CommentLines(di.comment,
+                                                        XMLOutput)
+                        # otherwise comnment end of this line or after
+                        elif di.instruction & 3 == 2:
+                            if CommentAfter != "":
+                                CommentAfter += "\n"
+                            CommentAfter += di.comment
+                        else:
+                            if CommentEnd != "":
+                                CommentEnd += ". "
+                            CommentEnd += di.comment
+
+                # make note of referenced number
+                if TreatDataNumbersAsLineReferences == 0:
+                    ReferencedLineNumbers.add(i, currentAddress)
+
+        # when prescanning only need referenced lines and address lengths
+        if prescan:
+            if XMLOutput == 0:
+                maxAddressLength = max(FormatAddressLength[AddressOutput],
+                                       maxAddressLength)
+
+            CommentEnd = ""
+            CommentAfter = ""
+            length -= commandlength
+            offset += commandlength
+            offset &= 0xFFFF
+            currentAddress += commandlength
+            continue
+
+        if XMLOutput == 0:
+            # work out max length of address
+            maxAddressLength = max(FormatAddressLength[AddressOutput],
+                                   maxAddressLength)
+
+        # record format settings for instruction if changed
+        if LineFormat is None:
+            LineFormat = (AddressOutput, NumberOutput, CommandOutput,
+                          OutputTStates, BreakAfterJumps, LineNumberOutput,
+                          ListEveryXLines, DisplayCommandBytes,
+                          DisplayComments, Seperator, ShowFlags,
+                          MarkUndocumenedCommand, XMLOutput)
+
+        # line is rendered once know all the lines referenced
+        if CommentEnd != "":
+            instruction.comment = CommentEnd
+        soutput.append((instruction, LineFormat, CommentAfter))
+
+        # clear comments
+        CommentEnd = ""
+        CommentAfter = ""
+
+        length -= commandlength
+        offset += commandlength
+        offset &= 0xFFFF
+        currentAddress += commandlength
+
+        workdone += commandlength * 2
+
+    # end 1st pass
+    if XMLOutput == 1:
+        soutput += ["</z80code>"]
+    else:
+        soutput += ['']
+
+    # pass details needed for formatting pass
+    Details["MaxAddressLength"] = maxAddressLength
+    Details["WorkDone"] = worktodo1 + worktodo2
+    Details["WorkToDo"] = worktodo3
+
+    yield soutput
+
+
+def _getaddressedlines(txt):
+    """Splits the text produced for a data block into lines for
+    _renderdisassembly.  Lines starting with an address marker (as made
+    by PredefinedStartLine) become (flags, ListEveryXLines, address,
+    text) tuples so that the address can be filled in once the
+    referenced lines are known, and other lines are left as they are.
+    """
+
+    return [(ord(line[1]), ord(line[2]), int(line[3:7], 16), line[7:]) if
+            line[:1] == "\0" else line for line in txt.split("\n")]
+
+
+def _renderdisassembly(items, ReferencedLineNumbers, maxAddressLength):
+    """Generator that renders the items produced by _disassemble as the
+    lines of the disassembly.  An item is either a finished line, a
+    (flags, ListEveryXLines, address, text) tuple for a line that needs
+    it's address putting in front of the text, or a (record,
+    lineformat, commentafter) tuple for an instruction.  record is the
+    Z80Instruction with the comment for the end of the line,
+    lineformat is a tuple of the format settings for the instruction
+    (see _disassemble), and commentafter is the comment for the lines
+    after the instruction.
+
+    flags holds the address format in bits 0-1, is the line in a data
+    block in bit 2, the LineNumberOutput in bits 3-4, and if the
+    seperator isn't 2 spaces in bit 5.
+    ReferencedLineNumbers is the ReferencedAddresses of lines that are
+    referenced, and maxAddressLength is the width to pad addresses to.
+    """
+
+    # holds how long byte is in each number format
+    FormatByteLength = (2, 3, 3, 8)
+
+    lastLineInData = -1  # -1 start, 0=last in code, 1=last in data
+    # count how many lines since last address reference
+    lineCounter = 0
+
+    lastformat = None
+
+    def getaddressedline(flags, ListEveryXLines, address, text):
+        nonlocal lastLineInData, lineCounter
+
+        # are we in a data block?
+        bInData = (flags & 4) == 4
+        # 0=All, 1=None,  2=only referenced lines
+        LineNumberOutput = (flags >> 3) & 3
+
+        # if moved from data to code
+        if lastLineInData != 0 and not bInData:
+            # this will force line to be rendered
+            lineCounter = ListEveryXLines
+
+        # remember if last in code or data
+        lastLineInData = 1 if bInData else 0
+
+        # increment line counter
+        lineCounter += 1
+
+        s = ""
+        if (LineNumberOutput == 0 or
+           (lineCounter >= ListEveryXLines and ListEveryXLines != 0) or
+           (LineNumberOutput == 2 and address in ReferencedLineNumbers)):
+            # output address
+            s = _numbertostring(address, 16, flags & 3, (flags & 3) > 1)
+
+            # reset line counter
+            lineCounter = 0
+
+        # if space seperator mode then pad with spaces if needed
+        if flags & 32 == 0:
+            s += " " * (maxAddressLength - len(s))
+
+        return s + text
+
+    for item in items:
+        # finished lines
+        if item.__class__ is str:
+            yield item
+            continue
+
+        # lines needing address
+        if len(item) == 4:
+            yield getaddressedline(*item)
+            continue
+
+        record, lineformat, CommentAfter = item
+
+        # unpack format if changed
+        if lineformat is not lastformat:
+            lastformat = lineformat
+            (AddressOutput, NumberOutput, CommandOutput, OutputTStates,
+             BreakAfterJumps, LineNumberOutput, ListEveryXLines,
+             DisplayCommandBytes, DisplayComments, Seperator, ShowFlags,
+             MarkUndocumenedCommand, XMLOutput) = lineformat
+
+            bytestrings = _BYTE_STRINGS[CommandOutput]
+            # width of command bytes column
+            bytewidth = 5 * FormatByteLength[CommandOutput] + 1
+            # adjust for commas
+            if CommandOutput > 0:
+                bytewidth += 4
+
+            # flags for address of line
+            lineflags = AddressOutput + (LineNumberOutput << 3)
+            if Seperator != "  ":
+                lineflags += 1 << 5
+
+            # format for address when every line has one
+            addressformat = _getnumberformat(16, AddressOutput,
+                                             AddressOutput > 1)
+
+        s = record.getinstruction(AddressOutput, NumberOutput) if \
+            record.operands else record.mnemonic
+        CommentEnd = record.comment or ""
+
+        # Handle XML output
+        if XMLOutput == 1:
+            currentline = "  <line><address>" + _numbertostring(
+                record.address, 16, AddressOutput, AddressOutput > 1) + \
+                "</address><bytes>" + ",".join(
+                    [bytestrings[b] for b in record.code]) + \
+                "</bytes><instruction>" + s + "</instruction>"
+
+            # do comment
+            if DisplayComments == 0 and CommentEnd != "":
+                currentline += "<comment>" + CommentEnd + "</comment>"
+
+            # do flags
+            sflags = _getflagchanges(record.flags)
+            # output flag states if we have them
+            if sflags is not None:
+                currentline += "<flags>" + sflags + "</flags>"
+
+            # do times
+            # get times
+            duration, states = _gettiminginfo(record.times)
+
+            # now output timings
+            currentline += "<timeing><cycles>"
+            currentline += "unknown" if duration[0] == 0 else str(duration[0])
+            currentline += "</cycles>"
+
+            if states is not None:
+                currentline += "<tstates>" + ",".join(
+                    str(x) for x in states[0])
+                currentline += "</tstates>"
+
+            currentline += "</timeing>"
+
+            if duration[1] != 0:
+                currentline += '<timeing alternate="true"><cycles>'
+                currentline += str(duration[1]) + "</cycles>"
+
+                if states is not None:
+                    currentline += "<tstates>"
+                    currentline += ",".join(str(x) for x in states[1])
+                    currentline += "</tstates>"
+
+                currentline += "</timeing>"
+
+            # do undocumented comments if needed
+            if ((record.flags >> 21) & 1) == 1:
+                currentline += "<undocumented/>"
+
+            yield currentline + "</line>"
+
+            # handle comments after line
+            if DisplayComments == 0 and CommentAfter != "":
+                for line in ("  <line><comment>" + CommentAfter +
+                             "</comment></line>").split("\n"):
+                    yield line
+
+            continue
+
+        currentline = Seperator
+
+        # output bytes of commands if want them
+        if DisplayCommandBytes == 0:
+            commandbytes = ",".join([bytestrings[b] for b in record.code])
+            currentline += commandbytes
+
+            # now ensure opcodes line up
+            # don't need to bother if using tabs
+            if Seperator == "  ":
+                # multiplying by negative number gives empty string
+                currentline += " " * (bytewidth - len(commandbytes))
+
+        # add seperator after command bytes
+        # needed even if no command bytes as can go from disply
+        # command bytes to not and have to ensure output stays in
+        # same column in case tab seperated output is used in
+        # spreadsheet
+        currentline += Seperator + s
+
+        # if want comments, do so
+        if DisplayComments == 0 and (CommentEnd != "" or ShowFlags > 0 or
+                                     OutputTStates > 0 or
+                                     MarkUndocumenedCommand > 0):
+            precomment = ""
+
+            # align any comments
+            # don't need to bother if using tabs
+            if Seperator == "  ":
+                precomment = _getcommentpadding(s, AddressOutput,
+                                                NumberOutput)
+
+            # space between opcode and comments, and comment marker
+            precomment += Seperator + ";"
+
+            # will we need a space before this comment (and any comment
+            # following)
+            bNeedSpace = False
+
+            # do comment
+            if CommentEnd != "":
+                # output pre comment text
+                currentline += precomment
+                # note has been output
+                precomment = None
+
+                if CommentEnd.find("\n") == -1:
+                    currentline += CommentEnd
+
+                else:
+                    comments = CommentEnd.split("\n")
+                    currentline += comments[0]
+                    if CommentAfter != "":
+                        CommentAfter = "\n" + CommentAfter
+                    CommentAfter = "\n".join(comments[1:]) + CommentAfter
+
+                # mark will need space if any comment following
+                bNeedSpace = True
+
+            # are we listing flags?
+            if ShowFlags > 0:
+                if precomment:
+                    # output pre comment text
+                    currentline += precomment
+                    # note has been output
+                    precomment = None
+
+                # insert space if needed
+                if bNeedSpace:
+                    currentline += "  "
+
+                # get flag states for this instruction
+                sflags = _getflagchanges(record.flags)
+                # output flag states if we have them
+                if sflags is not None:
+                    currentline += sflags
+
+                    # mark will need space if any comment following
+                    bNeedSpace = True
+
+            if OutputTStates > 0:
+                if precomment:
+                    # output pre comment text
+                    currentline += precomment
+                    # note has been output
+                    precomment = None
+
+                # insert space if needed
+                if bNeedSpace:
+                    currentline += "  "
+
+                # get times
+                duration, states = _gettiminginfo(record.times)
+
+                # now output timings
+                currentline += "T="
+                if (OutputTStates & 1) == 1:
+                    if duration[0] == 0:
+                        currentline += "unknown"
+                    else:
+                        currentline += str(duration[0])
+
+                if (OutputTStates & 2) == 2 and states is not None:
+                    currentline += "(" + ",".join(
+                        str(x) for x in states[0]) + ")"
+
+                if duration[1] != 0:
+                    currentline += "/"
+                    if (OutputTStates & 1) == 1:
+                        currentline += str(duration[1])
+
+                    if (OutputTStates & 2) == 2 and states is not None:
+                        currentline += "(" + ",".join(
+                            str(x) for x in states[1]) + ")"
+
+                bNeedSpace = True
+
+            # are we noteing undocumented commands?
+            if (MarkUndocumenedCommand > 0 and
+               ((record.flags >> 21) & 1) == 1):
+                if precomment:
+                    # output pre comment text
+                    currentline += precomment
+                    # note has been output
+                    precomment = None
+
+                # do we need gap?
+                if bNeedSpace:
+                    currentline += "  "
+
+                # record that is undocumented
+                currentline += "Undocumented Command"
+
+        if LineNumberOutput == 0:
+            # every line has an address, so no need to check references
+            lastLineInData = 0
+            lineCounter = 0
+            address = addressformat.format(record.address)
+            if Seperator == "  ":
+                address += " " * (maxAddressLength - len(address))
+
+            yield address + currentline
+
+        else:
+            yield getaddressedline(lineflags, ListEveryXLines,
+                                   record.address, currentline)
+
+        # handle comments after line.  These are output as in a data
+        # block without an address
+        if DisplayComments == 0 and CommentAfter != "":
+            for txt in CommentAfter.split("\n"):
+                yield getaddressedline(12, 0, 0, Seperator + ";" + txt)
+
+        # do we need to have newline after command to make more
+        # readable
+        i = record.flags & 3
+        if BreakAfterJumps != 0 and i != 0:
+            if BreakAfterJumps != 1 or i != 1:
+                yield ""
+
+
+def PredefinedStartLine(Settings, Vars, datatitle):
+    """This functions starts off a line for predefined functions."""
+
+    soutput = ""
+
+    # check if any comments to be added to this data
+    if "COMMENTCONTROL" in Settings:
+        # move past any instructions that has been & gone
+        dis = Settings["COMMENTCONTROL"][0]
+        # get rid of passed commands
+        while dis and Vars[0x0A] > dis[0].end:
+            dis.pop(0)
+        # cycle through commands for this line to find comments
+        i = 0
+        while dis and Vars[0x0A] >= dis[i].start:
+            # if is comment instruction process it
+            if (dis[i].instruction & 0xFFFF00 == 0x030000 and
+               dis[i].data is not None and dis[i].data != ""):
+                di = dis.pop(i)
+                if di.instruction == DisassembleInstruction.DISASSEMBLE_CODES[
+                   "Comment Before"]:
+                    if Settings["COMMENTCONTROL"][1] == 0:
+                        soutput += Settings["COMMENTCONTROL"][4](
+                            di.data, Settings["XMLOutput"]) + "\n"
+
+                # otherwise comnment end of this line or after
+                elif di.instruction == 0x030002:
+                    if Settings["COMMENTCONTROL"][3] != "":
+                        Settings["COMMENTCONTROL"][3] += "\n"
+                    Settings["COMMENTCONTROL"][3] += di.data
+                else:
+                    if Settings["COMMENTCONTROL"][2] != "":
+                        Settings["COMMENTCONTROL"][2] += ". "
+                    Settings["COMMENTCONTROL"][2] += di.data
+            else:
+                i += 1
+
+    # output line details
+    if Settings["XMLOutput"] == 1:
+        # not set if called directly as routine for data block
+        if not Settings.get("HadLineStart", False):
+            soutput += "  <line>"
+        soutput += "<address>{}</address>".format(
+            _numbertostring(Vars[10], 16, Settings["ADDRESSOUTPUT"], False))
+        soutput += "<instruction>{}</instruction>".format(datatitle)
+    else:
+        i = Settings["ADDRESSOUTPUT"] + 4
+        if Settings["SEPERATOR"] != "  ":
+            i += 1 << 5
+        soutput += "\0" + chr(i) + chr(Settings["DISPLAYEVERYXLINES"])
+        soutput += "{0:04X}{1}{1}{2}{1}".format(Vars[10],
+                                                Settings["SEPERATOR"],
+                                                datatitle)
+
+    Settings["HadLineStart"] = True
+    Settings["HadLineEnd"] = False
+
+    return soutput
+
+
+def PredefinedEndLine(Settings, Vars):
+    """This functions ends a line for predefined functions."""
+
+    soutput = ""
+
+    # update position
+    Vars[0x0A] += Vars[0x0C]
+    # update line number
+    Vars[0x0B] += 1
+
+    # do comment
+    if ("COMMENTCONTROL" in Settings and
+       Settings["COMMENTCONTROL"][1] == 0 and
+       Settings["COMMENTCONTROL"][2] != ""):
+        # XML comments
+        if Settings["XMLOutput"] == 1:
+            soutput += "<comment>{}</comment>".format(
+                Settings["COMMENTCONTROL"][2])
+        # plain text comments
+        else:
+            # output pre comment text
+            soutput += Settings["SEPERATOR"] + ';'
+
+            if Settings["COMMENTCONTROL"][2].find("\n") == -1:
+                soutput += Settings["COMMENTCONTROL"][2]
+
+            else:
+                comments = Settings["COMMENTCONTROL"][2].split("\n")
+                soutput += comments[0] + "\n"
+                soutput += Settings["COMMENTCONTROL"][4](
+                    "".join(comments[1:]), Settings["XMLOutput"])
+
+    if not Settings["HadLineEnd"]:
+        # end of line
+        if Settings["XMLOutput"] == 1:
+            soutput += '</line>'
+
+        # new line
+        soutput += "\n"
+
+    # handle comments after line
+    if "COMMENTCONTROL" in Settings:
+        if (Settings["COMMENTCONTROL"][1] == 0 and
+           Settings["COMMENTCONTROL"][3] != ""):
+            soutput += Settings["COMMENTCONTROL"][4](
+                Settings["COMMENTCONTROL"][3],
+                Settings["XMLOutput"]) + "\n"
+
+        # clear comments
+        Settings["COMMENTCONTROL"][2] = ""
+        Settings["COMMENTCONTROL"][3] = ""
+
+    Settings["HadLineStart"] = False
+    Settings["HadLineEnd"] = True
+
+    return soutput
+
+
+# pre-defined Functions
+def _PredefinedDefineByte(data, Settings, Vars, Signed=False, Format=0,
+                          FormatIdentifyer=True, GapFrequency=1, Gap=",",
+                          MaxPerLine=1):
+    """Outputs data as bytes.
+
+data is the data to process.
+Settings is a dictionary containing needed setings such as the origin of
+  the code, if wanting XML output, formats for adress, numbers, and
+  commands. This is the same as for the disassembledatablock in a
+  DisassembleInstruction object.
+Vars is a list of variables as used internally to process the scripting
+  code used by the disassembler. Of note Vars[0x0A] is the address of
+  the current line, Vars[0x0E] is the last byte that's part of the data,
+  and Vars[0x0C] is the offset of the current byte being processed in
+  bytes from Vars[0x0A].
+Signed specifies if 255 (0xFF) is 255 or -1.
+Format specifies the number format: 0 for Hexadecimal, 1 for decimal,
+  2 for octal, 3 for binary, 4 to use the same format as is used for
+  addresses, 5 to use same format as for numbers, and 6 to use the
+  same format as the bytes of a command
+FormatIdentifyer specifies if you want a label to identify the data:
+  # for hexadecimal numbers, b for binary, o for octal, nothing for
+  decimal. Set this to text if you want to specify your own identifyer
+  to use infront of a number.
+GapFrequency is how many bytes between gaps in the data output.
+  Set this to 0 if you don't want any gaps.
+Gap specifies what text you want to use between bytes in the output as
+  controlled by GapFrequency.
+MaxPerLine specified the maximum number of bytes output per line of data
+  before moveing onto a new line."""
+
+    if Format == 4:
+        Format = Settings["ADDRESSOUTPUT"]
+    elif Format == 5:
+        Format = Settings["NUMBEROUTPUT"]
+    elif Format == 6:
+        Format = Settings["COMMANDOUTPUT"]
+    dataformat = FormatIdentifyer if isinstance(FormatIdentifyer, str) else \
+        (("#", "", "o", "b")[Format] if FormatIdentifyer else "")
+    dataformat += ("{:02X}", "{}", "{:03o}", "{:08b}")[Format]
+
+    soutput = ""
+
+    # look until have passed end point
+    while Vars[0x0A] <= Vars[0x0E]:
+        # output line details
+        soutput += PredefinedStartLine(Settings, Vars,
+                                       "SB" if Signed else "DB")
+
+        # loop until run out of data area or hit max line length
+        Vars[0x0C] = 0
+        while Vars[0x0A] + Vars[0x0C] <= Vars[0x0E] and \
+              Vars[0x0C] < MaxPerLine:
+            if Settings["XMLOutput"] == 1:
+                soutput += "<data>"
+            elif (GapFrequency > 0 and Vars[0x0C] > 0 and
+                 Vars[0x0C] % GapFrequency == 0):
+                soutput += Gap
+
+            # get value to output
+            n = data[Vars[0x0A] + Vars[0x0C] - Settings["ORIGIN"]]
+            # handle negative
+            if Signed and n > 127:
+                soutput += "-"
+                n = 256 - n
+            # output value
+            soutput += dataformat.format(n)
+            if Settings["XMLOutput"] == 1:
+                soutput += "</data>"
+            Vars[0x0C] += 1
+
+        # end of line
+        soutput += PredefinedEndLine(Settings, Vars)
+
+    Vars[0x0E] = Vars[0x0A] - 1
+    return soutput
+
+
+def _PredefinedDefineWord(data, Settings, Vars, Signed=False, Format=0,
+                          FormatIdentifyer=True, GapFrequency=1, Gap=',',
+                          MaxPerLine=1, LittleEndian=True):
+    """Outputs data as 2 byte words.
+
+data is the data to process.
+Settings is a dictionary containing needed setings such as the origin of
+  the code, if wanting XML output, formats for adress, numbers, and
+  commands. This is the same as for the disassembledatablock in a
+  DisassembleInstruction object.
+Vars is a list of variables as used internally to process the scripting
+  code used by the disassembler. Of note Vars[0x0A] is the address of
+  the current line, Vars[0x0E] is the last byte that's part of the data,
+  and Vars[0x0C] is the offset of the current byte being processed in
+  bytes from Vars[0x0A].
+Signed specifies if 255 (0xFF) is 255 or -1.
+Format specifies the number format: 0 for Hexadecimal, 1 for decimal,
+  2 for octal, 3 for binary, 4 to use the same format as is used for
+  addresses, 5 to use same format as for numbers, and 6 to use the
+  same format as the bytes of a command
+FormatIdentifyer specifies if you want a label to identify the data:
+  # for hexadecimal numbers, b for binary, o for octal, nothing for
+  decimal. Set this to text if you want to specify your own identifyer
+  to use infront of a number.
+GapFrequency is how many words between gaps in the data output.
+  Set this to 0 if you don't want any gaps.
+Gap specifies what text you want to use between words in the output as
+  controlled by GapFrequency.
+MaxPerLine specified the maximum number of words output per line of data
+  before moveing onto a new line."""
+
+    if Format == 4:
+        Format = Settings["ADDRESSOUTPUT"]
+    elif Format == 5:
+        Format = Settings["NUMBEROUTPUT"]
+    elif Format == 6:
+        Format = Settings["COMMANDOUTPUT"]
+    dataformat = FormatIdentifyer if isinstance(FormatIdentifyer, str) else \
+        (("#", "", "o", "b")[Format] if FormatIdentifyer else "")
+    dataformat += ("{:04X}", "{}", "{:06o}", "{:016b}")[Format]
+    datatitle = "{}{}".format("SW" if Signed else "DW",
+                                "" if LittleEndian else "BE")
+
+    soutput = ""
+
+    # look until have passed end point
+    while Vars[0x0A] <= Vars[0x0E]:
+        # output line details
+        soutput += PredefinedStartLine(Settings, Vars, datatitle)
+
+        # loop until run out of data area or hit max line length
+        Vars[0x0C] = 0
+        while Vars[0x0A] + Vars[0x0C] <= Vars[0x0E] and \
+              Vars[0x0C] < (MaxPerLine * 2):
+            if Settings["XMLOutput"] == 1:
+                soutput += "<data>"
+            elif (GapFrequency > 0 and Vars[0x0C] > 0 and
+                 Vars[0x0C] % (GapFrequency * 2) == 0):
+                soutput += Gap
+
+            # get value to output
+            n = Vars[0x0A] + Vars[0x0C] - Settings["ORIGIN"]
+            n = (data[n] + 256 * data[n + 1]) if LittleEndian else \
+                (data[n + 1] + 256 * data[n])
+            # handle negative
+            if Signed and n > 0x7FFF:
+                soutput += "-"
+                n = 65536 - n
+            # output value
+            soutput += dataformat.format(n)
+            if Settings["XMLOutput"] == 1:
+                soutput += "</data>"
+            Vars[0x0C] += 2
+
+        # end of line
+        soutput += PredefinedEndLine(Settings, Vars)
+
+    Vars[0x0E] = Vars[0x0A] - 1
+
+    return soutput
+
+
+def _PredefinedDefineMessage(data, Settings, Vars, DataType="DM",
+                             Noncharoutofquotes=False):
+    """Outputs data as text.
+
+data is the data to process.
+Settings is a dictionary containing needed setings such as the origin of
+  the code, if wanting XML output, formats for adress, numbers, and
+  commands. This is the same as for the disassembledatablock in a
+  DisassembleInstruction object.
+Vars is a list of variables as used internally to process the scripting
+  code used by the disassembler. Of note Vars[0x0A] is the address of
+  the current line, Vars[0x0E] is the last byte that's part of the data,
+  and Vars[0x0C] is the offset of the current byte being processed in
+  bytes from Vars[0x0A].
+DataType specifies the length encoding of the message. "DM" to be length
+  of the data block, "DM0" to be terminated by a zero byte (ignoring a
+  zero after a control code), "DM7" to be terminated by bit 7 being set
+  on the last character, "DMLB" where the string length is encoded as a
+  byte at the start of the string, "DMLW" where the length is encoded as
+  a Little endian string before the start of a string, and "DMLWBE"
+  where he length is encoded as a big-endian word before the string.
+Noncharoutofquotes defines if you want non characters (ie control codes,
+  or commands if the "Hex instead of non-ASCII On" control is being
+  used) displayed as hex numbers outside of strings instead of 2 digit
+  hexacecimal numbers preceded by '^' (which is never used on the
+  spectrum) inside a string."""
+    endings = {"DM": "DM",
+               "DM0": "DM0", "0": "DM0",
+               "DM7": "DM7", "7": "DM7",
+               "DMLB": "DMLB", "LB": "DMLB",
+               "DMLW": "DMLW", "LW": "DMLW",
+               "DMLWBE": "DMLWBE", "LWBE": "DMLWBE", "BE": "DMLWBE"}
+    if DataType not in endings:
+        raise SpectrumTranslateError("{} not a recognised Word format".format(
+            DataType))
+    datatitle = endings[DataType]
+
+    soutput = ""
+    maxaddress = len(data) + Settings["ORIGIN"] - 1
+
+    # look until have passed end point
+    while Vars[0x0A] <= Vars[0x0E]:
+        # output line details
+        soutput += PredefinedStartLine(Settings, Vars, datatitle)
+        Vars[0x0C] = 0
+        # get last char of string
+        if datatitle == "DM":
+            end = Vars[0x0E]
+        elif datatitle == "DM0":
+            bytesaftercontrol = -1
+            end = Vars[0x0A]
+            while end < maxaddress and (data[end - Settings["ORIGIN"]] != 0 or
+                  bytesaftercontrol > 0):
+                bytesaftercontrol -= 1
+                d = data[end - Settings["ORIGIN"]]
+                end += 1
+                if d >= 16 and d <= 21:
+                    bytesaftercontrol = 1
+                elif d == 22:
+                    bytesaftercontrol = 2
+        elif datatitle == "DM7":
+            bytesaftercontrol = -1
+            end = Vars[0x0A]
+            while end < maxaddress and (data[end - Settings["ORIGIN"]] < 128 or
+                  bytesaftercontrol > 0):
+                bytesaftercontrol -= 1
+                d = data[end - Settings["ORIGIN"]]
+                end += 1
+                if d >= 16 and d <= 21:
+                    bytesaftercontrol = 1
+                elif d == 22:
+                    bytesaftercontrol = 2
+        elif datatitle == "DMLB":
+            length = data[Vars[0x0A] - Settings["ORIGIN"]]
+            end = min(maxaddress, Vars[0x0A] + length)
+            Vars[0x0C] = 1
+        elif datatitle == "DMLW":
+            length = data[Vars[0x0A] - Settings["ORIGIN"]] + \
+                     256 * data[Vars[0x0A] - Settings["ORIGIN"] + 1]
+            end = min(maxaddress, Vars[0x0A] + length + 1)
+            Vars[0x0C] = 2
+        else:
+            length = data[Vars[0x0A] - Settings["ORIGIN"] + 1] + \
+                     256 * data[Vars[0x0A] - Settings["ORIGIN"]]
+            end = min(maxaddress, Vars[0x0A] + length + 1)
+            Vars[0x0C] = 2
+
+        if Settings["XMLOutput"] == 1:
+            soutput += "<data>"
+        # loop until run out of data area or hit max line length
+        bytesaftercontrol = 0
+        inquotes = False
+        startoffset = Vars[0x0C]
+        while Vars[0x0A] + Vars[0x0C] <= end:
+            n = data[Vars[0x0A] + Vars[0x0C] - Settings["ORIGIN"]]
+            c = getspectrumchar(n, Settings["HexForNonASCII"])
+            # force bytes after control character to be number not char
+            # also bytes>127 in bit 7 mode
+            if bytesaftercontrol > 0 or (datatitle == "DM7" and n > 127):
+                c = "^{:02X}".format(n)
+            bytesaftercontrol -= 1
+            # handle numbers outside quotes
+            if c[0] == '^' and Noncharoutofquotes:
+                if inquotes:
+                    soutput += '"'
+                    inquotes = False
+                soutput += "{}0x{:02X}".format(
+                    "" if Vars[0x0C] == startoffset else ",", n)
+            else:
+                # print enter quotes if needed
+                if not inquotes:
+                    if Vars[0x0C] > startoffset:
+                        soutput += ','
+                    soutput += '"'
+                    inquotes = True
+                soutput += c
+
+            # if is control code, work out how many bytes follow
+            if n >= 16 and n <= 21:
+                bytesaftercontrol = 1
+            elif n == 22:
+                bytesaftercontrol = 2
+
+            # move to next char
+            Vars[0x0C] += 1
+
+        # close quotes if needed
+        if inquotes:
+            soutput += '"'
+
+        if Settings["XMLOutput"] == 1:
+            soutput += "</data>"
+        # end of line
+        soutput += PredefinedEndLine(Settings, Vars)
+
+    Vars[0x0E] = end
+
+    return soutput
+
+
+def _PredefinedFindPattern(data, Settings, Vars, *args):
+    """Returns a list of matching addresses to the supplied list of
+bytes. After the basic data, just supp;y the vlues to search for in
+order."""
+    arglen = len(args)
+    if arglen == 0:
+        raise SpectrumTranslateError("No bytes to match")
+
+    matches = []
+    pos = Vars[0x0A]
+    origin = Settings["ORIGIN"]
+    l = len(data)
+    # convert args to a bytearray so can be matched
+    args = bytearray(args)
+    while pos <= Vars[0x0E] and pos - origin < l:
+        n = pos - origin
+        if data[n:n + arglen] == args:
+            matches += [pos]
+        pos += 1
+
+    return matches
+
+
+def _PredefinedStartandEndByOffset(data, Settings, Vars, addresses,
+                                   startoffset=0, endoffset=0):
+    """Returns a list of lists for start and end addresses, given the
+offsets and origional addresses."""
+
+    return [[x + startoffset, x + endoffset] for x in addresses]
+
+
+class DisassembleInstruction:
+    DISASSEMBLE_CODES = {
+        "Address Output Format Hex": 0x0100,
+        "Address Output Format Decimal": 0x0101,
+        "Address Output Format Octal": 0x0102,
+        "Address Output Format Binary": 0x0103,
+        "Number Output Format Hex": 0x0200,
+        "Number Output Format Decimal": 0x0201,
+        "Number Output Format Octal": 0x0202,
+        "Number Output Format Binary": 0x0203,
+        "Command Output Format Hex": 0x0300,
+        "Command Output Format Decimal": 0x0301,
+        "Command Output Format Octal": 0x0302,
+        "Command Output Format Binary": 0x0303,
+        "Output T States Format None": 0x0400,
+        "Output T States Format Total": 0x0401,
+        "Output T States Format List States": 0x0402,
+        "Output T States Format List All": 0x0403,
+        "Line After Jump None": 0x0500,
+        "Line After Jump After Absolute": 0x0501,
+        "Line After Jump After All": 0x0502,
+        "Default Format Hex": 0x0600,
+        "Default Format Decimal": 0x0601,
+        "Default Format Octal": 0x0602,
+        "Default Format Binary": 0x0603,
+        "Custom Format": 0x0700,
+        "Line Numbers All": 0x0800,
+        "Line Numbers None": 0x0801,
+        "Line Numbers Referenced": 0x0802,
+        "Line Number Every X": 0x0900,
+        "Empty Line After Data On": 0x0A00,
+        "Empty Line After Data Off": 0x0A01,
+        "Reference Data Numbers On": 0x0B00,
+        "Reference Data Numbers Off": 0x0B01,
+        "List Command Bytes On": 0x0C00,
+        "List Command Bytes Off": 0x0C01,
+        "Comments On": 0x0D00,
+        "Comments Off": 0x0D01,
+        "Seperators Space": 0x0E00,
+        "Seperators Tab": 0x0E01,
+        "Seperators Custom": 0x0E02,
+        "Display Flags Off": 0x0F00,
+        "Display Flags On": 0x0F01,
+        "Mark Undocumented Command Off": 0x1000,
+        "Mark Undocumented Command On": 0x1001,
+        "Reference Line": 0x1100,
+        "XML Output Off": 0x1200,
+        "XML Output On": 0x1201,
+        "Hex instead of non-ASCII Off": 0x1300,
+        "Hex instead of non-ASCII On": 0x1301,
+        "Data Block": 0x010000,
+        "Pattern Data Block": 0x020000,
+        "Comment": 0x030000,
+        "Comment Before": 0x030001,
+        "Comment After": 0x030002,
+        "Comment Reference": 0x030100,
+        "Comment Reference Before": 0x030101,
+        "Comment Reference After": 0x030102,
+        "Comment Displacement": 0x030200,
+        "Comment Displacement Before": 0x030201,
+        "Comment Displacement After": 0x030202,
+        "Comment Pattern": 0x040001}
+
+    DISASSEMBLE_DATABLOCK_CODES = {
+        "Define Byte Hex": """\
+%$A       %#start address xml tag
+%F0004    %#set output format to general output format
+%ACA      %#output line address as address
+%$-A      %#close address xml tag
+%S%S      %#seperator
+%$I       %#start instruction xml tag
+DB        %#output instruction (DB or define byte in this case)
+%$-I      %#close instruction tag
+%S        %#seperator
+%$D       %#start data tag
+%F0000    %#set format to hexadecimal
+%F0100    %#set format to unsigned
+#         %#output '#' to indicate hex number following
+%B0F      %#output contents at current position as byte,
+          %#and increment current position
+%$-D      %#close data xml tag""",
+        "Define Byte Decimal": """\
+%$A       %#start address xml tag
+%F0004    %#set output format to general output format
+%ACA      %#output line address as address
+%$-A      %#close address xml tag
+%S%S      %#seperator
+%$I       %#start instruction xml tag
+DB        %#output instruction (DB or define byte in this case)
+%$-I      %#close instruction tag
+%S        %#seperator
+%$D       %#start data tag
+%F0001    %#set format to decimal
+%F0100    %#set format to unsigned
+%B0F      %#output contents at current position as byte,
+          %#and increment current position
+%$-D      %#close data xml tag""",
+        "Define Byte Octal": """\
+%$A       %#start address xml tag
+%F0004    %#set output format to general output format
+%ACA      %#output line address as address
+%$-A      %#close address xml tag
+%S%S      %#seperator
+%$I       %#start instruction xml tag
+DB        %#output instruction (DB or define byte in this case)
+%$-I      %#close instruction tag
+%S        %#seperator
+%$D       %#start data tag
+%F0002    %#set format to octal
+%F0100    %#set format to unsigned
+o         %#output 'o' to indicate octal number following
+%B0F      %#output contents at current position as byte,
+          %#and increment current position
+%$-D      %#close data xml tag""",
+        "Define Byte Binary": """\
+%$A       %#start address xml tag
+%F0004    %#set output format to general output format
+%ACA      %#output line address as address
+%$-A      %#close address xml tag
+%S%S      %#seperator
+%$I       %#start instruction xml tag
+DB        %#output instruction (DB or define byte in this case)
+%$-I      %#close instruction tag
+%S        %#seperator
+%$D       %#start data tag
+%F0003    %#set format to binary
+%F0100    %#set format to unsigned
+b         %#output 'b' to indicate binary number following
+%B0F      %#output contents at current position as byte,
+          %#and increment current position
+%$-D      %#close data xml tag""",
+        "Define Byte": """\
+%$A       %#start address xml tag
+%F0004    %#set output format to general output format
+%ACA      %#output line address as address
+%$-A      %#close address xml tag
+%S%S      %#seperator
+%$I       %#start instruction xml tag
+DB        %#output instruction (DB or define byte in this case)
+%$-I      %#close instruction tag
+%S        %#seperator
+%$D       %#start data tag
+%F0000    %#set format to hexadecimal (default for generic define byte)
+%F0100    %#set format to unsigned
+#         %#output '#' to indicate hex number following
+%B0F      %#output contents at current position as byte,
+          %#and increment current position
+%$-D      %#close data xml tag""",
+        "Signed Byte Hex": """\
+%$A       %#start address xml tag
+%F0004    %#set output format to general output format
+%ACA      %#output line address as address
+%$-A      %#close address xml tag
 %S%S      %#seperator
 %$I       %#start instruction xml tag
 SB        %#output instruction (SB or signed byte in this case)
@@ -5345,1619 +6652,2368 @@ DM0             %#output instuction (DM0 or Define Message 0 ternminated)
   %?EQ%V000001      %#is var0 equal to 1
 %)
 %(
-  "                 %#print closeing quote if we are
+  "                 %#print closeing quote if we are
+%)
+,                   %#print comma
+%X020C%V0C0001      %#add offset from linestart and 1 and save as offset from
+                    %#line start.  moves past 0 terminating byte
+#00                 %#print #00 as for terminating 0x00
+%$-D                %#close data xml tag""",
+        "Define Message bit 7 terminated": """\
+%$A             %#start address xml tag
+%F0004          %#number format to same as general address format
+%ACA            %#output line address (variable 0x0A) as an address,
+                %#don't increment line address(set bit 6),
+                %#is variable and not what points to we want (bit 7)
+%$-A            %#close address xml tag
+%S%S            %#seperator
+%$I             %#start instruction xml tag
+DM7             %#output instuction (DM7 or Define Message bit7 ternminated)
+%$-I            %#close instruction xml tag
+%S
+%$D             %#start data tag
+%X01000000         %#set var0 to 0 (used as flag: 0=out of quotes, 1=in quotes)
+%L%(               %#enter while() do{} loop
+  %?EQ00000000     %# 0==0: ie true.  this will loop until loop broken out of
+%)                 %#end of while test
+%(                 %#enter do part of loop
+  %X0701%MV0F007F  %#set var1 to contents of current position & 0x7F
+  %X0702%MV0F0080  %#set var2 to contents of current position & 0x80
+  %X020C%V0C0001   %#increment current position
+  %I%(             %#check if entering or leaving printable character
+    %( %?EQ%V000001 %?BA %?LT%V010020 %)   %#if in quotes & var1<0x20
+    %?BO           %#or
+    %( %?EQ%V000000 %?BA %?MT%V01001F %)   %#if not in quotes & var1>0x1F
+  %)               %#end of if test
+  %(               %#start of what to do if test true
+    "              %#output quotes
+    %X03000001%V00 %#set var0 to 1-var0 (so will set to 1 if was 0 and 0 if
+                   %#was 1: toggles if in quotes)
+  %)               %#end if action
+  %CC1             %#output character: var1 (what's at current position&0x7F)
+                   %#(bit 6=don't increment, bit7=contents of address pointer
+                   %#to by current address register)
+  %I%(             %#start if
+    %?EQ%V020080   %#is var2==0x80 (ie was bit 7 set in currentcharacter before
+                   %#incrementing?
+  %)               %#end of if test
+  %(               %#start of what to do if test true
+    %Y             %#break out of loop: have reached character with bit 7 set
+  %)               %#end if action
+%)                 %#end of loop
+
+%I%(               %#start of if
+  %?EQ%V000001     %#if var0==1 (is inside a quote)
+%)                 %#end of if test
+%(                 %#start of what to do if test true
+  "                %#print closing quote
+%)                 %#end of what to do if test true
+%$-D                %#close data xml tag""",
+        "Define Message Length Byte": """\
+%$A            %#start address xml tag
+%F0004         %#number format to same as general address format
+%ACA           %#output line address (variable 0x0A) as an address,
+               %#don't increment line address(set bit 6),
+               %#is variable and not what points to we want (bit 7)
+%$-A           %#close address xml tag
+%S%S           %#seperator
+%$I            %#start instruction xml tag
+DMLB           %#output instuction (DMLB or Define Message Length Byte)
+%$-I           %#close instruction xml tag
+%S
+%$D            %#start data tag
+%X01000000     %#set var0 to 0 (used as flag: 0=out of quotes, 1=inside quotes)
+%X0101%MV0F    %#var1 to contents of current address: number of bytes in string
+%X020C%V0C0001 %#increment current position to point to 1st byte of string
+
+%L%(           %#enter while() do{} loop
+  %?MT%V010000 %# Var1>0: ie true while still have characters to print
+%)             %#end of while test
+%(             %#enter do part of loop
+  %I%(         %#enter if check
+    %(%?EQ%V000001 %?BA
+      %(%?LT%MV0F0020 %?BO
+        %(%?MT%MV0F007F %?BA %?LT%MV0F00A3%)
+      %)
+    %)         %#if in quotes & not prinatable character
+    %?BO       %#or
+    %(%?EQ%V000000 %?BA
+      %(%?MT%MV0F00A2 %?BO
+        %(%?MT%MV0F001F %?BA %?LT%MV0F0080%)
+      %)
+    %)             %#not in quotes & printable character
+  %)               %#end condition block
+  %(               %#start block if true
+    "              %#print quote
+    %X03000001%V00 %#toggle var1 stateing in quotes
+  %)
+  %C0F             %#print char at current position, increase current position
+  %X0301%V010001   %#decrement var1 by 1
+%)                 %#end loop
+%I%(               %#start if block
+  %?EQ%V000001     %#are we in quotes
+%)
+%(
+  "                %#if so print close quotes
+%)
+%$-D                %#close data xml tag""",
+        "Define Message Length Word": """\
+%$A            %#start address xml tag
+%F0004         %#number format to same as general address format
+%ACA           %#output line address (variable 0x0A) as an address,
+               %#don't increment line address(set bit 6),
+               %#is variable and not what points to we want (bit 7)
+%$-A           %#close address xml tag
+%S%S           %#seperator
+%$I            %#start instruction xml tag
+DMLW           %#output instuction (DMLW or Define Message Length Word)
+%$-I           %#close instruction xml tag
+%S
+%$D            %#start data tag
+%X01000000     %#set var0 to 0 (used as flag: 0=out of quotes, 1=in quotes)
+%F0200         %#set little endian
+%X0101%MWV0F   %#set var1 to contents of current address: string len in bytes
+%X020F%V0F0002 %#increment current position to point to 1st byte of string
+
+%L%(           %#enter while() do{} loop
+  %?NE%V010000 %# Var1!=0: ie true while still have characters to print
+%)             %#end of while test
+%(             %#enter do part of loop
+  %I%(         %#enter if check
+    %(%?EQ%V000001 %?BA
+      %(%?LT%MV0F0020 %?BO
+        %(%?MT%MV0F007F %?BA %?LT%MV0F00A3%)
+      %)
+    %)         %#if in quotes & not prinatable character
+    %?BO       %#or
+    %(%?EQ%V000000 %?BA
+      %(%?MT%MV0F00A2 %?BO
+        %(%?MT%MV0F001F %?BA %?LT%MV0F0080%)
+      %)
+    %)             %#not in quotes & printable character
+  %)               %#end condition block
+  %(               %#start block if true
+    "              %#print quote
+    %X03000001%V00 %#toggle var1 stateing in quotes
+  %)
+  %C0F             %#print char at current position, increase current position
+  %X0301%V010001   %#decrement var1 by 1
+%)                 %#end loop
+%I%(               %#start if block
+  %?EQ%V000001     %#are we in quotes
+%)
+%(
+  "                %#if so print close quotes
+%)
+%$-D                %#close data xml tag""",
+        "Define Message Length Word Bigendian": """\
+%$A            %#start address xml tag
+%F0004         %#number format to same as general address format
+%ACA           %#output line address (variable 0x0A) as an address,
+               %#don't increment line address(set bit 6),
+               %#is variable and not what points to we want (bit 7)
+%$-A           %#close address xml tag
+%S%S           %#seperator
+%$I            %#start instruction xml tag
+DMLWBE         %#output instuction (DMLWBE or Define Message Length Word Big
+               %#Endian)
+%$-I           %#close instruction xml tag
+%S
+%$D            %#start data tag
+%X01000000     %#set var0 to 0 (used as flag: 0=out of quotes, 1=inside quotes)
+%F0201         %#set big endian
+%X0101%MWV0F   %#set var1 to contents of current address: string len in bytes
+%X020F%V0F0002 %#increment current position to point to 1st byte of string
+
+%L%(           %#enter while() do{} loop
+  %?NE%V010000 %# Var1!=0: ie true while still have characters to print
+%)             %#end of while test
+%(             %#enter do part of loop
+  %I%(         %#enter if check
+    %(%?EQ%V000001 %?BA
+      %(%?LT%MV0F0020 %?BO
+        %(%?MT%MV0F007F %?BA %?LT%MV0F00A3%)
+      %)
+    %)         %#if in quotes & not prinatable character
+    %?BO       %#or
+    %(%?EQ%V000000 %?BA
+      %(%?MT%MV0F00A2 %?BO
+        %(%?MT%MV0F001F %?BA %?LT%MV0F0080%)
+      %)
+    %)             %#not in quotes & printable character
+  %)               %#end condition block
+  %(               %#start block if true
+    "              %#print quote
+    %X03000001%V00 %#toggle var1 stateing in quotes
+  %)
+  %C0F             %#print char at current position,
+                   %#and increase current position
+  %X0301%V010001   %#decrement var1 by 1
+%)                 %#end loop
+%I%(               %#start if block
+  %?EQ%V000001     %#are we in quotes
+%)
+%(
+  "                %#if so print close quotes
 %)
-,                   %#print comma
-%X020C%V0C0001      %#add offset from linestart and 1 and save as offset from
-                    %#line start.  moves past 0 terminating byte
-#00                 %#print #00 as for terminating 0x00
 %$-D                %#close data xml tag""",
-        "Define Message bit 7 terminated": """\
-%$A             %#start address xml tag
-%F0004          %#number format to same as general address format
-%ACA            %#output line address (variable 0x0A) as an address,
-                %#don't increment line address(set bit 6),
-                %#is variable and not what points to we want (bit 7)
-%$-A            %#close address xml tag
-%S%S            %#seperator
-%$I             %#start instruction xml tag
-DM7             %#output instuction (DM7 or Define Message bit7 ternminated)
-%$-I            %#close instruction xml tag
+        "Custom": ""
+        }
+
+    # so can tell order
+    DISASSEMBLE_DATABLOCK_CODES_ORDERED = (
+        "Define Byte Hex",
+        "Define Byte Decimal",
+        "Define Byte Octal",
+        "Define Byte Binary",
+        "Define Byte",
+        "Signed Byte Hex",
+        "Signed Byte Decimal",
+        "Signed Byte Octal",
+        "Signed Byte Binary",
+        "Signed Byte",
+        "Define Word Hex",
+        "Define Word Decimal",
+        "Define Word Octal",
+        "Define Word Binary",
+        "Define Word",
+        "Signed Word Hex",
+        "Signed Word Decimal",
+        "Signed Word Octal",
+        "Signed Word Binary",
+        "Signed Word",
+        "Define Word BigEndian Hex",
+        "Define Word BigEndian Decimal",
+        "Define Word BigEndian Octal",
+        "Define Word BigEndian Binary",
+        "Define Word BigEndian",
+        "Signed Word BigEndian Hex",
+        "Signed Word BigEndian Decimal",
+        "Signed Word BigEndian Octal",
+        "Signed Word BigEndian Binary",
+        "Signed Word BigEndian",
+        "Define Message",
+        "Define Message zero terminated",
+        "Define Message bit 7 terminated",
+        "Define Message Length Byte",
+        "Define Message Length Word",
+        "Define Message Length Word Bigendian",
+        "Custom")
+
+    DISASSEMBLE_PATTERNBLOCK_CODES = {
+        "RST#08 (Error)": """\
+%(               %#start test block
+  %?EQ%MV0F00CF  %#does the first byte equal 0xCF (code for RST #08)
+%)               %#end test block
+
+%(               %#block to define first & last address of data block
+  %X0200%V0F0001 %#start position (var0) is position of RST #08 command +1
+  %X0101%V00     %#end position (var1) is start position (only 1 byte affter
+                 %#                                       error restart)
+%)               %#end variable setup block
+                 %#start of data handling block
+%S%S
+%$I              %#start instruction xml tag
+DEFB             %#output instuction (DEFB or Define Byte)
+%$-I             %#close instruction xml tag
 %S
-%$D             %#start data tag
-%X01000000         %#set var0 to 0 (used as flag: 0=out of quotes, 1=in quotes)
-%L%(               %#enter while() do{} loop
-  %?EQ00000000     %# 0==0: ie true.  this will loop until loop broken out of
-%)                 %#end of while test
-%(                 %#enter do part of loop
-  %X0701%MV0F007F  %#set var1 to contents of current position & 0x7F
-  %X0702%MV0F0080  %#set var2 to contents of current position & 0x80
-  %X020C%V0C0001   %#increment current position
-  %I%(             %#check if entering or leaving printable character
-    %( %?EQ%V000001 %?BA %?LT%V010020 %)   %#if in quotes & var1<0x20
-    %?BO           %#or
-    %( %?EQ%V000000 %?BA %?MT%V01001F %)   %#if not in quotes & var1>0x1F
-  %)               %#end of if test
-  %(               %#start of what to do if test true
-    "              %#output quotes
-    %X03000001%V00 %#set var0 to 1-var0 (so will set to 1 if was 0 and 0 if
-                   %#was 1: toggles if in quotes)
-  %)               %#end if action
-  %CC1             %#output character: var1 (what's at current position&0x7F)
-                   %#(bit 6=don't increment, bit7=contents of address pointer
-                   %#to by current address register)
-  %I%(             %#start if
-    %?EQ%V020080   %#is var2==0x80 (ie was bit 7 set in currentcharacter before
-                   %#incrementing?
-  %)               %#end of if test
-  %(               %#start of what to do if test true
-    %Y             %#break out of loop: have reached character with bit 7 set
-  %)               %#end if action
-%)                 %#end of loop
+%$D              %#start data tag
+%F0000           %#set hex mode
+%F0100           %#set unsigned
+#%B0F            %#output contents of current address as byte and increment
+                 %#current address
+%$-D             %#close data tag""",
+        "RST#28 (Calculator)": """\
+%(                 %#start test block
+  %?EQ%MV0F00EF    %#does the first byte equal 0xEF (code for RST #28)
+%)                 %#end test block
+
+%(                 %#block to define first & last address of data block
+  %X0200%V0F0001   %#start position (var0) is position of RST #28 command +1
+  %X0101%V00       %#set end pos (var1) is start position
+  %L%(
+    %?NE%MV010038  %#loop until reach a byte #38 used to mark end of calculate
+  %)
+  %(
+    %X0201%V010001 %#add 1 to end pos (var1) each time byte is not #38
+  %)
+%)                 %#end variable setup block
+
+                   %#start of data handling block
+%S%S
+%$I                %#start instruction xml tag
+DEFB               %#output instuction (DEFB or Define Byte)
+%$-I               %#close instruction xml tag
+%S
+%$D                %#start data tag
+%F0000             %#set hex mode
+%F0100             %#set unsigned
+#%B0F              %#output contents of current address as byte and increment
+                   %#current address
+%$-D               %#close data tag""",
+        "Custom": ""
+    }
+
+    DISASSEMBLE_PATTERNBLOCK_CODES_ORDERED = (
+        "RST#08 (Error)",
+        "RST#28 (Calculator)",
+        "Custom")
+
+    # list of predefined functions and routines
+    PredefinedFunctions = {"DefineByte": _PredefinedDefineByte,
+                           "DefineWord": _PredefinedDefineWord,
+                           "DefineMessage": _PredefinedDefineMessage}
+    PredefinedRoutines = {"DefineByte": _PredefinedDefineByte,
+                          "DefineWord": _PredefinedDefineWord,
+                          "DefineMessage": _PredefinedDefineMessage,
+                          "FindPattern": _PredefinedFindPattern,
+                          "StartandEndbyOffset": _PredefinedStartandEndByOffset
+                          }
+
+    def __init__(self, arg, start=0, end=65536, data=None):
+        """Creates a new DisassembleInstruction which is used to control
+        disassembly of Z80 code.
+
+        The only required argument is either a DisassembleInstruction to
+        copy, an int of the instruction to carry out, or a string with a
+        packed DisassembleInstruction in it (see __str__() for packing
+        this string.
+
+        Optional arguments are ignored for everything other than an
+        initial int argument.  They are:
+        start is the address from where this instruction applies.
+        end is the address up to and including that this instruction
+        applies.
+        data is a string that is needed by the DisassembleInstruction to
+        carry out it's instructions.
+        """
+
+        # if constructor arg is another DisassembleInstruction then make
+        # a copy
+        if isinstance(arg, DisassembleInstruction):
+            data = None if arg.data is None else str(arg.data)
+            end = arg.end
+            start = arg.start
+            arg = arg.instruction
+
+        # if argument is string for instruction type then get code
+        if arg in DisassembleInstruction.DISASSEMBLE_CODES:
+            arg = DisassembleInstruction.DISASSEMBLE_CODES[arg]
+
+        # if constructor arg is a string then unpack the contained data
+        if isinstance(arg, str):
+            # break data into components
+            parts = arg.split("#", 4)
+            arg = int(parts[0], 16)
+            start = int(parts[1], 16)
+            end = int(parts[2], 16)
+            data = parts[4] if len(parts) == 5 else None
+            # handle multiline data
+            if len(parts[3]) > 0:
+                # re-insert newline characters
+                for pos in parts[3].split(','):
+                    pos = int(pos, 16)
+                    data = data[:pos] + "\n" + data[pos:]
+
+        self.instruction = arg
+        self.start = start
+        self.end = end
+        # make copy of string
+        self.data = None if data is None else str(data)
+
+    def isformatinstruction(self):
+        """Tests if the DisassembleInstruction is a format instruction.
+        """
+
+        return self.instruction != 0 and (self.instruction & 0xFF0000) == 0
+
+    def __str__(self):
+        """Returns a String representation of the
+        DisassembleInstruction.  This is the instruction code in
+        hexadecimal, followed by a '#' followed by the start address in
+        hexadecimal, followed by a '#', followed by the end address in
+        hexadecimal, followed by a '#'.  If the data property is not
+        None then a comma seperated list of positions for new line
+        characters in the data field follows, then another '#', and then
+        the data field with newline characters stripped out.
+
+        This can be used as an argument to the constructor to create a
+        new DisassembleInstruction
+        """
+
+        if self.data is None or self.data == '':
+            return "{0.instruction:X}#{0.start:X}#{0.end:X}#".format(self)
+
+        return "{0.instruction:X}#{0.start:X}#{0.end:X}#{1}#{2}".format(
+            self,
+            ','.join(["{:X}".format(i) for i, c in enumerate(self.data) if
+                      c == '\n']),
+            self.data.replace('\n', ''))
+
+    def _getcompiledpattern(self):
+        """Returns the test, preperation, and action blocks of a Pattern
+        Data Block or Comment Pattern instruction, followed by the
+        compiled test and preperation blocks (None if they have to be
+        run by _processcommandblock), and the byte that must be at the
+        start of a match (None if not known).  This is worked out once
+        and remembered until the data changes.
+        """
+
+        cached = getattr(self, "_compiledpattern", None)
+        if cached is not None and cached[0] == self.data:
+            return cached[1]
+
+        TestBlock, PrepBlock, ActionBlock = getpartsofpatterndatablock(
+            self.data)
+        CompiledTest = None if TestBlock is None else \
+            _compilecommandblock(TestBlock)
+        CompiledPrep = None if PrepBlock is None else \
+            _compilecommandblock(PrepBlock)
+        FirstByte = None if CompiledTest is None else \
+            _getpatternfirstbyte(CompiledTest)
+
+        pattern = (TestBlock, PrepBlock, ActionBlock, CompiledTest,
+                   CompiledPrep, FirstByte)
+        self._compiledpattern = (self.data, pattern)
+        return pattern
+
+    def __lt__(self, other):
+        # defined so can sort by starting address
+        if self.start == other.start:
+            return self.end.__lt__(other.end)
+        return self.start.__lt__(other.start)
+
+    def disassembledatablock(self, Settings, data):
+        """This method will disassemble the given data according to the
+        current DisassembleInstruction.
+        """
+
+        """
+        var[0-9]  %V00-%V09
+        line address (not changable)  %V0A
+        line number (not changable)   %V0B
+        offset from line start        %V0C
+        start pos (not changable)     %V0D
+        end pos                       %V0E
+        current pos (not changable)   %V0F
+        """
+        Vars = [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, self.start, 0, 0, self.start,
+                self.end]
+        soutput = ""
+
+        # loop through commandline block
+        while Vars[0x0A] <= Vars[0x0E]:
+            # check if any comments to be added to this data
+            if "COMMENTCONTROL" in Settings:
+                # move past any instructions that has been & gone
+                dis = Settings["COMMENTCONTROL"][0]
+                while dis and Vars[0x0A] > dis[0].end:
+                    dis.pop(0)
+                # if is comment instruction process it
+                if (dis and
+                   Vars[0x0A] >= dis[0].start and
+                   dis[0].instruction & 0xFFFF00 == 0x030000 and
+                   dis[0].data is not None and dis[0].data != ""):
+                    di = dis.pop(0)
+                    if di.instruction == self.DISASSEMBLE_CODES[
+                       "Comment Before"]:
+                        if Settings["COMMENTCONTROL"][1] == 0:
+                            soutput += Settings["COMMENTCONTROL"][4](
+                                di.data, Settings["XMLOutput"]) + "\n"
+
+                        continue
+                    # otherwise comnment end of this line or after
+                    if di.instruction == 0x030002:
+                        if Settings["COMMENTCONTROL"][3] != "":
+                            Settings["COMMENTCONTROL"][3] += "\n"
+                        Settings["COMMENTCONTROL"][3] += di.data
+                    else:
+                        if Settings["COMMENTCONTROL"][2] != "":
+                            Settings["COMMENTCONTROL"][2] += ". "
+                        Settings["COMMENTCONTROL"][2] += di.data
+
+                    continue
+
+            Vars[0x0C] = 0  # point to start of line
+
+            # for each line go through commandline instructions
+            # character by chracter
+            Settings["DATASTRINGPOS"] = 0
+
+            # output start line if needed
+            if Settings["XMLOutput"] == 1:
+                soutput += '  <line>'
+            Settings["HadLineStart"] = True
+            Settings["HadLineEnd"] = False
+
+            while Settings["DATASTRINGPOS"] < len(self.data):
+                # make note of where command starts in case we have
+                # error
+                commandstart = Settings["DATASTRINGPOS"]
+
+                # get next char
+                s = _getnextcharacters(self.data, Settings, 1)
+
+                if s == "":
+                    break
+
+                # deal with non-control characters first
+                if s[0] != '%':
+                    soutput += getspectrumchar(s[0],
+                                               Settings["HexForNonASCII"])
+                    continue
+
+                # reset position
+                Settings["DATASTRINGPOS"] = commandstart
+
+                # deal with any instructions
+                # can ignore result
+                try:
+                    res, txt = _processcommandblock(self.data, Vars, Settings,
+                                                    data, False, False)
+                except IndexError:
+                    raise _newSpectrumTranslateError(
+                        Vars[0x0A], 0, self.data,
+                        "attempt to access data outside of supplied code")
+
+                soutput += txt
+
+            # update line address
+            Vars[0x0A] += Vars[0x0C]
+            # update line number
+            Vars[0x0B] += 1
+
+            # do comment
+            if ("COMMENTCONTROL" in Settings and
+               Settings["COMMENTCONTROL"][1] == 0 and
+               Settings["COMMENTCONTROL"][2] != ""):
+                # XML comments
+                if Settings["XMLOutput"] == 1:
+                    soutput += "<comment>{}</comment>".format(
+                        Settings["COMMENTCONTROL"][2])
+                # plain text comments
+                else:
+                    # output pre comment text
+                    soutput += Settings["SEPERATOR"] + ';'
+
+                    if Settings["COMMENTCONTROL"][2].find("\n") == -1:
+                        soutput += Settings["COMMENTCONTROL"][2]
+
+                    else:
+                        comments = Settings["COMMENTCONTROL"][2].split("\n")
+                        soutput += comments[0]
+                        if Settings["COMMENTCONTROL"][3] != "":
+                            Settings["COMMENTCONTROL"][3] = "\n" +\
+                                Settings["COMMENTCONTROL"][3]
+                        Settings["COMMENTCONTROL"][3] = "\n".join(
+                            comments[1:]) + Settings["COMMENTCONTROL"][3]
+
+            if not Settings["HadLineEnd"]:
+                # output end start line if needed
+                if Settings["XMLOutput"] == 1:
+                    soutput += '</line>'
+
+                # new line
+                soutput += "\n"
+
+            # handle comments after line
+            if "COMMENTCONTROL" in Settings:
+                if (Settings["COMMENTCONTROL"][1] == 0 and
+                   Settings["COMMENTCONTROL"][3] != ""):
+                    soutput += Settings["COMMENTCONTROL"][4](
+                        Settings["COMMENTCONTROL"][3],
+                        Settings["XMLOutput"]) + "\n"
+
+                # clear comments
+                Settings["COMMENTCONTROL"][2] = ""
+                Settings["COMMENTCONTROL"][3] = ""
+
+        # return end of data block as might have changed
+        return Vars[0x0E], soutput
+
+
+def isfindandcomment(instructions):
+    """Tests if the supplied instructions is a valid find and comment
+    routine.
+
+    Note that this routine is not perfect, as to be so would be too
+    complex.  It simply ensures that the code can be broken into three
+    sections like a pattern data block, and that the first section
+    contains the %; command.
+    """
+
+    test, prep, action = getpartsofpatterndatablock(instructions)
+
+    # must have a test area and must contain %;
+    if not test or test.find("%;") == -1:
+        return False
+
+    return True
+
+
+# holds the format strings made by _getnumberformat
+_NUMBER_FORMATS = {}
+
+
+def _getnumberformat(bits, form, typeindicator=True):
+    """Returns the format string to format a number as _numbertostring
+    does.  The format strings are remembered once made.
+    """
+
+    key = (bits, form, typeindicator)
+    fmt = _NUMBER_FORMATS.get(key)
+    if fmt is not None:
+        return fmt
+
+    if form == 0:
+        # hex
+        fmt = ("#" if typeindicator else "") + "{:0" + str(bits >> 2) + "X}"
+
+    elif form == 1:
+        # decimal
+        fmt = "{}"
+
+    elif form == 2:
+        # octal
+        fmt = ("o" if typeindicator else "") + "{:0" + str((bits + 2)//3) + \
+            "o}"
+
+    elif form == 3:
+        # binary
+        fmt = ("b" if typeindicator else "") + "{:0" + str(bits) + "b}"
+
+    else:
+        fmt = ""
+
+    _NUMBER_FORMATS[key] = fmt
+    return fmt
+
+
+def _numbertostring(n, bits, form, typeindicator=True):
+    """format: 0=hex,1=decimal,2=octal,3=binary
+    typeindictor specifies display type specifer before number: "" for
+    decimal, "#" for hex, "b" for binary, "o" for octal.
+    """
+
+    return _getnumberformat(bits, form, typeindicator).format(n)
+
+
+def _getnextcharacters(instructions, Settings, numberToGet):
+    """Returns required number of characters skipping space, new line,
+    tabs, and comments.
+    """
+
+    s = ""
+
+    # loop until have requested number of non whitespace characters or
+    # hit end of commands
+    while len(s) < numberToGet and \
+          Settings["DATASTRINGPOS"] < len(instructions):
+        c = instructions[Settings["DATASTRINGPOS"]]
+
+        # if found comment, move to end of line
+        if (c == '%' and len(instructions) > Settings["DATASTRINGPOS"] + 1 and
+           instructions[Settings["DATASTRINGPOS"] + 1] == "#"):
+            # check just incase have %%# which is display %#
+            escapes = 1
+            # see how far back escapes go back
+            while escapes > Settings["DATASTRINGPOS"] and \
+                  instructions[Settings["DATASTRINGPOS"]-escapes] == "%":
+                escapes += 1
+
+            # should have an odd number of escapes if this a comment
+            if escapes & 1 == 1:
+                # move position to new line character
+                Settings["DATASTRINGPOS"] = instructions.find(
+                    "\n", Settings["DATASTRINGPOS"])
+                # if newline not found,
+                if Settings["DATASTRINGPOS"] == -1:
+                    # set to end of line
+                    Settings["DATASTRINGPOS"] = len(instructions)
+
+                # loop back to deal with next character
+                continue
+
+            # otherwise is a hash to display
+
+        if c != ' ' and c != '\t' and c != '\n':
+            s += c
+        Settings["DATASTRINGPOS"] += 1
+
+    return s
+
+
+def _movetoblockend(instructions, Vars, Settings, commandstart):
+    """move to end of specified command block"""
+
+    # for each line go through commands instructions character by
+    # chracter
+    while Settings["DATASTRINGPOS"] < len(instructions):
+        # get next char
+        s = _getnextcharacters(instructions, Settings, 1)
 
-%I%(               %#start of if
-  %?EQ%V000001     %#if var0==1 (is inside a quote)
-%)                 %#end of if test
-%(                 %#start of what to do if test true
-  "                %#print closing quote
-%)                 %#end of what to do if test true
-%$-D                %#close data xml tag""",
-        "Define Message Length Byte": """\
-%$A            %#start address xml tag
-%F0004         %#number format to same as general address format
-%ACA           %#output line address (variable 0x0A) as an address,
-               %#don't increment line address(set bit 6),
-               %#is variable and not what points to we want (bit 7)
-%$-A           %#close address xml tag
-%S%S           %#seperator
-%$I            %#start instruction xml tag
-DMLB           %#output instuction (DMLB or Define Message Length Byte)
-%$-I           %#close instruction xml tag
-%S
-%$D            %#start data tag
-%X01000000     %#set var0 to 0 (used as flag: 0=out of quotes, 1=inside quotes)
-%X0101%MV0F    %#var1 to contents of current address: number of bytes in string
-%X020C%V0C0001 %#increment current position to point to 1st byte of string
+        if s == "":
+            break
 
-%L%(           %#enter while() do{} loop
-  %?MT%V010000 %# Var1>0: ie true while still have characters to print
-%)             %#end of while test
-%(             %#enter do part of loop
-  %I%(         %#enter if check
-    %(%?EQ%V000001 %?BA
-      %(%?LT%MV0F0020 %?BO
-        %(%?MT%MV0F007F %?BA %?LT%MV0F00A3%)
-      %)
-    %)         %#if in quotes & not prinatable character
-    %?BO       %#or
-    %(%?EQ%V000000 %?BA
-      %(%?MT%MV0F00A2 %?BO
-        %(%?MT%MV0F001F %?BA %?LT%MV0F0080%)
-      %)
-    %)             %#not in quotes & printable character
-  %)               %#end condition block
-  %(               %#start block if true
-    "              %#print quote
-    %X03000001%V00 %#toggle var1 stateing in quotes
-  %)
-  %C0F             %#print char at current position, increase current position
-  %X0301%V010001   %#decrement var1 by 1
-%)                 %#end loop
-%I%(               %#start if block
-  %?EQ%V000001     %#are we in quotes
-%)
-%(
-  "                %#if so print close quotes
-%)
-%$-D                %#close data xml tag""",
-        "Define Message Length Word": """\
-%$A            %#start address xml tag
-%F0004         %#number format to same as general address format
-%ACA           %#output line address (variable 0x0A) as an address,
-               %#don't increment line address(set bit 6),
-               %#is variable and not what points to we want (bit 7)
-%$-A           %#close address xml tag
-%S%S           %#seperator
-%$I            %#start instruction xml tag
-DMLW           %#output instuction (DMLW or Define Message Length Word)
-%$-I           %#close instruction xml tag
-%S
-%$D            %#start data tag
-%X01000000     %#set var0 to 0 (used as flag: 0=out of quotes, 1=in quotes)
-%F0200         %#set little endian
-%X0101%MWV0F   %#set var1 to contents of current address: string len in bytes
-%X020F%V0F0002 %#increment current position to point to 1st byte of string
+        # skip non-control characters first
+        if s != "%":
+            continue
+
+        # get next char
+        s = _getnextcharacters(instructions, Settings, 1)
+
+        if s == "":
+            break
+
+        # what command is it?
+        if s[0] == "(":
+            # move to end of nested block
+            _movetoblockend(instructions, Vars, Settings, commandstart)
+
+        # return if found end of block
+        elif s[0] == ')':
+            return
+
+        # otherwise skip command
+
+    # should always find end of block with close brackets, error if
+    # block not closed
+    raise _newSpectrumTranslateError(Vars[0x0A], commandstart, instructions,
+                                     "no closing brackets to block")
+
+
+def _incvarifneeded(var_num, Vars, inc_amount):
+    """increment variable if apropriate"""
+    if ((var_num & 0x40) == 0 and ((var_num & 0x3F) < 0x0A or
+       (var_num & 0x3F) in [0x0C, 0x0F])):
+        Vars[0x0C if ((var_num & 0x3F) == 0x0F) else
+             var_num & 0x3F] += inc_amount
+
+
+def _processcommandblock(instructions, Vars, Settings, data, inBrackets,
+                         InTest):
+    """processes an instruction block.
+       return bit 0 1=true, 0=false
+       bit 1 2=break, 0=not break
+       bit 2 4=continue, 0=not continue
+       ,output text
+    """
+
+    # nested functions needed by _processcommandblock
+    def get_number_var_or_memory(instructions, Vars, Settings, data,
+                                 commandstart):
+        # how many bytes are we getting
+        getByte = True
+        # remember where we started
+        pos = Settings["DATASTRINGPOS"]
+
+        # get next char
+        s = _getnextcharacters(instructions, Settings, 1)
+
+        if s == "":
+            raise _newSpectrumTranslateError(
+                Vars[0x0A], commandstart, instructions,
+                "Invalid variable or number definition")
+
+        # first check if is a number
+        if s[0] != "%":
+            # restore pointer to where it was
+            Settings["DATASTRINGPOS"] = pos
+
+            # extract number
+            i = int(_getnextcharacters(instructions, Settings, 4), 16)
+            # deal with error
+            if i < 0:
+                raise _newSpectrumTranslateError(
+                    Vars[0x0A], commandstart, instructions,
+                    "number must be 4 digit hexadecimal number")
+
+            return i
+
+        # get next char
+        s = _getnextcharacters(instructions, Settings, 1)
+
+        if s[0] == "V":
+            # get variable number
+            i = int(_getnextcharacters(instructions, Settings, 2), 16)
+            # deal with invalid variable number
+            if i < 0 or i > 0x0F:
+                raise _newSpectrumTranslateError(
+                    Vars[0x0A], commandstart, instructions, "invalid variable")
+
+            # return variable's content
+            return Vars[0x0A] + Vars[0x0C] if (i == 0x0F) else Vars[i]
+
+        # should now be 'M', handle if not
+        if s[0] != "M":
+            raise _newSpectrumTranslateError(
+                Vars[0x0A], commandstart, instructions,
+                "argument must be number, variable, or memory content")
+
+        pos = Settings["DATASTRINGPOS"]
+
+        # get next char
+        s = _getnextcharacters(instructions, Settings, 1)
+
+        # if next char is 'W' then need to get 2 bytes
+        if s[0] == "W":
+            # make note we need word not byte
+            getByte = False
+
+            # get next char
+            s = _getnextcharacters(instructions, Settings, 1)
+
+            pos = Settings["DATASTRINGPOS"]
+
+        # now get into i address of where to extract data from
+
+        # if next char is 'V' then variable pointing to memory address
+        if s[0] == "V":
+            # get variable number
+            i = int(_getnextcharacters(instructions, Settings, 2), 16)
+            # deal with invalid variable number
+            if i < 0 or i > 0x0F:
+                raise _newSpectrumTranslateError(
+                    Vars[0x0A], commandstart, instructions,
+                    "invalid variable number for memory address")
+
+            # get number variable's content
+            i = Vars[0x0A] + Vars[0x0C] if (i == 0x0F) else Vars[i]
+
+        # otherwise should be 4 hex digit address
+        else:
+            # in checking to see if next char was V will move pointer,
+            # so reset to where it should be
+            Settings["DATASTRINGPOS"] = pos
+
+            # extract number
+            i = int(_getnextcharacters(instructions, Settings, 4), 16)
+            # deal with error
+            if i < 0:
+                raise _newSpectrumTranslateError(
+                    Vars[0x0A], commandstart, instructions,
+                    "should be 4 digit hexadecimal number for memory address")
+
+        # now have address we need to extract in i, and if we want byte
+        # or not in getByte
+        # deal with byte
+        if getByte:
+            return data[i-Settings["ORIGIN"]]
+
+        # deal with word taking into account endedness of number we want
+        return data[i-Settings["ORIGIN"] + Settings["NUMBERWORDORDER"]] + \
+            256*data[i-Settings["ORIGIN"] +
+                     1-Settings["NUMBERWORDORDER"]]
+
+    def combineresults(mode, a, b):
+        if mode == 0:
+            return a and b
+        if mode == 1:
+            return a or b
+        if mode == 2:
+            return a ^ b
+
+    # end of _processcommandblock's nested functions
+
+    boolState = False
+    boolMode = 1      # 0=and, 1=or, 2=xor
+    soutput = ""
+
+    # for each line go through commands instructions character by
+    # character
+    while Settings["DATASTRINGPOS"] < len(instructions):
+        # make note of where command starts in case we have error
+        commandstart = Settings["DATASTRINGPOS"]
+
+        # get next char
+        s = _getnextcharacters(instructions, Settings, 1)
+
+        if s == "":
+            break
+
+        # deal with non-control characters first
+        if s[0] != '%':
+            soutput += getspectrumchar(s[0], Settings["HexForNonASCII"])
+            continue
+
+        # space after % will get missed by _getnextcharacters so handle
+        if instructions[Settings["DATASTRINGPOS"]] == ' ':  # output space
+            soutput += ' '
+            continue
+
+        # get next char (command
+        s = _getnextcharacters(instructions, Settings, 1)
 
-%L%(           %#enter while() do{} loop
-  %?NE%V010000 %# Var1!=0: ie true while still have characters to print
-%)             %#end of while test
-%(             %#enter do part of loop
-  %I%(         %#enter if check
-    %(%?EQ%V000001 %?BA
-      %(%?LT%MV0F0020 %?BO
-        %(%?MT%MV0F007F %?BA %?LT%MV0F00A3%)
-      %)
-    %)         %#if in quotes & not prinatable character
-    %?BO       %#or
-    %(%?EQ%V000000 %?BA
-      %(%?MT%MV0F00A2 %?BO
-        %(%?MT%MV0F001F %?BA %?LT%MV0F0080%)
-      %)
-    %)             %#not in quotes & printable character
-  %)               %#end condition block
-  %(               %#start block if true
-    "              %#print quote
-    %X03000001%V00 %#toggle var1 stateing in quotes
-  %)
-  %C0F             %#print char at current position, increase current position
-  %X0301%V010001   %#decrement var1 by 1
-%)                 %#end loop
-%I%(               %#start if block
-  %?EQ%V000001     %#are we in quotes
-%)
-%(
-  "                %#if so print close quotes
-%)
-%$-D                %#close data xml tag""",
-        "Define Message Length Word Bigendian": """\
-%$A            %#start address xml tag
-%F0004         %#number format to same as general address format
-%ACA           %#output line address (variable 0x0A) as an address,
-               %#don't increment line address(set bit 6),
-               %#is variable and not what points to we want (bit 7)
-%$-A           %#close address xml tag
-%S%S           %#seperator
-%$I            %#start instruction xml tag
-DMLWBE         %#output instuction (DMLWBE or Define Message Length Word Big
-               %#Endian)
-%$-I           %#close instruction xml tag
-%S
-%$D            %#start data tag
-%X01000000     %#set var0 to 0 (used as flag: 0=out of quotes, 1=inside quotes)
-%F0201         %#set big endian
-%X0101%MWV0F   %#set var1 to contents of current address: string len in bytes
-%X020F%V0F0002 %#increment current position to point to 1st byte of string
+        # what command is it?
+        if s[0] == 'F':  # //format settings
+            # get sub command & which format
+            i = int(_getnextcharacters(instructions, Settings, 4), 16)
+            if (i >> 8) == 0:  # format hex/decimal/octal/binary
+                if (i & 0xFF) > 6:
+                    raise _newSpectrumTranslateError(
+                        Vars[0x0A], commandstart, instructions,
+                        "Number format argument must be 0 to 6")
 
-%L%(           %#enter while() do{} loop
-  %?NE%V010000 %# Var1!=0: ie true while still have characters to print
-%)             %#end of while test
-%(             %#enter do part of loop
-  %I%(         %#enter if check
-    %(%?EQ%V000001 %?BA
-      %(%?LT%MV0F0020 %?BO
-        %(%?MT%MV0F007F %?BA %?LT%MV0F00A3%)
-      %)
-    %)         %#if in quotes & not prinatable character
-    %?BO       %#or
-    %(%?EQ%V000000 %?BA
-      %(%?MT%MV0F00A2 %?BO
-        %(%?MT%MV0F001F %?BA %?LT%MV0F0080%)
-      %)
-    %)             %#not in quotes & printable character
-  %)               %#end condition block
-  %(               %#start block if true
-    "              %#print quote
-    %X03000001%V00 %#toggle var1 stateing in quotes
-  %)
-  %C0F             %#print char at current position,
-                   %#and increase current position
-  %X0301%V010001   %#decrement var1 by 1
-%)                 %#end loop
-%I%(               %#start if block
-  %?EQ%V000001     %#are we in quotes
-%)
-%(
-  "                %#if so print close quotes
-%)
-%$-D                %#close data xml tag""",
-        "Custom": ""
-        }
+                if (i & 0xFF) == 4:
+                    Settings["NUMBERFORMAT"] = Settings["ADDRESSOUTPUT"]
 
-    # so can tell order
-    DISASSEMBLE_DATABLOCK_CODES_ORDERED = (
-        "Define Byte Hex",
-        "Define Byte Decimal",
-        "Define Byte Octal",
-        "Define Byte Binary",
-        "Define Byte",
-        "Signed Byte Hex",
-        "Signed Byte Decimal",
-        "Signed Byte Octal",
-        "Signed Byte Binary",
-        "Signed Byte",
-        "Define Word Hex",
-        "Define Word Decimal",
-        "Define Word Octal",
-        "Define Word Binary",
-        "Define Word",
-        "Signed Word Hex",
-        "Signed Word Decimal",
-        "Signed Word Octal",
-        "Signed Word Binary",
-        "Signed Word",
-        "Define Word BigEndian Hex",
-        "Define Word BigEndian Decimal",
-        "Define Word BigEndian Octal",
-        "Define Word BigEndian Binary",
-        "Define Word BigEndian",
-        "Signed Word BigEndian Hex",
-        "Signed Word BigEndian Decimal",
-        "Signed Word BigEndian Octal",
-        "Signed Word BigEndian Binary",
-        "Signed Word BigEndian",
-        "Define Message",
-        "Define Message zero terminated",
-        "Define Message bit 7 terminated",
-        "Define Message Length Byte",
-        "Define Message Length Word",
-        "Define Message Length Word Bigendian",
-        "Custom")
+                elif (i & 0xFF) == 5:
+                    Settings["NUMBERFORMAT"] = Settings["NUMBEROUTPUT"]
 
-    DISASSEMBLE_PATTERNBLOCK_CODES = {
-        "RST#08 (Error)": """\
-%(               %#start test block
-  %?EQ%MV0F00CF  %#does the first byte equal 0xCF (code for RST #08)
-%)               %#end test block
+                elif (i & 0xFF) == 6:
+                    Settings["NUMBERFORMAT"] = Settings["COMMANDOUTPUT"]
 
-%(               %#block to define first & last address of data block
-  %X0200%V0F0001 %#start position (var0) is position of RST #08 command +1
-  %X0101%V00     %#end position (var1) is start position (only 1 byte affter
-                 %#                                       error restart)
-%)               %#end variable setup block
-                 %#start of data handling block
-%S%S
-%$I              %#start instruction xml tag
-DEFB             %#output instuction (DEFB or Define Byte)
-%$-I             %#close instruction xml tag
-%S
-%$D              %#start data tag
-%F0000           %#set hex mode
-%F0100           %#set unsigned
-#%B0F            %#output contents of current address as byte and increment
-                 %#current address
-%$-D             %#close data tag""",
-        "RST#28 (Calculator)": """\
-%(                 %#start test block
-  %?EQ%MV0F00EF    %#does the first byte equal 0xEF (code for RST #28)
-%)                 %#end test block
+                else:
+                    Settings["NUMBERFORMAT"] = i & 0xFF
 
-%(                 %#block to define first & last address of data block
-  %X0200%V0F0001   %#start position (var0) is position of RST #28 command +1
-  %X0101%V00       %#set end pos (var1) is start position
-  %L%(
-    %?NE%MV010038  %#loop until reach a byte #38 used to mark end of calculate
-  %)
-  %(
-    %X0201%V010001 %#add 1 to end pos (var1) each time byte is not #38
-  %)
-%)                 %#end variable setup block
+            elif (i >> 8) == 1:  # number unsigned/signed
+                if (i & 0xFF) > 1:
+                    raise _newSpectrumTranslateError(
+                        Vars[0x0A], commandstart, instructions,
+                        "Number sign argument must be 0 or 1")
 
-                   %#start of data handling block
-%S%S
-%$I                %#start instruction xml tag
-DEFB               %#output instuction (DEFB or Define Byte)
-%$-I               %#close instruction xml tag
-%S
-%$D                %#start data tag
-%F0000             %#set hex mode
-%F0100             %#set unsigned
-#%B0F              %#output contents of current address as byte and increment
-                   %#current address
-%$-D               %#close data tag""",
-        "Custom": ""
-    }
+                Settings["NUMBERSIGNED"] = i & 0xFF
 
-    DISASSEMBLE_PATTERNBLOCK_CODES_ORDERED = (
-        "RST#08 (Error)",
-        "RST#28 (Calculator)",
-        "Custom")
+            elif (i >> 8) == 2:  # word mode little/big endian
+                if (i & 0xFF) > 1:
+                    raise _newSpectrumTranslateError(
+                        Vars[0x0A], commandstart, instructions,
+                        "Word endedness argument must be 0 or 1")
 
-    # list of predefined functions and routines
-    PredefinedFunctions = {"DefineByte": _PredefinedDefineByte,
-                           "DefineWord": _PredefinedDefineWord,
-                           "DefineMessage": _PredefinedDefineMessage}
-    PredefinedRoutines = {"DefineByte": _PredefinedDefineByte,
-                          "DefineWord": _PredefinedDefineWord,
-                          "DefineMessage": _PredefinedDefineMessage,
-                          "FindPattern": _PredefinedFindPattern,
-                          "StartandEndbyOffset": _PredefinedStartandEndByOffset
-                          }
+                Settings["NUMBERWORDORDER"] = i & 0xFF
 
-    def __init__(self, arg, start=0, end=65536, data=None):
-        """Creates a new DisassembleInstruction which is used to control
-        disassembly of Z80 code.
+            elif (i >> 8) == 3:  # display line address every X line
+                k = int(_getnextcharacters(instructions, Settings, 2), 16)
+                if k < 0 or k > 255:
+                    raise _newSpectrumTranslateError(
+                        Vars[0x0A], commandstart, instructions,
+                        "Display line address every X line argument must be 2 \
+digit hexadecimal number")
 
-        The only required argument is either a DisassembleInstruction to
-        copy, an int of the instruction to carry out, or a string with a
-        packed DisassembleInstruction in it (see __str__() for packing
-        this string.
+                Settings["DISPLAYEVERYXLINES"] = k + ((i & 0xFF) << 8)
 
-        Optional arguments are ignored for everything other than an
-        initial int argument.  They are:
-        start is the address from where this instruction applies.
-        end is the address up to and including that this instruction
-        applies.
-        data is a string that is needed by the DisassembleInstruction to
-        carry out it's instructions.
-        """
+            elif (i >> 8) == 4:  # separator to space/tab/default
+                if (i & 0xFF) > 2:
+                    raise _newSpectrumTranslateError(
+                        Vars[0x0A], commandstart, instructions,
+                        "Seperator setting argument must be 0 to 2")
+
+                if (i & 0xFF) == 0:
+                    Settings["SEPERATOR"] = "  "
+
+                elif (i & 0xFF) == 1:
+                    Settings["SEPERATOR"] = "\t"
+
+                else:
+                    Settings["SEPERATOR"] = Settings["ORIGIONALSEPERATOR"]
+
+            elif (i >> 8) == 5:  # blank line after data default/always/never
+                if (i & 0xFF) > 2:
+                    raise _newSpectrumTranslateError(
+                        Vars[0x0A], commandstart, instructions,
+                        "line after data setting argument must be 0 to 2")
 
-        # if constructor arg is another DisassembleInstruction then make
-        # a copy
-        if isinstance(arg, DisassembleInstruction):
-            data = None if arg.data is None else str(arg.data)
-            end = arg.end
-            start = arg.start
-            arg = arg.instruction
+                if (i & 0xFF) == 0:
+                    if "LINEAFTERDATA" in Settings:
+                        del Settings["LINEAFTERDATA"]
+                else:
+                    Settings["LINEAFTERDATA"] = (i & 0xFF) == 1
 
-        # if argument is string for instruction type then get code
-        if arg in DisassembleInstruction.DISASSEMBLE_CODES:
-            arg = DisassembleInstruction.DISASSEMBLE_CODES[arg]
+            else:
+                raise _newSpectrumTranslateError(
+                    Vars[0x0A], commandstart, instructions,
+                    "unrecognised format setting")
 
-        # if constructor arg is a string then unpack the contained data
-        if isinstance(arg, str):
-            # break data into components
-            parts = arg.split("#", 4)
-            arg = int(parts[0], 16)
-            start = int(parts[1], 16)
-            end = int(parts[2], 16)
-            data = parts[4] if len(parts) == 5 else None
-            # handle multiline data
-            if len(parts[3]) > 0:
-                # re-insert newline characters
-                for pos in parts[3].split(','):
-                    pos = int(pos, 16)
-                    data = data[:pos] + "\n" + data[pos:]
+        elif s[0] == '!':  # process predefined routine
+                raise _newSpectrumTranslateError(
+                    Vars[0x0A], commandstart, instructions,
+                    "Predefined routines not allowed inside instructions. Use \
+predefined Functions instead.")
 
-        self.instruction = arg
-        self.start = start
-        self.end = end
-        # make copy of string
-        self.data = None if data is None else str(data)
+        elif s[0] == 'P':  # process predefined function
+            # get details of command and it's arguments
+            details = _ProcessFunctionDetails(
+                instructions[Settings["DATASTRINGPOS"]:])
+            if isinstance(details, str):
+                raise _newSpectrumTranslateError(Vars[0x0A], commandstart,
+                                                 instructions, details)
 
-    def isformatinstruction(self):
-        """Tests if the DisassembleInstruction is a format instruction.
-        """
+            # check is valid command
+            if details[0] not in DisassembleInstruction.PredefinedFunctions:
+                raise _newSpectrumTranslateError(
+                    Vars[0x0A], commandstart, instructions,
+                    'function "{}" not defined'.format(details[0]))
 
-        return self.instruction != 0 and (self.instruction & 0xFF0000) == 0
+            # process function and combine result
+            args = [data, Settings, Vars] + details[1]
+            keyargs = details[2]
+            result = DisassembleInstruction.PredefinedFunctions[details[0]](
+                *args, **keyargs)
+            # extract text and logic from result
+            if isinstance(result, str):
+                txt = result
+                logic = None
+            elif isinstance(result, (bool, int)):
+                txt = None
+                logic = result
+            elif (_isarray(result) and len(result) > 1 and
+                 isinstance(result[1], str) and
+                 isinstance(result[0], (bool, int))):
+                txt = result[1]
+                logic = result[0]
+            elif (_isarray(result) and len(result) > 1 and
+                 isinstance(result[0], str) and
+                 isinstance(result[1], (bool, int))):
+                txt = result[0]
+                logic = result[1]
+            elif (_isarray(result) and len(result) > 0 and
+                 isinstance(result[0], str)):
+                txt = result[0]
+                logic = None
+            elif (_isarray(result) and len(result) > 0 and
+                 isinstance(result[0], (bool, int))):
+                txt = None
+                logic = result[0]
+            else:
+                txt = None
+                logic = None
 
-    def __str__(self):
-        """Returns a String representation of the
-        DisassembleInstruction.  This is the instruction code in
-        hexadecimal, followed by a '#' followed by the start address in
-        hexadecimal, followed by a '#', followed by the end address in
-        hexadecimal, followed by a '#'.  If the data property is not
-        None then a comma seperated list of positions for new line
-        characters in the data field follows, then another '#', and then
-        the data field with newline characters stripped out.
+            # update pointer to instructions
+            Settings["DATASTRINGPOS"] += details[3]
 
-        This can be used as an argument to the constructor to create a
-        new DisassembleInstruction
-        """
+            # process text and logic
+            if txt:
+                soutput += txt
+            if logic is not None and isinstance(logic, bool):
+                boolState = combineresults(boolMode, boolState, logic)
+            elif logic is not None and isinstance(logic, int):
+                boolState = combineresults(boolMode, boolState,
+                                           (logic & 1) == 1)
+            # if break or continue, leave, this will be False for bool
+            if isinstance(logic, int) and logic & 6 != 0:
+                # leave block
+                return (logic & 6) + (1 if boolState else 0), soutput
 
-        if self.data is None or self.data == '':
-            return "{0.instruction:X}#{0.start:X}#{0.end:X}#".format(self)
+        elif s[0] == 'B':  # ouput byte
+            # get info
+            i = int(_getnextcharacters(instructions, Settings, 2), 16)
+            if (i & 0x3F) == 0x3F:  # dealing with addresses
+                # get address
+                k = int(_getnextcharacters(instructions, Settings, 4), 16)
+                # getbyte at address, adjust for offset
+                k = data[k-Settings["ORIGIN"]]
 
-        return "{0.instruction:X}#{0.start:X}#{0.end:X}#{1}#{2}".format(
-            self,
-            ','.join(["{:X}".format(i) for i, c in enumerate(self.data) if
-                      c == '\n']),
-            self.data.replace('\n', ''))
+            elif (i & 0x3F) < 0x10:
+                # get variable content
+                k = Vars[0x0A] + \
+                    Vars[0x0C] if ((i & 0x3F) == 0x0F) else Vars[i & 0x3F]
+                # get content of memory address if this is a reference
+                if (i & 0x80) == 0:
+                    k = data[k-Settings["ORIGIN"]]
+                # increment if apropriate
+                _incvarifneeded(i, Vars, 1)
 
-    def __lt__(self, other):
-        # defined so can sort by starting address
-        if self.start == other.start:
-            return self.end.__lt__(other.end)
-        return self.start.__lt__(other.start)
+            else:
+                raise _newSpectrumTranslateError(
+                    Vars[0x0A], commandstart, instructions,
+                    "invalid byte output argument")
 
-    def disassembledatablock(self, Settings, data):
-        """This method will disassemble the given data according to the
-        current DisassembleInstruction.
-        """
+            # handle negative number if signed and not an address
+            if Settings["NUMBERSIGNED"] == 1 and (i & 0x80) == 0x80:
+                k = 0x100-k
+                soutput += "-"
 
-        """
-        var[0-9]  %V00-%V09
-        line address (not changable)  %V0A
-        line number (not changable)   %V0B
-        offset from line start        %V0C
-        start pos (not changable)     %V0D
-        end pos                       %V0E
-        current pos (not changable)   %V0F
-        """
-        Vars = [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, self.start, 0, 0, self.start,
-                self.end]
-        soutput = ""
+            # output byte
+            soutput += _numbertostring(k, 8, Settings["NUMBERFORMAT"], False)
 
-        # loop through commandline block
-        while Vars[0x0A] <= Vars[0x0E]:
-            # check if any comments to be added to this data
-            if "COMMENTCONTROL" in Settings:
-                # move past any instructions that has been & gone
-                dis = Settings["COMMENTCONTROL"][0]
-                while dis and Vars[0x0A] > dis[0].end:
-                    dis.pop(0)
-                # if is comment instruction process it
-                if (dis and
-                   Vars[0x0A] >= dis[0].start and
-                   dis[0].instruction & 0xFFFF00 == 0x030000 and
-                   dis[0].data is not None and dis[0].data != ""):
-                    di = dis.pop(0)
-                    if di.instruction == self.DISASSEMBLE_CODES[
-                       "Comment Before"]:
-                        if Settings["COMMENTCONTROL"][1] == 0:
-                            soutput += Settings["COMMENTCONTROL"][4](
-                                di.data, Settings["XMLOutput"]) + "\n"
+        elif s[0] == 'W':  # output word
+            # get info
+            i = int(_getnextcharacters(instructions, Settings, 2), 16)
+            if (i & 0x3F) == 0x3F:  # dealing with addresses
+                # get address
+                k = int(_getnextcharacters(instructions, Settings, 4), 16)
+                # getbyte, adjust for offset
+                k = data[k-Settings["ORIGIN"] +
+                         Settings["NUMBERWORDORDER"]] + \
+                    256*data[k-Settings["ORIGIN"] +
+                             1-Settings["NUMBERWORDORDER"]]
 
-                        continue
-                    # otherwise comnment end of this line or after
-                    if di.instruction == 0x030002:
-                        if Settings["COMMENTCONTROL"][3] != "":
-                            Settings["COMMENTCONTROL"][3] += "\n"
-                        Settings["COMMENTCONTROL"][3] += di.data
-                    else:
-                        if Settings["COMMENTCONTROL"][2] != "":
-                            Settings["COMMENTCONTROL"][2] += ". "
-                        Settings["COMMENTCONTROL"][2] += di.data
+            elif (i & 0x3F) < 0x10:
+                # get variable content
+                k = Vars[0x0A] + \
+                    Vars[0x0C] if ((i & 0x3F) == 0x0F) else Vars[i & 0x3F]
+                # get content of memory address if this is a reference
+                if (i & 0x80) == 0:
+                    k = data[k-Settings["ORIGIN"] +
+                             Settings["NUMBERWORDORDER"]] + \
+                        256*data[k-Settings["ORIGIN"] +
+                                 1-Settings["NUMBERWORDORDER"]]
 
-                    continue
+                # increment if apropriate
+                _incvarifneeded(i, Vars, 2)
 
-            Vars[0x0C] = 0  # point to start of line
+            else:
+                raise _newSpectrumTranslateError(
+                    Vars[0x0A], commandstart, instructions,
+                    "invalid number output argument")
 
-            # for each line go through commandline instructions
-            # character by chracter
-            Settings["DATASTRINGPOS"] = 0
+            # handle negative number if signed and not an addrss
+            if Settings["NUMBERSIGNED"] == 1 and (i & 0x80) == 0x80:
+                k = 0x100-k
+                soutput += "-"
 
-            # output start line if needed
-            if Settings["XMLOutput"] == 1:
-                soutput += '  <line>'
-            Settings["HadLineStart"] = True
-            Settings["HadLineEnd"] = False
+            # output word
+            soutput += _numbertostring(k, 16, Settings["NUMBERFORMAT"], False)
+            # remember number incase it is line number
+            if "ReferencedLineNumbers" in Settings:
+                Settings["ReferencedLineNumbers"] += [k]
+
+        elif s[0] == 'A':  # output address
+            # get info
+            i = int(_getnextcharacters(instructions, Settings, 2), 16)
+            if (i & 0x3F) == 0x3F:  # dealing with addresses
+                # get address
+                k = int(_getnextcharacters(instructions, Settings, 4), 16)
+                # getbyte, adjust for offset
+                k = data[k-Settings["ORIGIN"] +
+                         Settings["NUMBERWORDORDER"]] + \
+                    256*data[k-Settings["ORIGIN"] +
+                             1-Settings["NUMBERWORDORDER"]]
 
-            while Settings["DATASTRINGPOS"] < len(self.data):
-                # make note of where command starts in case we have
-                # error
-                commandstart = Settings["DATASTRINGPOS"]
+            elif (i & 0x3F) < 0x10:
+                # get variable content
+                k = Vars[0x0A] + \
+                    Vars[0x0C] if ((i & 0x3F) == 0x0F) else Vars[i & 0x3F]
+                # get content of memory address if this is a reference
+                if (i & 0x80) == 0:
+                    k = data[k-Settings["ORIGIN"] +
+                             Settings["NUMBERWORDORDER"]] + \
+                        256*data[k-Settings["ORIGIN"] +
+                                 1-Settings["NUMBERWORDORDER"]]
+                # increment if apropriate
+                _incvarifneeded(i, Vars, 2)
 
-                # get next char
-                s = _getnextcharacters(self.data, Settings, 1)
+            else:
+                raise _newSpectrumTranslateError(
+                    Vars[0x0A], commandstart, instructions,
+                    "invalid address output argument")
 
-                if s == "":
-                    break
+            # output address
+            if Settings["XMLOutput"] == 1:
+                soutput += _numbertostring(k, 16, Settings["NUMBERFORMAT"],
+                                           False)
 
-                # deal with non-control characters first
-                if s[0] != '%':
-                    soutput += getspectrumchar(s[0],
-                                               Settings["HexForNonASCII"])
-                    continue
+            else:
+                i = Settings["ADDRESSOUTPUT"] + 4
+                if Settings["SEPERATOR"] != "  ":
+                    i += 1 << 5
+                soutput += "\0" + chr(i) + chr(Settings["DISPLAYEVERYXLINES"])
+                soutput += _numbertostring(k, 16, 0, False)
 
-                # reset position
-                Settings["DATASTRINGPOS"] = commandstart
+        # output char, defaults to unsigned byte if not printable
+        elif s[0] == 'C':
+            # get info
+            i = int(_getnextcharacters(instructions, Settings, 2), 16)
+            if (i & 0x3F) == 0x3F:  # dealing with addresses
+                # get address
+                k = int(_getnextcharacters(instructions, Settings, 4), 16)
+                # getbyte, adjust for offset
+                k = data[k-Settings["ORIGIN"]]
 
-                # deal with any instructions
-                # can ignore result
-                try:
-                    res, txt = _processcommandblock(self.data, Vars, Settings,
-                                                    data, False, False)
-                except IndexError:
-                    raise _newSpectrumTranslateError(
-                        Vars[0x0A], 0, self.data,
-                        "attempt to access data outside of supplied code")
+            elif (i & 0x3F) < 0x10:
+                # get variable content
+                k = Vars[0x0A] + \
+                    Vars[0x0C] if ((i & 0x3F) == 0x0F) else Vars[i & 0x3F]
+                # get content of memory address if this is a reference
+                if (i & 0x80) == 0:
+                    k = data[k-Settings["ORIGIN"]]
+                # increment if apropriate
+                _incvarifneeded(i, Vars, 1)
 
-                soutput += txt
+            else:
+                raise _newSpectrumTranslateError(
+                    Vars[0x0A], commandstart, instructions,
+                    "invalid character output argument")
 
-            # update line address
-            Vars[0x0A] += Vars[0x0C]
-            # update line number
-            Vars[0x0B] += 1
+            # output character
+            soutput += getspectrumchar(k, Settings["HexForNonASCII"])
 
-            # do comment
-            if ("COMMENTCONTROL" in Settings and
-               Settings["COMMENTCONTROL"][1] == 0 and
-               Settings["COMMENTCONTROL"][2] != ""):
-                # XML comments
-                if Settings["XMLOutput"] == 1:
-                    soutput += "<comment>{}</comment>".format(
-                        Settings["COMMENTCONTROL"][2])
-                # plain text comments
-                else:
-                    # output pre comment text
-                    soutput += Settings["SEPERATOR"] + ';'
+        elif s[0] == 'G':  # output 5 byte floating point number
+            # get info
+            i = int(_getnextcharacters(instructions, Settings, 2), 16)
+            if (i & 0x3F) == 0x3F:  # dealing with addresses
+                # get address
+                k = int(_getnextcharacters(instructions, Settings, 4), 16)
+                # get and output floating point number
+                soutput += str(SpectrumNumber(data[k-Settings["ORIGIN"]:
+                                                   k-Settings["ORIGIN"] + 5]))
 
-                    if Settings["COMMENTCONTROL"][2].find("\n") == -1:
-                        soutput += Settings["COMMENTCONTROL"][2]
+            elif (i & 0x3F) < 0x10:
+                # get variable content
+                k = Vars[0x0A] + \
+                    Vars[0x0C] if ((i & 0x3F) == 0x0F) else Vars[i & 0x3F]
+                # has to be a memory address that holds 5 byte number
+                if (i & 0x80) != 0:
+                    raise _newSpectrumTranslateError(
+                        Vars[0x0A], commandstart, instructions,
+                        "invalid floating point number output argument")
 
-                    else:
-                        comments = Settings["COMMENTCONTROL"][2].split("\n")
-                        soutput += comments[0]
-                        if Settings["COMMENTCONTROL"][3] != "":
-                            Settings["COMMENTCONTROL"][3] = "\n" +\
-                                Settings["COMMENTCONTROL"][3]
-                        Settings["COMMENTCONTROL"][3] = "\n".join(
-                            comments[1:]) + Settings["COMMENTCONTROL"][3]
+                # get and output floating point number
+                soutput += str(SpectrumNumber(data[k-Settings["ORIGIN"]:
+                                                   k-Settings["ORIGIN"] + 5]))
+                # increment if apropriate
+                _incvarifneeded(i, Vars, 5)
 
-            if not Settings["HadLineEnd"]:
-                # output end start line if needed
-                if Settings["XMLOutput"] == 1:
-                    soutput += '</line>'
+            else:
+                raise _newSpectrumTranslateError(
+                    Vars[0x0A], commandstart, instructions,
+                    "invalid floating point number output argument")
 
-                # new line
-                soutput += "\n"
+        elif s[0] == '%':  # output '%'
+            soutput += '%'
 
-            # handle comments after line
-            if "COMMENTCONTROL" in Settings:
-                if (Settings["COMMENTCONTROL"][1] == 0 and
-                   Settings["COMMENTCONTROL"][3] != ""):
-                    soutput += Settings["COMMENTCONTROL"][4](
-                        Settings["COMMENTCONTROL"][3],
-                        Settings["XMLOutput"]) + "\n"
+        elif s[0] == 'S':  # output seperator
+            # only output if not in xml mode
+            if Settings["XMLOutput"] == 0:
+                soutput += Settings["SEPERATOR"]
 
-                # clear comments
-                Settings["COMMENTCONTROL"][2] = ""
-                Settings["COMMENTCONTROL"][3] = ""
+        elif s[0] == 'N':  # output newline
+            soutput += '\n'
 
-        # return end of data block as might have changed
-        return Vars[0x0E], soutput
+        elif s[0] == 'T':  # output tab
+            soutput += '\t'
 
+        # maths
+        elif s[0] == 'X':
+            # get sub command
+            i = int(_getnextcharacters(instructions, Settings, 2), 16)
+            # check if valid command
+            if i < 0 or i > 9:
+                raise _newSpectrumTranslateError(
+                    Vars[0x0A], commandstart, instructions,
+                    "invalid arithmetic operation. Must be 0 to 9")
 
-def isfindandcomment(instructions):
-    """Tests if the supplied instructions is a valid find and comment
-    routine.
+            # where to store result
+            result = int(_getnextcharacters(instructions, Settings, 2), 16)
+            # check is valid resultlocation
+            if (result < 0 or (result > 9 and result != 0x0C and
+               result != 0x0E and result != 0x0F)):
+                raise _newSpectrumTranslateError(
+                    Vars[0x0A], commandstart, instructions,
+                    "invalid arithmetic destination")
 
-    Note that this routine is not perfect, as to be so would be too
-    complex.  It simply ensures that the code can be broken into three
-    sections like a pattern data block, and that the first section
-    contains the %; command.
-    """
+            # get first argument
+            arga = get_number_var_or_memory(instructions, Vars, Settings, data,
+                                            commandstart)
+            # get 2nd argument if needed & keep compiler happy otherwise
+            argb = get_number_var_or_memory(instructions, Vars, Settings, data,
+                                            commandstart) if (i != 1) else 0
 
-    test, prep, action = getpartsofpatterndatablock(instructions)
+            # now process variables
+            if i == 1:    # let
+                k = arga
+            elif i == 2:  # add
+                k = arga + argb
+            elif i == 3:  # subtract
+                k = arga - argb
+            elif i == 4:  # multiply
+                k = arga * argb
+            elif i == 5:  # divide
+                k = arga // argb
+            elif i == 6:  # modulus
+                k = arga % argb
+            elif i == 7:  # binary and
+                k = arga & argb
+            elif i == 8:  # binary or
+                k = arga | argb
+            elif i == 9:  # binary xor
+                k = arga ^ argb
+            else:
+                k = 0
 
-    # must have a test area and must contain %;
-    if not test or test.find("%;") == -1:
-        return False
+            # ensure is 16 bit result
+            k &= 0xFFFF
 
-    return True
+            # save variable
+            if result == 0x0F:
+                Vars[0x0C] = k-Vars[0x0A]
+            else:
+                Vars[result] = k
 
+        # flow
+        elif s[0] == '(':
+            # process contents of brackets and combine result
+            i, txt = _processcommandblock(instructions, Vars, Settings, data,
+                                          True, InTest)
+            soutput += txt
+            boolState = combineresults(boolMode, boolState, (i & 1) == 1)
+            i = i & 6
+            # if break or continue, leave
+            if i != 0:
+                # move to end of current block
+                _movetoblockend(instructions, Vars, Settings, commandstart)
+                # leave block
+                return i + (1 if boolState else 0), soutput
 
-def _numbertostring(n, bits, form, typeindicator=True):
-    """format: 0=hex,1=decimal,2=octal,3=binary
-    typeindictor specifies display type specifer before number: "" for
-    decimal, "#" for hex, "b" for binary, "o" for octal.
-    """
-    if form == 0:
-        # hex
-        return ("{}{:0" + str(bits >> 2) + "X}").format(
-            "#" if typeindicator else "", n)
+        elif s[0] == ')':
+            # if not in brackets  then error
+            if not inBrackets:
+                raise _newSpectrumTranslateError(
+                    Vars[0x0A], commandstart, instructions,
+                    "Closing brackets without opening brackets")
 
-    elif form == 1:
-        # decimal
-        return "{}".format(n)
+            # otherwise ought to return from command
+            return 1 if boolState else 0, soutput
 
-    elif form == 2:
-        # octal
-        return ("{}{:0" + str((bits + 2)//3) + "o}").format(
-            "o" if typeindicator else "", n)
+        elif s[0] == 'I':  # if then block
+            # should have brackets afterwards
+            if _getnextcharacters(instructions, Settings, 2) != "%(":
+                raise _newSpectrumTranslateError(
+                    Vars[0x0A], commandstart, instructions,
+                    "bracket bound test must follow if statement")
 
-    elif form == 3:
-        # binary
-        return ("{}{:0" + str(bits) + "b}").format(
-            "b" if typeindicator else "", n)
+            # test if block
+            result, txt = _processcommandblock(instructions, Vars, Settings,
+                                               data, True, True)
+            bTest = (result & 1) == 1
+            soutput += txt
 
-    else:
-        return ""
+            # should have brackets afterwards for instruction block
+            if _getnextcharacters(instructions, Settings, 2) != "%(":
+                raise _newSpectrumTranslateError(
+                    Vars[0x0A], commandstart, instructions,
+                    "bracket bound action must follow if test")
 
+            # signal no break or continue
+            k = 0
+            # if contition met then process block
+            if bTest:
+                k, txt = _processcommandblock(instructions, Vars, Settings,
+                                              data, True, InTest)
+                soutput += txt
 
-def _getnextcharacters(instructions, Settings, numberToGet):
-    """Returns required number of characters skipping space, new line,
-    tabs, and comments.
-    """
+            # otherwise move past command block
+            else:
+                _movetoblockend(instructions, Vars, Settings, commandstart)
 
-    s = ""
+            # save position before checking to see if is else statement
+            # following
+            i = Settings["DATASTRINGPOS"]
+            # see if is an else block
+            if _getnextcharacters(instructions, Settings, 2) == "%J":
+                # should have brackets afterwards for instruction block
+                if _getnextcharacters(instructions, Settings, 2) != "%(":
+                    raise _newSpectrumTranslateError(
+                        Vars[0x0A], commandstart, instructions,
+                        "bracket bound action must follow else statement")
 
-    # loop until have requested number of non whitespace characters or
-    # hit end of commands
-    while len(s) < numberToGet and \
-          Settings["DATASTRINGPOS"] < len(instructions):
-        c = instructions[Settings["DATASTRINGPOS"]]
+                # process block
+                k, txt = _processcommandblock(instructions, Vars, Settings,
+                                              data, True, InTest)
+                if not bTest:
+                    soutput += txt
 
-        # if found comment, move to end of line
-        if (c == '%' and len(instructions) > Settings["DATASTRINGPOS"] + 1 and
-           instructions[Settings["DATASTRINGPOS"] + 1] == "#"):
-            # check just incase have %%# which is display %#
-            escapes = 1
-            # see how far back escapes go back
-            while escapes > Settings["DATASTRINGPOS"] and \
-                  instructions[Settings["DATASTRINGPOS"]-escapes] == "%":
-                escapes += 1
+            # otherwise reset string position
+            else:
+                Settings["DATASTRINGPOS"] = i
 
-            # should have an odd number of escapes if this a comment
-            if escapes & 1 == 1:
-                # move position to new line character
-                Settings["DATASTRINGPOS"] = instructions.find(
-                    "\n", Settings["DATASTRINGPOS"])
-                # if newline not found,
-                if Settings["DATASTRINGPOS"] == -1:
-                    # set to end of line
-                    Settings["DATASTRINGPOS"] = len(instructions)
+            # if break or continue happened inside if or else block then
+            # leave
+            if (k & 6) != 0:
+                # move to end of current block
+                _movetoblockend(instructions, Vars, Settings, commandstart)
+                # leave block
+                return k, soutput
 
-                # loop back to deal with next character
-                continue
+        elif s[0] == 'L':  # while do loop
+            # should have brackets afterwards
+            if _getnextcharacters(instructions, Settings, 2) != "%(":
+                raise _newSpectrumTranslateError(
+                    Vars[0x0A], commandstart, instructions,
+                    "bracket bound test must follow loop statement")
 
-            # otherwise is a hash to display
+            # make note of where while do loop starts
+            i = Settings["DATASTRINGPOS"]
 
-        if c != ' ' and c != '\t' and c != '\n':
-            s += c
-        Settings["DATASTRINGPOS"] += 1
+            bTest = True
 
-    return s
+            # loop until test condition is false;
+            while bTest:
+                # set where while do loop starts
+                Settings["DATASTRINGPOS"] = i
 
+                # test if block
+                result, txt = _processcommandblock(instructions, Vars,
+                                                   Settings, data, True, True)
+                bTest = (result & 1) == 1
+                soutput += txt
 
-def _movetoblockend(instructions, Vars, Settings, commandstart):
-    """move to end of specified command block"""
+                # should have brackets afterwards for instruction block
+                if _getnextcharacters(instructions, Settings, 2) != "%(":
+                    raise _newSpectrumTranslateError(
+                        Vars[0x0A], commandstart, instructions,
+                        "bracket bound action must follow loop test")
 
-    # for each line go through commands instructions character by
-    # chracter
-    while Settings["DATASTRINGPOS"] < len(instructions):
-        # get next char
-        s = _getnextcharacters(instructions, Settings, 1)
+                # if contition met then process block
+                if bTest:
+                    result, txt = _processcommandblock(instructions, Vars,
+                                                       Settings, data, True,
+                                                       InTest)
+                    soutput += txt
+                    if (result & 2) == 2:
+                        # if break from routine then break out of loop
 
-        if s == "":
-            break
+                        # move to end of current block
+                        _movetoblockend(instructions, Vars, Settings,
+                                        commandstart)
 
-        # skip non-control characters first
-        if s != "%":
-            continue
+                        break
 
-        # get next char
-        s = _getnextcharacters(instructions, Settings, 1)
+                # otherwise move past command block
+                if not bTest:
+                    _movetoblockend(instructions, Vars, Settings,
+                                    commandstart)
 
-        if s == "":
-            break
+        # end data block
+        elif s[0] == 'Q':
+            # setting end of data block as current position, then ending
+            # line will quit data block
+            Vars[0x0E] = Vars[0x0A] + Vars[0x0C] - 1
 
-        # what command is it?
-        if s[0] == "(":
-            # move to end of nested block
-            _movetoblockend(instructions, Vars, Settings, commandstart)
+            # by setting position to end of data string and returning,
+            # this will end line
+            Settings["DATASTRINGPOS"] = len(instructions)
+            return 1 if boolState else 0, soutput
 
-        # return if found end of block
-        elif s[0] == ')':
-            return
+        # end line
+        elif s[0] == 'E':
+            # by setting position to end of data string and returning,
+            # this will end line
+            Settings["DATASTRINGPOS"] = len(instructions)
+            return 1 if boolState else 0, soutput
 
-        # otherwise skip command
+        # break;
+        elif s[0] == 'Y':
+            # return
+            return 3 if boolState else 2, soutput
 
-    # should always find end of block with close brackets, error if
-    # block not closed
-    raise _newSpectrumTranslateError(Vars[0x0A], commandstart, instructions,
-                                     "no closing brackets to block")
+        # continue
+        elif s[0] == 'Z':
+            # return
+            return 5 if boolState else 4, soutput
 
+        # comparitors
+        elif s[0] == '?':
+            # get next chars
+            comp = _getnextcharacters(instructions, Settings, 2)
 
-def _processcommandblock(instructions, Vars, Settings, data, inBrackets,
-                         InTest):
-    """processes an instruction block.
-       return bit 0 1=true, 0=false
-       bit 1 2=break, 0=not break
-       bit 2 4=continue, 0=not continue
-       ,output text
-    """
+            # check if mode change
+            if comp[0] == 'B':
+                if comp[1] == 'A':  # and
+                    boolMode = 0
+                elif comp[1] == 'O':  # or
+                    boolMode = 1
+                elif comp[1] == 'X':  # xor
+                    boolMode = 2
+                else:  # unrecognised mode command
+                    raise _newSpectrumTranslateError(
+                        Vars[0x0A], commandstart, instructions,
+                        "unrecognised boolean combination mode")
 
-    # nested functions needed by _processcommandblock
-    def inc_var_if_needed(var_num, Vars, inc_amount):
-        """increment variable if apropriate"""
-        if ((var_num & 0x40) == 0 and ((var_num & 0x3F) < 0x0A or
-           (var_num & 0x3F) in [0x0C, 0x0F])):
-            Vars[0x0C if ((var_num & 0x3F) == 0x0F) else
-                 var_num & 0x3F] += inc_amount
+                continue
 
-    def get_number_var_or_memory(instructions, Vars, Settings, data,
-                                 commandstart):
-        # how many bytes are we getting
-        getByte = True
-        # remember where we started
-        pos = Settings["DATASTRINGPOS"]
+            # have we tested enough already?
+            # can we end testing based on results so far without further
+            # testing?
+            if (InTest and (    # are we in a test situation?
+               # are we anding with false: answer will be false
+               (boolMode == 0 and not boolState) or
+               # are we oring with true: answer will be true
+               (boolMode == 1 and boolState))
+               ):
+                # can leave test as have found answer
+                # move to end of current block
+                _movetoblockend(instructions, Vars, Settings, commandstart)
+                # return from test block
+                return 1 if boolState else 0, soutput
 
-        # get next char
-        s = _getnextcharacters(instructions, Settings, 1)
+            # should now be tests
+            # get which one
+            try:
+                i = {"LT": 0, "MT": 1, "EQ": 2, "LE": 3, "ME": 4,
+                     "NE": 5}[comp]
+            except:
+                raise _newSpectrumTranslateError(
+                    Vars[0x0A], commandstart, instructions,
+                    "unrecognised comparison")
 
-        if s == "":
-            raise _newSpectrumTranslateError(
-                Vars[0x0A], commandstart, instructions,
-                "Invalid variable or number definition")
+            # get 2 arguments
+            arga = get_number_var_or_memory(instructions, Vars, Settings, data,
+                                            commandstart)
+            # get 2nd argument if needed
+            argb = get_number_var_or_memory(instructions, Vars, Settings, data,
+                                            commandstart)
 
-        # first check if is a number
-        if s[0] != "%":
-            # restore pointer to where it was
-            Settings["DATASTRINGPOS"] = pos
+            # now do text
+            if i == 0:  # less than
+                boolState = combineresults(boolMode, boolState, arga < argb)
+            elif i == 1:  # more than
+                boolState = combineresults(boolMode, boolState, arga > argb)
+            elif i == 2:  # equal
+                boolState = combineresults(boolMode, boolState, arga == argb)
+            elif i == 3:  # less than or equal
+                boolState = combineresults(boolMode, boolState, arga <= argb)
+            elif i == 4:  # more than or equal
+                boolState = combineresults(boolMode, boolState, arga >= argb)
+            elif i == 5:  # not equal
+                boolState = combineresults(boolMode, boolState, arga != argb)
 
-            # extract number
-            i = int(_getnextcharacters(instructions, Settings, 4), 16)
-            # deal with error
-            if i < 0:
-                raise _newSpectrumTranslateError(
-                    Vars[0x0A], commandstart, instructions,
-                    "number must be 4 digit hexadecimal number")
+        # XML tags
+        elif s[0] == '$':
+            # default to normal tag
+            emptytag = False
+            closetag = False
 
-            return i
+            # get next char
+            nextchar = _getnextcharacters(instructions, Settings, 1)
 
-        # get next char
-        s = _getnextcharacters(instructions, Settings, 1)
+            # check & handle empty tag
+            if nextchar == '$':
+                emptytag = True
+                nextchar = _getnextcharacters(instructions, Settings, 1)
 
-        if s[0] == "V":
-            # get variable number
-            i = int(_getnextcharacters(instructions, Settings, 2), 16)
-            # deal with invalid variable number
-            if i < 0 or i > 0x0F:
-                raise _newSpectrumTranslateError(
-                    Vars[0x0A], commandstart, instructions, "invalid variable")
+            # check and handle closeing tag
+            elif nextchar == '-':
+                closetag = True
+                nextchar = _getnextcharacters(instructions, Settings, 1)
 
-            # return variable's content
-            return Vars[0x0A] + Vars[0x0C] if (i == 0x0F) else Vars[i]
+            # now figure out command
+            if nextchar == 'A':
+                tag = 'address'
 
-        # should now be 'M', handle if not
-        if s[0] != "M":
-            raise _newSpectrumTranslateError(
-                Vars[0x0A], commandstart, instructions,
-                "argument must be number, variable, or memory content")
+            elif nextchar == 'B':
+                tag = 'bytes'
 
-        pos = Settings["DATASTRINGPOS"]
+            elif nextchar == 'C':
+                tag = 'comment'
 
-        # get next char
-        s = _getnextcharacters(instructions, Settings, 1)
+            elif nextchar == 'D':
+                tag = 'data'
 
-        # if next char is 'W' then need to get 2 bytes
-        if s[0] == "W":
-            # make note we need word not byte
-            getByte = False
+            elif nextchar == 'F':
+                tag = 'flags'
 
-            # get next char
-            s = _getnextcharacters(instructions, Settings, 1)
+            elif nextchar == 'I':
+                tag = 'instruction'
 
-            pos = Settings["DATASTRINGPOS"]
+            elif nextchar == 'L':
+                tag = 'line'
 
-        # now get into i address of where to extract data from
+            elif nextchar == 'T':
+                tag = 'timeing'
 
-        # if next char is 'V' then variable pointing to memory address
-        if s[0] == "V":
-            # get variable number
-            i = int(_getnextcharacters(instructions, Settings, 2), 16)
-            # deal with invalid variable number
-            if i < 0 or i > 0x0F:
-                raise _newSpectrumTranslateError(
-                    Vars[0x0A], commandstart, instructions,
-                    "invalid variable number for memory address")
+            elif nextchar == '<':
+                # get position of closeing bracket
+                closepos = instructions.find(">", Settings["DATASTRINGPOS"])
 
-            # get number variable's content
-            i = Vars[0x0A] + Vars[0x0C] if (i == 0x0F) else Vars[i]
+                # handle no closeing bracket
+                if closepos == -1:
+                    raise _newSpectrumTranslateError(
+                        Vars[0x0A], commandstart, instructions,
+                        "no closeing bracket on XML tag")
 
-        # otherwise should be 4 hex digit address
-        else:
-            # in checking to see if next char was V will move pointer,
-            # so reset to where it should be
-            Settings["DATASTRINGPOS"] = pos
+                # get tag name from between brackets
+                tag = instructions[Settings["DATASTRINGPOS"]:closepos]
+                # update instructions position
+                Settings["DATASTRINGPOS"] = closepos + 1
 
-            # extract number
-            i = int(_getnextcharacters(instructions, Settings, 4), 16)
-            # deal with error
-            if i < 0:
+            else:
                 raise _newSpectrumTranslateError(
                     Vars[0x0A], commandstart, instructions,
-                    "should be 4 digit hexadecimal number for memory address")
-
-        # now have address we need to extract in i, and if we want byte
-        # or not in getByte
-        # deal with byte
-        if getByte:
-            return data[i-Settings["ORIGIN"]]
-
-        # deal with word taking into account endedness of number we want
-        return data[i-Settings["ORIGIN"] + Settings["NUMBERWORDORDER"]] + \
-            256*data[i-Settings["ORIGIN"] +
-                     1-Settings["NUMBERWORDORDER"]]
+                    "unrecognised predefined XML tag")
 
-    def combineresults(mode, a, b):
-        if mode == 0:
-            return a and b
-        if mode == 1:
-            return a or b
-        if mode == 2:
-            return a ^ b
+            # if in xml mode then output tag
+            if Settings["XMLOutput"] == 1:
+                if not closetag and tag == 'line':
+                    soutput += "  "
 
-    # end of _processcommandblock's nested functions
+                soutput += '<'
 
-    boolState = False
-    boolMode = 1      # 0=and, 1=or, 2=xor
-    soutput = ""
+                if closetag:
+                    soutput += '/'
 
-    # for each line go through commands instructions character by
-    # character
-    while Settings["DATASTRINGPOS"] < len(instructions):
-        # make note of where command starts in case we have error
-        commandstart = Settings["DATASTRINGPOS"]
+                soutput += tag
 
-        # get next char
-        s = _getnextcharacters(instructions, Settings, 1)
+                if emptytag:
+                    soutput += '/'
 
-        if s == "":
-            break
+                soutput += '>'
 
-        # deal with non-control characters first
-        if s[0] != '%':
-            soutput += getspectrumchar(s[0], Settings["HexForNonASCII"])
-            continue
+        # add comment
+        elif s[0] == ';':
+            commentstart = get_number_var_or_memory(instructions, Vars,
+                                                    Settings, data,
+                                                    commandstart)
+            commentend = get_number_var_or_memory(instructions, Vars, Settings,
+                                                  data, commandstart)
 
-        # space after % will get missed by _getnextcharacters so handle
-        if instructions[Settings["DATASTRINGPOS"]] == ' ':  # output space
-            soutput += ' '
-            continue
+            # get what comment is to be
+            nextchar = _getnextcharacters(instructions, Settings, 1)
+            if nextchar == "0":
+                commentinstruction = DisassembleInstruction.\
+                    DISASSEMBLE_CODES["Comment"]
+            elif nextchar == "1":
+                commentinstruction = DisassembleInstruction.\
+                    DISASSEMBLE_CODES["Comment Before"]
+            elif nextchar == "2":
+                commentinstruction = DisassembleInstruction.\
+                    DISASSEMBLE_CODES["Comment After"]
+            else:
+                raise _newSpectrumTranslateError(
+                    Vars[0x0A], commandstart, instructions,
+                    "bad comment position")
 
-        # get next char (command
-        s = _getnextcharacters(instructions, Settings, 1)
+            # find out where to get comment from
+            nextchar = _getnextcharacters(instructions, Settings, 1)
 
-        # what command is it?
-        if s[0] == 'F':  # //format settings
-            # get sub command & which format
-            i = int(_getnextcharacters(instructions, Settings, 4), 16)
-            if (i >> 8) == 0:  # format hex/decimal/octal/binary
-                if (i & 0xFF) > 6:
-                    raise _newSpectrumTranslateError(
-                        Vars[0x0A], commandstart, instructions,
-                        "Number format argument must be 0 to 6")
+            # check if comment is text to end of line
+            if nextchar == "1":
+                # find end of line
+                endofline = instructions.find("\n", Settings["DATASTRINGPOS"])
+                # if newline not found, set to end of line
+                if endofline == -1:
+                    endofline = len(instructions)
 
-                if (i & 0xFF) == 4:
-                    Settings["NUMBERFORMAT"] = Settings["ADDRESSOUTPUT"]
+                # set comment to be text to end of line
+                commenttext = nextchar + instructions[
+                    Settings["DATASTRINGPOS"]:endofline]
 
-                elif (i & 0xFF) == 5:
-                    Settings["NUMBERFORMAT"] = Settings["NUMBEROUTPUT"]
+                # move current position past end of line
+                Settings["DATASTRINGPOS"] = endofline
 
-                elif (i & 0xFF) == 6:
-                    Settings["NUMBERFORMAT"] = Settings["COMMANDOUTPUT"]
+            # if is text so far
+            elif nextchar == "0":
+                commenttext = soutput
 
-                else:
-                    Settings["NUMBERFORMAT"] = i & 0xFF
+            # otherwise has been incorrect value
+            else:
+                raise _newSpectrumTranslateError(
+                    Vars[0x0A], commandstart, instructions,
+                    "bad comment source")
 
-            elif (i >> 8) == 1:  # number unsigned/signed
-                if (i & 0xFF) > 1:
-                    raise _newSpectrumTranslateError(
-                        Vars[0x0A], commandstart, instructions,
-                        "Number sign argument must be 0 or 1")
+            # create instruction
+            di = DisassembleInstruction(commentinstruction, commentstart,
+                                        commentend, commenttext)
+            # add to list of instructions
+            Settings["InstructionsToAdd"] += [di]
 
-                Settings["NUMBERSIGNED"] = i & 0xFF
+        else:  # unrecognised command
+            raise _newSpectrumTranslateError(
+                Vars[0x0A], commandstart, instructions, "unrecognised command")
 
-            elif (i >> 8) == 2:  # word mode little/big endian
-                if (i & 0xFF) > 1:
-                    raise _newSpectrumTranslateError(
-                        Vars[0x0A], commandstart, instructions,
-                        "Word endedness argument must be 0 or 1")
+    return 1 if boolState else 0, soutput
 
-                Settings["NUMBERWORDORDER"] = i & 0xFF
 
-            elif (i >> 8) == 3:  # display line address every X line
-                k = int(_getnextcharacters(instructions, Settings, 2), 16)
-                if k < 0 or k > 255:
-                    raise _newSpectrumTranslateError(
-                        Vars[0x0A], commandstart, instructions,
-                        "Display line address every X line argument must be 2 \
-digit hexadecimal number")
+def _compilecommandblock(instructions):
+    """Compiles an instruction block such as the test or preperation
+    block of a Pattern Data Block or Comment Pattern instruction so that
+    it can be run repeatedly by _runcompiledblock without re-reading the
+    instruction text each time.  The instructions are read exactly as
+    _processcommandblock would read them.
 
-                Settings["DISPLAYEVERYXLINES"] = k + ((i & 0xFF) << 8)
+    Returns the compiled block, or None if the instructions contain
+    something that can only be handled by _processcommandblock (such
+    as predefined functions, breaks and continues, or errors).  In that
+    case use _processcommandblock instead.
+    """
 
-            elif (i >> 8) == 4:  # separator to space/tab/default
-                if (i & 0xFF) > 2:
-                    raise _newSpectrumTranslateError(
-                        Vars[0x0A], commandstart, instructions,
-                        "Seperator setting argument must be 0 to 2")
+    # nested functions needed by _compilecommandblock
+    def getnumber(Settings, digits):
+        i = int(_getnextcharacters(instructions, Settings, digits), 16)
+        if i < 0:
+            raise ValueError("negative number")
 
-                if (i & 0xFF) == 0:
-                    Settings["SEPERATOR"] = "  "
+        return i
 
-                elif (i & 0xFF) == 1:
-                    Settings["SEPERATOR"] = "\t"
+    def get_number_var_or_memory(Settings):
+        """returns (0, number), (1, variable), (2, address, isbyte), or
+        (3, variable holding address, isbyte)
+        """
 
-                else:
-                    Settings["SEPERATOR"] = Settings["ORIGIONALSEPERATOR"]
+        getByte = True
+        pos = Settings["DATASTRINGPOS"]
 
-            elif (i >> 8) == 5:  # blank line after data default/always/never
-                if (i & 0xFF) > 2:
-                    raise _newSpectrumTranslateError(
-                        Vars[0x0A], commandstart, instructions,
-                        "line after data setting argument must be 0 to 2")
+        s = _getnextcharacters(instructions, Settings, 1)
+        if s == "":
+            raise ValueError("no argument")
 
-                if (i & 0xFF) == 0:
-                    if "LINEAFTERDATA" in Settings:
-                        del Settings["LINEAFTERDATA"]
-                else:
-                    Settings["LINEAFTERDATA"] = (i & 0xFF) == 1
+        # number
+        if s[0] != "%":
+            Settings["DATASTRINGPOS"] = pos
+            return (0, getnumber(Settings, 4))
 
-            else:
-                raise _newSpectrumTranslateError(
-                    Vars[0x0A], commandstart, instructions,
-                    "unrecognised format setting")
+        s = _getnextcharacters(instructions, Settings, 1)
 
-        elif s[0] == '!':  # process predefined routine
-                raise _newSpectrumTranslateError(
-                    Vars[0x0A], commandstart, instructions,
-                    "Predefined routines not allowed inside instructions. Use \
-predefined Functions instead.")
+        # variable
+        if s[0] == "V":
+            i = getnumber(Settings, 2)
+            if i > 0x0F:
+                raise ValueError("invalid variable")
 
-        elif s[0] == 'P':  # process predefined function
-            # get details of command and it's arguments
-            details = _ProcessFunctionDetails(
-                instructions[Settings["DATASTRINGPOS"]:])
-            if isinstance(details, str):
-                raise _newSpectrumTranslateError(Vars[0x0A], commandstart,
-                                                 instructions, details)
+            return (1, i)
 
-            # check is valid command
-            if details[0] not in DisassembleInstruction.PredefinedFunctions:
-                raise _newSpectrumTranslateError(
-                    Vars[0x0A], commandstart, instructions,
-                    'function "{}" not defined'.format(details[0]))
+        # memory
+        if s[0] != "M":
+            raise ValueError("invalid argument")
 
-            # process function and combine result
-            args = [data, Settings, Vars] + details[1]
-            keyargs = details[2]
-            result = DisassembleInstruction.PredefinedFunctions[details[0]](
-                *args, **keyargs)
-            # extract text and logic from result
-            if isinstance(result, str):
-                txt = result
-                logic = None
-            elif isinstance(result, (bool, int)):
-                txt = None
-                logic = result
-            elif (_isarray(result) and len(result) > 1 and
-                 isinstance(result[1], str) and
-                 isinstance(result[0], (bool, int))):
-                txt = result[1]
-                logic = result[0]
-            elif (_isarray(result) and len(result) > 1 and
-                 isinstance(result[0], str) and
-                 isinstance(result[1], (bool, int))):
-                txt = result[0]
-                logic = result[1]
-            elif (_isarray(result) and len(result) > 0 and
-                 isinstance(result[0], str)):
-                txt = result[0]
-                logic = None
-            elif (_isarray(result) and len(result) > 0 and
-                 isinstance(result[0], (bool, int))):
-                txt = None
-                logic = result[0]
-            else:
-                txt = None
-                logic = None
+        pos = Settings["DATASTRINGPOS"]
+        s = _getnextcharacters(instructions, Settings, 1)
+        if s[0] == "W":
+            getByte = False
+            s = _getnextcharacters(instructions, Settings, 1)
+            pos = Settings["DATASTRINGPOS"]
 
-            # update pointer to instructions
-            Settings["DATASTRINGPOS"] += details[3]
+        if s[0] == "V":
+            i = getnumber(Settings, 2)
+            if i > 0x0F:
+                raise ValueError("invalid variable")
 
-            # process text and logic
-            if txt:
-                soutput += txt
-            if logic is not None and isinstance(logic, bool):
-                boolState = combineresults(boolMode, boolState, logic)
-            elif logic is not None and isinstance(logic, int):
-                boolState = combineresults(boolMode, boolState,
-                                           (logic & 1) == 1)
-            # if break or continue, leave, this will be False for bool
-            if isinstance(logic, int) and logic & 6 != 0:
-                # leave block
-                return (logic & 6) + (1 if boolState else 0), soutput
+            return (3, i, getByte)
 
-        elif s[0] == 'B':  # ouput byte
-            # get info
-            i = int(_getnextcharacters(instructions, Settings, 2), 16)
-            if (i & 0x3F) == 0x3F:  # dealing with addresses
-                # get address
-                k = int(_getnextcharacters(instructions, Settings, 4), 16)
-                # getbyte at address, adjust for offset
-                k = data[k-Settings["ORIGIN"]]
+        Settings["DATASTRINGPOS"] = pos
+        return (2, getnumber(Settings, 4), getByte)
 
-            elif (i & 0x3F) < 0x10:
-                # get variable content
-                k = Vars[0x0A] + \
-                    Vars[0x0C] if ((i & 0x3F) == 0x0F) else Vars[i & 0x3F]
-                # get content of memory address if this is a reference
-                if (i & 0x80) == 0:
-                    k = data[k-Settings["ORIGIN"]]
-                # increment if apropriate
-                inc_var_if_needed(i, Vars, 1)
+    def getbracketedblock(Settings):
+        """returns compiled block that must be bracketed and closed, and
+        where the block's contents start"""
+        if _getnextcharacters(instructions, Settings, 2) != "%(":
+            raise ValueError("no block")
 
-            else:
-                raise _newSpectrumTranslateError(
-                    Vars[0x0A], commandstart, instructions,
-                    "invalid byte output argument")
+        blockstart = Settings["DATASTRINGPOS"]
+        block = compileblock(Settings, True)
+        if not block[1]:
+            raise ValueError("block not closed")
 
-            # handle negative number if signed and not an address
-            if Settings["NUMBERSIGNED"] == 1 and (i & 0x80) == 0x80:
-                k = 0x100-k
-                soutput += "-"
+        return block, blockstart
 
-            # output byte
-            soutput += _numbertostring(k, 8, Settings["NUMBERFORMAT"], False)
+    def contains(block, commands):
+        for op in block[0]:
+            if op[0] in commands:
+                return True
 
-        elif s[0] == 'W':  # output word
-            # get info
-            i = int(_getnextcharacters(instructions, Settings, 2), 16)
-            if (i & 0x3F) == 0x3F:  # dealing with addresses
-                # get address
-                k = int(_getnextcharacters(instructions, Settings, 4), 16)
-                # getbyte, adjust for offset
-                k = data[k-Settings["ORIGIN"] +
-                         Settings["NUMBERWORDORDER"]] + \
-                    256*data[k-Settings["ORIGIN"] +
-                             1-Settings["NUMBERWORDORDER"]]
+            if op[0] in "(IL" and any([contains(b, commands) for b in
+                                       op[1:4] if isinstance(b, tuple)]):
+                return True
 
-            elif (i & 0x3F) < 0x10:
-                # get variable content
-                k = Vars[0x0A] + \
-                    Vars[0x0C] if ((i & 0x3F) == 0x0F) else Vars[i & 0x3F]
-                # get content of memory address if this is a reference
-                if (i & 0x80) == 0:
-                    k = data[k-Settings["ORIGIN"] +
-                             Settings["NUMBERWORDORDER"]] + \
-                        256*data[k-Settings["ORIGIN"] +
-                                 1-Settings["NUMBERWORDORDER"]]
+        return False
 
-                # increment if apropriate
-                inc_var_if_needed(i, Vars, 2)
+    def skipsto(pos):
+        """returns where _movetoblockend would move to from pos, or None
+        if it would raise an error"""
+        Settings = {"DATASTRINGPOS": pos}
+        try:
+            _movetoblockend(instructions, [0] * 15, Settings, 0)
+        except SpectrumTranslateError:
+            return None
 
+        return Settings["DATASTRINGPOS"]
+
+    def compileblock(Settings, inBrackets):
+        ops = []
+        # plain text is held as it is output without and with
+        # HexForNonASCII
+        text = ["", ""]
+        # places where _processcommandblock would skip to the end of
+        # this block
+        skips = []
+
+        def addtext(txt, spectrumchar=False):
+            if spectrumchar:
+                text[0] += getspectrumchar(txt, False)
+                text[1] += getspectrumchar(txt, True)
             else:
-                raise _newSpectrumTranslateError(
-                    Vars[0x0A], commandstart, instructions,
-                    "invalid number output argument")
+                text[0] += txt
+                text[1] += txt
 
-            # handle negative number if signed and not an addrss
-            if Settings["NUMBERSIGNED"] == 1 and (i & 0x80) == 0x80:
-                k = 0x100-k
-                soutput += "-"
+        def addop(op):
+            if text[0] != "" or text[1] != "":
+                ops.append(('"', text[0], text[1]))
+                text[0] = ""
+                text[1] = ""
 
-            # output word
-            soutput += _numbertostring(k, 16, Settings["NUMBERFORMAT"], False)
-            # remember number incase it is line number
-            if "ReferencedLineNumbers" in Settings:
-                Settings["ReferencedLineNumbers"] += [k]
+            if op is not None:
+                ops.append(op)
 
-        elif s[0] == 'A':  # output address
-            # get info
-            i = int(_getnextcharacters(instructions, Settings, 2), 16)
-            if (i & 0x3F) == 0x3F:  # dealing with addresses
-                # get address
-                k = int(_getnextcharacters(instructions, Settings, 4), 16)
-                # getbyte, adjust for offset
-                k = data[k-Settings["ORIGIN"] +
-                         Settings["NUMBERWORDORDER"]] + \
-                    256*data[k-Settings["ORIGIN"] +
-                             1-Settings["NUMBERWORDORDER"]]
+        closed = False
+        while Settings["DATASTRINGPOS"] < len(instructions):
+            commandstart = Settings["DATASTRINGPOS"]
 
-            elif (i & 0x3F) < 0x10:
-                # get variable content
-                k = Vars[0x0A] + \
-                    Vars[0x0C] if ((i & 0x3F) == 0x0F) else Vars[i & 0x3F]
-                # get content of memory address if this is a reference
-                if (i & 0x80) == 0:
-                    k = data[k-Settings["ORIGIN"] +
-                             Settings["NUMBERWORDORDER"]] + \
-                        256*data[k-Settings["ORIGIN"] +
-                                 1-Settings["NUMBERWORDORDER"]]
-                # increment if apropriate
-                inc_var_if_needed(i, Vars, 2)
+            s = _getnextcharacters(instructions, Settings, 1)
+            if s == "":
+                break
 
-            else:
-                raise _newSpectrumTranslateError(
-                    Vars[0x0A], commandstart, instructions,
-                    "invalid address output argument")
+            # non-control characters
+            if s[0] != '%':
+                addtext(s[0], True)
+                continue
 
-            # output address
-            if Settings["XMLOutput"] == 1:
-                soutput += _numbertostring(k, 16, Settings["NUMBERFORMAT"],
-                                           False)
+            # space after %
+            if instructions[Settings["DATASTRINGPOS"]] == ' ':
+                addtext(' ')
+                continue
 
-            else:
-                i = Settings["ADDRESSOUTPUT"] + 4
-                if Settings["SEPERATOR"] != "  ":
-                    i += 1 << 5
-                soutput += "\0" + chr(i) + chr(Settings["DISPLAYEVERYXLINES"])
-                soutput += _numbertostring(k, 16, 0, False)
+            s = _getnextcharacters(instructions, Settings, 1)
 
-        # output char, defaults to unsigned byte if not printable
-        elif s[0] == 'C':
-            # get info
-            i = int(_getnextcharacters(instructions, Settings, 2), 16)
-            if (i & 0x3F) == 0x3F:  # dealing with addresses
-                # get address
-                k = int(_getnextcharacters(instructions, Settings, 4), 16)
-                # getbyte, adjust for offset
-                k = data[k-Settings["ORIGIN"]]
+            if s[0] == 'F':
+                i = int(_getnextcharacters(instructions, Settings, 4), 16)
+                k = None
+                if ((i >> 8) == 0 and (i & 0xFF) > 6) or \
+                   ((i >> 8) in (1, 2) and (i & 0xFF) > 1) or \
+                   ((i >> 8) in (4, 5) and (i & 0xFF) > 2) or \
+                   (i >> 8) > 5 or i < 0:
+                    raise ValueError("invalid format")
 
-            elif (i & 0x3F) < 0x10:
-                # get variable content
-                k = Vars[0x0A] + \
-                    Vars[0x0C] if ((i & 0x3F) == 0x0F) else Vars[i & 0x3F]
-                # get content of memory address if this is a reference
-                if (i & 0x80) == 0:
-                    k = data[k-Settings["ORIGIN"]]
-                # increment if apropriate
-                inc_var_if_needed(i, Vars, 1)
+                if (i >> 8) == 3:
+                    k = int(_getnextcharacters(instructions, Settings, 2), 16)
+                    if k < 0 or k > 255:
+                        raise ValueError("invalid format")
 
-            else:
-                raise _newSpectrumTranslateError(
-                    Vars[0x0A], commandstart, instructions,
-                    "invalid character output argument")
+                addop(('F', i, k))
 
-            # output character
-            soutput += getspectrumchar(k, Settings["HexForNonASCII"])
+            elif s[0] in "BWACG":
+                i = int(_getnextcharacters(instructions, Settings, 2), 16)
+                k = None
+                if (i & 0x3F) == 0x3F:
+                    k = int(_getnextcharacters(instructions, Settings, 4), 16)
 
-        elif s[0] == 'G':  # output 5 byte floating point number
-            # get info
-            i = int(_getnextcharacters(instructions, Settings, 2), 16)
-            if (i & 0x3F) == 0x3F:  # dealing with addresses
-                # get address
-                k = int(_getnextcharacters(instructions, Settings, 4), 16)
-                # get and output floating point number
-                soutput += str(SpectrumNumber(data[k-Settings["ORIGIN"]:
-                                                   k-Settings["ORIGIN"] + 5]))
+                elif (i & 0x3F) >= 0x10 or (s[0] == 'G' and
+                                            (i & 0x80) != 0):
+                    raise ValueError("invalid argument")
 
-            elif (i & 0x3F) < 0x10:
-                # get variable content
-                k = Vars[0x0A] + \
-                    Vars[0x0C] if ((i & 0x3F) == 0x0F) else Vars[i & 0x3F]
-                # has to be a memory address that holds 5 byte number
-                if (i & 0x80) != 0:
-                    raise _newSpectrumTranslateError(
-                        Vars[0x0A], commandstart, instructions,
-                        "invalid floating point number output argument")
+                addop((s[0], i, k))
 
-                # get and output floating point number
-                soutput += str(SpectrumNumber(data[k-Settings["ORIGIN"]:
-                                                   k-Settings["ORIGIN"] + 5]))
-                # increment if apropriate
-                inc_var_if_needed(i, Vars, 5)
+            elif s[0] == '%':
+                addtext('%')
 
-            else:
-                raise _newSpectrumTranslateError(
-                    Vars[0x0A], commandstart, instructions,
-                    "invalid floating point number output argument")
+            elif s[0] == 'S':
+                addop(('S',))
+
+            elif s[0] == 'N':
+                addtext('\n')
+
+            elif s[0] == 'T':
+                addtext('\t')
 
-        elif s[0] == '%':  # output '%'
-            soutput += '%'
+            elif s[0] == 'X':
+                i = int(_getnextcharacters(instructions, Settings, 2), 16)
+                if i < 0 or i > 9:
+                    raise ValueError("invalid operation")
 
-        elif s[0] == 'S':  # output seperator
-            # only output if not in xml mode
-            if Settings["XMLOutput"] == 0:
-                soutput += Settings["SEPERATOR"]
+                result = int(_getnextcharacters(instructions, Settings, 2), 16)
+                if (result < 0 or (result > 9 and result != 0x0C and
+                   result != 0x0E and result != 0x0F)):
+                    raise ValueError("invalid destination")
 
-        elif s[0] == 'N':  # output newline
-            soutput += '\n'
+                arga = get_number_var_or_memory(Settings)
+                argb = get_number_var_or_memory(Settings) if i != 1 else None
+                addop(('X', i, result, arga, argb))
 
-        elif s[0] == 'T':  # output tab
-            soutput += '\t'
+            elif s[0] == '(':
+                block = compileblock(Settings, True)
+                if not block[1]:
+                    raise ValueError("block not closed")
 
-        # maths
-        elif s[0] == 'X':
-            # get sub command
-            i = int(_getnextcharacters(instructions, Settings, 2), 16)
-            # check if valid command
-            if i < 0 or i > 9:
-                raise _newSpectrumTranslateError(
-                    Vars[0x0A], commandstart, instructions,
-                    "invalid arithmetic operation. Must be 0 to 9")
+                addop(('(', block))
 
-            # where to store result
-            result = int(_getnextcharacters(instructions, Settings, 2), 16)
-            # check is valid resultlocation
-            if (result < 0 or (result > 9 and result != 0x0C and
-               result != 0x0E and result != 0x0F)):
-                raise _newSpectrumTranslateError(
-                    Vars[0x0A], commandstart, instructions,
-                    "invalid arithmetic destination")
+            elif s[0] == ')':
+                if not inBrackets:
+                    raise ValueError("unexpected close bracket")
 
-            # get first argument
-            arga = get_number_var_or_memory(instructions, Vars, Settings, data,
-                                            commandstart)
-            # get 2nd argument if needed & keep compiler happy otherwise
-            argb = get_number_var_or_memory(instructions, Vars, Settings, data,
-                                            commandstart) if (i != 1) else 0
+                closed = True
+                break
 
-            # now process variables
-            if i == 1:    # let
-                k = arga
-            elif i == 2:  # add
-                k = arga + argb
-            elif i == 3:  # subtract
-                k = arga - argb
-            elif i == 4:  # multiply
-                k = arga * argb
-            elif i == 5:  # divide
-                k = arga // argb
-            elif i == 6:  # modulus
-                k = arga % argb
-            elif i == 7:  # binary and
-                k = arga & argb
-            elif i == 8:  # binary or
-                k = arga | argb
-            elif i == 9:  # binary xor
-                k = arga ^ argb
-            else:
-                k = 0
+            elif s[0] in "IL":
+                test = getbracketedblock(Settings)[0]
+                action, actionstart = getbracketedblock(Settings)
+                # _processcommandblock skips the action block if the
+                # test fails
+                if skipsto(actionstart) != Settings["DATASTRINGPOS"]:
+                    raise ValueError("unable to skip block")
+
+                # ending the line in a test leaves the instructions part
+                # way through a block so is an error
+                if contains(test, "QE"):
+                    raise ValueError("line ended in test")
+
+                if s[0] == 'L':
+                    addop(('L', test, action))
+                    continue
 
-            # ensure is 16 bit result
-            k &= 0xFFFF
+                elseblock = None
+                i = Settings["DATASTRINGPOS"]
+                if _getnextcharacters(instructions, Settings, 2) == "%J":
+                    elseblock = getbracketedblock(Settings)[0]
+                else:
+                    Settings["DATASTRINGPOS"] = i
 
-            # save variable
-            if result == 0x0F:
-                Vars[0x0C] = k-Vars[0x0A]
-            else:
-                Vars[result] = k
+                addop(('I', test, action, elseblock))
 
-        # flow
-        elif s[0] == '(':
-            # process contents of brackets and combine result
-            i, txt = _processcommandblock(instructions, Vars, Settings, data,
-                                          True, InTest)
-            soutput += txt
-            boolState = combineresults(boolMode, boolState, (i & 1) == 1)
-            i = i & 6
-            # if break or continue, leave
-            if i != 0:
-                # move to end of current block
-                _movetoblockend(instructions, Vars, Settings, commandstart)
-                # leave block
-                return i + (1 if boolState else 0), soutput
+            elif s[0] in "QE":
+                addop((s[0],))
 
-        elif s[0] == ')':
-            # if not in brackets  then error
-            if not inBrackets:
-                raise _newSpectrumTranslateError(
-                    Vars[0x0A], commandstart, instructions,
-                    "Closing brackets without opening brackets")
+            elif s[0] == '?':
+                comp = _getnextcharacters(instructions, Settings, 2)
+                if comp[0] == 'B':
+                    addop(('?B', "AOX".index(comp[1])))
 
-            # otherwise ought to return from command
-            return 1 if boolState else 0, soutput
+                else:
+                    # when testing, _processcommandblock can skip to the
+                    # end of this block from here once the result is
+                    # known
+                    pos = Settings["DATASTRINGPOS"]
+                    skips.append(pos)
+                    i = {"LT": 0, "MT": 1, "EQ": 2, "LE": 3, "ME": 4,
+                         "NE": 5}[comp]
+                    arga = get_number_var_or_memory(Settings)
+                    argb = get_number_var_or_memory(Settings)
+                    addop(('?', i, arga, argb, commandstart, pos))
+
+            elif s[0] == '$':
+                emptytag = False
+                closetag = False
 
-        elif s[0] == 'I':  # if then block
-            # should have brackets afterwards
-            if _getnextcharacters(instructions, Settings, 2) != "%(":
-                raise _newSpectrumTranslateError(
-                    Vars[0x0A], commandstart, instructions,
-                    "bracket bound test must follow if statement")
+                nextchar = _getnextcharacters(instructions, Settings, 1)
+                if nextchar == '$':
+                    emptytag = True
+                    nextchar = _getnextcharacters(instructions, Settings, 1)
 
-            # test if block
-            result, txt = _processcommandblock(instructions, Vars, Settings,
-                                               data, True, True)
-            bTest = (result & 1) == 1
-            soutput += txt
+                elif nextchar == '-':
+                    closetag = True
+                    nextchar = _getnextcharacters(instructions, Settings, 1)
 
-            # should have brackets afterwards for instruction block
-            if _getnextcharacters(instructions, Settings, 2) != "%(":
-                raise _newSpectrumTranslateError(
-                    Vars[0x0A], commandstart, instructions,
-                    "bracket bound action must follow if test")
+                if nextchar == '<':
+                    closepos = instructions.find(">",
+                                                 Settings["DATASTRINGPOS"])
+                    tag = instructions[Settings["DATASTRINGPOS"]:closepos]
+                    if closepos == -1:
+                        raise ValueError("invalid tag")
 
-            # signal no break or continue
-            k = 0
-            # if contition met then process block
-            if bTest:
-                k, txt = _processcommandblock(instructions, Vars, Settings,
-                                              data, True, InTest)
-                soutput += txt
+                    Settings["DATASTRINGPOS"] = closepos + 1
 
-            # otherwise move past command block
-            else:
-                _movetoblockend(instructions, Vars, Settings, commandstart)
+                else:
+                    tag = {'A': 'address', 'B': 'bytes', 'C': 'comment',
+                           'D': 'data', 'F': 'flags', 'I': 'instruction',
+                           'L': 'line', 'T': 'timeing'}[nextchar]
 
-            # save position before checking to see if is else statement
-            # following
-            i = Settings["DATASTRINGPOS"]
-            # see if is an else block
-            if _getnextcharacters(instructions, Settings, 2) == "%J":
-                # should have brackets afterwards for instruction block
-                if _getnextcharacters(instructions, Settings, 2) != "%(":
-                    raise _newSpectrumTranslateError(
-                        Vars[0x0A], commandstart, instructions,
-                        "bracket bound action must follow else statement")
+                addop(('$', tag, emptytag, closetag))
 
-                # process block
-                k, txt = _processcommandblock(instructions, Vars, Settings,
-                                              data, True, InTest)
-                if not bTest:
-                    soutput += txt
+            elif s[0] == ';':
+                commentstart = get_number_var_or_memory(Settings)
+                commentend = get_number_var_or_memory(Settings)
 
-            # otherwise reset string position
-            else:
-                Settings["DATASTRINGPOS"] = i
+                commentinstruction = DisassembleInstruction.DISASSEMBLE_CODES[
+                    ("Comment", "Comment Before", "Comment After")[int(
+                        _getnextcharacters(instructions, Settings, 1))]]
 
-            # if break or continue happened inside if or else block then
-            # leave
-            if (k & 6) != 0:
-                # move to end of current block
-                _movetoblockend(instructions, Vars, Settings, commandstart)
-                # leave block
-                return k, soutput
+                nextchar = _getnextcharacters(instructions, Settings, 1)
+                if nextchar == "1":
+                    endofline = instructions.find("\n",
+                                                  Settings["DATASTRINGPOS"])
+                    if endofline == -1:
+                        endofline = len(instructions)
 
-        elif s[0] == 'L':  # while do loop
-            # should have brackets afterwards
-            if _getnextcharacters(instructions, Settings, 2) != "%(":
-                raise _newSpectrumTranslateError(
-                    Vars[0x0A], commandstart, instructions,
-                    "bracket bound test must follow loop statement")
+                    commenttext = nextchar + instructions[
+                        Settings["DATASTRINGPOS"]:endofline]
+                    Settings["DATASTRINGPOS"] = endofline
 
-            # make note of where while do loop starts
-            i = Settings["DATASTRINGPOS"]
+                elif nextchar == "0":
+                    commenttext = None
 
-            bTest = True
+                else:
+                    raise ValueError("bad comment source")
 
-            # loop until test condition is false;
-            while bTest:
-                # set where while do loop starts
-                Settings["DATASTRINGPOS"] = i
+                addop((';', commentstart, commentend, commentinstruction,
+                       commenttext))
 
-                # test if block
-                result, txt = _processcommandblock(instructions, Vars,
-                                                   Settings, data, True, True)
-                bTest = (result & 1) == 1
-                soutput += txt
+            # predefined functions and routines, breaks and continues
+            # (which leave _processcommandblock part way through a
+            # block), and errors are left to _processcommandblock
+            else:
+                raise ValueError("unsupported command")
 
-                # should have brackets afterwards for instruction block
-                if _getnextcharacters(instructions, Settings, 2) != "%(":
-                    raise _newSpectrumTranslateError(
-                        Vars[0x0A], commandstart, instructions,
-                        "bracket bound action must follow loop test")
+        addop(None)
 
-                # if contition met then process block
-                if bTest:
-                    result, txt = _processcommandblock(instructions, Vars,
-                                                       Settings, data, True,
-                                                       InTest)
-                    soutput += txt
-                    if (result & 2) == 2:
-                        # if break from routine then break out of loop
+        # check skipping to the end of the block matches how this block
+        # has been compiled
+        blockend = Settings["DATASTRINGPOS"] if closed else None
+        for pos in skips:
+            if skipsto(pos) != blockend:
+                raise ValueError("unable to skip block")
 
-                        # move to end of current block
-                        _movetoblockend(instructions, Vars, Settings,
-                                        commandstart)
+        return (tuple(ops), closed)
 
-                        break
+    # end of _compilecommandblock's nested functions
 
-                # otherwise move past command block
-                if not bTest:
-                    _movetoblockend(instructions, Vars, Settings,
-                                    commandstart)
+    try:
+        return compileblock({"DATASTRINGPOS": 0}, True)
+    except (ValueError, IndexError, KeyError):
+        return None
 
-        # end data block
-        elif s[0] == 'Q':
-            # setting end of data block as current position, then ending
-            # line will quit data block
-            Vars[0x0E] = Vars[0x0A] + Vars[0x0C] - 1
 
-            # by setting position to end of data string and returning,
-            # this will end line
-            Settings["DATASTRINGPOS"] = len(instructions)
-            return 1 if boolState else 0, soutput
+def _getcompiledvalue(arg, Vars, Settings, data):
+    """Returns the value of an argument compiled by
+    _compilecommandblock.
+    """
 
-        # end line
-        elif s[0] == 'E':
-            # by setting position to end of data string and returning,
-            # this will end line
-            Settings["DATASTRINGPOS"] = len(instructions)
-            return 1 if boolState else 0, soutput
+    if arg[0] == 0:
+        return arg[1]
 
-        # break;
-        elif s[0] == 'Y':
-            # return
-            return 3 if boolState else 2, soutput
+    if arg[0] == 1:
+        return Vars[0x0A] + Vars[0x0C] if (arg[1] == 0x0F) else Vars[arg[1]]
 
-        # continue
-        elif s[0] == 'Z':
-            # return
-            return 5 if boolState else 4, soutput
+    if arg[0] == 2:
+        i = arg[1]
+    else:
+        i = Vars[0x0A] + Vars[0x0C] if (arg[1] == 0x0F) else Vars[arg[1]]
 
-        # comparitors
-        elif s[0] == '?':
-            # get next chars
-            comp = _getnextcharacters(instructions, Settings, 2)
+    if arg[2]:
+        return data[i-Settings["ORIGIN"]]
 
-            # check if mode change
-            if comp[0] == 'B':
-                if comp[1] == 'A':  # and
-                    boolMode = 0
-                elif comp[1] == 'O':  # or
-                    boolMode = 1
-                elif comp[1] == 'X':  # xor
-                    boolMode = 2
-                else:  # unrecognised mode command
-                    raise _newSpectrumTranslateError(
-                        Vars[0x0A], commandstart, instructions,
-                        "unrecognised boolean combination mode")
+    return data[i-Settings["ORIGIN"] + Settings["NUMBERWORDORDER"]] + \
+        256*data[i-Settings["ORIGIN"] + 1-Settings["NUMBERWORDORDER"]]
 
-                continue
 
-            # have we tested enough already?
-            # can we end testing based on results so far without further
-            # testing?
-            if (InTest and (    # are we in a test situation?
-               # are we anding with false: answer will be false
-               (boolMode == 0 and not boolState) or
-               # are we oring with true: answer will be true
-               (boolMode == 1 and boolState))
-               ):
-                # can leave test as have found answer
-                # move to end of current block
-                _movetoblockend(instructions, Vars, Settings, commandstart)
-                # return from test block
-                return 1 if boolState else 0, soutput
+def _runcompiledblock(block, instructions, Vars, Settings, data, InTest):
+    """Runs an instruction block compiled by _compilecommandblock from
+    instructions.  This has the same effect as running
+    _processcommandblock on the instructions.
+    returns 1=true, 0=false, output text
+    """
 
-            # should now be tests
-            # get which one
-            try:
-                i = {"LT": 0, "MT": 1, "EQ": 2, "LE": 3, "ME": 4,
-                     "NE": 5}[comp]
-            except:
-                raise _newSpectrumTranslateError(
-                    Vars[0x0A], commandstart, instructions,
-                    "unrecognised comparison")
+    result, soutput, ended = _runcompiledops(block, instructions, Vars,
+                                             Settings, data, InTest)
+    return 1 if result else 0, soutput
+
+
+def _runcompiledops(block, instructions, Vars, Settings, data, InTest):
+    """Does the work for _runcompiledblock.  Returns the result of the
+    block, the output text, and if the line has been ended with %E or
+    %Q.
+    """
+
+    boolState = False
+    boolMode = 1      # 0=and, 1=or, 2=xor
+    soutput = ""
 
-            # get 2 arguments
-            arga = get_number_var_or_memory(instructions, Vars, Settings, data,
-                                            commandstart)
-            # get 2nd argument if needed
-            argb = get_number_var_or_memory(instructions, Vars, Settings, data,
-                                            commandstart)
+    for op in block[0]:
+        s = op[0]
 
-            # now do text
+        if s == '"':  # text
+            soutput += op[2] if Settings["HexForNonASCII"] else op[1]
+
+        # comparitors
+        elif s == '?':
+            # can we end testing based on results so far
+            if InTest and ((boolMode == 0 and not boolState) or
+                           (boolMode == 1 and boolState)):
+                # will raise error if block not closed
+                if not block[1]:
+                    _movetoblockend(instructions, Vars,
+                                    {"DATASTRINGPOS": op[5]}, op[4])
+
+                return boolState, soutput, False
+
+            arga = _getcompiledvalue(op[2], Vars, Settings, data)
+            argb = _getcompiledvalue(op[3], Vars, Settings, data)
+
+            i = op[1]
             if i == 0:  # less than
-                boolState = combineresults(boolMode, boolState, arga < argb)
+                result = arga < argb
             elif i == 1:  # more than
-                boolState = combineresults(boolMode, boolState, arga > argb)
+                result = arga > argb
             elif i == 2:  # equal
-                boolState = combineresults(boolMode, boolState, arga == argb)
+                result = arga == argb
             elif i == 3:  # less than or equal
-                boolState = combineresults(boolMode, boolState, arga <= argb)
+                result = arga <= argb
             elif i == 4:  # more than or equal
-                boolState = combineresults(boolMode, boolState, arga >= argb)
-            elif i == 5:  # not equal
-                boolState = combineresults(boolMode, boolState, arga != argb)
-
-        # XML tags
-        elif s[0] == '$':
-            # default to normal tag
-            emptytag = False
-            closetag = False
+                result = arga >= argb
+            else:  # not equal
+                result = arga != argb
+
+            if boolMode == 0:
+                boolState = boolState and result
+            elif boolMode == 1:
+                boolState = boolState or result
+            else:
+                boolState = boolState ^ result
 
-            # get next char
-            nextchar = _getnextcharacters(instructions, Settings, 1)
+        elif s == '?B':  # boolean combination mode
+            boolMode = op[1]
 
-            # check & handle empty tag
-            if nextchar == '$':
-                emptytag = True
-                nextchar = _getnextcharacters(instructions, Settings, 1)
+        elif s == '(':
+            result, txt, ended = _runcompiledops(op[1], instructions, Vars,
+                                                 Settings, data, InTest)
+            soutput += txt
+            if boolMode == 0:
+                boolState = boolState and result
+            elif boolMode == 1:
+                boolState = boolState or result
+            else:
+                boolState = boolState ^ result
 
-            # check and handle closeing tag
-            elif nextchar == '-':
-                closetag = True
-                nextchar = _getnextcharacters(instructions, Settings, 1)
+            # if ended line then leave
+            if ended:
+                return boolState, soutput, True
 
-            # now figure out command
-            if nextchar == 'A':
-                tag = 'address'
+        elif s == 'X':  # maths
+            arga = _getcompiledvalue(op[3], Vars, Settings, data)
+            argb = 0 if op[4] is None else _getcompiledvalue(op[4], Vars,
+                                                             Settings, data)
 
-            elif nextchar == 'B':
-                tag = 'bytes'
+            i = op[1]
+            if i == 1:    # let
+                k = arga
+            elif i == 2:  # add
+                k = arga + argb
+            elif i == 3:  # subtract
+                k = arga - argb
+            elif i == 4:  # multiply
+                k = arga * argb
+            elif i == 5:  # divide
+                k = arga // argb
+            elif i == 6:  # modulus
+                k = arga % argb
+            elif i == 7:  # binary and
+                k = arga & argb
+            elif i == 8:  # binary or
+                k = arga | argb
+            elif i == 9:  # binary xor
+                k = arga ^ argb
+            else:
+                k = 0
 
-            elif nextchar == 'C':
-                tag = 'comment'
+            # ensure is 16 bit result
+            k &= 0xFFFF
 
-            elif nextchar == 'D':
-                tag = 'data'
+            # save variable
+            if op[2] == 0x0F:
+                Vars[0x0C] = k-Vars[0x0A]
+            else:
+                Vars[op[2]] = k
 
-            elif nextchar == 'F':
-                tag = 'flags'
+        elif s in "BWACG":  # output data
+            i = op[1]
+            if s == 'G':
+                if (i & 0x3F) == 0x3F:
+                    k = op[2]
+                else:
+                    k = Vars[0x0A] + \
+                        Vars[0x0C] if ((i & 0x3F) == 0x0F) else Vars[i & 0x3F]
 
-            elif nextchar == 'I':
-                tag = 'instruction'
+                # get and output floating point number
+                soutput += str(SpectrumNumber(data[k-Settings["ORIGIN"]:
+                                                   k-Settings["ORIGIN"] + 5]))
+                if (i & 0x3F) != 0x3F:
+                    _incvarifneeded(i, Vars, 5)
 
-            elif nextchar == 'L':
-                tag = 'line'
+                continue
 
-            elif nextchar == 'T':
-                tag = 'timeing'
+            # get value
+            isbyte = s == 'B' or s == 'C'
+            if (i & 0x3F) == 0x3F:
+                k = _getcompiledvalue((2, op[2], isbyte), Vars, Settings,
+                                      data)
+            else:
+                k = Vars[0x0A] + \
+                    Vars[0x0C] if ((i & 0x3F) == 0x0F) else Vars[i & 0x3F]
+                # get content of memory address if this is a reference
+                if (i & 0x80) == 0:
+                    k = _getcompiledvalue((2, k, isbyte), Vars, Settings,
+                                          data)
+                # increment if apropriate
+                _incvarifneeded(i, Vars, 1 if isbyte else 2)
 
-            elif nextchar == '<':
-                # get position of closeing bracket
-                closepos = instructions.find(">", Settings["DATASTRINGPOS"])
+            if s == 'C':
+                soutput += getspectrumchar(k, Settings["HexForNonASCII"])
 
-                # handle no closeing bracket
-                if closepos == -1:
-                    raise _newSpectrumTranslateError(
-                        Vars[0x0A], commandstart, instructions,
-                        "no closeing bracket on XML tag")
+            elif s == 'A':
+                if Settings["XMLOutput"] == 1:
+                    soutput += _numbertostring(k, 16,
+                                               Settings["NUMBERFORMAT"], False)
 
-                # get tag name from between brackets
-                tag = instructions[Settings["DATASTRINGPOS"]:closepos]
-                # update instructions position
-                Settings["DATASTRINGPOS"] = closepos + 1
+                else:
+                    i = Settings["ADDRESSOUTPUT"] + 4
+                    if Settings["SEPERATOR"] != "  ":
+                        i += 1 << 5
+                    soutput += "\0" + chr(i) + chr(
+                        Settings["DISPLAYEVERYXLINES"])
+                    soutput += _numbertostring(k, 16, 0, False)
 
             else:
-                raise _newSpectrumTranslateError(
-                    Vars[0x0A], commandstart, instructions,
-                    "unrecognised predefined XML tag")
+                # handle negative number if signed and not an address
+                if Settings["NUMBERSIGNED"] == 1 and (i & 0x80) == 0x80:
+                    k = 0x100-k
+                    soutput += "-"
 
-            # if in xml mode then output tag
-            if Settings["XMLOutput"] == 1:
-                if not closetag and tag == 'line':
-                    sputput += "  "
+                soutput += _numbertostring(k, 8 if isbyte else 16,
+                                           Settings["NUMBERFORMAT"], False)
 
-                soutput += '<'
+                # remember number incase it is line number
+                if s == 'W' and "ReferencedLineNumbers" in Settings:
+                    Settings["ReferencedLineNumbers"] += [k]
 
-                if closetag:
-                    soutput += '/'
+        elif s == 'S':  # output seperator
+            if Settings["XMLOutput"] == 0:
+                soutput += Settings["SEPERATOR"]
 
-                soutput += tag
+        elif s == 'I':  # if then block
+            bTest, txt, ended = _runcompiledops(op[1], instructions, Vars,
+                                                Settings, data, True)
+            soutput += txt
 
-                if emptytag:
-                    soutput += '/'
+            if bTest:
+                result, txt, ended = _runcompiledops(op[2], instructions,
+                                                     Vars, Settings, data,
+                                                     InTest)
+                soutput += txt
+                if ended:
+                    return boolState, soutput, True
+
+            # else block is always run, but only output if test failed
+            if op[3] is not None:
+                result, txt, ended = _runcompiledops(op[3], instructions,
+                                                     Vars, Settings, data,
+                                                     InTest)
+                if not bTest:
+                    soutput += txt
+                if ended:
+                    return boolState, soutput, True
 
-                soutput += '>'
+        elif s == 'L':  # while do loop
+            bTest = True
+            while bTest:
+                bTest, txt, ended = _runcompiledops(op[1], instructions,
+                                                    Vars, Settings, data,
+                                                    True)
+                soutput += txt
 
-        # add comment
-        elif s[0] == ';':
-            commentstart = get_number_var_or_memory(instructions, Vars,
-                                                    Settings, data,
-                                                    commandstart)
-            commentend = get_number_var_or_memory(instructions, Vars, Settings,
-                                                  data, commandstart)
+                # ending line inside action block restarts loop
+                if bTest:
+                    result, txt, ended = _runcompiledops(op[2], instructions,
+                                                         Vars, Settings, data,
+                                                         InTest)
+                    soutput += txt
+
+        elif s == 'F':  # format settings
+            i = op[1]
+            if (i >> 8) == 0:
+                if (i & 0xFF) == 4:
+                    Settings["NUMBERFORMAT"] = Settings["ADDRESSOUTPUT"]
+                elif (i & 0xFF) == 5:
+                    Settings["NUMBERFORMAT"] = Settings["NUMBEROUTPUT"]
+                elif (i & 0xFF) == 6:
+                    Settings["NUMBERFORMAT"] = Settings["COMMANDOUTPUT"]
+                else:
+                    Settings["NUMBERFORMAT"] = i & 0xFF
+
+            elif (i >> 8) == 1:
+                Settings["NUMBERSIGNED"] = i & 0xFF
+
+            elif (i >> 8) == 2:
+                Settings["NUMBERWORDORDER"] = i & 0xFF
+
+            elif (i >> 8) == 3:
+                Settings["DISPLAYEVERYXLINES"] = op[2] + ((i & 0xFF) << 8)
+
+            elif (i >> 8) == 4:
+                if (i & 0xFF) == 0:
+                    Settings["SEPERATOR"] = "  "
+                elif (i & 0xFF) == 1:
+                    Settings["SEPERATOR"] = "\t"
+                else:
+                    Settings["SEPERATOR"] = Settings["ORIGIONALSEPERATOR"]
 
-            # get what comment is to be
-            nextchar = _getnextcharacters(instructions, Settings, 1)
-            if nextchar == "0":
-                commentinstruction = DisassembleInstruction.\
-                    DISASSEMBLE_CODES["Comment"]
-            elif nextchar == "1":
-                commentinstruction = DisassembleInstruction.\
-                    DISASSEMBLE_CODES["Comment Before"]
-            elif nextchar == "2":
-                commentinstruction = DisassembleInstruction.\
-                    DISASSEMBLE_CODES["Comment After"]
             else:
-                raise _newSpectrumTranslateError(
-                    Vars[0x0A], commandstart, instructions,
-                    "bad comment position")
+                if (i & 0xFF) == 0:
+                    if "LINEAFTERDATA" in Settings:
+                        del Settings["LINEAFTERDATA"]
+                else:
+                    Settings["LINEAFTERDATA"] = (i & 0xFF) == 1
 
-            # find out where to get comment from
-            nextchar = _getnextcharacters(instructions, Settings, 1)
+        elif s == '$':  # XML tags
+            if Settings["XMLOutput"] == 1:
+                if not op[3] and op[1] == 'line':
+                    soutput += "  "
 
-            # check if comment is text to end of line
-            if nextchar == "1":
-                # find end of line
-                endofline = instructions.find("\n", Settings["DATASTRINGPOS"])
-                # if newline not found, set to end of line
-                if endofline == -1:
-                    endofline = len(instructions)
+                soutput += '<' + ('/' if op[3] else '') + op[1] + (
+                    '/' if op[2] else '') + '>'
 
-                # set comment to be text to end of line
-                commenttext = nextchar + instructions[
-                    Settings["DATASTRINGPOS"]:endofline]
+        elif s == ';':  # add comment
+            Settings["InstructionsToAdd"] += [DisassembleInstruction(
+                op[3], _getcompiledvalue(op[1], Vars, Settings, data),
+                _getcompiledvalue(op[2], Vars, Settings, data),
+                soutput if op[4] is None else op[4])]
 
-                # move current position past end of line
-                Settings["DATASTRINGPOS"] = endofline
+        elif s == 'Q':  # end data block
+            Vars[0x0E] = Vars[0x0A] + Vars[0x0C] - 1
+            return boolState, soutput, True
 
-            # if is text so far
-            elif nextchar == "0":
-                commenttext = soutput
+        elif s == 'E':  # end line
+            return boolState, soutput, True
 
-            # otherwise has been incorrect value
-            else:
-                raise _newSpectrumTranslateError(
-                    Vars[0x0A], commandstart, instructions,
-                    "bad comment source")
+    return boolState, soutput, False
 
-            # create instruction
-            di = DisassembleInstruction(commentinstruction, commentstart,
-                                        commentend, commenttext)
-            # add to list of instructions
-            Settings["InstructionsToAdd"] += [di]
 
-        else:  # unrecognised command
-            raise _newSpectrumTranslateError(
-                Vars[0x0A], commandstart, instructions, "unrecognised command")
+def _getpatternfirstbyte(block):
+    """Returns the byte that must be at the address being tested for the
+    compiled test block of a pattern to match, or None if this is not
+    known.  Addresses without this byte can be skipped as the test
+    will fail at the first comparison without changing anything.
+    """
 
-    return 1 if boolState else 0, soutput
+    ops = block[0]
+    if len(ops) == 0:
+        return None
+
+    b = None
+    op = ops[0]
+    # first test is if current address holds a byte
+    if op[0] == '?' and op[1] == 2:
+        for arga, argb in ((op[2], op[3]), (op[3], op[2])):
+            # variables 0, A, D, and F all hold the current address
+            if (arga[0] == 3 and arga[1] in (0x00, 0x0A, 0x0D, 0x0F) and
+               arga[2] and argb[0] == 0 and argb[1] < 256):
+                b = argb[1]
+
+    # or first thing is block that needs this
+    elif op[0] == '(':
+        b = _getpatternfirstbyte(op[1])
+
+    if b is None:
+        return None
+
+    # a false result must then end the block without changing anything
+    # that lasts beyond testing this address
+    boolMode = 1
+    for op in ops[1:]:
+        if op[0] == '?B':
+            boolMode = op[1]
+
+        # anding with false leaves the block
+        elif op[0] == '?':
+            return b if boolMode == 0 and block[1] else None
+
+        # maths on variables reset for each address (except dividing
+        # which could fail)
+        elif (op[0] == 'X' and op[1] not in (5, 6) and
+              op[2] in (0x00, 0x01, 0x0C, 0x0E, 0x0F)):
+            continue
+
+        # output text is ignored when testing
+        elif op[0] not in ('"', 'S'):
+            return None
+
+    return b
 
 
 def _ProcessFunctionDetails(txt):
@@ -7619,6 +9675,21 @@ screen flags:
 -g specifies that we want the image to be outputed as a gif file (possibly
    animated) as opposed to a RGB file.
 --gif same as -g.
+-p specifies that we want the image to be outputed as a png file as opposed
+   to a RGB file.
+--png same as -p.
+--ppm specifies that we want the image to be outputed as a binary ppm file
+   as opposed to a RGB file.
+--indexed specifies that we want the image to be outputed as a raw file of
+   the colour number (0 to 15) of each pixel as opposed to a RGB file.
+--rgba specifies that we want the image to be outputed as a raw file of the
+   red, green, blue, and alpha bytes of each pixel as opposed to a RGB file.
+--scale specifies how many times bigger than the screen the image is to be.
+   It must be followed by a number from 1 to 16.  The default is 1.  This
+   is ignored for gif images.
+--border specifies that the image is to have a border around the screen.
+   It must be followed by the border colour from 0 to 7.  This is ignored
+   for gif images.
 -f Specifies the number of milliseconds between the two images in a gif
    image of a screen with flashing colours.  If not supplied the default
    is 320.  Set this to -1 if you want a non-flashing image, and -2 if
@@ -7640,6 +9711,13 @@ code flags:
    and be ended by a single empty line before the code to disassemble is
    passed through the standard input.
 --commands same as -c.
+--cache-dir specifies a directory in which to save disassemblies so that
+   disassembling the same code with the same special instructions again
+   uses the saved disassembly.  It must be followed by the name of the
+   directory, which is created if needed.  If omitted then no disassemblies
+   are saved or used.
+--no-cache specifies that no saved disassemblies are to be used or saved,
+   even if --cache-dir is used.
 
 instruction flags:
     the input and output are string arguments for creating disassemble
@@ -7664,6 +9742,17 @@ instruction flags:
 """
 
 
+def _writelines(fo, lines):
+    """Writes lines to fo with newlines between them as they are
+    produced.
+    """
+
+    newline = ""
+    for line in lines:
+        fo.write(newline + line)
+        newline = "\n"
+
+
 def _commandline(args):
     # analyse args
     i = 0
@@ -7679,6 +9768,8 @@ def _commandline(args):
     wantarraydimensions = False
     flashrate = 320
     imageFormat = "RGB"
+    imagescale = 1
+    imageborder = -1
     baseaddress = 0
     commandsource = None
     multilinein = False
@@ -7687,6 +9778,8 @@ def _commandline(args):
     hexfornonascii = False
     skipbytes = None
     usebytes = None
+    cachedir = None
+    usecache = True
 
     def getint(x):
         return int(x, 16 if x.lower().startswith("0x") else 10)
@@ -7798,6 +9891,39 @@ number, character, or string.")
             imageFormat = "GIF"
             continue
 
+        if arg in ['-p', '--png']:
+            imageFormat = "PNG"
+            continue
+
+        if arg == '--ppm':
+            imageFormat = "PPM"
+            continue
+
+        if arg == '--indexed':
+            imageFormat = "INDEXED"
+            continue
+
+        if arg == '--rgba':
+            imageFormat = "RGBA"
+            continue
+
+        if arg == '--scale':
+            try:
+                i += 1
+                imagescale = getint(args[i])
+                continue
+            except (IndexError, ValueError):
+                raise SpectrumTranslateError("Missing or invalid image scale.")
+
+        if arg == '--border':
+            try:
+                i += 1
+                imageborder = getint(args[i])
+                continue
+            except (IndexError, ValueError):
+                raise SpectrumTranslateError(
+                    "Missing or invalid image border colour.")
+
         if arg in ['-b', '--baseaddress', '--base']:
             try:
                 i += 1
@@ -7866,6 +9992,19 @@ source descriptor for special instructions.")
                 raise SpectrumTranslateError(
                     "Missing or invalid bytes length number.")
 
+        if arg == '--cache-dir':
+            try:
+                i += 1
+                cachedir = args[i]
+                continue
+            except IndexError:
+                raise SpectrumTranslateError(
+                    "Missing cache directory.")
+
+        if arg == '--no-cache':
+            usecache = False
+            continue
+
         # have unrecognised argument.
         if arg[0] == '-' or arg[0:2] == '--':
             raise SpectrumTranslateError(
@@ -7993,11 +10132,19 @@ from standard input.')
         if imageFormat == "GIF":
             retdata = getgiffromscreen(data, flashrate)
 
+        elif imageFormat == "PNG":
+            retdata = getpngfromscreen(data, imagescale, imageborder,
+                                       flashrate == -2)
+
+        elif imageFormat == "PPM":
+            retdata = getppmfromscreen(data, imagescale, imageborder,
+                                       flashrate == -2)
+
         else:
-            rgbdata = getrgbfromscreen(data, alphamask=-1, imageformat=1)
-            iwanted = 1 if flashrate == -2 and rgbdata[1] is not None else 0
-            retdata = rgbdata[iwanted]
-            retdata = bytearray([x[i] for x in retdata for i in (0, 1, 2)])
+            retdata = getrawfromscreen(data, imageFormat != "INDEXED",
+                                       0xFF if imageFormat == "RGBA" else -1,
+                                       imagescale, imageborder,
+                                       flashrate == -2)
 
     elif mode == 'code':
         if xml:
@@ -8008,8 +10155,12 @@ from standard input.')
                 specialInstructions = [DisassembleInstruction(
                     "XML Output On")] + specialInstructions
 
-        retdata = disassemble(data, 0, baseaddress, len(data),
-                              specialInstructions)
+        # disassembly is written out as it is produced, using cache if
+        # wanted
+        retdata = disassemble_iter(
+            data, 0, baseaddress, len(data), specialInstructions,
+            cache=DisassemblyCache(cachedir) if cachedir is not None and
+            usecache else None)
 
     if mode == 'instruction':
         # get instructions
@@ -8078,17 +10229,32 @@ from standard input.')
 
     # output data
     if not tostandardoutput:
-        if mode == "screen":
-            fo = open(outputfile, "wb")
-            fo.write(retdata)
-        else:
-            fo = open(outputfile, "w")
-            fo.write(retdata)
-        fo.close()
+        # code is disassembled as it is written, so write to a temporary
+        # file and only replace outputfile once all has been written so
+        # that an error part way through doesn't leave it truncated
+        tempname = "{}.{}.tmp".format(outputfile, os.getpid())
+        try:
+            if mode == "screen":
+                with open(tempname, "wb") as fo:
+                    fo.write(retdata)
+            elif mode == "code":
+                with open(tempname, "w") as fo:
+                    _writelines(fo, retdata)
+            else:
+                with open(tempname, "w") as fo:
+                    fo.write(retdata)
+
+            os.replace(tempname, outputfile)
+
+        finally:
+            if os.path.exists(tempname):
+                os.remove(tempname)
 
     else:
         if mode == "screen":
             sys.stdout.buffer.write(retdata)
+        elif mode == "code":
+            _writelines(sys.stdout, retdata)
         else:
             sys.stdout.write(retdata)
 
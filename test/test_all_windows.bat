@@ -4,6 +4,8 @@
 
 @call python3 test_spectrumnumber.py
 
+@call python3 test_spectrumscan.py
+
 @call python3 test_spectrumtape.py
 
 @call python3 test_spectrumtranslate.py
@@ -47,9 +47,11 @@ Unit Test for disciplefile file
 """
 
 import unittest
+import gc
 import sys
 import subprocess
 import re
+import io
 import os
 import pycodestyle
 from io import StringIO
@@ -516,6 +518,20 @@ class TestDiscipleImage(unittest.TestCase):
         self.assertEqual(di.ImageSource, "FileName")
         self.assertEqual(di.ImageFormat, "IMG")
 
+    def test_del(self):
+        # the image's file is closed as soon as the image is deleted even
+        # after the directory has been read
+        gc.disable()
+        try:
+            di = disciplefile.DiscipleImage("diskimagetest.mgt")
+            self.assertEqual(di.fileindexfromname("BASIC test"), [1])
+            imagefile = di.filehandle
+            del di
+            self.assertTrue(imagefile.closed)
+
+        finally:
+            gc.enable()
+
     def test_setbytes(self):
         di = disciplefile.DiscipleImage()
         di.setbytes(bytes(b"ABC"))
@@ -550,6 +566,28 @@ class TestDiscipleImage(unittest.TestCase):
         di.guessimageformat()
         self.assertEqual(di.ImageFormat, "IMG")
 
+        # the test images can be told apart without checking every file
+        def deeptest(deeptest=False):
+            raise AssertionError("deep test used")
+
+        for name, form in (("diskimagetest.mgt", "MGT"),
+                           ("diskimagetest.img", "IMG")):
+            di = disciplefile.DiscipleImage(name)
+            di.isimagevalid = deeptest
+            self.assertEqual(di.guessimageformat(), form)
+
+        # an empty image could be either so is checked in full
+        di = disciplefile.DiscipleImage()
+        di.setbytes([0] * 819200)
+        self.assertEqual(di.guessimageformat(), "MGT")
+
+        # an image that can't be worked out is only guessed at once
+        di.setbytes([1] * 819200)
+        self.assertEqual(di.getsectorposition(4, 1), 40 * 512)
+        di.isimagevalid = deeptest
+        di.guessimageformat = deeptest
+        self.assertEqual(di.getsectorposition(4, 1), 40 * 512)
+
     def test_getsectorposition(self):
         di = disciplefile.DiscipleImage("diskimagetest.mgt")
         self.assertRaises(spectrumtranslate.SpectrumTranslateError,
@@ -644,6 +682,48 @@ class TestDiscipleImage(unittest.TestCase):
         self.assertEqual(diff[1], [129, 10, bytearray([2] * 512),
                                    bytearray([0] * 512)])
 
+    def test_imagecache(self):
+        class CountingFile(io.BytesIO):
+            mode = "rb+"
+
+            def __init__(self, data):
+                io.BytesIO.__init__(self, data)
+                self.reads = []
+                self.writes = []
+
+            def read(self, size=-1):
+                self.reads += [(self.tell(), size)]
+                return io.BytesIO.read(self, size)
+
+            def write(self, data):
+                self.writes += [(self.tell(), len(data))]
+                return io.BytesIO.write(self, data)
+
+        imagefile = CountingFile(_getfileasbytes("diskimagetest.mgt"))
+        di = disciplefile.DiscipleImage()
+        di.setfile(imagefile, "MGT")
+
+        # the whole image is read once however many sectors are needed
+        files = [df.getfiledata() for df in di.iteratedisciplefiles()]
+        self.assertEqual(files[0], _getfileasbytes("basictest.dat"))
+        self.assertEqual(imagefile.reads, [(0, 819200)])
+
+        # a file's sectors are saved together once it's all written
+        di.writecodefile(bytearray(2000), "code", codestartaddress=0x8000)
+        self.assertEqual(imagefile.reads, [(0, 819200)])
+        self.assertEqual(imagefile.writes, [(1024, 512), (55296, 1024),
+                                            (61440, 1024)])
+
+        # the file holds the same as writing to an image in memory
+        di2 = disciplefile.DiscipleImage()
+        di2.setbytes(_getfileasbytes("diskimagetest.mgt"), "MGT")
+        di2.writecodefile(bytearray(2000), "code", codestartaddress=0x8000)
+        self.assertEqual(imagefile.getvalue(), di2.bytedata)
+
+        # changing the source drops the copy in memory
+        di.setfile(CountingFile(bytes(819200)), "MGT")
+        self.assertEqual(di.getsector(0, 1), bytearray(512))
+
     def test_deleteentry(self):
         # create memory copy to play with
         di = disciplefile.DiscipleImage()
@@ -732,6 +812,32 @@ with the error: Contains invalid filetype."))
         self.assertEqual(di.isimagevalid(False), (False, 'Contains file \
 (number 1) with the error: Contains invalid filetype.'))
 
+    def test_imagecheckforfaults(self):
+        di = disciplefile.DiscipleImage()
+        di.setbytes(_getfileasbytes("diskimagetest.mgt"), "MGT")
+        self.assertEqual(di.checkforfaults(), {})
+
+        # give file 2 the sector of file 1 as well as it's own, and
+        # break the chain of file 3
+        sector = di.getsector(0, 1)
+        sector[256 + 15] |= 1
+        di.writesector(sector, 0, 1)
+        di.writesector([0] * 510 + [4, 6], 4, 3)
+        faults = ["File Allocation Table overlaps with other file(s)",
+                  "Number of sectors do not match number of sectors in FAT",
+                  "Wrong length for number of sectors used",
+                  "Mismatch between details and sector chain",
+                  "Incorect FAT table"]
+        faults = {1: faults, 2: faults,
+                  3: ["Using sector not owned by this file"] + faults[3:]}
+        self.assertEqual(di.checkforfaults(), faults)
+        self.assertEqual(di.checkforfaults(True), {1: faults[1][:1]})
+
+        # each file gets the same faults as checking it on it's own
+        for entry in range(1, 81):
+            self.assertEqual(disciplefile.DiscipleFile(
+                di, entry).checkforfaults(), faults.get(entry))
+
     def test_writefile(self):
         di = disciplefile.DiscipleImage()
         # test write wrong header size
@@ -797,6 +903,34 @@ with the error: Contains invalid filetype."))
         self.assertRaises(spectrumtranslate.SpectrumTranslateError,
                           di.writefile, [0] * 256, [0] * 600, -1)
 
+    def test_writefiles(self):
+        di = disciplefile.DiscipleImage()
+        di.setbytes(_getfileasbytes("diskimagetest.mgt"), "MGT")
+        header = bytearray(1) + b"file      " + bytearray(245)
+        header[0] = 8
+        di.writefiles([(header, [1] * 510), (header, [2] * 1020, 10)])
+        self.assertEqual(di.getsector(0, 3)[:11], header[:11])
+        self.assertEqual(di.getsector(0, 5)[256:267], header[:11])
+        self.assertEqual(disciplefile.DiscipleFile(di, 10).getfiledata(),
+                         bytearray([2] * 1020))
+        self.assertEqual(di.checkforfaults(), {})
+
+        # new files go in the first gap big enough to hold them
+        di.deleteentry(5)
+        di.writefiles([(header, [3] * 1020)])
+        self.assertEqual(di.getsector(0, 3)[13:15], bytearray([6, 2]))
+        di.writefiles([(header, [4] * 510)])
+        self.assertEqual(di.getsector(0, 3)[256 + 13:256 + 15],
+                         bytearray([5, 9]))
+
+        # nothing is changed if any file can't be written
+        imagedata = bytearray(di.bytedata)
+        self.assertRaises(spectrumtranslate.SpectrumTranslateError,
+                          di.writefiles, [(header, [5] * 510),
+                                          (header, [5] * 800000)])
+        self.assertEqual(di.bytedata, imagedata)
+        self.assertEqual(di.fileindexfromname("file"), [5, 6, 10])
+
     def test_fileindexfromname(self):
         di = disciplefile.DiscipleImage("diskimagetest.mgt")
         self.assertEqual(di.fileindexfromname("BASIC test"), [1])
@@ -806,6 +940,34 @@ with the error: Contains invalid filetype."))
                          list(range(5, 81)))
         self.assertEqual(di.fileindexfromname("not exist"), [])
 
+    def test_directoryindex(self):
+        di = disciplefile.DiscipleImage()
+        di.setbytes(_getfileasbytes("diskimagetest.mgt"), "MGT")
+        df = disciplefile.DiscipleFile(di, 1)
+        self.assertEqual(df.getfilename(), "BASIC test")
+        self.assertEqual(df.getfiletype(), 1)
+        self.assertEqual(df.getsectorsused(), 1)
+        self.assertEqual(df.getfilelength(), 190)
+
+        # index is kept up to date as the directory is changed
+        directory = di._getdirectoryindex()
+        di.writesector([1] * 512, 4, 1)
+        di.writecodefile([1] * 600, "code")
+        self.assertIs(di._getdirectoryindex(), directory)
+        self.assertEqual(di.fileindexfromname("code"), [5])
+        self.assertEqual(directory.owners.count(1), 20)
+        self.assertEqual(disciplefile.DiscipleFile(di, 5).getfilelength(),
+                         600)
+        di.deleteentry(1)
+        self.assertEqual(df.getfiletype(), 0)
+        self.assertEqual(di.fileindexfromname("BASIC test", True), [1])
+
+        # as is changing the format of the image
+        directory = di._getdirectoryindex()
+        di.setimageformat("IMG")
+        self.assertIsNot(di._getdirectoryindex(), directory)
+        self.assertEqual(di._getdirectoryindex().imageformat, "IMG")
+
     def test_writebasicfile(self):
         di = disciplefile.DiscipleImage()
         di.setbytes([0] * 819200)
@@ -1476,6 +1638,8 @@ Wrong length for number of sectors used. Invalid first sector.
 
 In IMG format, the errors were:
 Contains file (number 1) with the error: Contains invalid filetype.
+Contains file (number 4) with the error: Mismatch between details and sector \
+chain.
 """)
         # tidy up
         os.remove("temp.img")
@@ -0,0 +1,530 @@
+#!/usr/bin/python
+#
+# This file is part of the SpectrumTranslate python module.
+#
+# It's licenced under GPL version 3 (www.gnu.org/licenses/gpl.html) with
+# a few extra stipulations:
+# 1) These first lines in this file as far as the line with the date
+# needs to be left in so anyone who gets a copy of this file has access
+# to the licence, extra stipulations, and disclaimors.
+# 2) If this code is used as part of another project, I'd apreciate a
+# mention in that project's documentation.
+# 3) If you improve on any of the routines, I'd be most grateful if you
+# would pass them back to me so that I can have the option to
+# incorporate them into the origional module with apropriate attribution
+# under this licence and stipulations.
+#
+# A copy of the licence and stipulations is bundled with the source
+# files as licence.txt, or you can go to the GNU website for the terms
+# of the GPL licence.
+#
+# If you try hard enough, I'm sure someone could damage something
+# (software, data, system, hardware) useing it.  I've put a lot of time
+# and effort into this software, and have removed any obvious bugs, but
+# nothing is perfect.  If you spot any flaws, please let me know so that
+# I might be able to fix them.  However I reserve the right not to fix
+# flaws that I don't have the time, or resources to fix, or that I feel
+# that fixing would detriment the software overall.  By useing this
+# software you accept this, and any potential risk to your own hardware,
+# software, data, and/or physical and mental health.  This software is
+# provided "as is" and any express or implied warranties, including, but
+# not limited to, the implied warranties of merchantability and fitness
+# for a particular purpose are disclaimed.  In no event shall I or any
+# contributors be liable for any direct, indirect, incidental, special,
+# exemplary, or consequential damages (including, but not limited to,
+# procurement of substitute goods or services; loss of use, data, or
+# profits; or business interruption) however caused and on any theory of
+# liability, whether in contract, strict liability, or tort (including
+# negligence or otherwise) arising in any way out of the use of this
+# software, even if advised of the possibility of such damage.  By using
+# this software you agree to these terms.
+#
+# Author: william.fraser@virgin.net
+# Date: 17th October 2026
+
+"""
+Unit Test for spectrumscan file
+"""
+
+
+import unittest
+import sys
+import os
+import csv
+import hashlib
+import json
+import pycodestyle
+import shutil
+import tempfile
+from io import StringIO
+# import modules from parent directory
+import addparentmodules
+import spectrumscan
+import spectrumtape
+import spectrumtranslate
+
+
+# change to current directory in case being run from elsewhere
+os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _getfileasbytes(name):
+    with open(name, 'rb') as infile:
+        return infile.read()
+
+
+def _gethash(name):
+    with open(name, 'rb') as infile:
+        return hashlib.sha256(infile.read()).hexdigest()
+
+
+class Testscanning(unittest.TestCase):
+    def setUp(self):
+        # a directory tree of archives and other files
+        self.tempdir = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.tempdir, "b"))
+        os.mkdir(os.path.join(self.tempdir, "a"))
+        shutil.copy("basictest.tap", os.path.join(self.tempdir, "b"))
+        shutil.copy("test.tzx", os.path.join(self.tempdir, "a", "TEST.TZX"))
+        shutil.copy("diskimagetest.mgt", self.tempdir)
+        shutil.copy("code.dat", self.tempdir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_findarchives(self):
+        self.assertEqual(list(spectrumscan.findarchives([self.tempdir,
+                                                         "code.dat"])),
+                         [os.path.join(self.tempdir, "diskimagetest.mgt"),
+                          os.path.join(self.tempdir, "a", "TEST.TZX"),
+                          os.path.join(self.tempdir, "b", "basictest.tap"),
+                          "code.dat"])
+
+    def test_scanarchive(self):
+        result = spectrumscan.scanarchive("basictest.tap")
+        self.assertEqual(result["format"], "Tap")
+        self.assertEqual(result["size"], os.path.getsize("basictest.tap"))
+        self.assertIsNone(result["error"])
+        self.assertEqual(result["rows"], [
+            {"archive": "basictest.tap", "format": "Tap", "index": 0,
+             "name": "BASIC     ", "type": "Program", "length": 190,
+             "autostart": None, "codestart": None, "checksum": "ok",
+             "sha256": _gethash("basictest.dat"), "error": None}])
+
+        # headers are paired with the next data block
+        result = spectrumscan.scanarchive("test.tzx")
+        self.assertEqual([(row["index"], row["name"], row["length"],
+                           row["codestart"]) for row in result["rows"]],
+                         [(1, "SCREENTEST", 6912, 16384),
+                          (5, "JPSP      ", 6912, 16384),
+                          (8, "JPSP      ", 6912, 16384)])
+        self.assertEqual(result["rows"][0]["sha256"],
+                         _gethash("screentest.dat"))
+        self.assertIsNone(result["rows"][1]["sha256"])
+
+        result = spectrumscan.scanarchive("diskimagetest.mgt")
+        self.assertEqual(result["format"], "MGT")
+        self.assertEqual([(row["index"], row["type"], row["sha256"]) for row
+                          in result["rows"]],
+                         [(1, "Basic", _gethash("basictest.dat")),
+                          (2, "String Array", _gethash("arraytest_char.dat")),
+                          (3, "Number Array",
+                           _gethash("arraytest_number.dat")),
+                          (4, "SCREEN$", _gethash("screentest.dat"))])
+
+        # headerless blocks and bad checksums
+        name = os.path.join(self.tempdir, "bad")
+        with open(name, "wb") as f:
+            f.write(b"ZXTape!\x1a\x01\x14\x10\x00\x00\x05\x00\xff\x01\x02\
+\x03\x00")
+
+        result = spectrumscan.scanarchive(name)
+        self.assertEqual(result["format"], "Tzx")
+        self.assertEqual([(row["type"], row["length"], row["checksum"]) for
+                          row in result["rows"]],
+                         [("Headerless", 3, "bad")])
+
+        # files after a bad checksum in a tap are still read
+        data = bytearray(_getfileasbytes("basictest.tap") +
+                         _getfileasbytes("screentest.tap"))
+        data[30] ^= 0xFF
+        name = os.path.join(self.tempdir, "bad.tap")
+        with open(name, "wb") as f:
+            f.write(data)
+
+        result = spectrumscan.scanarchive(name)
+        self.assertEqual(result["format"], "Tap")
+        self.assertEqual([(row["type"], row["checksum"]) for row in
+                          result["rows"]],
+                         [("Program", "bad"), ("Bytes", "ok")])
+
+        # errors are reported in a row rather than raised
+        for name, error in [("code.dat", "Not a recognised tape or disk \
+image."), ("diskimagetest.tap", "Not a valid tap or tzx file."),
+                            ("missing.tap", "[Errno 2] No such file or \
+directory: 'missing.tap'")]:
+            if name == "diskimagetest.tap":
+                name = os.path.join(self.tempdir, name)
+                shutil.copy("diskimagetest.mgt", name)
+
+            result = spectrumscan.scanarchive(name)
+            self.assertEqual(result["error"], error)
+            self.assertEqual(result["rows"][-1]["error"], error)
+
+        # rows read before a tape turns out to be corrupt are kept
+        name = os.path.join(self.tempdir, "short.tzx")
+        with open("test.tzx", "rb") as infile, open(name, "wb") as f:
+            f.write(infile.read()[:200])
+
+        result = spectrumscan.scanarchive(name)
+        self.assertEqual(result["error"], "Corrupt TZX Turbo Speed Data Block")
+        self.assertEqual([(row["index"], row["name"], row["error"]) for row in
+                          result["rows"]],
+                         [(1, "SCREENTEST", None),
+                          (None, None, "Corrupt TZX Turbo Speed Data Block")])
+
+    def test_scanarchives(self):
+        results = list(spectrumscan.scanarchives([self.tempdir], 1))
+        self.assertEqual([(result["format"], len(result["rows"])) for result
+                          in results], [("MGT", 4), ("Tzx", 3), ("Tap", 1)])
+        self.assertEqual(list(spectrumscan.scanarchives([self.tempdir], 2)),
+                         results)
+
+    def test_writecatalogue(self):
+        results = list(spectrumscan.scanarchives([self.tempdir, "code.dat"],
+                                                 1))
+        f = StringIO()
+        self.assertEqual(spectrumscan.writecatalogue(results, f),
+                         (4, 9, 1, sum(os.path.getsize(name) for name in
+                                       ["diskimagetest.mgt", "test.tzx",
+                                        "basictest.tap", "code.dat"])))
+        rows = [json.loads(line) for line in f.getvalue().splitlines()]
+        self.assertEqual(rows, [row for result in results for row in
+                                result["rows"]])
+
+        f = StringIO()
+        spectrumscan.writecatalogue(results, f, "csv")
+        rows = list(csv.DictReader(StringIO(f.getvalue())))
+        self.assertEqual(len(rows), 9)
+        self.assertEqual(rows[0]["name"], "BASIC test")
+        self.assertEqual(rows[0]["codestart"], "")
+        self.assertEqual(rows[3]["codestart"], "16384")
+
+        self.assertRaises(spectrumtranslate.SpectrumTranslateError,
+                          spectrumscan.writecatalogue, results, f, "xml")
+
+
+class TestArchiveCatalogue(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.tempdir, "sub"))
+        for name in ["basictest.tap", "screentest.tap", "test.tzx",
+                     "diskimagetest.mgt"]:
+            shutil.copy(name, self.tempdir)
+
+        shutil.copy("basictest.tap", os.path.join(self.tempdir, "sub"))
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_update(self):
+        with spectrumscan.ArchiveCatalogue() as catalogue:
+            self.assertEqual(catalogue.update([self.tempdir], 1), (5, 0, 0))
+            # only changed archives are scanned again
+            self.assertEqual(catalogue.update([self.tempdir], 1), (0, 5, 0))
+            name = os.path.join(self.tempdir, "basictest.tap")
+            self.assertEqual(catalogue.getrows(name),
+                             spectrumscan.scanarchive(name)["rows"])
+            os.utime(name, ns=(0, 0))
+            shutil.copy("arraytest_char.tap",
+                        os.path.join(self.tempdir, "screentest.tap"))
+            os.remove(os.path.join(self.tempdir, "sub", "basictest.tap"))
+            self.assertEqual(catalogue.update([self.tempdir], 1), (2, 2, 1))
+            self.assertEqual(catalogue.getrows(name),
+                             spectrumscan.scanarchive(name)["rows"])
+            self.assertEqual([row["name"] for row in catalogue.getrows(
+                os.path.join(self.tempdir, "screentest.tap"))],
+                             ["c         "])
+            self.assertEqual(len(catalogue.getrows()), 9)
+
+            # updating one archive leaves the others alone
+            self.assertEqual(catalogue.update([name], 1), (0, 1, 0))
+            self.assertEqual(len(catalogue.getrows()), 9)
+
+    def test_find(self):
+        with spectrumscan.ArchiveCatalogue() as catalogue:
+            catalogue.update([self.tempdir], 1)
+            self.assertEqual([(os.path.basename(row["archive"]), row["index"])
+                              for row in catalogue.findfiles(
+                                  codestart=0x4000)],
+                             [("diskimagetest.mgt", 4),
+                              ("screentest.tap", 0), ("test.tzx", 1),
+                              ("test.tzx", 5), ("test.tzx", 8)])
+            self.assertEqual(len(catalogue.findfiles(format="Tzx",
+                                                     sha256=None)), 2)
+            self.assertEqual(catalogue.findfiles(autostart=True), [])
+            self.assertRaises(spectrumtranslate.SpectrumTranslateError,
+                              catalogue.findfiles, wrong=1)
+
+            duplicates = catalogue.findduplicates()
+            self.assertEqual([[(os.path.relpath(row["archive"], self.tempdir),
+                                row["index"]) for row in group] for group in
+                              duplicates],
+                             [[("basictest.tap", 0),
+                               ("diskimagetest.mgt", 1),
+                               (os.path.join("sub", "basictest.tap"), 0)],
+                              [("diskimagetest.mgt", 4),
+                               ("screentest.tap", 0), ("test.tzx", 1)]])
+            self.assertEqual(duplicates[0][0]["sha256"],
+                             _gethash("basictest.dat"))
+
+
+class TestPayloadStore(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.tempdir, "archives"))
+        for name in ["basictest.tap", "screentest.tap", "diskimagetest.mgt",
+                     "diskimagetest.img"]:
+            shutil.copy(name, os.path.join(self.tempdir, "archives"))
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_add(self):
+        for compress in (False, True):
+            store = spectrumscan.PayloadStore(
+                os.path.join(self.tempdir, str(compress)), compress)
+            sha256 = hashlib.sha256(b"test").hexdigest()
+            self.assertNotIn(sha256, store)
+            self.assertEqual(store.add(b"test"), (sha256, True))
+            self.assertEqual(store.add(bytearray(b"test")), (sha256, False))
+            self.assertIn(sha256, store)
+            self.assertEqual(store.get(sha256), b"test")
+            self.assertTrue(os.path.isfile(store.getpath(
+                sha256, ".z" if compress else "")))
+            self.assertEqual(os.path.dirname(store.getpath(sha256)),
+                             os.path.join(self.tempdir, str(compress),
+                                          sha256[:2], sha256[2:4]))
+
+        self.assertRaises(spectrumtranslate.SpectrumTranslateError,
+                          store.get, hashlib.sha256(b"").hexdigest())
+
+    def test_gettranslation(self):
+        store = spectrumscan.PayloadStore(self.tempdir)
+        sha256, added = store.add(b"\x01\x02")
+        calls = []
+
+        def translate(data):
+            calls.append(data)
+            return bytearray(reversed(data))
+
+        # translations are only made once
+        for i in range(2):
+            self.assertEqual(store.gettranslation(sha256, "reverse",
+                                                  translate), b"\x02\x01")
+            self.assertEqual(store.gettranslation(sha256, "text",
+                                                  lambda data: "text"),
+                             "text")
+
+        self.assertEqual(calls, [b"\x01\x02"])
+        self.assertRaises(spectrumtranslate.SpectrumTranslateError,
+                          store.gettranslation, sha256, "a/b", translate)
+
+        with open("basictest.dat", "rb") as f:
+            sha256, added = store.add(f.read())
+
+        self.assertEqual(store.getbasiclisting(sha256),
+                         spectrumtranslate.basictotext(store.get(sha256)))
+        self.assertTrue(os.path.isfile(store.getpath(sha256,
+                                                     ".basic-1_-1.txt")))
+
+    def test_storearchives(self):
+        store = spectrumscan.PayloadStore(os.path.join(self.tempdir,
+                                                       "store"), True)
+        results = list(spectrumscan.storearchives(
+            [os.path.join(self.tempdir, "archives")], store, 1))
+        # the disk images hold the same files as the tap files so only
+        # the tape headers and the arrays are new after the first archive
+        self.assertEqual([result["added"] for result in results],
+                         [2, 3, 0, 1])
+        self.assertEqual([(row["index"], row["name"], row["type"],
+                           row["length"]) for row in results[0]["rows"]],
+                         [(0, "BASIC     ", "Header", 17),
+                          (1, None, "Data", 190)])
+        self.assertEqual(store.get(results[0]["rows"][0]["sha256"]),
+                         _getfileasbytes("basictest.tap")[3:20])
+        self.assertEqual([row["sha256"] for row in results[1]["rows"]],
+                         [row["sha256"] for row in results[2]["rows"]])
+        self.assertEqual(results[1]["rows"][0]["sha256"],
+                         _gethash("basictest.dat"))
+        self.assertEqual(results[3]["rows"][1]["sha256"],
+                         _gethash("screentest.dat"))
+        self.assertEqual(list(spectrumscan.storearchives(
+            [os.path.join(self.tempdir, "archives")], store, 2)),
+                         [dict(result, added=0) for result in results])
+
+
+class Testformating(unittest.TestCase):
+    class Mystdout(StringIO):
+        # a class to mimic the buffer behaviour of stdout
+        class bufferemulator:
+            def __init__(self):
+                self.bytedata = bytearray()
+
+            def write(self, data):
+                self.bytedata += data
+
+        def __init__(self):
+            StringIO.__init__(self)
+            self.buffer = Testformating.Mystdout.bufferemulator()
+
+    def runpycodestyle(self, py_file, stdoutignore):
+        saved_output = sys.stdout
+        output = Testformating.Mystdout()
+        sys.stdout = output
+        try:
+            style = pycodestyle.StyleGuide()
+            result = style.check_files([py_file])
+
+        finally:
+            sys.stdout = saved_output
+
+        output = output.getvalue()
+
+        output = output.splitlines()
+        if len(output) > 0 and isinstance(output[0], bytes):
+            output = [x.decode("utf-8") for x in output]
+        if stdoutignore:
+            output = [x for x in output if x not in stdoutignore]
+
+        return "\n".join(output)
+
+    def test_pep8(self):
+        output = self.runpycodestyle("../spectrumscan.py", [])
+        self.assertEqual(output, "", "../spectrumscan.py pep8 formatting \
+errors:\n" + output)
+
+        output = self.runpycodestyle("test_spectrumscan.py", [])
+        self.assertEqual(output, "", "test_spectrumscan.py pep8 \
+formatting errors:\n" + output)
+
+
+class Testcommandline(unittest.TestCase):
+    def runtest(self, command):
+        saved_output = sys.stdout
+        saved_error = sys.stderr
+        output = StringIO()
+        sys.stdout = output
+        sys.stderr = StringIO()
+        try:
+            spectrumscan._commandline(["x.py"] + command.split())
+
+        finally:
+            sys.stdout = saved_output
+            sys.stderr = saved_error
+
+        return output.getvalue()
+
+    def setUp(self):
+        # tidy up
+        for name in ["temp.txt", "temp.db"]:
+            try:
+                os.remove(name)
+            except FileNotFoundError:
+                pass
+
+    def tearDown(self):
+        self.setUp()
+
+    def test_help(self):
+        self.assertEqual(self.runtest(""), spectrumscan.usage())
+        self.assertEqual(self.runtest("help"), spectrumscan.usage())
+
+    def test_scan(self):
+        self.assertEqual(self.runtest("scan -w 1 basictest.tap"),
+                         json.dumps(spectrumscan.scanarchive(
+                             "basictest.tap")["rows"][0]) + "\n")
+
+        self.assertEqual(self.runtest("scan --csv -q --output temp.txt \
+basictest.tap diskimagetest.mgt"), "")
+        with open("temp.txt", "r", newline="") as f:
+            rows = list(csv.DictReader(f))
+
+        self.assertEqual([row["name"] for row in rows],
+                         ["BASIC     ", "BASIC test", "Array C   ",
+                          "Array X   ", "Screen    "])
+
+    def test_catalogue(self):
+        self.assertEqual(self.runtest("update -w 1 temp.db basictest.tap \
+diskimagetest.mgt"), "")
+        self.assertEqual(self.runtest("find --duplicates --csv -q temp.db"),
+                         """archive,format,index,name,type,length,autostart,\
+codestart,checksum,sha256,error
+{0},Tap,0,BASIC     ,Program,190,,,ok,{1},
+{2},MGT,1,BASIC test,Basic,190,,,ok,{1},
+""".format(os.path.abspath("basictest.tap"), _gethash("basictest.dat"),
+           os.path.abspath("diskimagetest.mgt")))
+        self.assertEqual(len(self.runtest("find --codestart 0x4000 \
+temp.db").splitlines()), 1)
+
+    def test_store(self):
+        tempdir = tempfile.mkdtemp()
+        try:
+            rows = [json.loads(line) for line in self.runtest(
+                "store -w 1 --compress {} basictest.tap".format(
+                    tempdir)).splitlines()]
+            self.assertEqual([row["sha256"] for row in rows],
+                             [hashlib.sha256(_getfileasbytes(
+                                 "basictest.tap")[3:20]).hexdigest(),
+                              _gethash("basictest.dat")])
+            self.assertEqual(spectrumscan.PayloadStore(tempdir).get(
+                rows[1]["sha256"]), _getfileasbytes("basictest.dat"))
+
+        finally:
+            shutil.rmtree(tempdir)
+
+    def checkinvalidcommand(self, command, message):
+        try:
+            spectrumscan._commandline(["x.py"] + command.split())
+            self.fail("No SpectrumTranslateError raised")
+        except spectrumtranslate.SpectrumTranslateError as se:
+            if se.value == message:
+                return
+            self.fail("Wrong exception message. Got:\n{}\nExpected:\n{}".
+                      format(se.value, message))
+
+    def test_invalidcommands(self):
+        # incorrect command
+        self.checkinvalidcommand("hello", "No command (scan, update, find, \
+store, or help) specified as first argument.")
+        # multiple actions
+        self.checkinvalidcommand("scan help", "Can't have multiple commands.")
+        # nothing to scan
+        self.checkinvalidcommand("scan --csv", "No files or directories \
+specified to scan.")
+        # invalid workers
+        self.checkinvalidcommand("scan -w 0 .",
+                                 "0 is not a valid number of workers.")
+        self.checkinvalidcommand("scan -w", " is not a valid number of \
+workers.")
+        # no output file
+        self.checkinvalidcommand("scan --output", "No output file \
+specified.")
+        # no catalogue
+        self.checkinvalidcommand("find --autostart",
+                                 "No catalogue file specified.")
+        self.checkinvalidcommand("update temp.db", "No files or directories \
+specified to scan.")
+        self.checkinvalidcommand("store", "No store directory specified.")
+        # invalid find values
+        self.checkinvalidcommand("find --codestart x temp.db",
+                                 "x is not a valid code start address.")
+        self.checkinvalidcommand("find --type",
+                                 "No value specified for --type.")
+        # invalid flag
+        self.checkinvalidcommand("scan --wrong .",
+                                 "--wrong is not a recognised flag.")
+
+
+if __name__ == "__main__":
+    unittest.main()
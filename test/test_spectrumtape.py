@@ -51,7 +51,9 @@ import unittest
 import sys
 import os
 import pycodestyle
-from io import StringIO
+import wave
+import zlib
+from io import BytesIO, StringIO
 # import modules from parent directory
 import addparentmodules
 import spectrumtape
@@ -78,6 +80,7 @@ class Testutilityfunctions(unittest.TestCase):
         self.assertTrue(spectrumtape._bytesarevalid(bytearray(b"Test")))
         self.assertTrue(spectrumtape._bytesarevalid([1, 2]))
         self.assertTrue(spectrumtape._bytesarevalid((1, 2)))
+        self.assertTrue(spectrumtape._bytesarevalid(memoryview(b"Test")))
 
         self.assertFalse(spectrumtape._bytesarevalid("Wrong"))
         self.assertFalse(spectrumtape._bytesarevalid([1, 'X']))
@@ -91,6 +94,27 @@ class Testutilityfunctions(unittest.TestCase):
         with open("basictest.tap", 'rb') as f:
             self.assertTrue(spectrumtape._sourceisvalid(f))
 
+    def test_getchecksum(self):
+        for length in (0, 1, 31, 32, 33, 255, 4097):
+            data = bytes((i * 7 + length) & 0xFF for i in range(length))
+            k = 0
+            for i in data:
+                k ^= i
+
+            self.assertEqual(spectrumtape._getchecksum(data), k)
+            self.assertEqual(spectrumtape._getchecksum(bytearray(data)), k)
+            self.assertEqual(spectrumtape._getchecksum(memoryview(data)), k)
+            self.assertEqual(spectrumtape._getchecksum(list(data)), k)
+
+        # check without numpy
+        numpy = spectrumtape.numpy
+        spectrumtape.numpy = None
+        try:
+            self.assertEqual(spectrumtape._getchecksum(bytes(range(256)) +
+                                                       b'\x01'), 1)
+        finally:
+            spectrumtape.numpy = numpy
+
     def test_validateandpreparebytes_validate(self):
         self.assertRaises(spectrumtranslate.SpectrumTranslateError,
                           spectrumtape._validateandpreparebytes,
@@ -116,6 +140,9 @@ class Testutilityfunctions(unittest.TestCase):
                          b"Test")), bytearray([84, 101, 115, 116]))
         self.assertEqual(spectrumtape._validateandpreparebytes(bytes(
                          b"Test")), bytearray([84, 101, 115, 116]))
+        # memoryviews are not copied
+        view = memoryview(bytearray(b"Test"))
+        self.assertIs(spectrumtape._validateandpreparebytes(view), view)
 
     def test_get_word(self):
         self.assertEqual(spectrumtape._get_word([1, 2, 3]), 0x030201)
@@ -284,6 +311,59 @@ class TestSpectrumTapBlock(unittest.TestCase):
         self.assertEqual(stb.getpackagedforfile(),
                          b'\x05\x00\xff\x01\x02\x03\xff')
 
+    def test_getchecksum(self):
+        stb = spectrumtape.SpectrumTapBlock(flag=255, data=[1, 2, 3])
+        self.assertEqual(stb.getchecksum(), 0xFF)
+        stb.flag = 0
+        self.assertEqual(stb.getchecksum(), 0)
+        # changing data has to give a new checksum
+        stb.data[0] = 5
+        self.assertEqual(stb.getchecksum(), 4)
+        stb.data = bytearray([0x10] * 40)
+        self.assertEqual(stb.getchecksum(), 0)
+        stb.data += b'\x21'
+        self.assertEqual(stb.getchecksum(), 0x21)
+        self.assertEqual(stb.getpackagedforfile()[-1], 0x21)
+        # changing data held from before checksum was got
+        d = stb.data
+        self.assertEqual(stb.getchecksum(), 0x21)
+        d[0] ^= 0xFF
+        self.assertEqual(stb.getchecksum(), 0xDE)
+        # checksum of blocks read from file is remembered
+        stb = [*spectrumtape.nexttapblock(_getfileasbytes("basictest.tap"))][1]
+        checksum = stb.getchecksum()
+        self.assertEqual(stb._datachecksum ^ stb.flag, checksum)
+        stb.data[0] ^= 0xFF
+        self.assertEqual(stb.getchecksum(), checksum ^ 0xFF)
+
+    def test_checksumisvalid(self):
+        self.assertTrue(spectrumtape.SpectrumTapBlock(data=[1]).
+                        checksumisvalid())
+        data = bytearray(_getfileasbytes("basictest.tap"))
+        tb = [*spectrumtape.nexttapblock(data)][0]
+        self.assertEqual(tb.storedChecksum, data[20])
+        self.assertTrue(tb.checksumisvalid())
+        tb.data[0] ^= 1
+        self.assertFalse(tb.checksumisvalid())
+        # bad checksums are only passed over if asked
+        data[20] ^= 1
+        self.assertRaises(IOError, list, spectrumtape.nexttapblock(data))
+        self.assertEqual(spectrumtape.detecttapefiletype(data), "unknown")
+        self.assertEqual(spectrumtape.detecttapefiletype(
+            data, checkchecksums=False), "Tap")
+        filetype, tbs = spectrumtape.getfiletypeandblockiteratorfromsource(
+            data, checkchecksums=False)
+        self.assertEqual([tb.checksumisvalid() for tb in tbs], [False, True])
+        tb = spectrumtape.SpectrumTZXStandardSpeedDataBlock(data=[0xFF, 1, 2,
+                                                                  0xFC])
+        self.assertTrue(tb.checksumisvalid())
+        tb.data[1] = 3
+        self.assertFalse(tb.checksumisvalid())
+        tb.data = bytearray([0xFF])
+        self.assertIsNone(tb.checksumisvalid())
+        self.assertIsNone(spectrumtape.SpectrumTZXPauseOrStopBlock(10).
+                          checksumisvalid())
+
 
 class Testmetafunctions(unittest.TestCase):
     def test_nexttapblock(self):
@@ -321,6 +401,160 @@ class Testmetafunctions(unittest.TestCase):
                                            4, 5, 6, 248])]
         self.assertEqual(len(tbs), 2)
 
+    def test_detecttapefiletype(self):
+        tapdata = _getfileasbytes("basictest.tap")
+        tzxdata = _getfileasbytes("test.tzx")
+
+        self.assertEqual(spectrumtape.detecttapefiletype(tapdata), "Tap")
+        self.assertEqual(spectrumtape.detecttapefiletype(tzxdata), "Tzx")
+        self.assertEqual(spectrumtape.detecttapefiletype([*tapdata]), "Tap")
+        self.assertEqual(spectrumtape.detecttapefiletype(b""), "unknown")
+        self.assertEqual(spectrumtape.detecttapefiletype(b"junk data"),
+                         "unknown")
+        # length chain doesn't end at end of file
+        self.assertEqual(spectrumtape.detecttapefiletype(tapdata[:-1]),
+                         "unknown")
+        self.assertEqual(spectrumtape.detecttapefiletype(tapdata + b"\x00"),
+                         "unknown")
+        # bad checksum in first block
+        baddata = bytearray(tapdata)
+        baddata[5] ^= 1
+        self.assertEqual(spectrumtape.detecttapefiletype(baddata), "unknown")
+        # quick check only looks at first few blocks
+        self.assertEqual(spectrumtape.detecttapefiletype(
+            tapdata * 4 + b"\xFF", True), "Tap")
+        self.assertEqual(spectrumtape.detecttapefiletype(
+            tapdata * 4 + b"\xFF"), "unknown")
+
+        # file position is kept
+        with open("test.tzx", "rb") as f:
+            f.seek(3)
+            self.assertEqual(spectrumtape.detecttapefiletype(f), "unknown")
+            self.assertEqual(f.tell(), 3)
+            f.seek(0)
+            self.assertEqual(spectrumtape.detecttapefiletype(f), "Tzx")
+            self.assertEqual(f.tell(), 0)
+
+            filetype, blocks = \
+                spectrumtape.getfiletypeandblockiteratorfromsource(f)
+            self.assertEqual(filetype, "Tzx")
+            self.assertEqual(next(blocks).blocktype(), "TZX Header")
+
+        filetype, blocks = spectrumtape.getfiletypeandblockiteratorfromsource(
+            tapdata)
+        self.assertEqual(filetype, "Tap")
+        self.assertEqual(len([*blocks]), 2)
+        self.assertEqual(spectrumtape.getfiletypeandblocksfromsource(
+            baddata), ("unknown", []))
+
+    def test_scanblocks(self):
+        # tap file with a large data block
+        data = bytes(range(256)) * 4
+        tapdata = spectrumtape.createcodeheader(
+            "scan", 32768, 1024).getpackagedforfile() + \
+            spectrumtape.createdatablock(data).getpackagedforfile()
+        with open("temp.tap", "wb") as f:
+            f.write(tapdata)
+
+        with open("temp.tap", "rb") as f:
+            filetype, tbs = spectrumtape.getfiletypeandblockindexfromsource(f)
+
+        self.assertEqual(filetype, "Tap")
+        self.assertEqual(len(tbs), 2)
+        # header is small so is read, but data block isn't
+        self.assertTrue(tbs[0].isloaded())
+        self.assertFalse(tbs[1].isloaded())
+        self.assertEqual(tbs[0].getfilename(), "scan      ")
+        self.assertEqual(tbs[1].getdetailslist(), "1\tTAP Block\tData\t\
+Flag:255\tLength:1024")
+        self.assertEqual(str(tbs[1]),
+                         "Tap file block. Flag:255, block length:1024")
+        self.assertEqual(tbs[1].flag, 255)
+        self.assertEqual(tbs[1].getpayloadstartoffset(), 24)
+        self.assertFalse(tbs[1].isloaded())
+        # data is loaded when needed, even though file is closed
+        self.assertEqual(tbs[1].data, data)
+        self.assertTrue(tbs[1].isloaded())
+        self.assertEqual(tbs[1].getpackagedforfile(), tapdata[21:])
+        os.remove("temp.tap")
+
+        # tzx blocks
+        tzxdata = _getfileasbytes("test.tzx")
+        tzxdata += spectrumtape.SpectrumTZXTurboSpeedDataBlock(
+            500, data).getpackagedforfile()
+        tbs = [*spectrumtape.scantzxblocks(tzxdata)]
+        fulltbs = [*spectrumtape.nexttzxblock(tzxdata)]
+        self.assertEqual([tb.getdetailslist() for tb in tbs],
+                         [tb.getdetailslist() for tb in fulltbs])
+        self.assertEqual([str(tb) for tb in tbs], [str(tb) for tb in fulltbs])
+        self.assertFalse(tbs[-1].isloaded())
+        self.assertEqual(tbs[-1].getpayloadlength(), 1022)
+        self.assertEqual(tbs[-1].getpayload(), data[1:-1])
+
+        # invalid files
+        self.assertEqual(spectrumtape.getfiletypeandblockindexfromsource(
+            tapdata[:-1]), ('unknown', []))
+        self.assertRaises(IOError, list,
+                          spectrumtape.scantapblocks(tapdata[:-1]))
+
+    def test_mappedsource(self):
+        tapdata = _getfileasbytes("arraytest_char.tap")
+
+        # test mapped file
+        with open("arraytest_char.tap", "rb") as f:
+            tbs = [*spectrumtape.nexttapblock(f, True)]
+
+        self.assertEqual(len(tbs), 2)
+        self.assertIsInstance(tbs[0]._data, memoryview)
+        self.assertEqual(tbs[0].data, tapdata[3:20])
+        self.assertIsInstance(tbs[0].data, bytearray)
+        self.assertEqual(tbs[0].getfilename(), "c         ")
+        self.assertEqual(tbs[1].flag, 255)
+        self.assertEqual(tbs[1].filePosition, 21)
+        self.assertEqual(tbs[1].getpackagedforfile(), tapdata[21:])
+
+        # changing data shouldn't change file
+        tbs[1].data[0] = 7
+        self.assertEqual(tbs[1].data[0], 7)
+        self.assertEqual(_getfileasbytes("arraytest_char.tap"), tapdata)
+
+        # map is closed when source is done with
+        with open("arraytest_char.tap", "rb") as f:
+            source = spectrumtape.SpectrumTapeSource(f, True)
+            mapping = source.source.obj
+            source.close()
+            self.assertRaises(ValueError, len, mapping)
+
+        # blocks from read only memoryview can be changed
+        tbs = [*spectrumtape.nexttapblock(memoryview(tapdata))]
+        tbs[0].data[0] = 1
+        self.assertEqual(tbs[0].data[0], 1)
+        self.assertIsInstance(tbs[0].getpayload(), bytearray)
+        tzxblock = spectrumtape.SpectrumTZXStandardSpeedDataBlock(
+            data=memoryview(tapdata)[21:])
+        tzxblock.data[0] = 1
+        self.assertEqual(tzxblock.data[0], 1)
+        self.assertIsInstance(tzxblock.getpayload(), bytearray)
+
+        # test memoryview
+        source = spectrumtape.SpectrumTapeSource(memoryview(tapdata))
+        self.assertEqual(source.getword(2), 19)
+        self.assertEqual(source.getbyte(), 0)
+        self.assertEqual(source.getword(2, True), 0x6302)
+        self.assertEqual(source.position, 5)
+        source.position = len(tapdata) - 1
+        self.assertRaises(EOFError, source.getword, 2)
+        self.assertIsNone(source.getbyte())
+
+        # tzx blocks
+        with open("test.tzx", "rb") as f:
+            self.assertEqual(
+                [x.getdetailslist() for x in
+                 spectrumtape.getfiletypeandblocksfromsource(f, True)[1]],
+                [x.getdetailslist() for x in
+                 spectrumtape.getfiletypeandblocksfromsource(
+                     _getfileasbytes("test.tzx"))[1]])
+
     def test_createbasicheader(self):
         tb = spectrumtape.createbasicheader("Hello", 20, 30)
         self.assertEqual(tb.flag, 0)
@@ -372,6 +606,161 @@ class Testmetafunctions(unittest.TestCase):
         self.assertEqual(tb.data, bytearray([3, 83, 99, 114, 101, 101, 110, 32,
                                              32, 32, 32, 0, 27, 0, 64, 0, 0]))
 
+    def test_writetapewav(self):
+        # at 1000 samples a second, each sample is 3500 T states
+        blocks = [spectrumtape.SpectrumTZXPureToneBlock(3500, 7),
+                  spectrumtape.SpectrumTZXPulseSequenceBlock([7000, 3500]),
+                  spectrumtape.SpectrumTZXPauseOrStopBlock(3),
+                  spectrumtape.SpectrumTZXSetSignalLevelBlock(1),
+                  spectrumtape.SpectrumTZXDirectRecordingBlock(3500, 4, 0,
+                                                               [0xB0])]
+        samples = b"\xc0\x40\xc0\x40\xc0\x40\xc0\x40\x40\xc0\x40\x40\x40\
+\xc0\x40\xc0\xc0"
+        self.assertEqual(b"".join(spectrumtape.gettapeaudiosamples(blocks,
+                                                                   1000)),
+                         samples)
+
+        f = BytesIO()
+        self.assertEqual(spectrumtape.writetapewav(blocks, f, 1000), 17)
+        self.assertEqual(f.getvalue(), b"RIFF\x36\x00\x00\x00WAVEfmt \x10\
+\x00\x00\x00\x01\x00\x01\x00\xe8\x03\x00\x00\xe8\x03\x00\x00\x01\x00\x08\
+\x00data\x11\x00\x00\x00" + samples + b"\x00")
+
+        # loops are repeated
+        blocks = [spectrumtape.SpectrumTZXLoopStartBlock(3),
+                  spectrumtape.SpectrumTZXPureToneBlock(3500, 1),
+                  spectrumtape.SpectrumTZXLoopEndBlock()]
+        self.assertEqual(b"".join(spectrumtape.gettapeaudiosamples(blocks,
+                                                                   1000)),
+                         b"\xc0\x40\xc0")
+
+        # tap and standard speed blocks use the rom timings, with 36 one
+        # bits and 116 zero bits in this header
+        tb = spectrumtape.createcodeheader("hello", 32768, 100)
+        length = 2168 * 8063 + 667 + 735 + 1710 * 2 * 36 + 855 * 2 * 116 + \
+            3500000
+        for tb in [tb, spectrumtape.convertblockformat(tb, "Tzx")]:
+            self.assertEqual(sum(len(x) for x in
+                                 spectrumtape.gettapeaudiosamples([tb],
+                                                                  3500000)),
+                             length)
+
+        self.assertRaises(spectrumtranslate.SpectrumTranslateError,
+                          lambda: next(spectrumtape.gettapeaudiosamples([],
+                                                                        0)))
+
+    def test_getblocksfromwav(self):
+        tbs = [spectrumtape.createcodeheader("hello", 32768, 300),
+               spectrumtape.createdatablock(bytes(range(256)) * 2),
+               spectrumtape.SpectrumTZXTurboSpeedDataBlock(
+                   200, bytes(range(100)), 2000, 600, 600, 600, 1200, 1000, 6),
+               spectrumtape.SpectrumTZXDirectRecordingBlock(
+                   79, 8, 0, bytes(range(0, 256, 3)) * 4)]
+        for samplerate, samplewidth in [(44100, 1), (22050, 2)]:
+            f = BytesIO()
+            with wave.open(f, "wb") as w:
+                w.setnchannels(1)
+                w.setsampwidth(samplewidth)
+                w.setframerate(samplerate)
+                for samples in spectrumtape.gettapeaudiosamples(tbs,
+                                                                samplerate):
+                    if samplewidth == 2:
+                        samples = b"".join(b"\x00\x60" if x > 128 else
+                                           b"\x00\xa0" for x in samples)
+                    w.writeframes(samples)
+
+            f.seek(0)
+            blocks = list(spectrumtape.getblocksfromwav(f))
+            self.assertEqual([type(x).__name__ for x in blocks],
+                             ["SpectrumTZXStandardSpeedDataBlock",
+                              "SpectrumTZXStandardSpeedDataBlock",
+                              "SpectrumTZXTurboSpeedDataBlock",
+                              "SpectrumTZXDirectRecordingBlock"])
+            self.assertEqual(blocks[0].getpayload(), tbs[0].data)
+            self.assertEqual(blocks[0].endPause, 1000)
+            self.assertEqual(blocks[1].getpayload(), tbs[1].data)
+            self.assertEqual(blocks[2].data[:-1], tbs[2].data[:-1])
+            self.assertEqual(blocks[2].data[-1], 99 & 0xFC)
+            self.assertEqual(blocks[2].lastByteUsedBits, 6)
+            self.assertEqual(blocks[2].lenPilotTone, 1000)
+            self.assertAlmostEqual(blocks[2].lenZeroPulse, 600, delta=5)
+            self.assertAlmostEqual(blocks[2].lenOnePulse, 1200, delta=5)
+
+        self.assertRaises(spectrumtranslate.SpectrumTranslateError,
+                          spectrumtape.getblocksfromwav,
+                          BytesIO(b"not a wav file"))
+
+    def test_cswpulses(self):
+        # pulses are a byte, or 0 followed by a 4 byte length
+        rle = b"\x03\x00\x10\x27\x00\x00\x02"
+        for compression, data in [(1, rle), (2, zlib.compress(rle))]:
+            tb = spectrumtape.SpectrumTZXCSWRecording(3500, compression, 3, 0,
+                                                      data)
+            self.assertEqual(list(tb.getpulselengths()), [3, 10000, 2])
+            self.assertEqual(list(tb.getpulses()),
+                             [(None, [3000, 10000000, 2000])])
+
+        # long runs of data split across decompression chunks
+        rle = b"\x00\xff\xff\x00\x00\x05" * 20000
+        tb = spectrumtape.SpectrumTZXCSWRecording(7000, 2, 40000, 1,
+                                                  zlib.compress(rle))
+        self.assertEqual(list(tb.getpulselengths()), [0xFFFF, 5] * 20000)
+        self.assertEqual(sum(sum(x[1]) for x in tb.getpulses()),
+                         (0xFFFF + 5) * 20000 * 500 + 3500)
+
+        for compression, data in [(1, b"\x00\x01\x02"), (2, b"junk"),
+                                  (3, b"\x01")]:
+            tb = spectrumtape.SpectrumTZXCSWRecording(3500, compression, 1, 0,
+                                                      data)
+            self.assertRaises(IOError, list, tb.getpulselengths())
+
+    def test_generalizeddatablock(self):
+        # a header saved with rom timings
+        tb = spectrumtape.createcodeheader("hello", 32768, 100)
+        data = bytes(tb.getpackagedforfile()[2:])
+        gb = spectrumtape.SpectrumTZXGeneralizedDataBlock(
+            2, 2, 2, len(data) * 8, 2, 2, [(0, [2168, 0]), (0, [667, 735])],
+            [(0, 8063), (1, 1)], [(0, [855, 855]), (0, [1710, 1710])], data,
+            1000)
+        self.assertEqual(gb.getdecodeddata(), data)
+        self.assertEqual(gb.flag, 0)
+        self.assertTrue(gb.isheader())
+        self.assertFalse(gb.isdatablock())
+        self.assertEqual(gb.getpayload(), tb.data)
+        self.assertEqual(gb.getpayloadlength(), 17)
+        self.assertEqual(list(gb.getdatasymbols())[:16],
+                         [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 1, 1])
+        self.assertEqual(list(spectrumtape.gettapeaudiosamples([gb], 1000)),
+                         list(spectrumtape.gettapeaudiosamples([tb], 1000)))
+
+        # symbols with longer pulses for 0 bits invert the data
+        gb.symbolDefinitionsData.reverse()
+        self.assertEqual(gb.getdecodeddata(), bytes(255 - x for x in data))
+        self.assertEqual(gb.flag, 255)
+        self.assertFalse(gb.isheader())
+
+        # 3 symbols take 2 bits each, and flags set the level
+        gb = spectrumtape.SpectrumTZXGeneralizedDataBlock(
+            0, 0, 0, 5, 2, 3, [], [],
+            [(0, [10, 20]), (1, [30, 0]), (3, [40, 50])], b"\x1b\x40")
+        self.assertEqual(list(gb.getdatasymbols()), [0, 1, 2, 3, 1])
+        self.assertIsNone(gb.getdecodeddata())
+        self.assertRaises(IOError, list, gb.getpulses())
+        gb.dataStreamData = bytearray(b"\x18\x40")
+        self.assertEqual(list(gb.getpulses()),
+                         [(None, [10, 20, 0, 30]), (1, [40, 50]),
+                          (None, [10, 20, 0, 30])])
+
+        # blocks without pilot or data symbols have no tables for them
+        packaged = gb.getpackagedforfile()
+        gb = spectrumtape.gettzxblockfromsource(
+            spectrumtape.SpectrumTapeSource(packaged))
+        self.assertEqual(gb.getpackagedforfile(), packaged)
+        self.assertEqual(gb.symbolDefinitionsPilot, [])
+        self.assertEqual(gb.symbolDefinitionsData,
+                         [(0, [10, 20]), (1, [30, 0]), (3, [40, 50])])
+        self.assertEqual(bytes(gb.dataStreamData), b"\x18\x40")
+
 
 class Testformating(unittest.TestCase):
     class Mystdout(StringIO):
@@ -524,7 +913,8 @@ block type                content information\n\
    5  TZX Pure Data        Header "JPSP      " Bytes 16384,6912\n\
    6  TZX Direct Recording         pause after:500ms\n\
    7  TZX CSW Recording            pause after:2000ms\n\
-   8  TZX Generalized Data         pause after:1000ms\n\
+   8  TZX Generalized Data Header "JPSP      " Bytes 16384,6912 \
+pause after:1000ms\n\
    9  TZX Pause or Stop            Pause 32ms\n\
   10  TZX Group Start              Group Name:Group Test\n\
   11  TZX Group End               \n\
@@ -554,7 +944,8 @@ block 18\n\
 5\tTZX Pure Data\tHeader\tJPSP      \tBytes\t16384\t6912
 6\tTZX Direct Recording\t\tpause after:500ms
 7\tTZX CSW Recording\t\tpause after:2000ms
-8\tTZX Generalized Data\t\tpause after:1000ms
+8\tTZX Generalized Data\tHeader\tJPSP      \tBytes\t16384\t6912\t\
+pause after:1000ms
 9\tTZX Pause or Stop\t\tPause 32ms
 10\tTZX Group Start\t\tGroup Name:Group Test
 11\tTZX Group End\t
@@ -694,6 +1085,38 @@ screentest.dat temp.tap"), b"")
         os.remove("temp.tap")
         os.remove("temp.bin")
 
+    def test_wav(self):
+        self.assertEqual(self.runtest("wav -s 1 screentest.tap temp.wav"),
+                         b"")
+        tbs = spectrumtape.getfiletypeandblocksfromsource(
+            _getfileasbytes("screentest.tap"))[1]
+        with wave.open("temp.wav", "rb") as w:
+            self.assertEqual(w.getnchannels(), 1)
+            self.assertEqual(w.getsampwidth(), 1)
+            self.assertEqual(w.getframerate(), 44100)
+            self.assertEqual(w.readframes(w.getnframes()), b"".join(
+                spectrumtape.gettapeaudiosamples([tbs[1]])))
+
+        # standard output can't seek, so has maximum lengths in header
+        self.assertEqual(self.runtest("wav --samplerate 11025 -i -o",
+                                      _getfileasbytes("screentest.tap"))[:44],
+                         b"RIFF\xfc\xff\xff\xffWAVEfmt \x10\x00\x00\x00\x01\
+\x00\x01\x00\x11\x2b\x00\x00\x11\x2b\x00\x00\x01\x00\x08\x00data\xd8\xff\
+\xff\xff")
+
+        # and back again
+        self.assertEqual(self.runtest("fromwav temp.wav temp.tzx"), b"")
+        self.assertEqual(self.runtest("list -o temp.tzx"),
+                         b"""block type                content information
+   0  TZX Header                  \n\
+   1  TZX Standard Speed   Data   Flag:255, block length:6912 pause \
+after:1000ms
+""")
+
+        # tidy up
+        os.remove("temp.wav")
+        os.remove("temp.tzx")
+
     def checkinvalidcommand(self, command, message):
         try:
             spectrumtape._commandline(["x.py"] + command.split())
@@ -707,7 +1130,7 @@ screentest.dat temp.tap"), b"")
     def test_invalidcommands(self):
         # incorrect command
         self.checkinvalidcommand("hello", "No command (list, extract, delete, \
-copy, create, or help) specified as first argument.")
+copy, create, wav, fromwav, or help) specified as first argument.")
         # multiple actions
         self.checkinvalidcommand("create list",
                                  "Can't have multiple commands.")
@@ -740,6 +1163,11 @@ file to create. Valid options are basic, code, array, screen, and block.")
         # invalid arraytype
         self.checkinvalidcommand("create array --arraytype wrong", "wrong is \
 not a valid array type (must be character, number or string).")
+        # invalid sample rate
+        self.checkinvalidcommand("wav --samplerate wrong in out",
+                                 "wrong is not a valid sample rate.")
+        self.checkinvalidcommand("wav --samplerate 0 in out",
+                                 "sample rate must be more than 0.")
         # invalid argument to -p
         self.checkinvalidcommand("copy -p wrong in out", "wrong is not a \
 valid index for the output file.")
@@ -52,6 +52,8 @@ import subprocess
 import re
 import sys
 import os
+import shutil
+import tempfile
 import pycodestyle
 from PIL import Image
 from io import BytesIO, StringIO
@@ -927,6 +929,49 @@ class TestImageConvert(unittest.TestCase):
         # compare images now
         self.assertEqual(refimage2, self.imageto32bitlist(gifimage))
 
+    def test_getgiffromscreens(self):
+        # get reference images
+        gifdata = _getfileasbytearray("screentest.gif")
+        irReference = Image.open(BytesIO(gifdata))
+        refimage1 = self.imageto32bitlist(irReference)
+        irReference.seek(1)
+        refimage2 = self.imageto32bitlist(irReference)
+
+        screen = _getfileasbytearray("screentest.dat")
+        blank = bytearray(6912)
+
+        # separate images should match single conversions
+        gifs = spectrumtranslate.getgiffromscreens([screen, blank])
+        self.assertEqual(len(gifs), 2)
+        self.assertEqual(gifs[0], spectrumtranslate.getgiffromscreen(screen))
+        self.assertEqual(gifs[1], spectrumtranslate.getgiffromscreen(blank))
+
+        # one animated image with a frame per screen
+        gifscreen = spectrumtranslate.getgiffromscreens(
+            [screen, blank, screen], multiframe=True, framedelay=1000)
+        gifimage = Image.open(BytesIO(gifscreen))
+        self.assertEqual(gifimage.info["duration"], 1000)
+        self.assertEqual(refimage1, self.imageto32bitlist(gifimage))
+        gifimage.seek(1)
+        self.assertEqual([0] * 256 * 192, self.imageto32bitlist(gifimage))
+        gifimage.seek(2)
+        self.assertEqual(refimage1, self.imageto32bitlist(gifimage))
+        self.assertRaises(EOFError, gifimage.seek, 3)
+
+        # flash image frames
+        gifscreen = spectrumtranslate.getgiffromscreens(
+            [screen], -2, True)
+        gifimage = Image.open(BytesIO(gifscreen))
+        self.assertEqual(refimage2, self.imageto32bitlist(gifimage))
+
+        # short screen
+        self.assertRaises(spectrumtranslate.SpectrumTranslateError,
+                          spectrumtranslate.getgiffromscreens,
+                          [screen, screen[:5]])
+        self.assertRaises(spectrumtranslate.SpectrumTranslateError,
+                          spectrumtranslate.getgiffromscreens,
+                          [screen, screen[:5]], multiframe=True)
+
     def test_getrgbfromscreen(self):
         # get reference images
         gifdata = _getfileasbytearray("screentest.gif")
@@ -995,6 +1040,137 @@ class TestImageConvert(unittest.TestCase):
         self.assertEqual(refimage1, gifscreen[0])
         self.assertEqual(refimage2, gifscreen[1])
 
+        # test RGBA bytes
+        gifscreen = spectrumtranslate.getrgbfromscreen(
+            _getfileasbytearray("screentest.dat"), imageformat=2)
+        self.assertEqual(type(gifscreen[0]), bytearray)
+        self.assertEqual(type(gifscreen[1]), bytearray)
+        irReference = Image.open(BytesIO(gifdata))
+        self.assertEqual(irReference.convert("RGBA").tobytes(), gifscreen[0])
+        irReference.seek(1)
+        self.assertEqual(irReference.convert("RGBA").tobytes(), gifscreen[1])
+
+    def test_getindexesfromscreen(self):
+        data = bytearray(6912)
+        # top left byte on 2nd row of pixels
+        data[0x100] = 0x81
+        # bright flashing blue ink on red paper in 2nd attribute
+        data[0x1801] = 0xD1
+        # 9th pixel row is 1st row of pixels for 2nd attribute
+        data[0x21] = 0x40
+
+        indexes = spectrumtranslate.getindexesfromscreen(data)
+        self.assertEqual(type(indexes), bytearray)
+        self.assertEqual(len(indexes), 256 * 192)
+        self.assertEqual(indexes[256:264], bytearray([0, 0, 0, 0, 0, 0,
+                                                      0, 0]))
+        self.assertEqual(indexes[8:16], bytearray([10] * 8))
+        self.assertEqual(indexes[264:272], bytearray([10] * 8))
+        self.assertEqual(indexes[8 * 256 + 8:8 * 256 + 16], bytearray(8))
+
+        data[0x1800] = 0x07
+        indexes = spectrumtranslate.getindexesfromscreen(data)
+        self.assertEqual(indexes[256:264], bytearray([7, 0, 0, 0, 0, 0, 0,
+                                                      7]))
+
+        data[0x101] = 0x40
+        indexes = spectrumtranslate.getindexesfromscreen(data)
+        self.assertEqual(indexes[264:272], bytearray([10, 9, 10, 10, 10, 10,
+                                                      10, 10]))
+        indexes = spectrumtranslate.getindexesfromscreen(data, True)
+        self.assertEqual(indexes[264:272], bytearray([9, 10, 9, 9, 9, 9, 9,
+                                                      9]))
+        self.assertEqual(indexes[256:264], bytearray([7, 0, 0, 0, 0, 0, 0,
+                                                      7]))
+
+        self.assertRaises(spectrumtranslate.SpectrumTranslateError,
+                          spectrumtranslate.getindexesfromscreen, data[:6911])
+
+        # flashing colours swapped from normal image same as decoded
+        screen = _getfileasbytearray("screentest.dat")
+        screen[0x1800:0x1B00] = bytes([(i * 37) & 0xFF for i in range(768)])
+        numpy = spectrumtranslate.numpy
+        try:
+            for spectrumtranslate.numpy in (numpy, None):
+                self.assertEqual(spectrumtranslate._getflashswappedindexes(
+                    screen, spectrumtranslate.getindexesfromscreen(screen)),
+                    spectrumtranslate.getindexesfromscreen(screen, True))
+
+        finally:
+            spectrumtranslate.numpy = numpy
+
+    def test_getpngfromscreen(self):
+        screen = _getfileasbytearray("screentest.dat")
+        rgb = spectrumtranslate.getrgbfromscreen(screen, -1, 2)
+
+        # normal and flashing images
+        for flashswapped in (False, True):
+            im = Image.open(BytesIO(spectrumtranslate.getpngfromscreen(
+                screen, flashswapped=flashswapped)))
+            self.assertEqual(im.size, (256, 192))
+            self.assertEqual(im.convert("RGB").tobytes(),
+                             rgb[1 if flashswapped else 0])
+
+        # scaled with blue border
+        im = Image.open(BytesIO(spectrumtranslate.getpngfromscreen(screen, 3,
+                                                                   1)))
+        self.assertEqual(im.size, (960, 768))
+        im = im.convert("RGB")
+        self.assertEqual(im.getpixel((0, 0)), (0, 0, 0xCD))
+        self.assertEqual(im.getpixel((959, 767)), (0, 0, 0xCD))
+        ref = Image.frombytes("RGB", (256, 192), bytes(rgb[0]))
+        for x, y in ((0, 0), (17, 100), (255, 191)):
+            self.assertEqual(im.getpixel((96 + x * 3 + 2, 96 + y * 3 + 1)),
+                             ref.getpixel((x, y)))
+
+        self.assertRaises(spectrumtranslate.SpectrumTranslateError,
+                          spectrumtranslate.getpngfromscreen, screen, 0)
+        self.assertRaises(spectrumtranslate.SpectrumTranslateError,
+                          spectrumtranslate.getpngfromscreen, screen, 1, 8)
+
+    def test_getppmfromscreen(self):
+        screen = _getfileasbytearray("screentest.dat")
+        rgb = spectrumtranslate.getrgbfromscreen(screen, -1, 2)
+
+        ppm = spectrumtranslate.getppmfromscreen(screen)
+        self.assertEqual(type(ppm), bytearray)
+        self.assertEqual(ppm, b"P6\n256 192\n255\n" + rgb[0])
+
+        ppm = spectrumtranslate.getppmfromscreen(screen, 2, 7, True)
+        self.assertEqual(ppm[:15], b"P6\n640 512\n255\n")
+        self.assertEqual(len(ppm), 15 + 640 * 512 * 3)
+        im = Image.open(BytesIO(ppm))
+        self.assertEqual(im.getpixel((0, 0)), (0xCD, 0xCD, 0xCD))
+        ref = Image.frombytes("RGB", (256, 192), bytes(rgb[1]))
+        self.assertEqual(im.crop((64, 64, 576, 448)).tobytes(),
+                         ref.resize((512, 384), Image.NEAREST).tobytes())
+
+    def test_getrawfromscreen(self):
+        screen = _getfileasbytearray("screentest.dat")
+
+        self.assertEqual(spectrumtranslate.getrawfromscreen(screen),
+                         spectrumtranslate.getindexesfromscreen(screen))
+        self.assertEqual(spectrumtranslate.getrawfromscreen(screen, True),
+                         spectrumtranslate.getrgbfromscreen(screen, 0xFF,
+                                                            2)[0])
+        self.assertEqual(spectrumtranslate.getrawfromscreen(screen, True, -1,
+                                                            flashswapped=True),
+                         spectrumtranslate.getrgbfromscreen(screen, -1, 2)[1])
+
+        # scaled with border
+        indexes = spectrumtranslate.getindexesfromscreen(screen)
+        raw = spectrumtranslate.getrawfromscreen(screen, scale=2, border=3)
+        self.assertEqual(len(raw), 640 * 512)
+        self.assertEqual(raw[:640], bytearray([3] * 640))
+        self.assertEqual(raw[640 * 64:640 * 65], bytearray([3] * 64) +
+                         bytearray(i for i in indexes[:256] for j in (0, 1)) +
+                         bytearray([3] * 64))
+        self.assertEqual(raw[640 * 64:640 * 65], raw[640 * 65:640 * 66])
+
+        self.assertRaises(spectrumtranslate.SpectrumTranslateError,
+                          spectrumtranslate.getrawfromscreen, screen, True,
+                          256)
+
 
 class TestSnapConvert(unittest.TestCase):
     # todo : test snap files once I have snap files to test
@@ -1245,6 +1421,70 @@ data"""
                          (4, ''))
         self.assertEqual(Settings["DATASTRINGPOS"], 2)
 
+    def test_compilecommandblock(self):
+        Settings = {"DATASTRINGPOS": 0,
+                    "NUMBERFORMAT": 0,
+                    "NUMBERSIGNED": 0,
+                    "NUMBERWORDORDER": 0,
+                    "DISPLAYEVERYXLINES": 1,
+                    "ORIGIONALSEPERATOR": "  ",
+                    "SEPERATOR": "  ",
+                    "ORIGIN": 0x4000,
+                    "ADDRESSOUTPUT": 0,
+                    "NUMBEROUTPUT": 0,
+                    "COMMANDOUTPUT": 0,
+                    "XMLOutput": 0,
+                    "HexForNonASCII": 0}
+        data = bytearray([0xEF, 0x01, 0x02, 0x38, 0x00])
+
+        # compiled blocks should give same results as interpreted ones
+        for instructions in ["%( %?EQ%V00%V00 %?BO %?NE%V00%V00 Hello %)",
+                             "%( %?EQ%V00%V00 %?BA %?NE%V00%V00 Hello %)",
+                             "%( %?EQ%V00%V00 %?BX %?NE%V00%V00 Hello %)",
+                             "%(%X0101%V0F%L%(%?NE%MV010038%)%(%X0201%V010001\
+%)%)%B01%I%(%?EQ%V014003%)%( Yes%)%J%( No%)",
+                             "%(%?EQ%MV0F00EF%)% %F0001%W3F4001%S%C81"]:
+            block = spectrumtranslate._compilecommandblock(instructions)
+            self.assertIsNotNone(block)
+            Vars = [0x4000, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0x4000, 0, 0, 0x4000,
+                    0x4004]
+            Settings["DATASTRINGPOS"] = 0
+            result = spectrumtranslate._processcommandblock(
+                instructions, Vars, Settings, data, True, True)
+            Vars2 = [0x4000, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0x4000, 0, 0, 0x4000,
+                     0x4004]
+            self.assertEqual(spectrumtranslate._runcompiledblock(
+                block, instructions, Vars2, Settings, data, True), result)
+            self.assertEqual(Vars2, Vars)
+
+        # things left to _processcommandblock
+        self.assertIsNone(spectrumtranslate._compilecommandblock("%Y"))
+        self.assertIsNone(spectrumtranslate._compilecommandblock(
+            "%PTest()"))
+        self.assertIsNone(spectrumtranslate._compilecommandblock("%(%?EQ"))
+
+        # check can find first byte of pattern
+        self.assertEqual(spectrumtranslate._getpatternfirstbyte(
+            spectrumtranslate._compilecommandblock("%(%?EQ%MV0F00EF%)")),
+            0xEF)
+        self.assertEqual(spectrumtranslate._getpatternfirstbyte(
+            spectrumtranslate._compilecommandblock(
+                spectrumtranslate.getpartsofpatterndatablock(
+                    spectrumtranslate.createfindandcomment(
+                        "%?EQ%MV0F00CD", "Hello", 3, 0))[0])), 0xCD)
+        self.assertIsNone(spectrumtranslate._getpatternfirstbyte(
+            spectrumtranslate._compilecommandblock(
+                "%(%?EQ%MV0F00EF%?BO%?EQ%MV0F00CF%)")))
+
+        # pattern looking past end of data shouldn't stop disassembly
+        self.assertEqual(spectrumtranslate.disassemble(
+            bytearray([0, 0xEF]), 0, 0x4000, 2,
+            [spectrumtranslate.DisassembleInstruction(
+                "Pattern Data Block", 0x4000, 0x4001,
+                "%(%?EQ%MV0F00EF%?BA%?EQ%MV0F0100EF%)%(%)%B0F")]),
+            "ORG #4000\n\n4000  00           NOP\n"
+            "4001  EF           RST 28H\n")
+
     def test_get_custom_format_string(self):
         self.assertEqual(spectrumtranslate.get_custom_format_string(
             spectrumtranslate.DisassembleInstruction.DISASSEMBLE_CODES[
@@ -2448,6 +2688,311 @@ F00A3%)%)%)%?BO%(%?EQ%V000000%?BA%(%?MT%MV0F00A2%?BO%(%?MT%MV0F001F%?BA%?LT%MV\
 
 """)
 
+    def test_decodetable(self):
+        table = spectrumtranslate._Z80_DECODE_TABLE
+        self.assertEqual(table[0x01], ("LD BC,nn", 1198372, 22, 1, 1, 8, 0x01,
+                                       ("nn",)))
+        self.assertEqual(table[0x10][5], 2)
+        self.assertEqual(table[0xCB][0x47][:4], ("BIT 0,A", 1089636, 84, 2))
+        self.assertEqual(table[0xDD][0x36][5:], (17, 0xDD36, ("d", "n")))
+        self.assertEqual(table[0xFD][0xCB][0x06][0], "RLC (IY+d)")
+        self.assertEqual(table[0xFD][0xCB][0x06][3:], (3, 2, 1, 0xFDCB06,
+                                                       ("d",)))
+        self.assertEqual(table[0x22][5], 4)
+        # invalid index codes act as 1 byte NOP, invalid ED as 2 bytes
+        self.assertEqual(table[0xDD][0x00], ("", 0, 1, 1, 2, 0, 0xDD, ()))
+        self.assertEqual(table[0xED][0x00], ("", 0, 1, 2, 2, 0, 0xED00, ()))
+
+    def test_disassembletorecords(self):
+        data = bytearray(b"\x21\x03\x40\xDD\x36\x05\x07\xED\x70\xCD")
+        records = spectrumtranslate.disassembletorecords(data, 0, 0x4000,
+                                                         len(data))
+        self.assertEqual(len(records), 4)
+        self.assertEqual(records[0].address, 0x4000)
+        self.assertEqual(records[0].code, b"\x21\x03\x40")
+        self.assertEqual(records[0].operands, (("nn", 0x4003),))
+        self.assertEqual(records[0].getreferences(), [0x4003])
+        self.assertEqual(records[1].opcode, 0xDD36)
+        self.assertEqual(records[1].operands, (("d", 5), ("n", 7)))
+        self.assertEqual(records[1].getinstruction(), "LD (IX+#05),#07")
+        self.assertTrue(records[2].isundocumented())
+        # incomplete instruction at end is data
+        self.assertEqual(records[3].opcode, None)
+        self.assertEqual(len(records[3]), 1)
+
+        # records output should match disassemble
+        formats = ("Hex", "Decimal", "Octal", "Binary")
+        for a, n, c in ((0, 0, 0), (1, 1, 1), (2, 3, 2)):
+            di = [spectrumtranslate.DisassembleInstruction(
+                "Address Output Format " + formats[a]),
+                spectrumtranslate.DisassembleInstruction(
+                "Number Output Format " + formats[n]),
+                spectrumtranslate.DisassembleInstruction(
+                "Command Output Format " + formats[c])]
+            self.assertEqual(
+                spectrumtranslate.recordstotext(records[:3], a, n, c),
+                spectrumtranslate.disassemble(data, 0, 0x4000, 9, di))
+
+        di = [spectrumtranslate.DisassembleInstruction("XML Output On")]
+        self.assertEqual(
+            spectrumtranslate.recordstotext(records[:3], XMLOutput=1),
+            spectrumtranslate.disassemble(data, 0, 0x4000, 9, di))
+
+        records[0].comment = "test"
+        self.assertEqual(
+            spectrumtranslate.recordstotext(records[:1]), """ORG #4000
+
+4000  21,03,40     LD HL,#4003          ;test
+""")
+
+        # trailing data bytes in each number format
+        records = spectrumtranslate.disassembletorecords(b"\x00\xDD", 0,
+                                                         0x4000, 2)
+        for n, number in enumerate(("#DD", "221", "o335", "b11011101")):
+            self.assertEqual(
+                spectrumtranslate.recordstotext(records, 1, n, 1),
+                """ORG 16384
+
+16384  0                     NOP
+16385    DB  {}
+
+""".format(number))
+            self.assertEqual(
+                spectrumtranslate.recordstotext(records, NumberOutput=n,
+                                                XMLOutput=1).split("\n")[4],
+                "  <line><address>4001</address><instruction>DB"
+                "</instruction><data>{}</data></line>".format(number))
+
+        # matches disassemble for hex
+        self.assertEqual(spectrumtranslate.recordstotext(records),
+                         spectrumtranslate.disassemble(b"\x00\xDD", 0,
+                                                       0x4000, 2))
+
+    def test_referencedaddresses(self):
+        ra = spectrumtranslate.ReferencedAddresses([0x4006])
+        ra.add(0x4000, 0x4008)
+        ra.add(0x4006, 0x4003)
+        ra += [0x5000]
+        self.assertTrue(0x4006 in ra)
+        self.assertFalse(0x4001 in ra)
+        self.assertEqual(list(ra), [0x4000, 0x4006, 0x5000])
+        self.assertEqual(ra.getxref(), [(0x4000, [0x4008]),
+                                        (0x4006, [0x4003]), (0x5000, [])])
+
+        ra2 = spectrumtranslate.ReferencedAddresses(ra)
+        ra2.add(0x4006, 0x4000)
+        self.assertEqual(ra.getxref()[1], (0x4006, [0x4003]))
+        ra |= ra2
+        self.assertEqual(ra.getxref()[1], (0x4006, [0x4000, 0x4003]))
+
+        # get references from disassembly
+        data = b"\x21\x06\x40\xCD\x06\x40\x18\xFE\xC3\x00\x40"
+        ra = spectrumtranslate.ReferencedAddresses()
+        self.assertEqual(
+            spectrumtranslate.disassemble(
+                data, 0, 0x4000, len(data),
+                [spectrumtranslate.DisassembleInstruction(
+                    "Line Numbers Referenced")], referencedaddresses=ra),
+            """ORG #4000
+
+4000  21,06,40     LD HL,#4006
+      CD,06,40     CALL #4006
+4006  18,FE        JR #4006
+
+      C3,00,40     JP #4000
+
+""")
+        self.assertEqual(ra.xreftotext(), "4000  4008\n4006  4000,4003,4006\n")
+        self.assertEqual(
+            spectrumtranslate.getreferencedaddresses(
+                spectrumtranslate.disassembletorecords(
+                    data, 0, 0x4000, len(data))).getxref(),
+            [(0x4000, [0x4008]), (0x4006, [0x4000, 0x4003, 0x4006])])
+
+    def test_disassemble_iter(self):
+        data = b"\x21\x06\x40\xCD\x06\x40\x18\xFE\xC3\x00\x40\xDD"
+        lines = spectrumtranslate.disassemble_iter(
+            data, 0, 0x4000, len(data),
+            [spectrumtranslate.DisassembleInstruction(
+                "Line Numbers Referenced")])
+        # referenced line must have address before it is reached
+        self.assertEqual(next(lines), "ORG #4000")
+        self.assertEqual(list(lines), [
+            "", "4000  21,06,40     LD HL,#4006",
+            "      CD,06,40     CALL #4006", "4006  18,FE        JR #4006", "",
+            "      C3,00,40     JP #4000", "", "400B    DB  #DD", "", ""])
+
+        # should match disassemble
+        di = [["Data Block", 0x4003, 0x4005, "%!DefineByte()"],
+              ["Address Output Format Decimal", 0x4006, 0x4007],
+              ["Line Numbers None"], ["XML Output On"]]
+        for i in range(len(di) + 1):
+            self.assertEqual(
+                "\n".join(spectrumtranslate.disassemble_iter(
+                    data, 0, 0x4000, len(data),
+                    [spectrumtranslate.DisassembleInstruction(*x) for x in
+                     di[:i]])),
+                spectrumtranslate.disassemble(
+                    data, 0, 0x4000, len(data),
+                    [spectrumtranslate.DisassembleInstruction(*x) for x in
+                     di[:i]]))
+
+    def test_disassemblebatch(self):
+        data = b"\x21\x06\x40\xCD\x06\x40\x18\xFE\xC3\x00\x40\x00"
+        jobs = spectrumtranslate.getdisassemblyjobs(
+            data, 0, 0x4000, len(data), 3,
+            [spectrumtranslate.DisassembleInstruction(
+                "Data Block", 0x4003, 0x4004, "%!DefineByte()")])
+        # split at instructions, not in data block
+        self.assertEqual([(job[2], job[3]) for job in jobs],
+                         [(0x4000, 5), (0x4005, 3), (0x4008, 4)])
+        # each job only has it's own bytes
+        self.assertEqual([(bytes(job[0]), job[1]) for job in jobs],
+                         [(data[:8], 0), (data[5:11], 0), (data[8:], 0)])
+
+        progress = []
+        texts, ra = spectrumtranslate.disassemblebatch(
+            jobs, lambda *args: progress.append(args), 2)
+        self.assertEqual(texts, [spectrumtranslate.disassemble(*job[:5]) for
+                                 job in jobs])
+        self.assertEqual(texts[1], """ORG #4005
+
+4005  40           LD B,B
+4006  18,FE        JR #4006
+
+""")
+        self.assertEqual(ra.getxref(), [
+            (0x4000, [0x4008]), (0x4006, [0x4000, 0x4006])])
+        self.assertEqual(progress[-1], ("Done", 3, 3, 12, 12))
+
+        # same in one process
+        self.assertEqual(spectrumtranslate.disassemblebatch(jobs, None, 1)[0],
+                         texts)
+
+        # parts mark lines referenced from other parts as serial
+        # disassembly does
+        data = b"".join([bytes([0xCD, (i * 148) & 0xFF, 0x80, 0]) for i in
+                         range(64)])
+        serial = spectrumtranslate.disassemble(
+            data, 0, 0x8000, len(data),
+            [spectrumtranslate.DisassembleInstruction(
+                "Line Numbers Referenced")])
+        jobs = spectrumtranslate.getdisassemblyjobs(
+            data, 0, 0x8000, len(data), 4,
+            [spectrumtranslate.DisassembleInstruction(
+                "Line Numbers Referenced")])
+        self.assertEqual(len(jobs), 4)
+        for maxworkers in (1, 2):
+            texts, ra = spectrumtranslate.disassemblebatch(jobs, None,
+                                                           maxworkers)
+            # join parts without the ORG at the start of each
+            self.assertEqual(texts[0] + "".join([text.split("\n", 2)[2] for
+                                                 text in texts[1:]]), serial)
+            self.assertEqual(len(ra), 64)
+
+        # 2 byte numbers are only references where they are treated as
+        # such
+        data = b"".join([bytes([0x21 if i & 1 else 0xCD, (i * 148) & 0xFF,
+                                0x80, 0]) for i in range(64)])
+        instructions = [
+            spectrumtranslate.DisassembleInstruction(
+                "Line Numbers Referenced"),
+            spectrumtranslate.DisassembleInstruction(
+                "Reference Data Numbers Off"),
+            spectrumtranslate.DisassembleInstruction(
+                "Reference Data Numbers On", 0x8040, 0x807F)]
+        serialra = spectrumtranslate.ReferencedAddresses()
+        serial = spectrumtranslate.disassemble(data, 0, 0x8000, len(data),
+                                               instructions, None, serialra)
+        texts, ra = spectrumtranslate.disassemblebatch(
+            spectrumtranslate.getdisassemblyjobs(data, 0, 0x8000, len(data),
+                                                 4, instructions), None, 1)
+        self.assertEqual(texts[0] + "".join([text.split("\n", 2)[2] for
+                                             text in texts[1:]]), serial)
+        self.assertEqual(ra.getxref(), serialra.getxref())
+
+    def test_disassemblycache(self):
+        data = b"\x21\x06\x40\xCD\x06\x40\x18\xFE"
+        instructions = [spectrumtranslate.DisassembleInstruction(
+            "Line Numbers Referenced")]
+        expected = spectrumtranslate.disassemble(data, 0, 0x4000, len(data),
+                                                 instructions)
+        cachedir = tempfile.mkdtemp()
+        try:
+            cache = spectrumtranslate.DisassemblyCache(cachedir, 1)
+            for i in range(2):
+                ra = spectrumtranslate.ReferencedAddresses()
+                self.assertEqual(spectrumtranslate.disassemble(
+                    data, 0, 0x4000, len(data), [
+                        spectrumtranslate.DisassembleInstruction(
+                            "Line Numbers Referenced")], None, ra, cache),
+                    expected)
+                self.assertEqual(ra.getxref(), [
+                    (0x4000, []), (0x4006, [0x4000, 0x4003, 0x4006])])
+
+            self.assertEqual(cache.getstats()["misses"], 1)
+            self.assertEqual(cache.getstats()["memoryhits"], 1)
+
+            # same code at same address elsewhere in other data is found
+            self.assertEqual(spectrumtranslate.disassemble(
+                b"\xFF\xFF" + data, 2, 0x3FFE, len(data), instructions,
+                cache=cache), expected)
+            self.assertEqual(cache.getstats()["memoryhits"], 2)
+
+            # unless other data could be used by the instructions
+            datablock = [spectrumtranslate.DisassembleInstruction(
+                "Data Block", 0x4000, 0x4001, "%!DefineByte()")]
+            self.assertNotEqual(
+                spectrumtranslate.DisassemblyCache.getkey(
+                    b"\xFF\xFF" + data, 2, 0x3FFE, len(data), datablock),
+                spectrumtranslate.DisassemblyCache.getkey(
+                    data, 0, 0x4000, len(data), datablock))
+
+            # different instructions or data aren't found
+            spectrumtranslate.disassemble(data, 0, 0x4000, len(data), None,
+                                          cache=cache)
+            spectrumtranslate.disassemble(data, 0, 0x8000, len(data), None,
+                                          cache=cache)
+            self.assertEqual(cache.getstats()["misses"], 3)
+
+            # saved results are used by new cache
+            cache = spectrumtranslate.DisassemblyCache(cachedir)
+            self.assertEqual(spectrumtranslate.disassemble(
+                data, 0, 0x4000, len(data), instructions, cache=cache),
+                expected)
+            self.assertEqual(cache.getstats()["diskhits"], 1)
+            self.assertEqual(len(os.listdir(cachedir)), 3)
+
+            # disassemble_iter uses the same results
+            self.assertEqual("\n".join(spectrumtranslate.disassemble_iter(
+                data, 0, 0x4000, len(data), instructions, cache=cache)),
+                expected)
+            self.assertEqual(cache.getstats()["memoryhits"], 1)
+            lines = spectrumtranslate.disassemble_iter(
+                data, 0, 0xA000, len(data), instructions, cache=cache)
+            next(lines)
+            self.assertEqual(len(os.listdir(cachedir)), 3)
+            self.assertEqual("ORG #A000\n" + "\n".join(lines),
+                             spectrumtranslate.disassemble(
+                                 data, 0, 0xA000, len(data), instructions,
+                                 cache=cache))
+            self.assertEqual(len(os.listdir(cachedir)), 4)
+            self.assertEqual(cache.getstats()["memoryhits"], 2)
+
+            # old results removed when out of space
+            cache = spectrumtranslate.DisassemblyCache(cachedir,
+                                                       maxdisksize=1)
+            spectrumtranslate.disassemble(data, 0, 0xC000, len(data), None,
+                                          cache=cache)
+            self.assertEqual(len(os.listdir(cachedir)), 1)
+
+            cache.clear()
+            self.assertEqual(os.listdir(cachedir), [])
+            self.assertEqual(cache.getstats()["entries"], 0)
+
+        finally:
+            shutil.rmtree(cachedir)
+
     def test_predefined(self):
         def testfunction(data, Settings, Vars, txt=None, val=None, mode=0):
             if mode == 1:
@@ -3429,6 +3974,42 @@ temp.gif", ""), "")
         self.assertEqual(refimage, _getfileasbytearray("temp.bin"),
                          "Screen test Failed 5.")
 
+        irReference = Image.open(BytesIO(gifdata))
+        refimage = imagetobytearray(irReference)
+        self.assertEqual(self.runtest("screen -p -f -1 screentest.dat \
+temp.bin", ""), "")
+        irTemp = Image.open("temp.bin")
+        self.assertEqual(irTemp.format, "PNG")
+        self.assertEqual(imagetobytearray(irTemp), refimage,
+                         "Screen test Failed 6.")
+        irTemp.close()
+
+        ppm = self.runtest("screen --ppm -o screentest.dat", "", True)
+        self.assertEqual(ppm[:15], b"P6\n256 192\n255\n")
+        self.assertEqual(ppm[15:], refimage, "Screen test Failed 7.")
+
+        self.assertEqual(self.runtest("screen --rgba -o screentest.dat", "",
+                                      True)[3::4], bytearray([255] * 49152),
+                         "Screen test Failed 8.")
+        self.assertEqual(self.runtest("screen --indexed -o screentest.dat",
+                                      "", True),
+                         spectrumtranslate.getindexesfromscreen(
+                             _getfileasbytearray("screentest.dat")),
+                         "Screen test Failed 9.")
+
+        # scaled with border
+        self.assertEqual(self.runtest("screen --indexed --scale 2 --border 1 \
+-o screentest.dat", "", True),
+                         spectrumtranslate.getrawfromscreen(
+                             _getfileasbytearray("screentest.dat"), False,
+                             scale=2, border=1),
+                         "Screen test Failed 10.")
+        self.assertRaises(spectrumtranslate.SpectrumTranslateError,
+                          self.runtest, "screen --scale -o screentest.dat", "")
+        self.assertRaises(spectrumtranslate.SpectrumTranslateError,
+                          self.runtest, "screen --border 9 -o screentest.dat",
+                          "")
+
         # tidy up
         os_remove("temp.gif")
         os_remove("temp.bin")
@@ -3475,6 +4056,50 @@ code.dat temp.txt", ""), "")
 4006  00           NOP
 """)
 
+        # should give same result from saved disassembly
+        cachedir = tempfile.mkdtemp()
+        try:
+            for i in range(2):
+                self.assertEqual(self.runtest("code -b 16384 -c f \
+instructions.txt --cache-dir " + cachedir + " code.dat temp.txt", ""), "")
+                self.assertEqual(_getfile("temp.txt"), """ORG #4000
+
+4000  21,03,40     LD HL,16387
+4003  C3,06,40     JP #4006
+4006  00           NOP
+""")
+                self.assertEqual(len(os.listdir(cachedir)), 1)
+
+            self.assertEqual(self.runtest("code -io --no-cache --cache-dir " +
+                                          cachedir, "\x21\x12\x34"),
+                             """ORG #0000
+
+0000  21,12,34     LD HL,#3412
+""")
+            self.assertEqual(len(os.listdir(cachedir)), 1)
+
+        finally:
+            shutil.rmtree(cachedir)
+
+        # error part way through disassembly leaves output file alone
+        with open("tempinstructions.txt", "w") as f:
+            f.write("10000#4000#4001#B#%!Unknown()")
+        try:
+            self.checkinvalidcommand("code -b 16384 -c f \
+tempinstructions.txt code.dat temp.txt", 'Routine "Unknown" not defined')
+
+        finally:
+            os_remove("tempinstructions.txt")
+
+        self.assertEqual(_getfile("temp.txt"), """ORG #4000
+
+4000  21,03,40     LD HL,16387
+4003  C3,06,40     JP #4006
+4006  00           NOP
+""")
+        self.assertEqual([name for name in os.listdir(".") if
+                          name.startswith("temp.txt.")], [])
+
         # tidy up
         os_remove("temp.txt")
 